@@ -0,0 +1,72 @@
+import click
+import logging
+import sys
+from typing import List
+from benchmarks.suite import REPEAT, SCENARIOS, TOLERANCE, compare, read_results, run, write_results
+from src.cli import DEFAULT_WORKERS
+
+
+@click.command()
+@click.option('--out', type=click.Path(dir_okay=False), default='benchmark.json', show_default=True,
+              help='File the results are written to, as JSON.')
+@click.option('--scenario', 'names', type=click.Choice([s.name for s in SCENARIOS]), multiple=True,
+              help='Scenario to run, can be repeated (default: all of them).')
+@click.option('--repeat', type=click.IntRange(min=1), default=REPEAT, show_default=True,
+              help='Number of times every scenario is timed.')
+@click.option('--interval', type=click.FloatRange(min=0, min_open=True), default=None, metavar='SECONDS',
+              help='Seconds between epochs of the synthetic files (default: 30).')
+@click.option('--satellites', type=click.IntRange(min=1, max=32), default=None,
+              help='Number of satellites in view at every epoch (default: 10).')
+@click.option('--latency', type=click.FloatRange(min=0), default=0, show_default=True, metavar='SECONDS',
+              help='Seconds the FTP server waits before processing every command.')
+@click.option('--bandwidth', type=click.IntRange(min=0), default=0, show_default=True, metavar='BYTES',
+              help='Bytes per second every transfer is throttled to, 0 for no limit.')
+@click.option('--workers', type=click.IntRange(min=1), default=DEFAULT_WORKERS, show_default=True,
+              help='Largest number of concurrent FTP sessions used to download files.')
+@click.option('--data-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory the synthetic archives are kept in and reused from across runs.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Results of an earlier run to compare with. Exits with status 1 if a stage got slower.')
+@click.option('--tolerance', type=click.FloatRange(min=0), default=TOLERANCE, show_default=True,
+              help='Fraction of its baseline time a stage may slow down by before it counts as a regression.')
+def benchmark(out: str, names: List[str], repeat: int, interval: float, satellites: int, latency: float,
+              bandwidth: int, workers: int, data_dir: str, baseline: str, tolerance: float):
+    """ Times downloading and merging synthetic RINEX files from a local FTP server
+
+        Args:
+            out: path the results are written to
+            names: names of the scenarios to run
+            repeat: number of times every scenario is timed
+            interval: seconds between epochs of the synthetic files
+            satellites: number of satellites in view at every epoch
+            latency: seconds the FTP server waits before processing every command
+            bandwidth: bytes per second every transfer is throttled to
+            workers: largest number of concurrent FTP sessions
+            data_dir: directory the synthetic archives are kept in
+            baseline: path to the results to compare with
+            tolerance: fraction of its baseline time a stage may slow down by
+    """
+    # the FTP server only logs its warnings
+    logger = logging.getLogger('pyftpdlib')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    scenarios = [s for s in SCENARIOS if not names or s.name in names]
+    overrides = {key: value for key, value in (('interval', interval), ('satellites', satellites))
+                 if value is not None}
+    scenarios = [s._replace(**overrides) for s in scenarios]
+    results = run(scenarios, repeat, latency, bandwidth, workers, data_dir)
+    write_results(results, out)
+    for name, scenario in results['scenarios'].items():
+        print('{:<12} {:>4} files {:>11} bytes  '.format(name, scenario['files'], scenario['archive_bytes'])
+              + '  '.join('{} {:.3f}s'.format(stage, timing['median'])
+                          for stage, timing in scenario['stages'].items()))
+    if baseline:
+        regressions = compare(results, read_results(baseline), tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
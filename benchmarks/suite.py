@@ -0,0 +1,216 @@
+"""Class responsible for timing downloads and merges of synthetic data served by a local FTP server.
+
+Every scenario publishes synthetic files (see synthetic) to a local stand-in
+for the NOAA archive, with a configurable latency and bandwidth, and then times
+RinexDownloader.download, RinexMerger.decompress_files and RinexMerger.merge
+on them, a number of times. The results are written as JSON, and can be
+compared with the results of an earlier run to catch performance regressions.
+
+  Typical usage example:
+
+  foo = run(SCENARIOS, repeat=3)
+  write_results(foo, 'benchmark.json')
+  regressions = compare(foo, read_results('baseline.json'), tolerance=0.2)
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, List, NamedTuple
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Metrics import Metrics
+from src.Output import atomic_write
+from testing.archive import CorsArchive
+from testing.synthetic import publish
+
+STATION = 'nybp'
+STAGES = ('download', 'decompress', 'merge', 'total')
+COUNTERS = ('bytes_transferred', 'ftp_connections', 'ftp_round_trips')
+REPEAT = 3
+TOLERANCE = 0.2  # fraction a stage may slow down by before it counts as a regression
+MIN_SLOWDOWN = 0.05  # seconds a stage may always slow down by, for timings too short to compare
+ARCHIVE_FILE = 'archive.json'  # what a generated archive holds, to reuse it across runs
+
+
+class Scenario(NamedTuple):
+    """ A time window downloaded and merged from synthetic data.
+
+        Args:
+            name: name of the scenario in the results
+            start: start of the time window
+            end: end of the time window
+            interval: seconds between epochs of the synthetic files
+            satellites: number of satellites in view at every epoch
+    """
+    name: str
+    start: datetime
+    end: datetime
+    interval: float = 30
+    satellites: int = 10
+
+
+SCENARIOS = [
+    Scenario('1-hour', datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 14, 59, 59)),
+    Scenario('1-day', datetime(2021, 3, 10), datetime(2021, 3, 10, 23, 59, 59)),
+    Scenario('cross-year', datetime(2020, 12, 31, 20), datetime(2021, 1, 1, 3, 59, 59)),
+    Scenario('1-month', datetime(2021, 3, 1), datetime(2021, 3, 30, 23, 59, 59)),
+]
+
+
+def prepare(scenario: Scenario, archive: CorsArchive) -> int:
+    """ Publish the synthetic files of a scenario to an archive, unless they already are.
+
+        Returns:
+            Total size of the files in bytes.
+    """
+    description = {'station': STATION, 'start': scenario.start.isoformat(), 'end': scenario.end.isoformat(),
+                   'interval': scenario.interval, 'satellites': scenario.satellites}
+    marker = os.path.join(archive.root, ARCHIVE_FILE)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            published = json.load(f)
+        if published['scenario'] == description:
+            return published['bytes']
+        raise ValueError('{} holds the files of another scenario.'.format(archive.root))
+    paths = publish(archive, STATION, scenario.start, scenario.end,
+                    scenario.interval, scenario.satellites)
+    size = sum(os.path.getsize(path) for path in paths)
+    with open(marker, 'w') as f:
+        json.dump({'scenario': description, 'bytes': size}, f)
+    return size
+
+
+def summarize(runs: List[float]) -> Dict[str, float]:
+    """ Summarize the timings of a stage over several runs. """
+    return {'runs': runs, 'median': statistics.median(runs), 'min': min(runs)}
+
+
+def run_scenario(scenario: Scenario, root: str, repeat: int = REPEAT, latency: float = 0, bandwidth: int = 0,
+                 workers: int = 1) -> Dict:
+    """ Time the download, decompression and merge of a scenario.
+
+        Args:
+            scenario: the scenario
+            root: root of the archive holding the files of the scenario (see prepare)
+            repeat: number of times the scenario is timed
+            latency: seconds the FTP server waits before processing every command
+            bandwidth: bytes per second every transfer is throttled to (0 for no limit)
+            workers: number of concurrent FTP sessions of the downloader
+
+        Returns:
+            The results of the scenario.
+    """
+    timings = {stage: [] for stage in STAGES}
+    archive = CorsArchive(root, latency=latency, bandwidth=bandwidth)
+    size = prepare(scenario, archive)
+    archive.start()
+    try:
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as directory:
+                metrics = Metrics()
+                output = os.path.join(directory, 'merged.obs')
+                downloader = RinexDownloader(STATION, scenario.start, scenario.end, directory, workers=workers,
+                                             servers=archive.servers, metrics=metrics)
+                merger = RinexMerger(STATION, scenario.start, scenario.end, directory, output=output,
+                                     metrics=metrics)
+                started = time.perf_counter()
+                plan = downloader.download()
+                downloaded = time.perf_counter()
+                merger.decompress_files()
+                decompressed = time.perf_counter()
+                merger.merge(plan)
+                merged = time.perf_counter()
+                output_bytes = os.path.getsize(output)
+            for stage, seconds in (('download', downloaded - started), ('decompress', decompressed - downloaded),
+                                   ('merge', merged - decompressed), ('total', merged - started)):
+                timings[stage].append(seconds)
+    finally:
+        archive.stop()
+    counters = metrics.trace()['counters']
+    return {'start': scenario.start.isoformat(), 'end': scenario.end.isoformat(),
+            'interval': scenario.interval, 'satellites': scenario.satellites,
+            'files': len(plan), 'archive_bytes': size, 'output_bytes': output_bytes,
+            'counters': {name: counters.get(name, 0) for name in COUNTERS},
+            'stages': {stage: summarize(runs) for stage, runs in timings.items()}}
+
+
+def run(scenarios: List[Scenario], repeat: int = REPEAT, latency: float = 0, bandwidth: int = 0,
+        workers: int = 1, data_dir: str = None) -> Dict:
+    """ Run scenarios one after the other.
+
+        Args:
+            scenarios: the scenarios
+            repeat: number of times every scenario is timed
+            latency: seconds the FTP server waits before processing every command
+            bandwidth: bytes per second every transfer is throttled to (0 for no limit)
+            workers: number of concurrent FTP sessions of the downloader
+            data_dir: directory the synthetic archives are kept in, to reuse them in later runs
+                (default: a temporary directory)
+
+        Returns:
+            The results of the run, with the settings and machine it ran with.
+    """
+    if repeat < 1:
+        raise ValueError('Scenarios must be timed at least once.')
+    results = {'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'settings': {'repeat': repeat, 'latency': latency, 'bandwidth': bandwidth, 'workers': workers},
+               'scenarios': {}}
+    with ExitStack() as stack:
+        if data_dir is None:
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        for scenario in scenarios:
+            print('Running {}...'.format(scenario.name), file=sys.stderr)
+            results['scenarios'][scenario.name] = run_scenario(
+                scenario, os.path.join(data_dir, scenario.name), repeat, latency, bandwidth, workers)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = TOLERANCE) -> List[str]:
+    """ Find the stages that got slower than in a baseline run.
+
+        The medians of the runs are compared, for the scenarios and stages found
+        in both. A stage only regresses when it slows down by more than a
+        fraction of its baseline time and by more than a few hundredths of a
+        second, so very short stages do not fail on noise.
+
+        Args:
+            results: results of this run
+            baseline: results of the run to compare with
+            tolerance: fraction of its baseline time a stage may slow down by
+
+        Returns:
+            A description of every regression, empty if there is none.
+    """
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for stage, timing in scenario['stages'].items():
+            if stage not in before['stages']:
+                continue
+            old, new = before['stages'][stage]['median'], timing['median']
+            if new > old * (1 + tolerance) and new - old > MIN_SLOWDOWN:
+                regressions.append('{} {}: {:.3f}s -> {:.3f}s ({:+.0%})'.format(
+                    name, stage, old, new, new / old - 1 if old else float('inf')))
+    return regressions
+
+
+def read_results(path: str) -> Dict:
+    """ Read the results of a run written by write_results. """
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_results(results: Dict, path: str):
+    """ Write the results of a run as JSON, replacing the file atomically. """
+    with atomic_write(path) as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
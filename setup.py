@@ -3,14 +3,21 @@ from setuptools import setup, find_packages
 setup(
     name='grab_data',
     version='0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'testing']),
     include_package_data=True,
     install_requires=[
         'Click',
-        'progress'
+        'progress',
+        'numpy>=1.19'
     ],
     entry_points='''
         [console_scripts]
         grab_data=src.cli:cli
+        grab_batch=src.cli:batch
+        grab_stations=src.cli:stations
+        grab_serve=src.cli:serve
+        grab_follow=src.cli:follow
+        grab_ingest=src.cli:ingest
+        grab_query=src.cli:query
     ''',
 )
@@ -0,0 +1,333 @@
+"""Class responsible for keeping decoded observations on local disk, one columnar chunk per station-day.
+
+Merging a window again and again means downloading (or copying from the
+cache), decompressing and parsing the same files every time. Files ingested
+into the archive are parsed once into an ObservationTable (see Columnar) and
+stored by station and day under {directory}/{station}/{year}/{doy}.col: a
+small JSON description of the arrays (and the RINEX header they came from)
+followed by the arrays themselves, uncompressed and aligned, so each of them
+can be memory-mapped. An index of the days held and the hours they cover sits
+at {directory}/{station}/index.json.
+
+A query maps the chunks of the days it needs, finds the window with a binary
+search of the epoch times and copies only the rows of the epochs inside it,
+before writing them out as RINEX. Like ObservationTable, the archive only
+holds epochs with observations, not event records.
+
+  Typical usage example:
+
+  foo = ObservationArchive(directory)
+  foo.ingest(station, start, end, RinexDownloader)
+  with open('nybp.obs', 'w', encoding='latin-1') as f:
+      foo.write(station, start, end, f)
+"""
+import json
+import os
+import struct
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, List, Optional, TextIO, Tuple
+import numpy as np
+from src.Cache import RinexCache
+from src.Columnar import BLANK, ObservationTable
+from src.Downloader import RinexDownloader
+from src.Merger import merge_headers
+from src.Output import atomic_write
+from src.Planner import HOUR_BLOCKS, FetchPlan, PlannedFile
+from src.Rinex import ObservationWriter, RinexHeader, interval_microseconds, microseconds
+
+CHUNK_SUFFIX = '.col'
+CHUNK_MAGIC = b'RINEXCOL'
+ALIGNMENT = 64  # bytes every array starts on a multiple of
+INDEX_FILE = 'index.json'
+ARRAYS = ('times', 'flags', 'clocks', 'offsets', 'satellites', 'values', 'lli', 'snr')
+ALL_HOURS = list(range(24))
+
+
+def aligned(position: int) -> int:
+    """ Round a position in a chunk up to the start of the next array. """
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def write_chunk(path: str, table: ObservationTable, header: RinexHeader):
+    """ Write a table to a chunk file, replacing it atomically.
+
+        Args:
+            path: path of the chunk
+            table: the observations of the chunk
+            header: header of the files the observations came from
+    """
+    arrays = [np.ascontiguousarray(getattr(table, name)) for name in ARRAYS]
+    description = {'types': list(table.types), 'header': header.lines, 'blank': BLANK, 'arrays': {}}
+    position = 0
+    for name, array in zip(ARRAYS, arrays):
+        description['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position = aligned(position + array.nbytes)
+    text = json.dumps(description).encode()
+    start = aligned(len(CHUNK_MAGIC) + 8 + len(text))
+    with atomic_write(path, 'wb') as f:
+        f.write(CHUNK_MAGIC + struct.pack('<Q', len(text)) + text)
+        for name, array in zip(ARRAYS, arrays):
+            f.seek(start + description['arrays'][name]['offset'])
+            f.write(array.tobytes())
+
+
+class Chunk:
+    """ Memory-mapped chunk of an archive, the observations of a station on one day.
+
+        Args:
+            path: path of the chunk (see write_chunk)
+
+        Raises:
+            ValueError: the file is not a chunk.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            if f.read(len(CHUNK_MAGIC)) != CHUNK_MAGIC:
+                raise ValueError('{} is not an archive chunk.'.format(path))
+            length, = struct.unpack('<Q', f.read(8))
+            description = json.loads(f.read(length))
+        start = aligned(len(CHUNK_MAGIC) + 8 + length)
+        self.types = tuple(description['types'])
+        self.header = RinexHeader(description['header'])
+        # chunks written before blank indicators were told apart from 0 hold 0 for both
+        self.__blank = description.get('blank', 0)
+        self.__arrays = {}
+        for name, array in description['arrays'].items():
+            shape = tuple(array['shape'])
+            if 0 in shape:
+                self.__arrays[name] = np.zeros(shape, np.dtype(array['dtype']))
+            else:
+                self.__arrays[name] = np.memmap(path, np.dtype(array['dtype']), 'r',
+                                                start + array['offset'], shape)
+
+    def __len__(self) -> int:
+        return len(self.__arrays['times'])
+
+    def table(self, start: datetime = None, end: datetime = None) -> ObservationTable:
+        """ Read the epochs inside a time window (both ends included), touching only their rows.
+
+            Returns:
+                An ObservationTable holding copies of the rows.
+        """
+        arrays = self.__arrays
+        times = arrays['times']
+        first = 0 if start is None else int(np.searchsorted(times, microseconds(start), 'left'))
+        last = len(times) if end is None else int(np.searchsorted(times, microseconds(end), 'right'))
+        last = max(first, last)
+        offsets = np.array(arrays['offsets'][first:last + 1])
+        rows = slice(offsets[0], offsets[-1])
+        return ObservationTable(self.types, np.array(times[first:last]), np.array(arrays['flags'][first:last]),
+                                np.array(arrays['clocks'][first:last]), offsets - offsets[0],
+                                np.array(arrays['satellites'][rows]), np.array(arrays['values'][rows]),
+                                self.__indicators('lli', rows), self.__indicators('snr', rows))
+
+    def __indicators(self, name: str, rows: slice) -> np.ndarray:
+        """ Copy the rows of the loss of lock or signal strength indicators, with blanks as BLANK. """
+        indicators = np.array(self.__arrays[name][rows])
+        if self.__blank != BLANK:
+            indicators[indicators == self.__blank] = BLANK
+        return indicators
+
+
+def file_hours(file: PlannedFile) -> List[int]:
+    """ Hours of the day an archive file covers. """
+    return ALL_HOURS if file.is_daily else [HOUR_BLOCKS.index(file.name[7])]
+
+
+def day_of(time: datetime) -> Tuple[int, int]:
+    """ Get the (year, day-of-year) of a time. """
+    return time.year, time.timetuple().tm_yday
+
+
+def day_start(year: int, yday: int) -> datetime:
+    """ Get the start of a day given by its year and day-of-year. """
+    return datetime(year, 1, 1) + timedelta(days=yday - 1)
+
+
+class ObservationArchive:
+    """ Local archive of decoded observations, partitioned by station and day.
+
+        Args:
+            directory: path to the directory holding the archive (created if missing)
+    """
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __chunk_path(self, station: str, year: int, yday: int) -> str:
+        return os.path.join(self.__directory, station.lower(), str(year), '{:03d}{}'.format(yday, CHUNK_SUFFIX))
+
+    def __index_path(self, station: str) -> str:
+        return os.path.join(self.__directory, station.lower(), INDEX_FILE)
+
+    def index(self, station: str) -> Dict[Tuple[int, int], Dict]:
+        """ Get the days held of a station.
+
+            Returns:
+                Mapping of (year, day-of-year) to the hours the day covers, its number of
+                epochs, and the times of its first and last epoch (None if it has none).
+        """
+        path = self.__index_path(station)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            days = json.load(f)
+        return {tuple(int(part) for part in day.split('/')): entry for day, entry in days.items()}
+
+    def __write_index(self, station: str, days: Dict[Tuple[int, int], Dict]):
+        """ Write the index of a station, replacing it atomically. """
+        path = self.__index_path(station)
+        with atomic_write(path) as f:
+            json.dump({'{}/{:03d}'.format(*day): entry for day, entry in sorted(days.items())},
+                      f, indent=2, sort_keys=True)
+
+    def missing(self, station: str, start: datetime, end: datetime) -> List[Tuple[int, int]]:
+        """ Find the days of a time window the archive does not hold every needed hour of.
+
+            Returns:
+                The (year, day-of-year) of each such day, in order.
+        """
+        days = self.index(station)
+        missing = []
+        day = datetime(start.year, start.month, start.day)
+        while day <= end:
+            first = max(start, day).hour
+            last = min(end, day + timedelta(hours=23)).hour
+            covered = days.get(day_of(day), {}).get('hours', [])
+            if not set(range(first, last + 1)) <= set(covered):
+                missing.append(day_of(day))
+            day += timedelta(days=1)
+        return missing
+
+    def store(self, station: str, year: int, yday: int, tables: List[ObservationTable], header: RinexHeader,
+              hours: List[int]):
+        """ Add observations to the chunk of a day, keeping the epochs already held where both have one.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                tables: the new observations, epochs outside the day are left out
+                header: header of the files they came from (the header already held is kept)
+                hours: hours of the day the new observations cover
+        """
+        station = station.lower()
+        path = self.__chunk_path(station, year, yday)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        begin = day_start(year, yday)
+        with self.__lock:
+            days = self.index(station)
+            entry = days.get((year, yday))
+            if entry is not None and os.path.exists(path):
+                chunk = Chunk(path)
+                tables = [chunk.table()] + tables
+                header = chunk.header
+                hours = sorted(set(entry['hours']) | set(hours))
+            table = ObservationTable.concatenate(tables).window(
+                begin, begin + timedelta(days=1) - timedelta(microseconds=1))
+            write_chunk(path, table, header)
+            times = table.datetimes()
+            days[(year, yday)] = {'hours': sorted(hours), 'epochs': len(table),
+                                  'first': str(times[0]) if len(table) else None,
+                                  'last': str(times[-1]) if len(table) else None}
+            self.__write_index(station, days)
+
+    def ingest(self, station: str, start: datetime, end: datetime, downloader: RinexDownloader,
+               workers: int = 1, servers: List[Tuple[str, int]] = None, cache_dir: str = None) -> int:
+        """ Download the files of a time window the archive does not hold yet, and store their observations.
+
+            Args:
+                station: 4-character site (base) identifier
+                start: start of the time window
+                end: end of the time window
+                downloader: reference to RinexDownloader (uninitialised)
+                workers: largest number of concurrent FTP sessions used by the downloader (default: 1)
+                servers: list of (host, port) pairs of mirrors, tried in order (default: NOAA main and alternate servers)
+                cache_dir: directory of the persistent file cache shared across runs (default: no cache)
+
+            Returns:
+                The number of files ingested.
+        """
+        station = station.lower()
+        days = self.index(station)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            downloader = downloader(station, start, end, temp_dir, workers=workers, servers=servers,
+                                    cache=RinexCache(cache_dir) if cache_dir else None, decompress=True)
+            files = [f for f in downloader.fetch_plan()
+                     if not set(file_hours(f)) <= set(days.get((f.year, f.yday), {}).get('hours', []))]
+            if not files:
+                return 0
+            downloader.download(FetchPlan(station, files))
+            for (year, yday), group in groupby(files, key=lambda f: (f.year, f.yday)):
+                group = list(group)
+                paths = [os.path.join(temp_dir, f.rinex_name) for f in group]
+                with open(paths[0], encoding='latin-1') as f:
+                    header = RinexHeader.read(f)
+                self.store(station, year, yday, [ObservationTable.from_file(path) for path in paths], header,
+                           sorted({hour for f in group for hour in file_hours(f)}))
+                for path in paths:
+                    os.remove(path)
+        return len(files)
+
+    def query(self, station: str, start: datetime, end: datetime,
+              decimate: float = None) -> Tuple[Optional[RinexHeader], ObservationTable]:
+        """ Read the observations of a time window from the chunks of the days it covers.
+
+            Args:
+                station: 4-character site (base) identifier
+                start: time of the first epoch to include
+                end: time of the last epoch to include
+                decimate: only keep epochs at whole multiples of this interval in seconds (default: keep every epoch)
+
+            Returns:
+                The header of the merged observations (None if the archive holds no day of the window) and
+                the observations.
+        """
+        days = self.index(station)
+        chunks = []
+        day = datetime(start.year, start.month, start.day)
+        while day <= end:
+            path = self.__chunk_path(station, *day_of(day))
+            if day_of(day) in days and os.path.exists(path):
+                chunks.append(Chunk(path))
+            day += timedelta(days=1)
+        if not chunks:
+            return None, ObservationTable.empty(())
+        table = ObservationTable.concatenate([chunk.table(start, end) for chunk in chunks])
+        if decimate is not None:
+            table = table.take(table.times % interval_microseconds(decimate) == 0)
+        header = merge_headers([chunk.header for chunk in chunks], decimate).with_types(table.types)
+        if len(table):
+            header = header.with_first_epoch(table.datetimes()[0].astype(datetime))
+        return header, table
+
+    def write(self, station: str, start: datetime, end: datetime, output: TextIO, decimate: float = None) -> int:
+        """ Write the observations of a time window as a RINEX observation file.
+
+            Args:
+                station: 4-character site (base) identifier
+                start: time of the first epoch to include
+                end: time of the last epoch to include
+                output: file opened in text mode the observations are written to
+                decimate: only keep epochs at whole multiples of this interval in seconds (default: keep every epoch)
+
+            Returns:
+                The number of epochs written.
+
+            Raises:
+                FileNotFoundError: the archive holds no day of the window.
+        """
+        header, table = self.query(station, start, end, decimate)
+        if header is None:
+            raise FileNotFoundError('The archive holds no observations of {} in the time window.'.format(station))
+        writer = ObservationWriter(output, header)
+        writer.write_header()
+        for epoch in table.to_epochs():
+            writer.write(epoch)
+        return len(table)
@@ -0,0 +1,214 @@
+"""Class responsible for running many download and merge jobs as one batch.
+
+Jobs are read from a JSON Lines file, one {station, start, end, output} object
+per line. Every job is planned on one shared FTP session, the plans are
+combined so files needed by several overlapping jobs are downloaded only once,
+over one pool of FTP sessions, and the merges are then run in parallel in a
+pool of processes.
+
+  Typical usage example:
+
+  jobs = read_jobs(f)
+  foo = RinexBatch(jobs, RinexDownloader, RinexMerger, workers=4)
+  foo.run()
+"""
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from ftplib import error_perm
+from typing import Dict, List, NamedTuple, TextIO, Tuple
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Planner import FetchPlan
+from src.Runner import TIMESTAMP_FORMAT, check_window, open_caches
+
+
+class BatchJob(NamedTuple):
+    """ A single station and time window to download and merge.
+
+        Args:
+            station: 4-character site (base) identifier
+            start: start of the time window
+            end: end of the time window
+            output: path of the merged file
+    """
+    station: str
+    start: datetime
+    end: datetime
+    output: str
+
+
+def parse_job(line: str) -> BatchJob:
+    """ Parse a job from a JSON object with station, start and end keys and an optional output key.
+
+        Timestamps have the same format as on the command line, e.g. 2017-09-14T23:11:22Z.
+        The output defaults to {station}.obs.
+
+        Raises:
+            ValueError: the line is not a valid job.
+    """
+    try:
+        job = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError('Invalid JSON: {}'.format(e))
+    if not isinstance(job, dict):
+        raise ValueError('A job must be a JSON object.')
+    missing = [key for key in ('station', 'start', 'end') if key not in job]
+    if missing:
+        raise ValueError('Missing {}.'.format(', '.join(missing)))
+    station = str(job['station']).lower()
+    start = datetime.strptime(str(job['start']), TIMESTAMP_FORMAT)
+    end = datetime.strptime(str(job['end']), TIMESTAMP_FORMAT)
+    check_window(start, end)
+    return BatchJob(station, start, end, str(job.get('output') or '{}.obs'.format(station)))
+
+
+def read_jobs(f: TextIO) -> List[BatchJob]:
+    """ Read jobs from a JSON Lines file, skipping blank lines.
+
+        Args:
+            f: file opened in text mode with one job per line (see parse_job)
+
+        Returns:
+            The jobs in the order they appear.
+
+        Raises:
+            ValueError: a line is not a valid job, or two jobs write to the same output.
+    """
+    jobs = []
+    outputs = set()
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            job = parse_job(line)
+        except ValueError as e:
+            raise ValueError('Line {}: {}'.format(number, e))
+        if job.output in outputs:
+            raise ValueError('Line {}: another job already writes to {}.'.format(number, job.output))
+        outputs.add(job.output)
+        jobs.append(job)
+    return jobs
+
+
+def merge_job(merger: RinexMerger, plan: FetchPlan):
+    """ Merge the files of a job. Module level so it can run in a process pool. """
+    merger.merge(plan)
+
+
+class RinexBatch:
+    """ Downloads and merges the files of many jobs, fetching every file once.
+
+        Args:
+            jobs: the jobs to run
+            downloader: reference to RinexDownloader (uninitialised)
+            merger: reference to RinexMerger (uninitialised)
+            workers: largest number of concurrent FTP sessions used to download files (default: 1)
+            merge_workers: number of processes merging files concurrently (default: number of CPUs)
+            cache_dir: directory of the persistent file and listing caches shared across runs (default: no cache)
+            dry_run: only print the files that would be downloaded and their total size (default: False)
+            decimate: interval in seconds to decimate the merged files to (default: keep every epoch)
+            min_workers: smallest number of concurrent FTP sessions the download adapts down to (default: 1)
+    """
+
+    def __init__(self, jobs: List[BatchJob], downloader: RinexDownloader, merger: RinexMerger,
+                 workers: int = 1, merge_workers: int = None, cache_dir: str = None, dry_run: bool = False,
+                 decimate: float = None, min_workers: int = 1):
+        if merge_workers is not None and merge_workers < 1:
+            raise ValueError('Number of merge workers must be at least 1.')
+        self.__jobs = jobs
+        self.__downloader = downloader
+        self.__merger = merger
+        self.__workers = workers
+        self.__min_workers = min_workers
+        self.__merge_workers = merge_workers or os.cpu_count() or 1
+        self.__cache, self.__index, self.__catalog = open_caches(cache_dir)
+        self.__dry_run = dry_run
+        self.__decimate = decimate
+
+    def __make_downloader(self, job: BatchJob, directory: str, workers: int, min_workers: int = 1) -> RinexDownloader:
+        return self.__downloader(job.station, job.start, job.end, directory, workers=workers,
+                                 min_workers=min_workers, cache=self.__cache, index=self.__index,
+                                 catalog=self.__catalog, decompress=True)
+
+    def plan(self, directory: str = '') -> Tuple[Dict[BatchJob, FetchPlan], List[Tuple[BatchJob, Exception]]]:
+        """ Plan every job on one FTP session.
+
+            The station catalog and directory listings are shared between the jobs,
+            so the archive's stations are listed once, and each day of each station
+            is only listed once.
+
+            Args:
+                directory: directory the files are downloaded to
+
+            Returns:
+                The plan of every job that could be planned, and the jobs that could not with their error.
+        """
+        plans = {}
+        failures = []
+        if not self.__jobs:
+            return plans, failures
+        downloaders = [self.__make_downloader(job, directory, 1) for job in self.__jobs]
+        with downloaders[0].connect() as ftp:
+            for job, downloader in zip(self.__jobs, downloaders):
+                try:
+                    downloader.validate(ftp)
+                    plans[job] = downloader.plan(ftp)
+                except (ValueError, error_perm) as e:
+                    failures.append((job, e))
+        return plans, failures
+
+    def merge(self, plans: Dict[BatchJob, FetchPlan], directory: str) -> List[Tuple[BatchJob, Exception]]:
+        """ Merge the downloaded files of every job, in parallel.
+
+            Args:
+                plans: the plan of every job to merge
+                directory: directory the files were downloaded to
+
+            Returns:
+                The jobs that could not be merged with their error.
+        """
+        mergers = {job: self.__merger(job.station, job.start, job.end, directory, workers=1,
+                                      decimate=self.__decimate, output=job.output) for job in plans}
+        failures = []
+        if self.__merge_workers == 1 or len(plans) < 2:
+            for job, plan in plans.items():
+                try:
+                    merge_job(mergers[job], plan)
+                except (OSError, ValueError, RuntimeError) as e:
+                    failures.append((job, e))
+            return failures
+        with ProcessPoolExecutor(max_workers=min(self.__merge_workers, len(plans))) as pool:
+            futures = {job: pool.submit(merge_job, mergers[job], plan) for job, plan in plans.items()}
+            for job, future in futures.items():
+                try:
+                    future.result()
+                except (OSError, ValueError, RuntimeError) as e:
+                    failures.append((job, e))
+        return failures
+
+    def run(self):
+        """ Plans every job, downloads the files they need once and merges them into one file per job.
+
+            Raises:
+                RuntimeError: some jobs could not be planned or merged. The other jobs are still run.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            plans, failures = self.plan(temp_dir)
+            plan = FetchPlan.union(list(plans.values()))
+            if self.__dry_run:
+                print(plan.describe())
+            elif plans:
+                print('{} jobs need {} files'.format(len(plans), len(plan)))
+                self.__make_downloader(next(iter(plans)), temp_dir, self.__workers,
+                                       self.__min_workers).download(plan)
+                print("Merging files...")
+                failures += self.merge(plans, temp_dir)
+        if failures:
+            raise RuntimeError('Could not complete {} of {} jobs:\n{}'.format(
+                len(failures), len(self.__jobs),
+                '\n'.join('{}: {}'.format(job.output, e) for job, e in failures)))
+        if not self.__dry_run:
+            print('All done!')
@@ -0,0 +1,235 @@
+"""Class responsible for caching RINEX archive files on local disk between runs.
+
+Files are stored under {directory}/{station}/{year}/{doy}/{file} next to a
+sidecar holding their SHA-256 digest, which is checked every time a file is
+served. Writes go to a temporary file that is atomically renamed into place,
+and the least recently used files are evicted once the cache grows past its
+size limit.
+
+  Typical usage example:
+
+  foo = RinexCache(directory)
+  with foo.store(station, year, yday, file) as f:
+      f.write(data)
+  path = foo.get(station, year, yday, file)
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+CACHE_MAX_BYTES = 10 * 1024 ** 3  # 10 GiB
+# Archive files older than this are never modified on the server
+SETTLE_DAYS = 3
+DIGEST_SUFFIX = '.sha256'
+PARTIAL_SUFFIX = '.part'
+CHUNK_SIZE = 1024 * 1024
+
+
+def day_age(year: int, yday: int) -> timedelta:
+    """ Get how long ago a day of the archive ended. Archive days are UTC days.
+
+        Args:
+            year: 4-digit year
+            yday: day-of-year
+
+        Returns:
+            Time since the end of the day, negative if the day has not ended yet.
+    """
+    return datetime.utcnow() - (datetime(year, 1, 1) + timedelta(days=yday))
+
+
+def is_settled(year: int, yday: int) -> bool:
+    """ Checks whether files and listings of a given day are old enough to never change on the server.
+
+        Args:
+            year: 4-digit year
+            yday: day-of-year
+
+        Returns:
+            True if the day ended more than the archive's settle period ago. Otherwise False.
+    """
+    return day_age(year, yday) > timedelta(days=SETTLE_DAYS)
+
+
+class RinexCache:
+    """ Size-bounded LRU cache of RINEX archive files shared across runs.
+
+        Args:
+            directory: path to the directory holding the cache (created if missing)
+            max_bytes: total size the cache may grow to before files are evicted (default: 10 GiB)
+    """
+
+    def __init__(self, directory: str, max_bytes: int = CACHE_MAX_BYTES):
+        if max_bytes < 0:
+            raise ValueError('Cache size cannot be negative.')
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__size = None  # computed lazily on the first write
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, station: str, year: int, yday: int, file: str) -> str:
+        """ Get the location a file is (or would be) stored at inside the cache.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                file: name of the archive file
+
+            Returns:
+                Path to the cached file.
+        """
+        return os.path.join(self.__directory, station.lower(), str(year), '{:03d}'.format(yday), file)
+
+    def is_settled(self, year: int, yday: int) -> bool:
+        """ Checks whether files for a given day are old enough to never change on the server.
+
+            Args:
+                year: 4-digit year
+                yday: day-of-year
+
+            Returns:
+                True if the day ended more than the archive's settle period ago. Otherwise False.
+        """
+        return is_settled(year, yday)
+
+    def __digest(self, path: str) -> str:
+        """ Compute the SHA-256 digest of a file. """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def __discard(self, path: str):
+        """ Remove a cached file together with its digest. """
+        for p in (path, path + DIGEST_SUFFIX):
+            try:
+                size = os.path.getsize(p)
+                os.remove(p)
+            except FileNotFoundError:
+                continue
+            with self.__lock:
+                if self.__size is not None:
+                    self.__size -= size
+
+    def get(self, station: str, year: int, yday: int, file: str) -> Optional[str]:
+        """ Look up a file in the cache, checking its integrity.
+
+            A hit refreshes the file's position in the LRU order. A file that fails
+            its integrity check is removed from the cache and reported as a miss.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                file: name of the archive file
+
+            Returns:
+                Path to the cached file, or None if the file is not cached.
+        """
+        path = self.path(station, year, yday, file)
+        try:
+            with open(path + DIGEST_SUFFIX) as f:
+                expected = f.read().strip()
+        except FileNotFoundError:
+            return None
+        try:
+            valid = self.__digest(path) == expected
+        except FileNotFoundError:
+            valid = False
+        if not valid:
+            self.__discard(path)
+            return None
+        os.utime(path)
+        return path
+
+    @contextmanager
+    def store(self, station: str, year: int, yday: int, file: str) -> Iterator[BinaryIO]:
+        """ Open a file in the cache for writing.
+
+            Data is written to a temporary file and only renamed into place once the
+            block exits without an exception, so readers never see a partial file.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                file: name of the archive file
+
+            Yields:
+                A writable binary file object.
+        """
+        path = self.path(station, year, yday, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # not Output.atomic_write: the file and its digest sidecar are replaced together, and the old copy is
+        # discarded before either of them, so a reader never pairs a file with the digest of another
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.' + file, suffix=PARTIAL_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            digest = self.__digest(temp_path)
+            # invalidate any old copy before the new data becomes visible
+            self.__discard(path)
+            with open(temp_path + DIGEST_SUFFIX, 'w') as f:
+                f.write(digest)
+            os.replace(temp_path, path)
+            os.replace(temp_path + DIGEST_SUFFIX, path + DIGEST_SUFFIX)
+        except BaseException:
+            for p in (temp_path, temp_path + DIGEST_SUFFIX):
+                if os.path.exists(p):
+                    os.remove(p)
+            raise
+        self.__added(os.path.getsize(path) + os.path.getsize(path + DIGEST_SUFFIX))
+
+    def __entries(self) -> List[Tuple[float, int, str]]:
+        """ List every file in the cache as (last access time, size, path) tuples. """
+        entries = []
+        for root, _, files in os.walk(self.__directory):
+            for file in files:
+                if file.endswith(DIGEST_SUFFIX) or file.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                    digest_size = os.path.getsize(path + DIGEST_SUFFIX)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size + digest_size, path))
+        return entries
+
+    def size(self) -> int:
+        """ Get the total number of bytes held by the cache. """
+        with self.__lock:
+            if self.__size is None:
+                self.__size = sum(entry_size for _, entry_size, _ in self.__entries())
+            return self.__size
+
+    def __added(self, size: int):
+        """ Account for a newly stored file and evict old files if the cache is over its limit. """
+        with self.__lock:
+            if self.__size is None:
+                # the scan already includes the new file
+                self.__size = sum(entry_size for _, entry_size, _ in self.__entries())
+            else:
+                self.__size += size
+            if self.__size <= self.__max_bytes:
+                return
+            # least recently used files go first
+            for _, entry_size, path in sorted(self.__entries()):
+                if self.__size <= self.__max_bytes:
+                    break
+                for p in (path, path + DIGEST_SUFFIX):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self.__size -= entry_size
@@ -0,0 +1,290 @@
+"""Class responsible for caching the catalog of stations in the NOAA FTP archive.
+
+Every station publishes a site log in /cors/station_log, so one listing of that
+directory gives the whole catalog. It is kept in memory as a mapping of station
+code to site log name (and optionally on disk as JSON), so validating a
+station is a set lookup instead of a wildcard NLST on a new session every run.
+The dates a station has been running are read from its site log the first
+time they are needed and cached with the catalog.
+
+  Typical usage example:
+
+  foo = StationCatalog(directory)
+  if foo.get() is None:
+      foo.fetch(ftp)
+  foo.search('nyb')
+  first, last = foo.date_range(ftp, station)
+"""
+import difflib
+import json
+import os
+import posixpath
+import re
+import threading
+import time
+from datetime import date, datetime
+from ftplib import FTP, error_perm
+from typing import Dict, List, Optional, Tuple
+from src.Output import atomic_write
+
+STATION_LOG_PATH = '/cors/station_log'
+CATALOG_FILE = 'stations.json'
+CATALOG_TTL = 24 * 60 * 60  # seconds, stations are added and retired rarely
+SEARCH_LIMIT = 10
+FUZZY_CUTOFF = 0.5  # similarity (0 to 1) a station needs to be suggested for a misspelt code
+
+# first and last day a station recorded data (None when open ended or unknown)
+DateRange = Tuple[Optional[date], Optional[date]]
+
+DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+SECTION = re.compile(r'^(\d+)\.\s')  # e.g. "3.   GNSS Receiver Information"
+ENTRY = re.compile(r'^(\d+)\.(\d+|x)\s')  # e.g. "3.1  Receiver Type ..."
+
+
+def station_code(name: str) -> Optional[str]:
+    """ Get the station a site log belongs to from its name, e.g. nybp.log.txt -> nybp
+
+        Returns:
+            The 4-character station code, or None if the name is not that of a site log.
+    """
+    code = name.split('.')[0].lower()
+    if len(code) != 4 or not code.isalnum() or not name.lower().endswith('.txt'):
+        return None
+    return code
+
+
+def parse_date(text: str) -> Optional[date]:
+    """ Get the first CCYY-MM-DD date in a site log field, or None if it has not been filled in. """
+    match = DATE.search(text)
+    if match is None:
+        return None
+    try:
+        return date(*(int(group) for group in match.groups()))
+    except ValueError:
+        return None
+
+
+def parse_site_log(text: str) -> DateRange:
+    """ Work out the dates a station has been running from its IGS site log.
+
+        The station starts with its earliest installation date, and has stopped
+        on the latest removal date of its receivers if every receiver has been
+        removed.
+
+        Args:
+            text: contents of the site log
+
+        Returns:
+            The first and last day of data, each None if not known from the log.
+    """
+    installed = []
+    receivers = []  # [installed, removed] dates of every receiver entry
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        match = SECTION.match(line)
+        if match:
+            section = match.group(1)
+            continue
+        match = ENTRY.match(line)
+        if match:
+            section = match.group(1)
+            if section == '3':
+                receivers.append([None, None])
+            continue
+        field, _, value = line.partition(':')
+        field = field.strip().lower()
+        if field == 'date installed':
+            day = parse_date(value)
+            if day is not None:
+                installed.append(day)
+            if section == '3' and receivers:
+                receivers[-1][0] = day
+        elif field == 'date removed' and section == '3' and receivers:
+            receivers[-1][1] = parse_date(value)
+    # the blank template entry at the end of the section was never installed
+    removed = [day for installed_day, day in receivers if installed_day is not None]
+    first = min(installed) if installed else None
+    last = max(removed) if removed and None not in removed else None
+    return first, last
+
+
+class StationCatalog:
+    """ Cache of the stations in the archive and the dates they have been running.
+
+        Args:
+            directory: path to the directory the catalog is persisted to (default: memory only)
+            ttl: seconds the catalog stays valid for (default: one day)
+    """
+
+    def __init__(self, directory: str = None, ttl: float = CATALOG_TTL):
+        self.__directory = directory
+        self.__ttl = ttl
+        self.__fetched: Optional[float] = None
+        self.__stations: Dict[str, str] = {}
+        self.__ranges: Dict[str, DateRange] = {}
+        self.__lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.__load()
+
+    def __path(self) -> str:
+        return os.path.join(self.__directory, CATALOG_FILE)
+
+    def __load(self):
+        """ Read the persisted catalog, if there is a readable one. """
+        try:
+            with open(self.__path()) as f:
+                stored = json.load(f)
+            fetched, stations = stored['fetched'], dict(stored['stations'])
+            ranges = {station: (parse_date(first or ''), parse_date(last or ''))
+                      for station, (first, last) in stored.get('ranges', {}).items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self.__fetched, self.__stations, self.__ranges = fetched, stations, ranges
+
+    def __save(self):
+        """ Persist the catalog, replacing the previous copy in one step. """
+        if not self.__directory:
+            return
+        with self.__lock:
+            stored = {
+                'fetched': self.__fetched,
+                'stations': self.__stations,
+                'ranges': {station: [day.isoformat() if day else None for day in days]
+                           for station, days in self.__ranges.items()},
+            }
+        with atomic_write(self.__path()) as f:
+            json.dump(stored, f, sort_keys=True)
+
+    def get(self) -> Optional[Dict[str, str]]:
+        """ Get the cached catalog.
+
+            Returns:
+                Mapping of station codes to the names of their site logs, or None if there is no valid cached catalog.
+        """
+        with self.__lock:
+            if self.__fetched is None or time.time() - self.__fetched >= self.__ttl:
+                return None
+            return self.__stations
+
+    def put(self, stations: Dict[str, str]):
+        """ Store the catalog, dropping the dates of stations that are no longer in it.
+
+            Args:
+                stations: mapping of station codes to the names of their site logs
+        """
+        with self.__lock:
+            self.__fetched = time.time()
+            self.__stations = dict(stations)
+            self.__ranges = {station: days for station, days in self.__ranges.items() if station in stations}
+        self.__save()
+
+    def fetch(self, ftp: FTP) -> Dict[str, str]:
+        """ List the site logs on the FTP server in one go and store the result.
+
+            Uses MLSD, falling back to a plain NLST on servers that do not support it.
+            Stations whose site log is listed as empty have no known dates, so their
+            logs are never read.
+
+            Args:
+                ftp: a logged in FTP session
+
+            Returns:
+                Mapping of station codes to the names of their site logs.
+        """
+        try:
+            sizes = {posixpath.basename(name): int(facts['size']) if 'size' in facts else None
+                     for name, facts in ftp.mlsd(STATION_LOG_PATH, facts=['type', 'size'])
+                     if facts.get('type', 'file') == 'file'}
+        except error_perm:
+            # some servers answer NLST with full paths
+            sizes = {posixpath.basename(name): None for name in ftp.nlst(STATION_LOG_PATH)}
+        stations = {}
+        for name in sorted(sizes):
+            code = station_code(name)
+            if code is not None:
+                stations.setdefault(code, name)
+        with self.__lock:
+            for code, name in stations.items():
+                if sizes[name] == 0:
+                    self.__ranges[code] = (None, None)
+        self.put(stations)
+        return stations
+
+    def stations(self, ftp: FTP) -> Dict[str, str]:
+        """ Get the catalog, only going to the FTP server when there is no valid cached one.
+
+            Args:
+                ftp: a logged in FTP session
+
+            Returns:
+                Mapping of station codes to the names of their site logs.
+        """
+        stations = self.get()
+        if stations is None:
+            stations = self.fetch(ftp)
+        return stations
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[str]:
+        """ Find stations in the cached catalog by code.
+
+            Stations starting with the query are listed in order. If there are none,
+            the closest matches for a misspelt code are listed instead, those with
+            the most characters in the right place first.
+
+            Args:
+                query: the start of a station code, or a misspelt one
+                limit: largest number of stations returned
+
+            Returns:
+                Matching station codes, best first.
+        """
+        query = query.lower()
+        with self.__lock:
+            stations = sorted(self.__stations)
+        matches = [station for station in stations if station.startswith(query)]
+        if matches or not query:
+            return matches[:limit]
+        close = difflib.get_close_matches(query, stations, len(stations), FUZZY_CUTOFF)
+        return sorted(close, key=lambda station: (-sum(a == b for a, b in zip(query, station)), station))[:limit]
+
+    def date_range(self, ftp: FTP, station: str) -> DateRange:
+        """ Get the first and last day a station recorded data, reading its site log the first time.
+
+            Args:
+                ftp: a logged in FTP session
+                station: 4-character site (base) identifier
+
+            Returns:
+                The first and last day of data, each None if not known (e.g. a station still running has no last day).
+        """
+        station = station.lower()
+        with self.__lock:
+            if station in self.__ranges:
+                return self.__ranges[station]
+            name = self.__stations.get(station)
+        if name is None:
+            return None, None
+        lines = []
+        try:
+            ftp.retrbinary('RETR {}/{}'.format(STATION_LOG_PATH, name), lines.append)
+        except error_perm:
+            return None, None
+        days = parse_site_log(b''.join(lines).decode('latin-1'))
+        with self.__lock:
+            self.__ranges[station] = days
+        self.__save()
+        return days
+
+    def check_window(self, ftp: FTP, station: str, start: datetime, end: datetime):
+        """ Check that a station was running at some point during a time window.
+
+            Raises:
+                ValueError: the window ends before the station started or starts after it stopped.
+        """
+        first, last = self.date_range(ftp, station)
+        if first is not None and end.date() < first:
+            raise ValueError('Station {} has no data before {}.'.format(station, first.isoformat()))
+        if last is not None and start.date() > last:
+            raise ValueError('Station {} has no data after {}.'.format(station, last.isoformat()))
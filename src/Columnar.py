@@ -0,0 +1,273 @@
+"""Class responsible for holding RINEX 2 observations as columns of NumPy arrays.
+
+Instead of text, every epoch becomes a time, a flag and a clock offset, and
+every satellite in it a row of observation values with their loss of lock and
+signal strength indicators. Rows are grouped by epoch CSR style: the
+satellites of epoch i are rows offsets[i] to offsets[i + 1]. The fixed-width
+16-character fields are parsed a whole block of epochs at a time.
+
+  Typical usage example:
+
+  foo = ObservationTable.from_file(path, start, end)
+  l1 = foo.values[:, foo.types.index('L1')]
+  for epoch in foo.to_epochs():
+      writer.write(epoch)
+"""
+from datetime import datetime, timedelta
+from typing import Iterator, List, Tuple
+import numpy as np
+from src.Hatanaka import format_clock, format_observation
+from src.Rinex import (CLOCK_COLUMN, CYCLE_SLIP_FLAG, EVENT_FLAGS, FIELD_WIDTH, FIELDS_PER_LINE, SATELLITES_PER_LINE,
+                       TIME_ORIGIN, Epoch, ObservationFile, format_epoch_time, microseconds)
+
+LINE_WIDTH = 80
+SYSTEMS = 'GRSET'  # GPS, GLONASS, SBAS, Galileo, Transit
+VALUE_WIDTH = 14
+DECIMAL_POINT = 10  # column of the decimal point inside an F14.3 value
+# weight of each character of an F14.3 value, in thousandths
+DIGIT_WEIGHTS = np.array([10 ** (12 - i) for i in range(DECIMAL_POINT)] + [0, 100, 10, 1], dtype=np.int64)
+ZERO = ord('0')
+BLANK = 255  # loss of lock or signal strength indicator left blank, unlike an explicit 0
+NINE = ord('9')
+
+
+def satellite_code(name: str) -> int:
+    """ Encode a satellite as a small integer, e.g. G01 -> 1, R05 -> 105. A blank system means GPS. """
+    system = name[0] if name[0] != ' ' else 'G'
+    if system not in SYSTEMS:
+        raise ValueError('Unknown satellite system in {}.'.format(name))
+    return SYSTEMS.index(system) * 100 + int(name[1:])
+
+
+def satellite_name(code: int) -> str:
+    """ Decode a satellite encoded by satellite_code, e.g. 105 -> R05. """
+    return '{}{:02d}'.format(SYSTEMS[code // 100], code % 100)
+
+
+def parse_fields(fields: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Parse 16-character observation fields.
+
+        Args:
+            fields: uint8 array of the characters of the fields, with 16 as its last dimension
+
+        Returns:
+            The values (NaN for blank fields), loss of lock indicators and signal strength indicators (BLANK if blank).
+    """
+    text = fields[..., :VALUE_WIDTH]
+    is_digit = (text >= ZERO) & (text <= NINE)
+    blank = ~is_digit.any(axis=-1)
+    digits = np.where(is_digit, text - ZERO, 0).astype(np.int64)
+    thousandths = (digits * DIGIT_WEIGHTS).sum(axis=-1)
+    thousandths[(text == ord('-')).any(axis=-1)] *= -1
+    values = thousandths / 1000
+    values[blank] = np.nan
+    # values that are not written as F14.3 are parsed one by one
+    for index in zip(*np.nonzero(~blank & (text[..., DECIMAL_POINT] != ord('.')))):
+        values[index] = float(text[index].tobytes())
+    indicators = fields[..., VALUE_WIDTH:]
+    indicators = np.where((indicators >= ZERO) & (indicators <= NINE), indicators - ZERO, BLANK).astype(np.uint8)
+    return values, indicators[..., 0], indicators[..., 1]
+
+
+class ObservationTable:
+    """ Observations of a RINEX 2 observation file held as NumPy arrays.
+
+        Only epochs holding observations are kept; event records are not.
+
+        Args:
+            types: observation types, one column of values per type
+            times: time of every epoch in microseconds since 1980-01-01 (int64)
+            flags: epoch flag of every epoch (uint8)
+            clocks: receiver clock offset of every epoch in seconds (float64, NaN if not given)
+            offsets: the satellites of epoch i are rows offsets[i] to offsets[i + 1] (int64, one more than epochs)
+            satellites: satellite of every row, see satellite_code (uint16)
+            values: observations, one row per satellite and one column per type (float64, NaN if blank)
+            lli: loss of lock indicators, laid out like values (uint8, BLANK if blank)
+            snr: signal strength indicators, laid out like values (uint8, BLANK if blank)
+    """
+
+    def __init__(self, types: Tuple[str, ...], times: np.ndarray, flags: np.ndarray, clocks: np.ndarray,
+                 offsets: np.ndarray, satellites: np.ndarray, values: np.ndarray, lli: np.ndarray,
+                 snr: np.ndarray):
+        self.types = tuple(types)
+        self.times = times
+        self.flags = flags
+        self.clocks = clocks
+        self.offsets = offsets
+        self.satellites = satellites
+        self.values = values
+        self.lli = lli
+        self.snr = snr
+
+    @classmethod
+    def empty(cls, types: Tuple[str, ...]) -> 'ObservationTable':
+        """ Make a table without any epochs. """
+        return cls(types, np.zeros(0, np.int64), np.zeros(0, np.uint8), np.zeros(0),
+                   np.zeros(1, np.int64), np.zeros(0, np.uint16), np.zeros((0, len(types))),
+                   np.full((0, len(types)), BLANK, np.uint8), np.full((0, len(types)), BLANK, np.uint8))
+
+    @classmethod
+    def from_file(cls, path: str, start: datetime = None, end: datetime = None) -> 'ObservationTable':
+        """ Parse the epochs of an observation file inside a time window.
+
+            Args:
+                path: path to the observation file
+                start: time of the first epoch to include (default: no limit)
+                end: time of the last epoch to include (default: no limit)
+
+            Returns:
+                An ObservationTable holding every observation type used in the window.
+        """
+        with ObservationFile(path) as f:
+            first, last = f.window(start, end)
+            segments = []  # epochs that share the same observation types
+            types = None
+            for record, view in enumerate(f.records(start, end), first):
+                lines = bytes(view).decode('latin-1').splitlines()
+                view.release()
+                flag = int(lines[0][28])
+                if flag in EVENT_FLAGS:
+                    continue
+                if f.types_at(record) != types:
+                    types = f.types_at(record)
+                    segments.append((types, []))
+                segments[-1][1].append((f.times[record], flag, lines))
+        tables = [cls.__parse(types, epochs) for types, epochs in segments]
+        return cls.concatenate(tables) if tables else cls.empty(f.header.types)
+
+    @classmethod
+    def __parse(cls, types: Tuple[str, ...], epochs: List[Tuple[int, int, List[str]]]) -> 'ObservationTable':
+        """ Parse the text of epochs that share the same observation types. """
+        lines_per_satellite = (len(types) + FIELDS_PER_LINE - 1) // FIELDS_PER_LINE
+        counts = []
+        clocks = []
+        satellites = []
+        data = []
+        for _, _, lines in epochs:
+            count = int(lines[0][29:32])
+            continuation = max(count - 1, 0) // SATELLITES_PER_LINE
+            names = ''.join(line[32:CLOCK_COLUMN] for line in lines[:1 + continuation])
+            satellites += [satellite_code(names[i:i + 3]) for i in range(0, 3 * count, 3)]
+            clock = lines[0][CLOCK_COLUMN:CLOCK_COLUMN + 12]
+            clocks.append(float(clock) if clock.strip() else np.nan)
+            counts.append(count)
+            data += [line[:LINE_WIDTH].ljust(LINE_WIDTH) for line in lines[1 + continuation:]]
+        rows = len(satellites)
+        if len(data) != rows * lines_per_satellite:
+            raise ValueError('Epochs do not hold one set of observations per satellite.')
+        block = np.frombuffer(''.join(data).encode('latin-1'), dtype=np.uint8)
+        block = block.reshape(rows, lines_per_satellite * LINE_WIDTH)[:, :len(types) * FIELD_WIDTH]
+        values, lli, snr = parse_fields(block.reshape(rows, len(types), FIELD_WIDTH))
+        offsets = np.zeros(len(epochs) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(types, np.array([e[0] for e in epochs], np.int64), np.array([e[1] for e in epochs], np.uint8),
+                   np.array(clocks), offsets, np.array(satellites, np.uint16), values, lli, snr)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory held by the arrays of the table. """
+        return sum(a.nbytes for a in (self.times, self.flags, self.clocks, self.offsets,
+                                      self.satellites, self.values, self.lli, self.snr))
+
+    def datetimes(self) -> np.ndarray:
+        """ Get the time of every epoch as datetime64 values. """
+        return np.datetime64(TIME_ORIGIN, 'us') + self.times.astype('timedelta64[us]')
+
+    def epoch_rows(self) -> np.ndarray:
+        """ Get the epoch each row belongs to. """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def take(self, epochs: np.ndarray) -> 'ObservationTable':
+        """ Get a table holding some of the epochs.
+
+            Args:
+                epochs: positions of the epochs to keep, or a boolean mask over the epochs
+
+            Returns:
+                A new ObservationTable.
+        """
+        epochs = np.arange(len(self))[epochs]
+        counts = np.diff(self.offsets)[epochs]
+        offsets = np.zeros(len(epochs) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # positions of the rows of the kept epochs
+        rows = np.repeat(self.offsets[epochs] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return ObservationTable(self.types, self.times[epochs], self.flags[epochs], self.clocks[epochs], offsets,
+                                self.satellites[rows], self.values[rows], self.lli[rows], self.snr[rows])
+
+    def window(self, start: datetime = None, end: datetime = None) -> 'ObservationTable':
+        """ Get a table holding the epochs inside a time window (both ends included). """
+        first = 0 if start is None else np.searchsorted(self.times, microseconds(start), 'left')
+        last = len(self) if end is None else np.searchsorted(self.times, microseconds(end), 'right')
+        return self.take(slice(first, max(first, last)))
+
+    def with_types(self, types: Tuple[str, ...]) -> 'ObservationTable':
+        """ Get a table with its columns rearranged to different observation types, blank where missing. """
+        rows = len(self.satellites)
+        values = np.full((rows, len(types)), np.nan)
+        lli = np.full((rows, len(types)), BLANK, np.uint8)
+        snr = np.full((rows, len(types)), BLANK, np.uint8)
+        for column, name in enumerate(types):
+            if name in self.types:
+                source = self.types.index(name)
+                values[:, column] = self.values[:, source]
+                lli[:, column] = self.lli[:, source]
+                snr[:, column] = self.snr[:, source]
+        return ObservationTable(types, self.times, self.flags, self.clocks, self.offsets,
+                                self.satellites, values, lli, snr)
+
+    @classmethod
+    def concatenate(cls, tables: List['ObservationTable']) -> 'ObservationTable':
+        """ Merge tables into one in chronological order.
+
+            Observation types are reconciled like the merger does, and when several
+            tables have an epoch at the same time, the one from the table given
+            first is kept. Cycle slip records (epoch flag 6), which share the time
+            of the epoch before them, are only dropped for another one.
+
+            Args:
+                tables: tables to merge
+
+            Returns:
+                A new ObservationTable.
+        """
+        types = []
+        for table in tables:
+            types += [t for t in table.types if t not in types]
+        tables = [table.with_types(tuple(types)) for table in tables]
+        if not tables:
+            return cls.empty(())
+        counts = np.concatenate([np.diff(t.offsets) for t in tables])
+        offsets = np.zeros(len(counts) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        merged = cls(types, np.concatenate([t.times for t in tables]), np.concatenate([t.flags for t in tables]),
+                     np.concatenate([t.clocks for t in tables]), offsets,
+                     np.concatenate([t.satellites for t in tables]), np.concatenate([t.values for t in tables]),
+                     np.concatenate([t.lli for t in tables]), np.concatenate([t.snr for t in tables]))
+        # a stable sort keeps the epoch of the earlier table first
+        order = np.argsort(merged.times, kind='stable')
+        kinds = merged.times[order] * 2 + (merged.flags[order] == CYCLE_SLIP_FLAG)
+        keep = np.zeros(len(order), bool)
+        keep[np.unique(kinds, return_index=True)[1]] = True
+        return merged.take(order[keep])
+
+    def to_epochs(self) -> Iterator[Epoch]:
+        """ Convert the table back to epochs that can be written with an ObservationWriter.
+
+            Values and clock offsets are written like CRX2RNX does, without a
+            leading zero below one.
+        """
+        for i in range(len(self)):
+            rows = slice(self.offsets[i], self.offsets[i + 1])
+            time = TIME_ORIGIN + timedelta(microseconds=int(self.times[i]))
+            observations = []
+            for values, lli, snr in zip(self.values[rows], self.lli[rows], self.snr[rows]):
+                observations.append(['{:16}'.format('') if np.isnan(v) else '{}{}{}'.format(
+                    format_observation(round(v * 1000)), ' ' if l == BLANK else l, ' ' if s == BLANK else s)
+                    for v, l, s in zip(values, lli, snr)])
+            clock = '' if np.isnan(self.clocks[i]) else format_clock(round(self.clocks[i] * 10 ** 9))
+            yield Epoch(time, format_epoch_time(time), int(self.flags[i]),
+                        [satellite_name(s) for s in self.satellites[rows]], clock, observations, self.types, [])
@@ -0,0 +1,168 @@
+"""Class responsible for adapting the number of transfers in flight to what the server can take.
+
+The window of transfers allowed in flight grows and shrinks like a TCP
+congestion window (additive increase, multiplicative decrease). Transfers are
+counted in rounds of one window's worth of completed files. While each round
+is at least as fast as the one before and its latency has not grown well above
+the lowest of the last few rounds, the window grows: doubling at first (slow
+start), then by one transfer per round. A dropped connection or a jump in
+latency halves it, once per round, and a "too many connections" reply shrinks
+it to the number of transfers the server accepted. A round whose latency is
+still high right after a decrease keeps the window as it is, and the latency
+of a lasting change of route becomes the new baseline once the rounds before
+it are forgotten.
+
+  Typical usage example:
+
+  foo = ConcurrencyWindow(maximum=8)
+  with foo:
+      # transfer a file
+      foo.completed(size, seconds, latency)
+  print(foo.stats())
+"""
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+THROUGHPUT_TOLERANCE = 0.1  # a round this much slower than the last one stops the window growing
+LATENCY_LIMIT = 3.0  # a round with latency this many times the lowest of the last rounds halves the window
+LATENCY_ROUNDS = 10  # rounds the lowest latency is taken over
+DECREASE = 0.5
+
+
+class ConcurrencyWindow:
+    """ AIMD limit on the number of transfers in flight.
+
+        Args:
+            maximum: largest number of transfers in flight
+            minimum: smallest number of transfers in flight (default: 1)
+            initial: number of transfers in flight to start with (default: minimum)
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: int = None):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError('Concurrency limits must satisfy 1 <= minimum <= maximum.')
+        initial = minimum if initial is None else initial
+        if not minimum <= initial <= maximum:
+            raise ValueError('Initial concurrency must be between the minimum and maximum.')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = initial
+        self.in_flight = 0
+        self.__condition = threading.Condition()
+        self.__slow_start = True
+        self.__decreased = False  # already decreased during this round
+        self.__previous: Optional[float] = None  # throughput of the last round
+        self.__latencies: Deque[float] = deque(maxlen=LATENCY_ROUNDS)  # latency of the last rounds
+        self.__new_round()
+        self.completed_transfers = 0
+        self.congestion_events = 0
+        self.throughput: Optional[float] = None
+
+    def __new_round(self):
+        self.__round_start = time.monotonic()
+        self.__round_transfers = 0
+        self.__round_bytes = 0
+        self.__round_latency = 0.0
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """ Take a place in the window, waiting for one to free up if needed.
+
+            Returns:
+                True if a place was taken (always when blocking).
+        """
+        with self.__condition:
+            while self.in_flight >= self.window:
+                if not blocking:
+                    return False
+                self.__condition.wait()
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """ Give back a place taken by acquire. """
+        with self.__condition:
+            self.in_flight -= 1
+            self.__condition.notify()
+
+    def __enter__(self) -> 'ConcurrencyWindow':
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __resize(self, window: int):
+        self.window = max(self.minimum, min(self.maximum, window))
+        self.__condition.notify_all()
+
+    def completed(self, size: int, seconds: float, latency: float):
+        """ Record a completed transfer, growing the window at the end of a round that went well.
+
+            Args:
+                size: number of bytes transferred
+                seconds: how long the transfer took
+                latency: seconds until its first byte arrived
+        """
+        with self.__condition:
+            self.completed_transfers += 1
+            self.__round_transfers += 1
+            self.__round_bytes += size
+            self.__round_latency += latency
+            if self.__round_transfers < self.window:
+                return
+            elapsed = max(time.monotonic() - self.__round_start, seconds, 1e-6)
+            throughput = self.__round_bytes / elapsed
+            latency = self.__round_latency / self.__round_transfers
+            self.throughput = throughput
+            self.__latencies.append(latency)
+            if latency > LATENCY_LIMIT * max(min(self.__latencies), 1e-3):
+                if not self.__decreased:
+                    self.__decrease()
+                    return
+                # the round right after a decrease, never grown while the latency is high
+            elif self.__previous is None or throughput >= self.__previous * (1 - THROUGHPUT_TOLERANCE):
+                self.__resize(self.window * 2 if self.__slow_start else self.window + 1)
+            else:
+                # more transfers in flight did not help
+                self.__slow_start = False
+            self.__previous = throughput
+            self.__decreased = False
+            self.__new_round()
+
+    def __decrease(self):
+        self.congestion_events += 1
+        self.__slow_start = False
+        self.__decreased = True
+        self.__resize(int(self.window * DECREASE))
+        self.__previous = None
+        self.__new_round()
+
+    def congested(self, limit: int = None):
+        """ Record a sign of congestion (too many connections, a dropped connection), halving the window once per round.
+
+            Args:
+                limit: number of transfers the server is known to take at most, e.g. the sessions
+                    it accepted before refusing one. The window shrinks to it straight away.
+        """
+        with self.__condition:
+            if limit is not None and limit < self.window:
+                self.congestion_events += 1
+                self.__slow_start = False
+                self.__resize(limit)
+            elif not self.__decreased:
+                self.__decrease()
+
+    def stats(self) -> Dict[str, float]:
+        """ Get the limits, the current window and what it is based on. """
+        with self.__condition:
+            return {
+                'minimum': self.minimum,
+                'maximum': self.maximum,
+                'window': self.window,
+                'in_flight': self.in_flight,
+                'completed_transfers': self.completed_transfers,
+                'congestion_events': self.congestion_events,
+                'throughput': self.throughput or 0.0,
+            }
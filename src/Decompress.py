@@ -0,0 +1,355 @@
+"""Streaming decompressors for the archive formats served by the NOAA FTP server.
+
+Gzip files (.gz) are decompressed with zlib and Unix compress files (.Z) with
+an LZW decoder written in Python, so neither needs the external gunzip tool.
+Both accept data in arbitrary chunks as they arrive off the wire, and can be
+chained with the Compact RINEX decoder to turn .yyd.Z files straight into
+standard RINEX. An LZW encoder writes .Z files the Unix uncompress tool reads.
+
+  Typical usage example:
+
+  with open(decompressed_name(file), 'wb') as f:
+      writer = DecompressingWriter(f, file)
+      ftp.retrbinary('RETR {}'.format(file), writer.write)
+      writer.close()
+"""
+import os
+import re
+import zlib
+from typing import BinaryIO, Dict, List, Optional
+from src.Hatanaka import CRXDecoder
+
+LZW_MAGIC = b'\x1f\x9d'
+LZW_BLOCK_MODE = 0x80  # a CLEAR code resets the dictionary
+LZW_BITS_MASK = 0x1f
+LZW_INIT_BITS = 9
+LZW_CLEAR = 256
+LZW_MAX_BITS = 16
+CHUNK_SIZE = 1024 * 1024
+COMPRESSED_EXTENSIONS = ('.gz', '.Z')
+HATANAKA_NAME = re.compile(r'\.\d\dd$')  # ssssdddh.yyd
+
+
+class GzipDecompressor:
+    """ Incrementally decompresses gzip data, including files made of several gzip members. """
+
+    def __init__(self):
+        self.__zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        """ Decompress the next chunk of data.
+
+            Args:
+                data: compressed bytes
+
+            Returns:
+                The decompressed bytes that could be produced so far.
+
+            Raises:
+                ValueError: the data is not valid gzip data.
+        """
+        try:
+            output = [self.__zlib.decompress(data)]
+            while self.__zlib.eof and self.__zlib.unused_data:
+                # another gzip member follows the one that just ended
+                data = self.__zlib.unused_data
+                self.__zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                output.append(self.__zlib.decompress(data))
+        except zlib.error as e:
+            raise ValueError('Corrupt gzip compressed data: {}'.format(e))
+        return b''.join(output)
+
+    def flush(self) -> bytes:
+        """ Signal the end of the data and return whatever is left.
+
+            Raises:
+                ValueError: the data ended in the middle of a gzip member.
+        """
+        output = self.__zlib.flush()
+        if not self.__zlib.eof:
+            raise ValueError('Compressed data ended before the end of the gzip stream.')
+        return output
+
+
+class LZWDecompressor:
+    """ Incrementally decompresses data made by the Unix compress tool (.Z files).
+
+        Codes are packed least significant bit first in groups of eight codes. When
+        the code width grows or the dictionary is cleared, compress pads out to the
+        end of the current group, so the decoder works a group at a time.
+    """
+
+    def __init__(self):
+        self.__pending = bytearray()
+        self.__header = False
+        self.__max_bits = 16
+        self.__block_mode = True
+        self.__reset(LZW_INIT_BITS)
+        self.__previous = None
+
+    def __reset(self, bits: int):
+        """ Start again with an empty dictionary of a given code width. """
+        self.__bits = bits
+        self.__table = [bytes([i]) for i in range(256)]
+        if self.__block_mode:
+            self.__table.append(b'')  # CLEAR code is never output
+        self.__previous = None
+
+    def __max_code(self) -> int:
+        """ The largest code the dictionary can hold before the code width grows. """
+        return (1 << self.__bits) - 1
+
+    def __decode_group(self, group: bytes, codes: int) -> bytes:
+        """ Decode up to a number of codes from a group, stopping early when it is padded out.
+
+            Returns:
+                The decoded bytes.
+        """
+        bits = self.__bits
+        mask = (1 << bits) - 1
+        value = int.from_bytes(group, 'little')
+        table = self.__table
+        max_code = self.__max_code()
+        max_entries = 1 << self.__max_bits
+        previous = self.__previous
+        output = []
+        for i in range(codes):
+            code = (value >> (i * bits)) & mask
+            if code == LZW_CLEAR and self.__block_mode:
+                self.__reset(LZW_INIT_BITS)
+                return b''.join(output)
+            if code < len(table):
+                entry = table[code]
+                if previous is not None and len(table) < max_entries:
+                    table.append(previous + entry[:1])
+            elif code == len(table) and previous is not None:
+                # the code being defined by this very step
+                entry = previous + previous[:1]
+                table.append(entry)
+            else:
+                raise ValueError('Corrupt LZW compressed data.')
+            output.append(entry)
+            previous = entry
+            if len(table) > max_code and bits < self.__max_bits:
+                # the remaining codes of this group are padding
+                self.__previous = previous
+                self.__bits += 1
+                return b''.join(output)
+        self.__previous = previous
+        return b''.join(output)
+
+    def decompress(self, data: bytes) -> bytes:
+        """ Decompress the next chunk of data.
+
+            Args:
+                data: compressed bytes
+
+            Returns:
+                The decompressed bytes that could be produced so far.
+        """
+        self.__pending += data
+        if not self.__header:
+            if len(self.__pending) < 3:
+                return b''
+            if self.__pending[:2] != LZW_MAGIC:
+                raise ValueError('Not LZW compressed data.')
+            flags = self.__pending[2]
+            self.__max_bits = flags & LZW_BITS_MASK
+            self.__block_mode = bool(flags & LZW_BLOCK_MODE)
+            if not LZW_INIT_BITS <= self.__max_bits <= 16:
+                raise ValueError(
+                    'Unsupported LZW code width of {} bits.'.format(self.__max_bits))
+            self.__reset(LZW_INIT_BITS)
+            del self.__pending[:3]
+            self.__header = True
+        output = []
+        start = 0
+        # only whole groups can be decoded, a group may still be padded
+        while len(self.__pending) - start >= self.__bits:
+            group_size = self.__bits
+            output.append(self.__decode_group(
+                self.__pending[start:start + group_size], 8))
+            start += group_size
+        del self.__pending[:start]
+        return b''.join(output)
+
+    def flush(self) -> bytes:
+        """ Signal the end of the data and decode the last partial group. """
+        if not self.__header:
+            if self.__pending:
+                raise ValueError('Not LZW compressed data.')
+            return b''
+        codes = len(self.__pending) * 8 // self.__bits
+        output = self.__decode_group(bytes(self.__pending), codes)
+        self.__pending.clear()
+        return output
+
+
+class LZWCompressor:
+    """ Incrementally compresses data like the Unix compress tool does (.Z files), with codes of up to 16 bits.
+
+        Codes are packed in the same groups of eight the decompressor reads, and
+        the current group is padded out whenever the code width grows. The
+        dictionary is never cleared, so no CLEAR code is output.
+    """
+
+    def __init__(self):
+        self.__header = False
+        self.__table: Dict[int, int] = {}  # code of a string << 8 | next byte -> code of the longer string
+        self.__free = LZW_CLEAR + 1  # next code to define
+        self.__code: Optional[int] = None  # code of the longest string matched so far
+        self.__bits = LZW_INIT_BITS
+        self.__group: List[int] = []
+
+    def __output(self, code: int, output: bytearray):
+        """ Output a code, writing out its group once full or when the code width grows. """
+        group = self.__group
+        group.append(code)
+        grow = self.__free > (1 << self.__bits) - 1 and self.__bits < LZW_MAX_BITS
+        if len(group) == 8 or grow:
+            output += self.__pack(self.__bits)
+        if grow:
+            self.__bits += 1
+
+    def __pack(self, size: int) -> bytes:
+        """ Pack the codes of the current group into a number of bytes and start the next group. """
+        bits = self.__bits
+        value = 0
+        for i, code in enumerate(self.__group):
+            value |= code << (i * bits)
+        self.__group.clear()
+        return value.to_bytes(size, 'little')
+
+    def compress(self, data: bytes) -> bytes:
+        """ Compress the next chunk of data.
+
+            Args:
+                data: bytes to compress
+
+            Returns:
+                The compressed bytes that could be produced so far.
+        """
+        output = bytearray()
+        if not self.__header:
+            output += LZW_MAGIC + bytes([LZW_BLOCK_MODE | LZW_MAX_BITS])
+            self.__header = True
+        table = self.__table
+        code = self.__code
+        for byte in data:
+            if code is None:
+                code = byte
+                continue
+            key = code << 8 | byte
+            longer = table.get(key)
+            if longer is not None:
+                code = longer
+                continue
+            self.__output(code, output)
+            if self.__free < 1 << LZW_MAX_BITS:
+                table[key] = self.__free
+                self.__free += 1
+            code = byte
+        self.__code = code
+        return bytes(output)
+
+    def flush(self) -> bytes:
+        """ Signal the end of the data and return the last codes. """
+        output = bytearray(self.compress(b''))
+        if self.__code is not None:
+            self.__output(self.__code, output)
+            self.__code = None
+        output += self.__pack((len(self.__group) * self.__bits + 7) // 8)
+        return bytes(output)
+
+
+def is_compressed(name: str) -> bool:
+    """ Checks whether a file name has a compressed extension (.gz or .Z). """
+    return name.endswith(COMPRESSED_EXTENSIONS)
+
+
+def decompressed_name(name: str) -> str:
+    """ Strip the compressed extension from a file name, e.g. ssssddd0.yyd.Z -> ssssddd0.yyd """
+    for extension in COMPRESSED_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def is_hatanaka(name: str) -> bool:
+    """ Checks whether a file name, once decompressed, is a Hatanaka compressed RINEX file (.yyd). """
+    return HATANAKA_NAME.search(decompressed_name(name)) is not None
+
+
+def decompressor_for(name: str):
+    """ Get a decompressor for a file based on its extension.
+
+        Args:
+            name: file name ending in .gz or .Z
+
+        Returns:
+            A GzipDecompressor or LZWDecompressor.
+    """
+    if name.endswith('.gz'):
+        return GzipDecompressor()
+    if name.endswith('.Z'):
+        return LZWDecompressor()
+    raise ValueError('{} is not a compressed file.'.format(name))
+
+
+class DecompressingWriter:
+    """ File-like object that decompresses data written to it into another file.
+
+        Args:
+            f: binary file the decompressed data is written to
+            name: name of the compressed file, used to pick the decompressor
+            hatanaka: also convert Hatanaka compressed RINEX (.yyd) to standard RINEX (default: False)
+    """
+
+    def __init__(self, f: BinaryIO, name: str, hatanaka: bool = False):
+        self.__file = f
+        self.__stages = []
+        if is_compressed(name):
+            self.__stages.append(decompressor_for(name))
+        if hatanaka and is_hatanaka(name):
+            self.__stages.append(CRXDecoder())
+        if not self.__stages:
+            raise ValueError('{} is not a compressed file.'.format(name))
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        for stage in self.__stages:
+            data = stage.decompress(data)
+        self.__file.write(data)
+        return size
+
+    def close(self):
+        """ Write out the end of the decompressed data. Does not close the underlying file. """
+        data = b''
+        for stage in self.__stages:
+            data = stage.decompress(data) + stage.flush()
+        self.__file.write(data)
+
+
+def decompress_file(path: str) -> str:
+    """ Decompress a .gz or .Z file next to itself and remove the original, like gunzip.
+
+        Args:
+            path: path to the compressed file
+
+        Returns:
+            Path to the decompressed file.
+    """
+    output_path = decompressed_name(path)
+    try:
+        with open(path, 'rb') as src, open(output_path, 'wb') as dst:
+            writer = DecompressingWriter(dst, path)
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                writer.write(chunk)
+            writer.close()
+    except BaseException:
+        # never leave a partial file behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    os.remove(path)
+    return output_path
@@ -3,24 +3,82 @@
 The class will connect to the FTP, dynamically generate a list of required files,
 download them and save them to a specified directory.
 
+The list of files is planned up front and then drained through a bounded pool
+of worker FTP sessions, so several transfers can be in flight at once.
+Transfers that are cut short are resumed from the last byte received (FTP
+REST) on a new session, backing off exponentially between attempts. When
+several mirrors are given, the sessions are spread over all of them and the
+files are shared out by their speed (see MirrorManager). The number of
+transfers in flight adapts to the throughput and errors seen, up to the
+number of workers (see ConcurrencyWindow). Every transfer, cache hit, FTP
+command and retry is recorded in the downloader's metrics (see Metrics).
+
   Typical usage example:
 
-  foo = RinexDownloader(station, start_time, end_time, directoy)
+  foo = RinexDownloader(station, start_time, end_time, directoy, workers=4)
   foo.download()
 """
-from ftplib import FTP, error_perm
+from ftplib import FTP, error_perm, error_reply, error_temp
 from socket import gaierror
-import string
 import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from progress.bar import IncrementalBar
 import subprocess
 from glob import glob
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, List, Tuple
+from src.Cache import RinexCache
+from src.Catalog import StationCatalog
+from src.Concurrency import ConcurrencyWindow
+from src.Decompress import DecompressingWriter
+from src.Listing import DIRECTORY_PATH, Listing, ListingIndex
+from src.Metrics import Metrics
+from src.Mirrors import Mirror, MirrorManager
+from src.Planner import FetchPlan, PlannedFile, RinexPlanner
 
 MAIN_SERVER = 'geodesy.noaa.gov'
 ALT_SERVER = 'alt.ngs.noaa.gov'
-DIRECTORY_PATH = '/cors/rinex/{}/{:03d}/{}'
+FTP_PORT = 21
+SERVERS = [(MAIN_SERVER, FTP_PORT), (ALT_SERVER, FTP_PORT)]
+RETRIES = 5  # attempts per file after the first one
+BACKOFF = 1.0  # seconds to wait at most before the first retry, doubled after each one
+MAX_BACKOFF = 60.0
+# errors of a dropped or stalled connection, worth retrying on a new session
+TRANSIENT_ERRORS = (OSError, EOFError, error_temp, error_reply)
+
+
+def backoff_delay(attempt: int, backoff: float = BACKOFF) -> float:
+    """ Get how long to wait before a retry, with exponential backoff and full jitter.
+
+        Args:
+            attempt: number of the retry, starting at 1
+            backoff: longest wait before the first retry in seconds
+
+        Returns:
+            A random delay in seconds between 0 and backoff * 2 ** (attempt - 1), capped at MAX_BACKOFF.
+    """
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** (attempt - 1)))
+
+
+class MeteredFTP(FTP):
+    """ FTP session counting the connections it makes and the commands it sends, i.e. its round trips. """
+
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def connect(self, *args, **kwargs) -> str:
+        self.metrics.count('ftp_connections')
+        return super().connect(*args, **kwargs)
+
+    def putcmd(self, line: str):
+        self.metrics.count('ftp_round_trips')
+        super().putcmd(line)
 
 
 class RinexDownloader:
@@ -31,38 +89,175 @@ class RinexDownloader:
             start_time: datetime object
             end_time: datetime object
             directory: file path to location where files will be saved to (default: current directory)
+            workers: largest number of FTP sessions used to transfer files concurrently (default: 1)
+            servers: list of (host, port) pairs of mirrors, tried in order for single sessions and all used at once by a pool of workers (default: NOAA main and alternate servers)
+            cache: local cache consulted before downloading archive files (default: no cache)
+            index: cache of directory listings used to plan downloads (default: in-memory index)
+            catalog: cache of the stations in the archive used to validate requests (default: in-memory catalog)
+            decompress: decompress .gz, .Z and Hatanaka files while they are downloaded, saving only standard RINEX files (default: False)
+            retries: number of times a transfer is resumed after a transient failure before giving up on a file (default: 5)
+            backoff: longest wait before the first retry in seconds, doubled after each retry (default: 1)
+            min_workers: smallest number of concurrent transfers the adaptive window shrinks to (default: 1)
+            metrics: where transfers, cache hits and FTP round trips are recorded (default: new metrics)
     """
 
-    def __init__(self, station: str, start_time: datetime, end_time: datetime, directory: str = ''):
+    def __init__(self, station: str, start_time: datetime, end_time: datetime, directory: str = '',
+                 workers: int = 1, servers: List[Tuple[str, int]] = None, cache: RinexCache = None,
+                 index: ListingIndex = None, decompress: bool = False, retries: int = RETRIES,
+                 backoff: float = BACKOFF, min_workers: int = 1, catalog: StationCatalog = None,
+                 metrics: Metrics = None):
+        if workers < 1:
+            raise ValueError('Number of workers must be at least 1.')
+        if retries < 0:
+            raise ValueError('Number of retries cannot be negative.')
+        if not 1 <= min_workers <= workers:
+            raise ValueError('Minimum number of workers must be between 1 and the number of workers.')
         self.__station = station.lower()
         self.__start = start_time
         self.__end = end_time
         self.__directory = directory
+        self.__workers = workers
+        self.__servers = servers or SERVERS
+        self.__cache = cache
+        self.__index = index or ListingIndex()
+        self.__catalog = catalog or StationCatalog()
+        self.__planner = RinexPlanner(station)
+        self.__decompress = decompress
+        self.__retries = retries
+        self.__backoff = backoff
+        # transfers in flight, adapted as files are downloaded
+        self.concurrency = ConcurrencyWindow(workers, min_workers)
+        self.metrics = metrics or Metrics()
         self.__ftp = None
-
-    def __set_ftp(self):
-        """ Create new FTP object. """
-        try:
-            self.__ftp = FTP(MAIN_SERVER)
-        except gaierror:
+        self.__local = threading.local()
+        self.__sessions = []
+        self.__idle = []  # (server, session) pairs no worker thread holds
+        self.__lock = threading.Lock()
+
+    def __set_ftp(self, server: Tuple[str, int] = None) -> FTP:
+        """ Create new FTP object, falling back to the alternate server(s) unless a server is given. """
+        for host, port in [server] if server else self.__servers:
+            ftp = MeteredFTP(self.metrics)
             try:
-                self.__ftp = FTP(ALT_SERVER)  # try alternate server
+                ftp.connect(host, port)
+                return ftp
             except gaierror:
-                raise RuntimeError(
-                    'Unable to connect to FTP. Please check your connection.')
+                continue  # try alternate server
+        raise RuntimeError(
+            'Unable to connect to FTP. Please check your connection.')
+
+    def connect(self, server: Tuple[str, int] = None) -> FTP:
+        """ Open up a new logged in session with the FTP server, e.g. to share between downloaders.
+
+            Args:
+                server: (host, port) pair of the mirror to connect to (default: the first one reachable)
+
+            Raises:
+                RuntimeError: no server could be reached or logged in to.
+        """
+        ftp = self.__set_ftp(server)
+        try:
+            ftp.login()
+        except error_temp:
+            # e.g. 421 too many connections, worth trying again later
+            ftp.close()
+            raise
+        except:
+            ftp.close()
+            raise RuntimeError(
+                'Unable to connect to FTP. NOAA servers are down.')
+        return ftp
 
     def __ftp_connect(self):
         """ Open up a connection with the FTP server. """
-        self.__set_ftp()
+        self.__ftp = self.connect()
+
+    def __worker_session(self) -> FTP:
+        """ Get the FTP session held by the current worker thread, taking an idle one or opening one if it has none.
+
+            Workers bound to a mirror use sessions with that mirror, the others take any idle session.
+        """
+        ftp = getattr(self.__local, 'ftp', None)
+        if ftp is not None:
+            return ftp
+        server = getattr(self.__local, 'server', None)
+        with self.__lock:
+            idle = next((pair for pair in self.__idle if server is None or pair[0] == server), None)
+            if idle is not None:
+                self.__idle.remove(idle)
+                ftp = idle[1]
+        if ftp is None:
+            ftp = self.connect(server)
+            with self.__lock:
+                self.__sessions.append(ftp)
+        self.__local.ftp = ftp
+        return ftp
+
+    def __park_session(self):
+        """ Hand the session of the current thread over to any other worker, closing it if the window has shrunk. """
+        ftp = getattr(self.__local, 'ftp', None)
+        if ftp is None:
+            return
+        with self.__lock:
+            surplus = len(self.__sessions) > self.concurrency.window
+            if not surplus:
+                self.__idle.append(((ftp.host, ftp.port), ftp))
+                self.__local.ftp = None
+        if surplus:
+            self.__close_session(ftp)
+
+    def __close_session(self, ftp: FTP):
+        """ Close a session of the current thread, so the next one used is a new one. """
+        with self.__lock:
+            if ftp in self.__sessions:
+                self.__sessions.remove(ftp)
+        if getattr(self.__local, 'ftp', None) is ftp:
+            self.__local.ftp = None
         try:
-            # Check if connection is currently alive
-            self.__ftp.voidcmd('NOOP')
-        except error_perm:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def __replace_session(self, ftp: FTP) -> FTP:
+        """ Close a broken session and open a new one in its place for the current thread. """
+        ftp.close()
+        self.__close_session(ftp)
+        return self.__worker_session()
+
+    def __keep_idle_sessions(self, slots: List[Mirror]):
+        """ Keep as many idle sessions with every mirror as it has workers, closing the others (e.g. those left
+            by the listing), so they do not count against the window while no worker can take them.
+        """
+        with self.__lock:
+            wanted = [m.server for m in slots]
+            kept, surplus = [], []
+            for server, ftp in self.__idle:
+                if server in wanted:
+                    wanted.remove(server)
+                    kept.append((server, ftp))
+                else:
+                    surplus.append(ftp)
+                    self.__sessions.remove(ftp)
+            self.__idle = kept
+        for ftp in surplus:
             try:
-                self.__ftp.login()
-            except:
-                raise RuntimeError(
-                    'Unable to connect to FTP. NOAA servers are down.')
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+    def __close_worker_sessions(self):
+        """ Close every FTP session opened by the worker pool. """
+        with self.__lock:
+            sessions, self.__sessions, self.__idle = self.__sessions, [], []
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+    def close(self):
+        """ Close the FTP sessions the downloader opened itself, e.g. in place of a broken session it was given. """
+        self.__close_worker_sessions()
 
     def deconstruct_datetime(self, date: datetime) -> List[int]:
         """ Extracts information from a datetime object
@@ -76,20 +271,39 @@ class RinexDownloader:
         year, month, day, hour, _, _, _, yday, _ = date.timetuple()
         return [year, yday, hour]
 
-    def is_valid_station_code(self):
+    def is_valid_station_code(self, ftp: FTP = None):
         """ Checks if station code is valid (and accessible) on the FTP server. 
 
+            Stations are looked up in the station catalog, which only goes to the FTP
+            server when it has no valid cached copy.
+
+            Args:
+                ftp: a logged in FTP session to check with (default: open a new one if needed)
+
             Returns: 
                 True if valid station. Otherwise False.
         """
         if not self.__station:
             return False
-        self.__ftp_connect()
-        self.__ftp.cwd('/cors/station_log')
-        station_results = []
-        self.__ftp.retrlines('NLST *{}*'.format(self.__station),
-                             station_results.append)
-        return bool(station_results)
+        if ftp is None and self.__catalog.get() is None:
+            self.__ftp_connect()
+            ftp = self.__ftp
+        return self.__station in self.__catalog.stations(ftp)
+
+    def validate(self, ftp: FTP):
+        """ Check that the station exists and was running at some point during the time window.
+
+            Args:
+                ftp: a logged in FTP session
+
+            Raises:
+                ValueError: the station is not valid, or has no data in the time window.
+        """
+        if not self.is_valid_station_code(ftp):
+            suggestions = self.__catalog.search(self.__station, 3)
+            raise ValueError('Station code is not valid!{}'.format(
+                ' Did you mean {}?'.format(', '.join(suggestions)) if suggestions else ''))
+        self.__catalog.check_window(ftp, self.__station, self.__start, self.__end)
 
     def get_days_left_in_year(self, date: datetime) -> int:
         """ Get number of days left in the year given a specific date
@@ -153,15 +367,16 @@ class RinexDownloader:
         elif ord(start) > ord('x') or ord(end) > ord('x'):
             raise ValueError("Start or end hour block cannot exceed 'x'.")
 
-        # We make use of in-built structures to efficiently generate all alphabetical letters between hour_block_start and hour_block_end
-        hour_range = string.ascii_lowercase[ord(start)-97: ord(end)-96]
-        return ["{}{:03d}{}.{}o.gz".format(self.__station, yday, h, year % 100) for h in hour_range]
+        return self.__planner.hourly_names(year, yday, ord(start)-97, ord(end)-97)
 
-    def create_file_list(self, directory_listing: str, current_day: int, start_year: int, start_day: int, start_hour: str, end_day: int, end_hour: str) -> List[str]:
+    def create_file_list(self, directory_listing: Listing, current_day: int, start_year: int, start_day: int, start_hour: int, end_day: int, end_hour: int) -> List[str]:
         """ Create list of files to download from FTP.
 
+            The full day log is only used when it is cheaper than the hourly files
+            covering the required hours (see RinexPlanner.choose).
+
             Args:
-                directory_listing: ftp directory where files will be downloaded from
+                directory_listing: mapping of file names in the day's directory on the FTP server to their sizes
                 current_day: day-of-year
                 start_year: 4-digit year
                 start_day: day-of-year
@@ -173,96 +388,339 @@ class RinexDownloader:
                 A list of file names.
 
          """
-        file_list = []
-        start_hour = chr(start_hour+97)
-        end_hour = chr(end_hour+97)
-
-        standard_day_log = "{}{:03d}0.{}o.gz".format(
-            self.__station, current_day, start_year % 100)
-        # older full day logs look different and are compressed differently
-        hatanaka_day_log = "{}{:03d}0.{}d.Z".format(
-            self.__station, current_day, start_year % 100)
-
-        if standard_day_log in directory_listing:
-            # download full day log in available
-            file_list.append(standard_day_log)
-        elif hatanaka_day_log in directory_listing:
-            file_list.append(hatanaka_day_log)
-        else:
-            # generate all files to download using their hour block code
-            if current_day == start_day:
-                # on start day, get all files from start_hour to x
-                file_list = self.generate_file_names(
-                    start_year, start_day, start_hour, 'x')
-            elif current_day == end_day:
-                # on end day, get all files up to end_hour
-                file_list = self.generate_file_names(
-                    start_year, end_day, 'a', end_hour)
-            else:
-                # on in-between day, get all files
-                file_list = self.generate_file_names(
-                    start_year, current_day, 'a', 'x')
-        return file_list
-
-    def download(self):
-        """ Download files within a specific time window from the FTP server. """
+        # on start day, get all files from start_hour, on end day, get all files up to end_hour
+        first_hour = start_hour if current_day == start_day else 0
+        last_hour = end_hour if current_day == end_day else 23
+        return self.__planner.choose(directory_listing, start_year, current_day, first_hour, last_hour)
+
+    def days(self) -> List[Tuple[int, int]]:
+        """ List every day touched by the time window, rolling over into new years as required.
+
+            Returns:
+                A list of (year, day-of-year) tuples in chronological order.
+        """
+        days = []
+        day = self.__start.date()
+        while day <= self.__end.date():
+            days.append((day.year, day.timetuple().tm_yday))
+            day += timedelta(days=1)
+        return days
+
+    def __hours(self, year: int, yday: int) -> Tuple[int, int]:
+        """ Get the first and last hour of a day that fall inside the time window. """
+        start_year, start_day, start_hour = self.deconstruct_datetime(self.__start)
+        end_year, end_day, end_hour = self.deconstruct_datetime(self.__end)
+        first_hour = start_hour if (year, yday) == (start_year, start_day) else 0
+        last_hour = end_hour if (year, yday) == (end_year, end_day) else 23
+        return first_hour, last_hour
+
+    def plan(self, ftp: FTP) -> FetchPlan:
+        """ Walk every day in the time window and work out which files need to be downloaded.
+
+            Directory listings come from the listing index, which only goes to the FTP
+            server for days it has no valid listing of. Each day is covered by either
+            the full day log or the hourly files, whichever is fewer bytes.
+
+            Args:
+                ftp: a logged in FTP session used to list the daily directories
+
+            Returns:
+                The plan of files to download in chronological order.
+        """
+        days = self.days()
+
+        # list every missing directory up front, sharing the work between the worker sessions
+        session = (lambda: ftp) if self.__workers == 1 or len(days) < 2 else self.__worker_session
+        self.__index.warm(session, self.__station, days, self.__workers)
+        if self.__workers > 1:
+            # the listing is done with its sessions, so the downloads can take them over
+            with self.__lock:
+                self.__idle = [((f.host, f.port), f) for f in self.__sessions]
+            self.__local.ftp = None
+
+        files = []
+        for year, yday in days:
+            first_hour, last_hour = self.__hours(year, yday)
+            directory_listing = self.__index.listing(
+                ftp, self.__station, year, yday)
+            daily = [name for name in self.__planner.daily_names(year, yday)
+                     if name in directory_listing]
+            hourly = self.__planner.hourly_names(
+                year, yday, first_hour, last_hour)
+            if daily and any(name in directory_listing for name in hourly):
+                # sizes are needed to choose between the two
+                directory_listing = self.__index.resolve_sizes(
+                    ftp, self.__station, year, yday, daily + hourly)
+
+            # generate files to download in current directory
+            file_list = self.__planner.choose(
+                directory_listing, year, yday, first_hour, last_hour)
+            for file in file_list:
+                if file not in directory_listing:
+                    print(
+                        "Warning: your end timestamp exceeds the logs that are currently available on the FTP server.")
+                    break
+                files.append(PlannedFile(
+                    year, yday, file, directory_listing[file]))
+        return FetchPlan(self.__station, files)
+
+    def __retrieve(self, ftp: FTP, file: PlannedFile, callback: Callable[[bytes], None]):
+        """ Transfer a file from the FTP server, handing each chunk to a callback as it arrives.
+
+            The number of bytes handed over so far is the checkpoint of the transfer:
+            when the connection drops, or the transfer ends before the size given by
+            the listing, it is restarted from there (REST) on a new session, so the
+            callback sees every byte exactly once. Every attempt is reported to the
+            concurrency window, and the transfer to the metrics.
+
+            Raises:
+                RuntimeError: the file could not be transferred within the retry budget,
+                    or it is larger than the listing says.
+        """
+        received = 0
+        first_byte = None
+
+        def write(data: bytes):
+            nonlocal received, first_byte
+            if first_byte is None:
+                first_byte = time.monotonic()
+            callback(data)
+            received += len(data)
+
+        command = 'RETR {}/{}'.format(DIRECTORY_PATH.format(file.year, file.yday, file.station), file.name)
+        began = time.monotonic()
+        for attempt in range(self.__retries + 1):
+            offset = received
+            try:
+                if attempt:
+                    self.metrics.count('retries')
+                    time.sleep(backoff_delay(attempt, self.__backoff))
+                    ftp = self.__replace_session(ftp)
+                started, first_byte = time.monotonic(), None
+                ftp.retrbinary(command, write, rest=received or None)
+            except TRANSIENT_ERRORS as e:
+                self.concurrency.congested()
+                error = e
+                continue
+            finally:
+                self.metrics.count('bytes_transferred', received - offset)
+            finished = time.monotonic()
+            self.concurrency.completed(received - offset, finished - started, (first_byte or finished) - started)
+            if file.size is None or received == file.size:
+                self.metrics.file(file.name, 'ftp', received, finished - began,
+                                  server=ftp.host, attempts=attempt + 1)
+                return
+            if received > file.size:
+                raise RuntimeError('{} is larger than the server listing says ({} > {} bytes).'.format(
+                    file.name, received, file.size))
+            error = 'transfer ended after {} of {} bytes'.format(received, file.size)
+        raise RuntimeError('Could not download {} after {} attempts: {}'.format(
+            file.name, self.__retries + 1, error))
+
+    @contextmanager
+    def __destination(self, file: PlannedFile) -> Iterator[BinaryIO]:
+        """ Open the local file a planned file is saved to, decompressing it on the fly if enabled. """
+        decompress = self.__decompress and file.rinex_name != file.name
+        path = os.path.join(self.__directory, file.rinex_name if decompress else file.name)
+        try:
+            with open(path, 'wb') as f:
+                if not decompress:
+                    yield f
+                    return
+                writer = DecompressingWriter(f, file.name, hatanaka=True)
+                yield writer
+                writer.close()
+        except BaseException:
+            # never leave a partial file behind for the merger
+            os.remove(path)
+            raise
+
+    def from_cache(self, file: PlannedFile) -> bool:
+        """ Copy a file from the cache into the specified directory, decompressing it if enabled.
+
+            Returns:
+                True if the file was served from the cache. Otherwise False.
+        """
+        if self.__cache is None:
+            return False
+        cached = self.__cache.get(
+            file.station, file.year, file.yday, file.name)
+        if cached is None:
+            return False
+        started = time.monotonic()
+        with open(cached, 'rb') as src, self.__destination(file) as dst:
+            shutil.copyfileobj(src, dst)
+        self.metrics.file(file.name, 'cache', os.path.getsize(cached), time.monotonic() - started)
+        return True
+
+    def fetch_file(self, ftp: FTP, file: PlannedFile):
+        """ Download a single file from the FTP server into the specified directory.
+
+            Files old enough to never change on the server are also stored (compressed)
+            in the cache while they are being downloaded. Transient failures are
+            retried, resuming the transfer where it stopped.
+
+            Args:
+                ftp: a logged in FTP session (replaced by a new one if it breaks)
+                file: the planned file to download
+
+            Raises:
+                RuntimeError: the file could not be downloaded. Nothing is left behind for it.
+        """
+        if self.__cache is None or not self.__cache.is_settled(file.year, file.yday):
+            with self.__destination(file) as dst:
+                self.__retrieve(ftp, file, dst.write)
+            return
+
+        with self.__cache.store(file.station, file.year, file.yday, file.name) as cached, \
+                self.__destination(file) as dst:
+            def write(data: bytes):
+                cached.write(data)
+                dst.write(data)
+            self.__retrieve(ftp, file, write)
+
+    def __fetch_in_window(self, file: PlannedFile) -> float:
+        """ Download a file on the calling worker thread's own FTP session once the concurrency window has room.
+
+            Sessions are handed between workers as they take files, and closed when
+            more are open than the window allows, so the server does not see more
+            sessions than the window for long. A server refusing another session
+            (e.g. 421 too many connections) shrinks the window to the transfers
+            already in flight, and the file is tried again after a while.
+
+            Returns:
+                How long the download took in seconds, not counting the wait for room.
+
+            Raises:
+                RuntimeError: no session could be opened within the retry budget.
+        """
+        for attempt in range(self.__retries + 1):
+            self.concurrency.acquire()
+            try:
+                ftp = self.__worker_session()
+            except error_temp as e:
+                self.concurrency.release()
+                # the server takes no more sessions than the transfers already in flight
+                self.concurrency.congested(self.concurrency.in_flight)
+                error = e
+                time.sleep(backoff_delay(attempt + 1, self.__backoff))
+                continue
+            started = time.monotonic()
+            try:
+                self.fetch_file(ftp, file)
+            finally:
+                self.__park_session()
+                self.concurrency.release()
+            return time.monotonic() - started
+        raise RuntimeError('Could not connect to download {} after {} attempts: {}'.format(
+            file.name, self.__retries + 1, error))
+
+    def __fetch_in_worker(self, file: PlannedFile, done: Callable[[PlannedFile], None]):
+        """ Download a file on the calling worker thread's own FTP session and report it done. """
+        self.__fetch_in_window(file)
+        done(file)
+
+    def __fetch_from_mirror(self, mirrors: MirrorManager, mirror: Mirror, done: Callable[[PlannedFile], None]):
+        """ Download files on a session with a mirror until there are none left for it, timing each transfer. """
+        self.__local.server = mirror.server
+        try:
+            while True:
+                file = mirrors.next(mirror)
+                if file is None:
+                    return
+                mirrors.record(mirror, file.size, self.__fetch_in_window(file))
+                done(file)
+        except BaseException:
+            # stop the other workers after their current file
+            mirrors.cancel()
+            raise
+
+    def __download_from_mirrors(self, files: List[PlannedFile], done: Callable[[PlannedFile], None]):
+        """ Download files over sessions with every reachable mirror at once. """
+        mirrors = MirrorManager(self.__servers, self.connect)
+        # the largest file, so the sample of every mirror is as long as it can be
+        sample = max(files, key=lambda f: f.size or 0, default=None)
+        mirrors.probe('{}/{}'.format(DIRECTORY_PATH.format(sample.year, sample.yday, sample.station), sample.name)
+                      if sample else None)
+        mirrors.split(files)
+        slots = mirrors.assign(self.__workers)
+        self.__keep_idle_sessions(slots)
+        with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+            futures = [pool.submit(self.__fetch_from_mirror, mirrors, mirror, done)
+                       for mirror in slots]
+            for future in futures:
+                future.result()
+
+    def fetch_plan(self) -> FetchPlan:
+        """ Connect to the FTP server and plan the download without transferring any files.
+
+            Returns:
+                The plan of files to download in chronological order.
+        """
+        self.__ftp_connect()
+        with self.__ftp as ftp:
+            self.validate(ftp)
+            try:
+                return self.plan(ftp)
+            finally:
+                self.__close_worker_sessions()
+
+    def download(self, plan: FetchPlan = None, on_file: Callable[[PlannedFile], None] = None) -> FetchPlan:
+        """ Download files within a specific time window from the FTP server.
+
+            Args:
+                plan: the files to download, of any station (default: plan the time window first)
+                on_file: called with every file once it is in the directory, from the thread that fetched it,
+                    e.g. to start merging a day as soon as all its files are in (default: nothing)
+
+            Returns:
+                The plan of files that were downloaded.
+        """
         self.__ftp_connect()
         with self.__ftp as ftp:
+            if plan is None:
+                self.validate(ftp)
             try:
-                if not self.is_valid_station_code():
-                    raise ValueError('Station code is not valid!')
-
-                start_year, start_day, start_hour = self.deconstruct_datetime(
-                    self.__start)
-                end_year, end_day, end_hour = self.deconstruct_datetime(
-                    self.__end)
-
-                # The following algorithm calculates the days between the start_date and end_date
-                # And downloads all the files between the two dates.
-                # To handle the case where you want to download files across multiple years
-                # We keep track of how many days are left in the year and once we've reached that limit
-                # We increment the year, set the current_day to the first day of the new year since we "rolling over" to a new year
-                # and continue the loop and until we have downloaded all the files necessary
-
-                day_count = 0
-                current_day = start_day  # day-of-year
-                days_between_dates = (
-                    self.__end.date() - self.__start.date()).days + 1
-                days_left_in_year = self.get_days_left_in_year(self.__start)
-
-                while start_year <= end_year:
-                    while day_count < days_between_dates and day_count < days_left_in_year:
-
-                        ftp.cwd(DIRECTORY_PATH.format(
-                            start_year, current_day, self.__station))
-                        directory_listing = ftp.nlst()
-
-                        # generate files to download in current directory
-                        file_list = self.create_file_list(
-                            directory_listing, current_day, start_year, start_day, start_hour, end_day, end_hour)
-
-                        # Download files from FTP and store them into specified directory(by default, will save in current folder)
-                        with IncrementalBar('Downloading files', max=len(file_list)) as bar:
-                            for file in file_list:
-                                original_extension = '.'.join(
-                                    file.split('.')[1:])
-                                if file in directory_listing:
-                                    ftp.retrbinary('RETR {}'.format(file),
-                                                   open(os.path.join(self.__directory, file), 'wb').write)
-                                    bar.next()
-                                else:
-                                    bar.finish()
-                                    print(
-                                        "Warning: your end timestamp exceeds the logs that are currently available on the FTP server.")
-                                    break
-
-                        current_day += 1
-                        day_count += 1
-
-                    start_year += 1
-                    current_day = 1  # set current day to first day of the new year ie. 01/01/YYYY
-                    # we have a specific function for getting days in year (rather than setting to 365) to automatically handle the case of leap years
-                    days_left_in_year = self.get_days_in_year(start_year)
-
-            except Exception as e:
-                raise e
+                if plan is None:
+                    plan = self.plan(ftp)
+
+                # Download files from FTP and store them into specified directory(by default, will save in current folder)
+                with IncrementalBar('Downloading files', max=len(plan)) as bar:
+                    def done(file: PlannedFile):
+                        with self.__lock:
+                            bar.next()
+                        if on_file is not None:
+                            on_file(file)
+
+                    # files already in the local cache never touch the network
+                    pending = []
+                    for file in plan:
+                        if self.from_cache(file):
+                            done(file)
+                        else:
+                            pending.append(file)
+
+                    if self.__workers == 1:
+                        # the planning session is replaced if it breaks
+                        self.__local.ftp = ftp
+                        for file in pending:
+                            self.fetch_file(self.__worker_session(), file)
+                            done(file)
+                        return plan
+                    if len(self.__servers) > 1:
+                        self.__download_from_mirrors(pending, done)
+                        return plan
+                    with ThreadPoolExecutor(max_workers=self.__workers) as pool:
+                        futures = [pool.submit(self.__fetch_in_worker, file, done)
+                                   for file in pending]
+                        try:
+                            for future in futures:
+                                future.result()
+                        except Exception:
+                            for future in futures:
+                                future.cancel()
+                            raise
+                return plan
+            finally:
+                self.__local.ftp = None
+                self.__close_worker_sessions()
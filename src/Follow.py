@@ -0,0 +1,313 @@
+"""Class responsible for keeping a merged RINEX file of a station up to date as new hourly files are published.
+
+Instead of downloading and merging a whole window again every hour, the
+follower keeps the merged file and a manifest next to it listing the hourly
+files (ssssdddh.yyo.gz) already in it. Every update lists the directory of the
+current day (and of the day before, just after midnight), downloads only the
+hourly files that are not in the manifest yet, and appends their epochs to the
+end of the merged file. The merged file can be trimmed to a retention window,
+which rewrites it, but only once it has grown an hour past the window.
+
+Hours are appended in order. An hour that has not been published yet holds
+back the hours after it, until it is so late (see GAP_WAIT) that it is taken
+to be missing for good, e.g. because the station was down.
+
+  Typical usage example:
+
+  foo = RinexFollower(station, 'nybp.obs', RinexDownloader, retention=timedelta(days=7))
+  foo.follow(interval=300)
+"""
+import json
+import os
+import tempfile
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import List, NamedTuple, Optional, Tuple
+from src.Downloader import TRANSIENT_ERRORS, RinexDownloader
+from src.Merger import merge_headers, merged_epochs
+from src.Metrics import Metrics
+from src.Output import atomic_write
+from src.Planner import FetchPlan, PlannedFile, RinexPlanner
+from src.Rinex import ObservationFile, ObservationWriter, RinexHeader, types_event
+from src.Runner import open_caches
+
+MANIFEST_SUFFIX = '.manifest.json'
+POLL_INTERVAL = 5 * 60  # seconds between updates
+GAP_WAIT = timedelta(hours=2)  # how long after its end a missing hour is waited for before it is skipped
+TRIM_SLACK = timedelta(hours=1)  # how far past the retention window the file grows before it is trimmed
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+class Manifest(NamedTuple):
+    """ What a merged file being followed holds.
+
+        Args:
+            station: 4-character site (base) identifier
+            decimate: interval in seconds the epochs are decimated to (None if not decimated)
+            files: (year, day-of-year, name) of the hourly files appended, from the day of the last epoch on
+            size: size of the merged file in bytes once the last update was done
+            first: time of the first epoch in the merged file
+            last: time of the last epoch in the merged file
+            types: observation types the last epochs are written with
+    """
+    station: str
+    decimate: Optional[float]
+    files: List[Tuple[int, int, str]]
+    size: int
+    first: datetime
+    last: datetime
+    types: Tuple[str, ...]
+
+
+def read_manifest(path: str) -> Manifest:
+    """ Read a manifest written by write_manifest. """
+    with open(path) as f:
+        manifest = json.load(f)
+    return Manifest(manifest['station'], manifest['decimate'], [tuple(f) for f in manifest['files']],
+                    manifest['size'], datetime.strptime(manifest['first'], TIME_FORMAT),
+                    datetime.strptime(manifest['last'], TIME_FORMAT), tuple(manifest['types']))
+
+
+def write_manifest(manifest: Manifest, path: str):
+    """ Write a manifest as JSON, replacing the file atomically. """
+    with atomic_write(path) as f:
+        json.dump(dict(manifest._asdict(), first=manifest.first.strftime(TIME_FORMAT),
+                       last=manifest.last.strftime(TIME_FORMAT)), f, indent=2)
+
+
+def listed(manifest: Manifest, done: List[Tuple[int, int, str]]) -> Manifest:
+    """ Add newly merged files to a manifest, keeping only those of the days from its last epoch on,
+        which are listed again.
+    """
+    last_day = (manifest.last.year, manifest.last.timetuple().tm_yday)
+    return manifest._replace(files=sorted(f for f in set(manifest.files + done) if f[:2] >= last_day))
+
+
+class RinexFollower:
+    """ Appends the newly published hours of a station to a merged file, every time it is updated.
+
+        Args:
+            station: 4-character site (base) identifier
+            output: path of the merged file, with its manifest alongside it (see MANIFEST_SUFFIX)
+            downloader: reference to RinexDownloader (uninitialised)
+            since: time of the first epoch of a new merged file (default: the start of the current day, UTC)
+            retention: how much data the merged file keeps, older epochs being trimmed (default: everything)
+            decimate: interval in seconds to decimate the merged file to (default: keep every epoch)
+            workers: largest number of concurrent FTP sessions used by the downloader (default: 1)
+            servers: list of (host, port) pairs of mirrors, tried in order (default: NOAA main and alternate servers)
+            cache_dir: directory of the persistent file and listing caches shared across runs (default: no cache)
+    """
+
+    def __init__(self, station: str, output: str, downloader: RinexDownloader, since: datetime = None,
+                 retention: timedelta = None, decimate: float = None, workers: int = 1,
+                 servers: List[Tuple[str, int]] = None, cache_dir: str = None):
+        if retention is not None and retention <= timedelta(0):
+            raise ValueError('Retention window must be positive.')
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+        self.__station = station.lower()
+        self.__output = output
+        self.__manifest_path = output + MANIFEST_SUFFIX
+        self.__downloader = downloader
+        today = datetime.utcnow()
+        self.__since = since or datetime(today.year, today.month, today.day)
+        self.__retention = retention
+        self.__decimate = decimate
+        self.__workers = workers
+        self.__servers = servers
+        self.__cache, self.__index, self.__catalog = open_caches(cache_dir)
+        self.__planner = RinexPlanner(station)
+        self.metrics = Metrics()  # everything recorded since the follower was created
+
+    def __recover(self) -> Optional[Manifest]:
+        """ Read the manifest, first undoing any update that was interrupted.
+
+            Returns:
+                The manifest, or None if nothing has been merged yet.
+
+            Raises:
+                ValueError: the merged file was not made by a follower with the same settings.
+        """
+        if not os.path.exists(self.__manifest_path):
+            if os.path.exists(self.__output):
+                raise ValueError('{} already exists and has no manifest.'.format(self.__output))
+            return None
+        if not os.path.exists(self.__output):
+            return None  # deleted, so it is started again
+        manifest = read_manifest(self.__manifest_path)
+        if manifest.station != self.__station or manifest.decimate != self.__decimate:
+            raise ValueError('{} follows {} decimated to {}, not {} decimated to {}.'.format(
+                self.__output, manifest.station, manifest.decimate, self.__station, self.__decimate))
+        size = os.path.getsize(self.__output)
+        if size > manifest.size:
+            # epochs appended by an update that did not finish, they are appended again
+            with open(self.__output, 'r+b') as f:
+                f.truncate(manifest.size)
+        elif size < manifest.size:
+            # trimmed by an update that did not finish
+            with ObservationFile(self.__output) as f:
+                manifest = manifest._replace(size=size, first=f.time(0))
+            write_manifest(manifest, self.__manifest_path)
+        return manifest
+
+    def __poll(self, ftp, manifest: Optional[Manifest], after: datetime, now: datetime) -> List[PlannedFile]:
+        """ List the days from the last epoch on, and find the hourly files to append next, in order.
+
+            Args:
+                ftp: a logged in FTP session
+                manifest: the manifest (None if nothing has been merged yet)
+                after: time the hours must end after
+                now: current time, UTC
+        """
+        done = set(manifest.files) if manifest else set()
+        files = []
+        day = datetime(after.year, after.month, after.day)
+        while day <= now:
+            year, yday = day.year, day.timetuple().tm_yday
+            # listed every time, unlike when planning a window, as new hours keep arriving
+            listing = self.__index.fetch(ftp, self.__station, year, yday)
+            for hour, name in enumerate(self.__planner.hourly_names(year, yday, 0, 23)):
+                begin = day + timedelta(hours=hour)
+                if begin + timedelta(hours=1) <= after or (year, yday, name) in done:
+                    continue
+                if begin >= now:
+                    return files
+                if name not in listing:
+                    if begin + timedelta(hours=1) + GAP_WAIT > now:
+                        return files  # not published yet, the hours after it wait for it
+                    continue
+                files.append(PlannedFile(year, yday, name, listing[name]))
+            day += timedelta(days=1)
+        return files
+
+    def update(self, now: datetime = None) -> int:
+        """ Download the hourly files published since the last update and append their epochs.
+
+            Args:
+                now: current time, UTC, hours starting after it are not looked for (default: the system clock)
+
+            Returns:
+                The number of records appended.
+
+            Raises:
+                ValueError: the station is not valid, or the merged file was made with other settings.
+                RuntimeError: files could not be downloaded.
+        """
+        now = now or datetime.utcnow()
+        manifest = self.__recover()
+        after = manifest.last if manifest else self.__since
+        with tempfile.TemporaryDirectory() as temp_dir:
+            downloader = self.__downloader(
+                self.__station, after, now, temp_dir, workers=self.__workers, servers=self.__servers,
+                cache=self.__cache, index=self.__index, catalog=self.__catalog, decompress=True,
+                metrics=self.metrics)
+            with self.metrics.stage('plan'), downloader.connect() as ftp:
+                if manifest is None:
+                    downloader.validate(ftp)
+                files = self.__poll(ftp, manifest, after, now)
+            if not files:
+                return 0
+            with self.metrics.stage('download'):
+                downloader.download(FetchPlan(self.__station, files))
+            with self.metrics.stage('merge'), ExitStack() as stack:
+                inputs = [stack.enter_context(ObservationFile(os.path.join(temp_dir, f.rinex_name)))
+                          for f in files]
+                written, manifest = self.__append(inputs, manifest, [(f.year, f.yday, f.name) for f in files])
+        if manifest is None:
+            return 0  # the files had no epochs after the start
+        if self.__retention is not None and manifest.last - manifest.first > self.__retention + TRIM_SLACK:
+            with self.metrics.stage('trim'):
+                self.__trim(manifest)
+        return written
+
+    def __append(self, inputs: List[ObservationFile], manifest: Optional[Manifest],
+                 done: List[Tuple[int, int, str]]) -> Tuple[int, Optional[Manifest]]:
+        """ Append the epochs of new files after the last epoch of the merged file, creating it if needed,
+            and write the manifest describing the merged file after them.
+
+            A new merged file only replaces the output once its manifest is written, so an update interrupted
+            in between leaves a manifest without a merged file, which is started again (see __recover).
+
+            Args:
+                inputs: the new files
+                manifest: the manifest (None if nothing has been merged yet)
+                done: (year, day-of-year, name) of the new files
+
+            Returns:
+                The number of records appended, and the manifest.
+        """
+        start = self.__since if manifest is None else manifest.last + timedelta(microseconds=1)
+        epochs = merged_epochs([f.epochs(start, None, self.__decimate) for f in inputs],
+                               start, None, self.__decimate)
+        first = next(epochs, None)
+        if first is None:
+            if manifest is not None:
+                manifest = listed(manifest, done)
+                write_manifest(manifest, self.__manifest_path)
+            return 0, manifest
+        headers = [f.header for f in inputs]
+        if manifest is None:
+            header = merge_headers(headers, self.__decimate).with_first_epoch(first.time)
+            manifest = Manifest(self.__station, self.__decimate, [], 0, first.time, first.time, header.types)
+            output = atomic_write(self.__output, encoding='latin-1')
+            prefix = ''.join(line + '\n' for line in header.lines)
+        else:
+            types = list(manifest.types)
+            types += [t for h in headers for t in h.types if t not in types]
+            with open(self.__output, encoding='latin-1') as f:
+                header = RinexHeader.read(f).with_types(tuple(types))
+            # new observation types are announced by an event, the header stays as it is
+            output = open(self.__output, 'a', encoding='latin-1')
+            prefix = types_event(header.types) if len(types) > len(manifest.types) else ''
+        written = 0
+        last = manifest.last
+        with output as f:
+            f.write(prefix)
+            writer = ObservationWriter(f, header)
+            for epoch in chain([first], epochs):
+                writer.write(epoch)
+                written += 1
+                last = max(last, epoch.time)
+            f.flush()
+            os.fsync(f.fileno())
+            manifest = listed(manifest._replace(size=os.fstat(f.fileno()).st_size, last=last, types=header.types),
+                              done)
+            write_manifest(manifest, self.__manifest_path)
+        return written, manifest
+
+    def __trim(self, manifest: Manifest):
+        """ Drop the epochs older than the retention window, rewriting the merged file. """
+        cut = manifest.last - self.__retention
+        with atomic_write(self.__output, 'wb') as f, ObservationFile(self.__output) as merged:
+            first, _ = merged.window(cut)
+            header = merged.header.with_types(merged.types_at(first)).with_first_epoch(merged.time(first))
+            f.write(''.join(line + '\n' for line in header.lines).encode('latin-1'))
+            with merged.slice(cut) as records:
+                f.write(records)
+            first = merged.time(first)
+        write_manifest(manifest._replace(size=os.path.getsize(self.__output), first=first),
+                       self.__manifest_path)
+
+    def follow(self, interval: float = POLL_INTERVAL, updates: int = None):
+        """ Update the merged file at regular intervals, until interrupted.
+
+            Failures to reach the server are reported and retried at the next update.
+
+            Args:
+                interval: seconds between the start of one update and the next (default: 5 minutes)
+                updates: number of updates to do before returning (default: no limit)
+        """
+        done = 0
+        while updates is None or done < updates:
+            started = time.monotonic()
+            try:
+                written = self.update()
+                if written:
+                    print('Appended {} records to {}.'.format(written, self.__output))
+            except TRANSIENT_ERRORS + (RuntimeError,) as e:
+                print('Warning: update failed, retrying in {:.0f} seconds: {}'.format(interval, e))
+            done += 1
+            if updates is None or done < updates:
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -0,0 +1,998 @@
+"""Class responsible for decoding and encoding Hatanaka compressed (Compact RINEX) observation files.
+
+Implements version 1.0 of the Compact RINEX format, which the NOAA archive uses
+for its RINEX 2 daily logs (ssssddd0.yyd), and produces the same output as the
+reference CRX2RNX tool byte for byte. Epoch lines and data flags are stored as
+text differences from the previous epoch, and every observation as a difference
+of up to a given order. The decoder reads a block of epochs at a time and sums
+the differences of every satellite back up at once, with cumulative sums along
+the arcs in NumPy arrays (see AccumulationTable).
+
+The encoder does the reverse like the reference RNX2CRX tool, whose output it
+matches byte for byte apart from the program and date line. It differences the
+observations of all satellites of an epoch at once, in NumPy arrays holding the
+arcs of every satellite (see DifferenceTable).
+
+  Typical usage example:
+
+  foo = CRXDecoder()
+  with open(rinex_file, 'wb') as f:
+      for chunk in chunks:
+          f.write(foo.decompress(chunk))
+      f.write(foo.flush())
+"""
+import os
+from datetime import datetime
+from itertools import chain
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+CRX_VERSION = '1.0'
+CRX_VERSION_LABEL = 'CRINEX VERS   / TYPE'
+CRX_FORMAT = 'COMPACT RINEX FORMAT'
+CRX_PROGRAM_LABEL = 'CRINEX PROG / DATE'
+CRX_PROGRAM = 'grab_data'
+CRX_DATE_FORMAT = '%d-%b-%y %H:%M'
+RINEX_VERSION_LABEL = 'RINEX VERSION / TYPE'
+TYPES_LABEL = '# / TYPES OF OBSERV'
+END_OF_HEADER_LABEL = 'END OF HEADER'
+LABEL_COLUMN = 60
+EPOCH_FLAG_COLUMN = 28
+SATELLITE_COLUMN = 32
+SATELLITES_PER_LINE = 12
+FIELDS_PER_LINE = 5
+ARC_START = '&'  # marks the start of a new arc, both for epochs and values
+ARC_ORDER = 3  # order of the differences the encoder takes
+OBSERVATION_UNIT = 10 ** 5  # observations (in thousandths) are differenced in two parts split at this unit
+CLOCK_UNIT = 10 ** 8  # and clock offsets (in nanoseconds) at this one
+CYCLE_SLIP = 10 ** 5  # a difference whose upper part is larger than this starts a new arc
+CLOCK_COLUMN = 68
+DOS_EOF = '\032'
+CHUNK_SIZE = 1024 * 1024
+BLOCK_EPOCHS = 256  # epochs the encoder differences and the decoder accumulates at once
+MAX_ARC_ORDER = 9  # the order of an arc is written as a single digit
+
+# (arc order, current order, differences from order 0 up to the current order)
+Arc = Tuple[int, int, List[int]]
+# (current order, upper parts and lower parts of the differences from order 0 up to the current order)
+DifferenceArc = Tuple[int, List[int], List[int]]
+
+
+def repair(old: str, diff: str) -> str:
+    """ Apply a text difference to the previous version of a line.
+
+        A space keeps the old character, an ampersand stands for a space and any
+        other character replaces the old one. Characters past the end of the
+        old line are appended.
+
+        Args:
+            old: the line at the previous epoch
+            diff: the difference to apply
+
+        Returns:
+            The line at the current epoch.
+    """
+    n = min(len(old), len(diff))
+    repaired = [o if d == ' ' else ' ' if d == ARC_START else d
+                for o, d in zip(old[:n], diff[:n])]
+    return ''.join(repaired) + old[n:] + diff[n:].replace(ARC_START, ' ')
+
+
+def text_difference(old: str, new: str) -> str:
+    """ Take the text difference of a line from its previous version, the reverse of repair.
+
+        Unchanged characters become spaces, characters changed to a space become
+        an ampersand, and so do the characters of the old line past the end of
+        the new one. Trailing blanks are dropped.
+
+        Args:
+            old: the line at the previous epoch
+            new: the line at the current epoch
+
+        Returns:
+            The difference to write.
+    """
+    n = min(len(old), len(new))
+    diff = [' ' if o == c else ARC_START if c == ' ' else c
+            for o, c in zip(old[:n], new[:n])]
+    removed = ''.join(' ' if o == ' ' else ARC_START for o in old[n:])
+    return (''.join(diff) + removed + new[n:]).rstrip(' ')
+
+
+def chop_blank(line: str) -> str:
+    """ Strip trailing blanks from a line, keeping the first character like CRX2RNX does. """
+    return line[:1] + line[1:].rstrip(' ')
+
+
+def format_observation(value: int) -> str:
+    """ Format an observation held in thousandths as an F14.3 field.
+
+        Like CRX2RNX, values smaller than one are written without a leading
+        zero, e.g. .123 and -.123.
+
+        Raises:
+            ValueError: the value does not fit the field.
+    """
+    integer, fraction = divmod(abs(value), 1000)
+    text = '{}{}.{:03d}'.format('-' if value < 0 else '', integer or '', fraction)
+    if len(text) > 14:
+        raise ValueError('Observation {} does not fit in a RINEX data field.'.format(value))
+    return text.rjust(14)
+
+
+def format_clock(value: int) -> str:
+    """ Format a receiver clock offset held in nanoseconds as an F12.9 field, without a leading zero.
+
+        Raises:
+            ValueError: the value does not fit the field.
+    """
+    integer, fraction = divmod(abs(value), 10 ** 9)
+    text = '{}{}.{:09d}'.format('-' if value < 0 else '', integer or '', fraction)
+    if len(text) > 12:
+        raise ValueError('Clock offset {} does not fit in a RINEX epoch line.'.format(value))
+    return text.rjust(12)
+
+
+def accumulate(difference: str, previous: Optional[Arc]) -> Arc:
+    """ Recover a value from its difference with the previous epochs.
+
+        Args:
+            difference: the difference as written in the file, 'k&value' when a new arc of order k starts
+            previous: state of the arc at the previous epoch (None if there was no value)
+
+        Returns:
+            The state of the arc at this epoch. The recovered value is the last difference.
+    """
+    if difference[1:2] == ARC_START:
+        arc_order, order, before = int(difference[0]), -1, []
+        difference = difference[2:]
+    elif previous is None:
+        raise ValueError('Difference {} does not belong to an arc.'.format(difference))
+    else:
+        arc_order, order, before = previous
+    values = [int(difference)]
+    if order < arc_order:
+        # not enough epochs yet for the full order of differences
+        order += 1
+        for k in range(order):
+            values.append(values[k] + before[k])
+    else:
+        for k in range(order):
+            values.append(values[k] + before[k + 1])
+    return arc_order, order, values
+
+
+def format_observations(values: np.ndarray) -> np.ndarray:
+    """ Format observations held in thousandths as F14.3 fields, all at once, like format_observation.
+
+        Args:
+            values: the observations
+
+        Returns:
+            The characters of the fields, with one more dimension of 14 characters than the values.
+
+        Raises:
+            ValueError: a value does not fit the field.
+    """
+    text = np.full(values.shape + (14,), ord(' '), dtype=np.uint8)
+    magnitude = np.abs(values)
+    fraction = magnitude % 1000
+    text[..., 10] = ord('.')
+    for position in (13, 12, 11):
+        text[..., position] = ord('0') + fraction % 10
+        fraction //= 10
+    # the integer part is written without a leading zero
+    integer = magnitude // 1000
+    digits = np.zeros(values.shape, dtype=np.intp)
+    for position in range(9, -1, -1):
+        more = integer > 0
+        text[more, position] = ord('0') + integer[more] % 10
+        digits += more
+        integer //= 10
+    negative = values < 0
+    wide = (integer > 0) | negative & (digits > 9)
+    if wide.any():
+        raise ValueError('Observation {} does not fit in a RINEX data field.'.format(values[wide].flat[0]))
+    text[negative, 9 - digits[negative]] = ord('-')
+    return text
+
+
+def split_value(value: int, unit: int) -> Tuple[int, int]:
+    """ Split a value into its upper and lower parts at a unit, both with the sign of the value. """
+    upper = abs(value) // unit
+    if value < 0:
+        upper = -upper
+    return upper, value - upper * unit
+
+
+def difference(value: int, previous: Optional[DifferenceArc], unit: int,
+               limit: Optional[int] = None) -> Tuple[str, DifferenceArc]:
+    """ Take the difference of a value from the previous epochs, the reverse of accumulate.
+
+        Like RNX2CRX, the upper and lower parts of the value are differenced
+        separately, so a jump can be told apart from a large value.
+
+        Args:
+            value: the value at this epoch
+            previous: state of the arc at the previous epoch (None to start a new arc)
+            unit: unit the value is split at
+            limit: largest upper part of the difference before a new arc is started (default: no limit)
+
+        Returns:
+            The difference as written in the file and the state of the arc at this epoch.
+    """
+    upper, lower = split_value(value, unit)
+    if previous is not None:
+        order, before_upper, before_lower = previous
+        order = min(order + 1, ARC_ORDER)
+        uppers, lowers = [upper], [lower]
+        for k in range(order):
+            uppers.append(uppers[k] - before_upper[k])
+            lowers.append(lowers[k] - before_lower[k])
+        if limit is None or abs(uppers[order]) <= limit:
+            return str(uppers[order] * unit + lowers[order]), (order, uppers, lowers)
+    return '{}{}{}'.format(ARC_ORDER, ARC_START, value), (0, [upper], [lower])
+
+
+class DifferenceTable:
+    """ Arcs of the observations of every satellite, differenced a block of epochs at a time.
+
+        Holds the state of the arcs of difference for every satellite and
+        observation type at once: the order each arc has reached and the upper
+        and lower parts of its last values. The observations of a whole block of
+        epochs are differenced together with array operations along time, and
+        give the same differences as difference one value at a time: the
+        difference of order k is the k-th backward difference of the values of
+        the arc, and the order grows by one every epoch up to ARC_ORDER.
+
+        Args:
+            types: number of observation types
+    """
+
+    def __init__(self, types: int):
+        self.types = types
+        self.__rows: Dict[str, int] = {}  # satellite -> row of its arcs
+        self.__orders = np.full((0, types), -1, dtype=np.int64)  # at the last epoch, -1 where there is no arc
+        # upper and lower parts of the values of the last ARC_ORDER epochs, the last epoch last
+        self.__uppers = np.zeros((ARC_ORDER, 0, types), dtype=np.int64)
+        self.__lowers = np.zeros((ARC_ORDER, 0, types), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+    def row(self, satellite: str) -> int:
+        """ Get the row of the arcs of a satellite, adding one for a satellite not seen before. """
+        row = self.__rows.get(satellite)
+        if row is None:
+            row = self.__rows[satellite] = len(self.__rows)
+            self.__orders = np.concatenate([self.__orders, np.full((1, self.types), -1, np.int64)])
+            self.__uppers = np.concatenate([self.__uppers, np.zeros((ARC_ORDER, 1, self.types), np.int64)], axis=1)
+            self.__lowers = np.concatenate([self.__lowers, np.zeros((ARC_ORDER, 1, self.types), np.int64)], axis=1)
+        return row
+
+    def difference(self, values: np.ndarray, present: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Take the differences of the observations of a block of epochs from the epochs before them.
+
+            Arcs end where an observation is blank or its satellite is not in an
+            epoch, and start again, like in difference, where the difference of
+            the upper parts is larger than CYCLE_SLIP.
+
+            Args:
+                values: observations in thousandths, indexed by epoch, row (see row) and type
+                present: False where an observation is blank or its satellite is not in the epoch
+
+            Returns:
+                The differences, and True where a new arc starts and the value itself is written instead.
+        """
+        epochs = np.arange(len(values))[:, None, None]
+        upper = np.abs(values) // OBSERVATION_UNIT
+        upper = np.where(values < 0, -upper, upper)
+        lower = values - upper * OBSERVATION_UNIT
+        # the differences of every order at every epoch, from the values of the epochs before it
+        uppers, lowers = [np.concatenate([self.__uppers, upper])], [np.concatenate([self.__lowers, lower])]
+        for _ in range(ARC_ORDER):
+            uppers.append(np.diff(uppers[-1], axis=0))
+            lowers.append(np.diff(lowers[-1], axis=0))
+        uppers = np.stack([u[ARC_ORDER - k:] for k, u in enumerate(uppers)])
+        lowers = np.stack([d[ARC_ORDER - k:] for k, d in enumerate(lowers)])
+        # arcs start where an observation follows a blank, or where they were restarted
+        before = np.concatenate([(self.__orders >= 0)[None], present[:-1]])
+        continued = np.where(before[0] & present[0], -1 - self.__orders, 0)
+        starts = present & ~before
+        restarts = np.zeros_like(present)
+        while True:
+            # epochs not in an arc started in the block are at least ARC_ORDER epochs into theirs
+            first = np.where(starts | restarts, epochs, -ARC_ORDER - 1)
+            first[0] = np.where(starts[0] | restarts[0], 0, continued)
+            orders = np.minimum(epochs - np.maximum.accumulate(first, axis=0), ARC_ORDER)
+            upper = np.take_along_axis(uppers, orders[None], axis=0)[0]
+            slips = present & (orders > 0) & (np.abs(upper) > CYCLE_SLIP)
+            if not slips.any():
+                break
+            # a restart changes the orders of the epochs after it, so only the first one of every arc is kept
+            restarts |= slips & (np.cumsum(slips, axis=0) == 1)
+        lower = np.take_along_axis(lowers, orders[None], axis=0)[0]
+        new = present & (orders == 0)
+        self.__orders = np.where(present[-1], orders[-1], -1)
+        self.__uppers = np.concatenate([self.__uppers, uppers[0]])[-ARC_ORDER:]
+        self.__lowers = np.concatenate([self.__lowers, lowers[0]])[-ARC_ORDER:]
+        return upper * OBSERVATION_UNIT + lower, new
+
+
+class AccumulationTable:
+    """ Arcs of the observations of every satellite, accumulated a block of epochs at a time.
+
+        The reverse of DifferenceTable. Holds the state of the arcs for every
+        satellite and observation type at once: the order of each arc, the order
+        it has reached, and its differences of every order at the last epoch.
+        The differences of a whole block of epochs are summed back up together
+        with cumulative sums along time, and give the same values as accumulate
+        one value at a time: the difference of order k - 1 at an epoch is the sum
+        of the differences of order k along the arc since that order was reached.
+
+        Args:
+            types: number of observation types
+    """
+
+    def __init__(self, types: int):
+        self.types = types
+        self.__rows: Dict[str, int] = {}  # satellite -> row of its arcs
+        self.__arc_orders = np.zeros((0, types), dtype=np.int64)
+        self.__orders = np.full((0, types), -1, dtype=np.int64)  # at the last epoch, -1 where there is no arc
+        # differences of every order at the last epoch
+        self.__differences = np.zeros((MAX_ARC_ORDER + 1, 0, types), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+    def row(self, satellite: str) -> int:
+        """ Get the row of the arcs of a satellite, adding one for a satellite not seen before. """
+        row = self.__rows.get(satellite)
+        if row is None:
+            row = self.__rows[satellite] = len(self.__rows)
+            self.__arc_orders = np.concatenate([self.__arc_orders, np.zeros((1, self.types), np.int64)])
+            self.__orders = np.concatenate([self.__orders, np.full((1, self.types), -1, np.int64)])
+            self.__differences = np.concatenate(
+                [self.__differences, np.zeros((MAX_ARC_ORDER + 1, 1, self.types), np.int64)], axis=1)
+        return row
+
+    def accumulate(self, differences: np.ndarray, present: np.ndarray, arc_orders: np.ndarray) -> np.ndarray:
+        """ Recover the observations of a block of epochs from their differences.
+
+            Args:
+                differences: differences as written in the file, indexed by epoch, row (see row) and type,
+                    the value itself where a new arc starts
+                present: False where an observation is blank or its satellite is not in the epoch
+                arc_orders: order of the new arc where one starts, -1 elsewhere
+
+            Returns:
+                The observations.
+
+            Raises:
+                ValueError: a difference does not belong to an arc.
+        """
+        # row 0 stands for the last epoch before the block
+        epochs = np.arange(len(differences) + 1)[:, None, None]
+        starts = arc_orders >= 0
+        continued = self.__orders >= 0
+        lost = present & ~starts & ~np.concatenate([continued[None], present[:-1]])
+        if lost.any():
+            raise ValueError('Difference {} does not belong to an arc.'.format(differences[lost][0]))
+        in_arc = np.concatenate([continued[None], present])
+        # epoch the arc started at, before the block for an arc continued from it
+        first = np.concatenate([np.where(continued, -self.__orders, -MAX_ARC_ORDER - 1)[None],
+                                np.where(starts, epochs[1:], -MAX_ARC_ORDER - 1)])
+        first = np.maximum.accumulate(first, axis=0)
+        begin = np.maximum(first, 0)
+        arc_orders = np.take_along_axis(np.concatenate([self.__arc_orders[None], arc_orders]), begin, axis=0)
+        orders = np.minimum(epochs - first, arc_orders)
+        values = np.concatenate([np.zeros_like(differences[:1]), differences])
+        last = np.zeros_like(self.__differences)
+        np.put_along_axis(last, np.maximum(orders[-1], 0)[None], values[-1][None], axis=0)
+        for order in range(int(arc_orders[in_arc].max(initial=0)), 0, -1):
+            # the differences of one order lower, summed along the arcs from where they reached it
+            summed = in_arc & (orders >= order - 1) & (arc_orders >= order)
+            values[0] = self.__differences[order - 1]
+            sums = np.cumsum(np.where(summed, values, 0), axis=0)
+            sums = np.concatenate([np.zeros_like(sums[:1]), sums])
+            values = np.where(summed, sums[1:] - np.take_along_axis(sums, begin, axis=0), values)
+            last[order - 1] = np.where(summed[-1], values[-1], last[order - 1])
+        self.__arc_orders = arc_orders[-1]
+        self.__orders = np.where(in_arc[-1], orders[-1], -1)
+        self.__differences = last
+        return values[1:]
+
+
+def read_observation(field: str) -> int:
+    """ Read an F14.3 observation field into thousandths. """
+    return int(field.replace('.', '', 1))
+
+
+class CRXDecoder:
+    """ Incrementally decodes Compact RINEX 1.0 data into RINEX 2 observation data. """
+
+    def __init__(self):
+        self.__pending = b''
+        self.__next: Callable[[str], List[str]] = self.__crinex_version
+        self.__types = 0
+        self.__events = 0  # special records left in the current event
+        self.__epoch = ''
+        self.__satellites: List[str] = []
+        self.__clock: Optional[Arc] = None
+        self.__clock_arc: Optional[Arc] = None
+        self.__record: List[str] = []  # data lines of the current epoch read so far
+        # epoch line, clock offset, satellites and data lines of the epochs read and not decoded yet
+        self.__block: List[Tuple[str, Optional[int], List[str], List[str]]] = []
+        self.__table: Optional[AccumulationTable] = None  # arcs of the observations of every satellite
+        self.__flags = np.zeros((0, 0), dtype=np.uint8)  # data flags of every row of the table at the last epoch
+        self.__finished = False
+
+    def decode_line(self, line: str) -> List[str]:
+        """ Decode the next line of Compact RINEX.
+
+            Args:
+                line: the line, with or without its line break
+
+            Returns:
+                The RINEX lines it completes, each ending in a line break.
+        """
+        if self.__finished:
+            return []
+        return self.__next(line.rstrip('\r\n'))
+
+    def decompress(self, data: bytes) -> bytes:
+        """ Decode the next chunk of Compact RINEX data.
+
+            Args:
+                data: Compact RINEX bytes
+
+            Returns:
+                The RINEX bytes that could be produced so far.
+        """
+        lines = (self.__pending + data).split(b'\n')
+        self.__pending = lines.pop()
+        output = []
+        for line in lines:
+            output.extend(self.decode_line(line.decode('latin-1')))
+        return ''.join(output).encode('latin-1')
+
+    def flush(self) -> bytes:
+        """ Signal the end of the data and return whatever is left.
+
+            Raises:
+                ValueError: the data ended in the middle of the header or an epoch.
+        """
+        output = self.decode_line(self.__pending.decode('latin-1')) if self.__pending else []
+        self.__pending = b''
+        if not self.__finished and self.__next not in (self.__epoch_line, self.__event_end):
+            raise ValueError('Compact RINEX data ended in the middle of a record.')
+        return ''.join(output + self.__decode_block()).encode('latin-1')
+
+    def __crinex_version(self, line: str) -> List[str]:
+        if line[LABEL_COLUMN:].startswith(CRX_VERSION_LABEL) and line.startswith('3.0'):
+            raise ValueError('Compact RINEX version 3.0 is not supported.')
+        if not (line.startswith(CRX_VERSION) and line[LABEL_COLUMN:].startswith(CRX_VERSION_LABEL)):
+            raise ValueError('Not Compact RINEX data.')
+        self.__next = self.__crinex_program
+        return []
+
+    def __crinex_program(self, line: str) -> List[str]:
+        self.__next = self.__rinex_version
+        return []
+
+    def __rinex_version(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        if not line[LABEL_COLUMN:].startswith(RINEX_VERSION_LABEL) or line[5:6] != '2':
+            raise ValueError('Compact RINEX 1.0 data must hold RINEX version 2 observations.')
+        self.__next = self.__header
+        return [line + '\n']
+
+    def __header(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        self.__read_types(line)
+        if line[LABEL_COLUMN:].startswith(END_OF_HEADER_LABEL):
+            self.__next = self.__epoch_line
+        return [line + '\n']
+
+    def __read_types(self, line: str):
+        """ Pick up the number of observation types from a header line that starts a list of them. """
+        if line[LABEL_COLUMN:].startswith(TYPES_LABEL) and line[5:6] != ' ':
+            self.__types = int(line[:6])
+
+    def __epoch_line(self, line: str) -> List[str]:
+        if line.startswith(DOS_EOF):
+            self.__finished = True
+            return self.__decode_block()
+        output = []
+        if line.startswith(ARC_START):
+            line = ' ' + line[1:]
+            if line[EPOCH_FLAG_COLUMN:EPOCH_FLAG_COLUMN + 1] not in ('0', '1'):
+                return self.__event(line)
+            # every arc starts again
+            output = self.__decode_block()
+            self.__epoch = ''
+            self.__satellites = []
+            self.__table = None
+        epoch = repair(self.__epoch, line)
+        if (epoch[:1] != ' ' or len(epoch) < 29 or epoch[26:28] != '  '
+                or not epoch[EPOCH_FLAG_COLUMN].isdigit()):
+            raise ValueError('Invalid epoch line: {}'.format(line))
+        self.__epoch = chop_blank(epoch)
+        count = int(self.__epoch[29:SATELLITE_COLUMN])
+        self.__satellites = [self.__epoch[SATELLITE_COLUMN + 3 * i:SATELLITE_COLUMN + 3 * (i + 1)]
+                             for i in range(count)]
+        self.__next = self.__clock_line
+        return output
+
+    def __event(self, line: str) -> List[str]:
+        """ Copy an event record (epoch flag above 1) and the special records that follow it. """
+        line = chop_blank(line)
+        output = self.__decode_block()
+        self.__events = int(line[29:SATELLITE_COLUMN].strip() or 0)
+        self.__next = self.__event_record if self.__events else self.__event_end
+        return output + [line + '\n']
+
+    def __event_record(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        self.__read_types(line)
+        self.__events -= 1
+        if not self.__events:
+            self.__next = self.__event_end
+        return [line + '\n']
+
+    def __event_end(self, line: str) -> List[str]:
+        # an event is always followed by a new arc of epochs
+        if (not line.startswith(ARC_START) or len(line) < 29
+                or not line[EPOCH_FLAG_COLUMN].isdigit()):
+            raise ValueError('Expected the start of a new arc after an event: {}'.format(line))
+        self.__next = self.__epoch_line
+        return self.__epoch_line(line)
+
+    def __clock_line(self, line: str) -> List[str]:
+        if not line:
+            self.__clock = None
+            if self.__clock_arc is not None:
+                # the differences start again the next time the clock is given
+                self.__clock_arc = (self.__clock_arc[0], -1, [])
+        else:
+            if line[1:2] == ARC_START:
+                self.__clock_arc = None
+            self.__clock = self.__clock_arc = accumulate(line, self.__clock_arc)
+        self.__record = []
+        self.__next = self.__data_line
+        if not self.__satellites:
+            return self.__keep_epoch()
+        return []
+
+    def __data_line(self, line: str) -> List[str]:
+        self.__record.append(line)
+        if len(self.__record) == len(self.__satellites):
+            return self.__keep_epoch()
+        return []
+
+    def __keep_epoch(self) -> List[str]:
+        """ Keep an epoch once all its data lines were read, decoding the epochs kept once there are enough. """
+        clock = self.__clock[2][-1] if self.__clock is not None else None
+        self.__block.append((self.__epoch, clock, self.__satellites, self.__record))
+        self.__next = self.__epoch_line
+        if len(self.__block) == BLOCK_EPOCHS:
+            return self.__decode_block()
+        return []
+
+    def __decode_block(self) -> List[str]:
+        """ Write out the epochs kept, summing their differences back up all at once. """
+        records, self.__block = self.__block, []
+        if not records:
+            return []
+        types = self.__types
+        if self.__table is None or self.__table.types != types:
+            self.__table = AccumulationTable(types)
+            self.__flags = np.zeros((0, 2 * types), dtype=np.uint8)
+        counts = []  # number of satellites of every epoch
+        rows = []  # row of the arcs of every satellite of every epoch
+        fields = []  # differences of every satellite of every epoch
+        flags = []  # differences of the data flags of every satellite of every epoch
+        for _, _, satellites, lines in records:
+            counts.append(len(satellites))
+            rows += [self.__table.row(satellite) for satellite in satellites]
+            for line in lines:
+                parts = line.split(' ', types)
+                if len(parts) > types:
+                    flags.append(parts.pop()[:2 * types].ljust(2 * types))
+                else:
+                    flags.append(' ' * 2 * types)
+                    parts += [''] * (types - len(parts))
+                fields += parts
+        differences, present, arc_orders = self.__read_differences(fields, len(rows))
+
+        # the differences of every epoch laid out by row of the table, for the arcs to be followed along time
+        epochs, rows = np.repeat(np.arange(len(records)), counts), np.array(rows, dtype=np.intp)
+        shape = (len(records), len(self.__table), types)
+        block_differences, block_present = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=bool)
+        block_orders = np.full(shape, -1, dtype=np.int64)
+        block_differences[epochs, rows] = differences
+        block_present[epochs, rows] = present
+        block_orders[epochs, rows] = arc_orders
+        values = self.__table.accumulate(block_differences, block_present, block_orders)[epochs, rows]
+
+        # a data flag is the last one given for the satellite since it was last blank or not in the epoch
+        block_flags = np.full((len(records) + 1, shape[1], 2 * types), ord(' '), dtype=np.uint8)
+        block_flags[0, :len(self.__flags)] = self.__flags
+        block_flags[epochs + 1, rows] = np.frombuffer(''.join(flags).encode('latin-1'), dtype=np.uint8).reshape(
+            len(rows), 2 * types)
+        given = block_flags != ord(' ')
+        # Compact RINEX 1.0 drops the flags of blank fields
+        given[1:] |= np.repeat(~block_present, 2, axis=-1)
+        given[0] = True
+        block_flags[block_flags == ord(ARC_START)] = ord(' ')
+        block_flags[1:][np.repeat(~block_present, 2, axis=-1)] = ord(' ')
+        latest = np.maximum.accumulate(np.where(given, np.arange(len(records) + 1)[:, None, None], 0), axis=0)
+        block_flags = np.take_along_axis(block_flags, latest, axis=0)
+        self.__flags = block_flags[-1]
+
+        text = np.full((len(rows), types, 16), ord(' '), dtype=np.uint8)
+        text[..., :14] = format_observations(values)
+        text[..., 14:] = block_flags[epochs + 1, rows].reshape(len(rows), types, 2)
+        text[~present] = ord(' ')
+        lines = []  # data lines of every satellite, by line of the record
+        for start in range(0, types, FIELDS_PER_LINE):
+            width = 16 * min(types - start, FIELDS_PER_LINE)
+            group = np.ascontiguousarray(text[:, start:start + FIELDS_PER_LINE]).reshape(len(rows), width).view(
+                'S{}'.format(width))
+            lines.append([line.decode('latin-1').rstrip(' ') + '\n' for line in group[:, 0].tolist()])
+        output = []
+        position = 0
+        for (epoch, clock, satellites, _), count in zip(records, counts):
+            if clock is not None:
+                output.append('{:<68.68}{}\n'.format(epoch, format_clock(clock)))
+            else:
+                output.append(epoch[:68] + '\n')
+            for start in range(68, 68 + 36 * ((count - 1) // SATELLITES_PER_LINE), 36):
+                output.append(' ' * 32 + epoch[start:start + 36] + '\n')
+            for satellite in range(position, position + count):
+                output += [group[satellite] for group in lines]
+            position += count
+        return output
+
+    def __read_differences(self, fields: List[str], count: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Read the differences of the observations of satellites, all at once.
+
+            Args:
+                fields: the difference of every observation type of every satellite, '' where blank
+                count: number of satellites
+
+            Returns:
+                The differences (0 if blank) with one row per satellite, False where they are
+                blank, and the order of the new arc where one starts (-1 elsewhere).
+
+            Raises:
+                ValueError: a difference is not a number.
+        """
+        if not count:
+            nothing = np.zeros((0, self.__types), dtype=np.int64)
+            return nothing, nothing.astype(bool), nothing
+        fields = np.array(fields, dtype=str).reshape(count, self.__types)
+        order, start, difference = np.moveaxis(np.char.rpartition(fields, ARC_START), -1, 0)
+        present = fields != ''
+        starts = start == ARC_START
+        invalid = starts & ~((np.char.str_len(order) == 1) & np.char.isdigit(order))
+        if invalid.any():
+            raise ValueError('Invalid difference: {}'.format(fields[invalid][0]))
+        try:
+            differences = np.where(present, difference, '0').astype(np.int64)
+        except (ValueError, OverflowError):
+            for field, digits in zip(fields[present].tolist(), difference[present].tolist()):
+                try:
+                    np.int64(int(digits))
+                except (ValueError, OverflowError):
+                    raise ValueError('Invalid difference: {}'.format(field)) from None
+            raise
+        return differences, present, np.where(starts, order, '-1').astype(np.int64)
+
+
+class CRXEncoder:
+    """ Incrementally encodes RINEX 2 observation data into Compact RINEX 1.0 data.
+
+        Args:
+            program: name written in the CRINEX PROG / DATE line (default: grab_data)
+    """
+
+    def __init__(self, program: str = CRX_PROGRAM):
+        self.__program = program
+        self.__pending = b''
+        self.__next: Callable[[str], List[str]] = self.__rinex_version
+        self.__types = 0
+        self.__events = 0  # special records left in the current event
+        self.__record: List[str] = []  # lines of the current epoch read so far
+        self.__record_size = 0  # number of lines of the current epoch
+        self.__block: List[List[str]] = []  # lines of the epochs read and not encoded yet
+        self.__epoch = ARC_START
+        self.__clock: Optional[DifferenceArc] = None
+        self.__table: Optional[DifferenceTable] = None  # arcs of the observations of every satellite
+        self.__flags = np.zeros((0, 0), dtype=np.uint8)  # data flags of every row of the table at the last epoch
+        self.__flagged = np.zeros(0, dtype=bool)  # rows of the satellites in the last epoch
+        self.__finished = False
+
+    def encode_line(self, line: str) -> List[str]:
+        """ Encode the next line of RINEX.
+
+            Args:
+                line: the line, with or without its line break
+
+            Returns:
+                The Compact RINEX lines it completes, each ending in a line break.
+        """
+        if self.__finished:
+            return []
+        return self.__next(line.rstrip('\r\n'))
+
+    def compress(self, data: bytes) -> bytes:
+        """ Encode the next chunk of RINEX data.
+
+            Args:
+                data: RINEX bytes
+
+            Returns:
+                The Compact RINEX bytes that could be produced so far.
+        """
+        lines = (self.__pending + data).split(b'\n')
+        self.__pending = lines.pop()
+        output = []
+        for line in lines:
+            output.extend(self.encode_line(line.decode('latin-1')))
+        return ''.join(output).encode('latin-1')
+
+    def flush(self) -> bytes:
+        """ Signal the end of the data and return whatever is left.
+
+            Raises:
+                ValueError: the data ended in the middle of the header or an epoch.
+        """
+        output = self.encode_line(self.__pending.decode('latin-1')) if self.__pending else []
+        self.__pending = b''
+        if not self.__finished and self.__next != self.__epoch_line:
+            raise ValueError('RINEX data ended in the middle of a record.')
+        return ''.join(output + self.__encode_block()).encode('latin-1')
+
+    def __rinex_version(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        if (not line[LABEL_COLUMN:].startswith(RINEX_VERSION_LABEL) or line[20:21] != 'O'
+                or line[5:6] != '2'):
+            raise ValueError('Compact RINEX 1.0 data can only hold RINEX version 2 observations.')
+        self.__next = self.__header
+        return ['{:<20.20}{:<40.40}{}\n'.format(CRX_VERSION, CRX_FORMAT, CRX_VERSION_LABEL),
+                '{:<40.40}{:<20.20}{}\n'.format(self.__program, datetime.utcnow().strftime(CRX_DATE_FORMAT),
+                                                CRX_PROGRAM_LABEL),
+                line + '\n']
+
+    def __header(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        self.__read_types(line)
+        if line[LABEL_COLUMN:].startswith(END_OF_HEADER_LABEL):
+            self.__next = self.__epoch_line
+        return [line + '\n']
+
+    def __read_types(self, line: str):
+        """ Pick up the number of observation types from a header line that starts a list of them. """
+        if line[LABEL_COLUMN:].startswith(TYPES_LABEL) and line[5:6] != ' ':
+            self.__types = int(line[:6])
+
+    def __epoch_line(self, line: str) -> List[str]:
+        if line.startswith(DOS_EOF):
+            self.__finished = True
+            return self.__encode_block()
+        line = chop_blank(line)
+        if (len(line) < 29 or line[:1] != ' ' or line[27] != ' ' or not line[EPOCH_FLAG_COLUMN].isdigit()
+                or line[29:30] not in ('', ' ') and not line[29].isdigit()):
+            raise ValueError('Invalid epoch line: {}'.format(line))
+        if line[EPOCH_FLAG_COLUMN] not in ('0', '1'):
+            return self.__event(line)
+        count = int(line[29:SATELLITE_COLUMN])
+        continuation = -(-max(count - SATELLITES_PER_LINE, 0) // SATELLITES_PER_LINE)
+        self.__record = [line]
+        self.__record_size = 1 + continuation + count * -(-self.__types // FIELDS_PER_LINE)
+        if self.__record_size == 1:
+            return self.__keep_epoch()
+        self.__next = self.__record_line
+        return []
+
+    def __event(self, line: str) -> List[str]:
+        """ Copy an event record (epoch flag above 1) and the special records that follow it. """
+        if line[26:27] == '.':
+            raise ValueError('Invalid epoch line: {}'.format(line))
+        digits = line[29:SATELLITE_COLUMN].strip()
+        output = self.__encode_block()
+        self.__events = int(digits) if digits.isdigit() else 0
+        self.__next = self.__event_record if self.__events else self.__epoch_line
+        # every arc starts again after an event
+        self.__epoch = ARC_START
+        self.__clock = None
+        self.__table = None
+        return output + [ARC_START + line[1:] + '\n']
+
+    def __event_record(self, line: str) -> List[str]:
+        line = chop_blank(line)
+        self.__read_types(line)
+        self.__events -= 1
+        if not self.__events:
+            self.__next = self.__epoch_line
+        return [line + '\n']
+
+    def __record_line(self, line: str) -> List[str]:
+        self.__record.append(chop_blank(line))
+        if len(self.__record) == self.__record_size:
+            self.__next = self.__epoch_line
+            return self.__keep_epoch()
+        return []
+
+    def __keep_epoch(self) -> List[str]:
+        """ Keep an epoch once all its lines were read, encoding the epochs kept once there are enough of them. """
+        self.__block.append(self.__record)
+        if len(self.__block) == BLOCK_EPOCHS:
+            return self.__encode_block()
+        return []
+
+    def __encode_block(self) -> List[str]:
+        """ Write out the differences of the epochs kept, all at once, and keep the last one for the next ones. """
+        records, self.__block = self.__block, []
+        if not records:
+            return []
+        if self.__table is None or self.__table.types != self.__types:
+            self.__table = DifferenceTable(self.__types)
+            self.__flags = np.zeros((0, 2 * self.__types), dtype=np.uint8)
+            self.__flagged = np.zeros(0, dtype=bool)
+        heads = []  # epoch and clock lines of every epoch
+        counts = []  # number of satellites of every epoch
+        rows = []  # row of the arcs of every satellite of every epoch
+        data = []  # data lines of every epoch
+        for record in records:
+            epoch, lines = record[0], iter(record[1:])
+            count = int(epoch[29:SATELLITE_COLUMN])
+            clock = None
+            if len(epoch) > CLOCK_COLUMN:
+                text = epoch[CLOCK_COLUMN:]
+                if text[2:3] != '.':
+                    raise ValueError('Invalid receiver clock offset: {}'.format(text))
+                clock = read_observation(text)
+                epoch = epoch[:CLOCK_COLUMN]
+            for i in range(SATELLITES_PER_LINE, count, SATELLITES_PER_LINE):
+                line = next(lines)
+                epoch = epoch.ljust(CLOCK_COLUMN + 36 * (i // SATELLITES_PER_LINE - 1)) + (
+                    line[SATELLITE_COLUMN:] if line[2:3] == ' ' else line)
+            epoch = epoch[:SATELLITE_COLUMN + 3 * count]
+            satellites = [epoch[SATELLITE_COLUMN + 3 * i:SATELLITE_COLUMN + 3 * (i + 1)] for i in range(count)]
+            if len(set(satellites)) < count:
+                raise ValueError('Duplicated satellite in epoch: {}'.format(epoch))
+            heads.append(text_difference(self.__epoch, epoch) + '\n')
+            if clock is None:
+                self.__clock = None
+                heads[-1] += '\n'
+            else:
+                diff, self.__clock = difference(clock, self.__clock, CLOCK_UNIT)
+                heads[-1] += diff + '\n'
+            self.__epoch = epoch
+            counts.append(count)
+            rows += [self.__table.row(satellite) for satellite in satellites]
+            data.append(lines)
+        values, present, flags = self.__read_data(chain.from_iterable(data), len(rows))
+
+        # the observations of every epoch laid out by row of the table, for the arcs to be followed along time
+        epochs, rows = np.repeat(np.arange(len(records)), counts), np.array(rows, dtype=np.intp)
+        shape = (len(records), len(self.__table), self.__types)
+        block_values, block_present = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=bool)
+        block_values[epochs, rows] = values
+        block_present[epochs, rows] = present
+        diffs, new = self.__table.difference(block_values, block_present)
+        diffs, new = diffs[epochs, rows], new[epochs, rows]
+
+        # the data flags are differenced from those of the satellite at the epoch before, if it was in it
+        flagged = np.zeros((len(records) + 1, shape[1]), dtype=bool)
+        flagged[0, :len(self.__flagged)] = self.__flagged
+        flagged[epochs + 1, rows] = True
+        block_flags = np.full((len(records) + 1, shape[1], 2 * self.__types), ord(' '), dtype=np.uint8)
+        block_flags[0, :len(self.__flags)] = self.__flags
+        block_flags[epochs + 1, rows] = flags
+        old = block_flags[epochs, rows]
+        # Compact RINEX 1.0 drops the flags of blank fields
+        old[np.repeat(~present, 2, axis=1)] = ord(' ')
+        changed = np.where(old == flags, ord(' '), np.where(flags == ord(' '), ord(ARC_START), flags))
+        flags = np.where(flagged[epochs, rows][:, None], changed, flags).astype(np.uint8)
+        self.__flags, self.__flagged = block_flags[-1], flagged[-1]
+
+        arc_start = '{}{}'.format(ARC_ORDER, ARC_START)
+        flags = [f.decode('latin-1') for f in flags.view('S{}'.format(2 * self.__types))[:, 0].tolist()]
+        lines = [(' '.join([(arc_start + str(v) if n else str(d)) if p else ''
+                            for d, n, v, p in zip(*cells)]) + ' ' + f).rstrip(' ') + '\n'
+                 for *cells, f in zip(diffs.tolist(), new.tolist(), values.tolist(), present.tolist(), flags)]
+        output = []
+        position = 0
+        for head, count in zip(heads, counts):
+            output.append(head)
+            output += lines[position:position + count]
+            position += count
+        return output
+
+    def __read_data(self, lines: Iterator[str], count: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Read the observations of satellites from their data lines, all at once.
+
+            Args:
+                lines: the data lines of the satellites, one after the other
+                count: number of satellites
+
+            Returns:
+                The observations in thousandths (0 if blank) with one row per satellite,
+                False where they are blank, and the characters of the data flags of every satellite.
+        """
+        padded = []
+        for _ in range(count):
+            for start in range(0, self.__types, FIELDS_PER_LINE):
+                line = next(lines)
+                size = 16 * min(self.__types - start, FIELDS_PER_LINE)
+                if len(line) > size:
+                    raise ValueError('Mismatch of the number of observation types: {}'.format(line))
+                padded.append(line.ljust(size))
+        fields = np.frombuffer(''.join(padded).encode('latin-1'), dtype=np.uint8).reshape(count, self.__types, 16)
+        present = fields[..., 10] == ord('.')
+        blank = (fields[..., :14] == ord(' ')).all(axis=-1)
+        for problem, message in ((~present & ~blank, 'Invalid observation: {}'),
+                                 (blank & (fields[..., 14:] != ord(' ')).any(axis=-1),
+                                  'Data flags of a blank observation: {}')):
+            if problem.any():
+                field = fields[tuple(np.argwhere(problem)[0])]
+                raise ValueError(message.format(field.tobytes().decode('latin-1')))
+        # the digits of every field without its decimal point, or 0 where blank
+        digits = np.ascontiguousarray(fields[..., [*range(10), 11, 12, 13]])
+        digits[blank] = ord(' ')
+        digits[blank, -1] = ord('0')
+        values = digits.view('S13')[..., 0].astype(np.int64)
+        return values, present, fields[..., 14:].reshape(count, 2 * self.__types)
+
+
+def decompress_crx(path: str) -> str:
+    """ Convert a Compact RINEX file (ssssdddh.yyd) to standard RINEX (ssssdddh.yyo) and remove the original.
+
+        Args:
+            path: path to the Compact RINEX file
+
+        Returns:
+            Path to the RINEX file.
+    """
+    output_path = path[:-1] + 'o'
+    decoder = CRXDecoder()
+    try:
+        with open(path, 'rb') as src, open(output_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(decoder.decompress(chunk))
+            dst.write(decoder.flush())
+    except BaseException:
+        # never leave a partial file behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    os.remove(path)
+    return output_path
+
+
+def compress_rinex(path: str) -> str:
+    """ Convert a RINEX observation file (ssssdddh.yyo) to Compact RINEX (ssssdddh.yyd) and remove the original.
+
+        Args:
+            path: path to the RINEX file
+
+        Returns:
+            Path to the Compact RINEX file.
+    """
+    output_path = path[:-1] + 'd'
+    encoder = CRXEncoder()
+    try:
+        with open(path, 'rb') as src, open(output_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(encoder.compress(chunk))
+            dst.write(encoder.flush())
+    except BaseException:
+        # never leave a partial file behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    os.remove(path)
+    return output_path
@@ -0,0 +1,220 @@
+"""Class responsible for caching directory listings of the NOAA FTP archive.
+
+Each /cors/rinex/{year}/{doy}/{station} listing is kept in memory as a mapping
+of file name to size (and optionally on disk as JSON) so planning a download
+no longer needs a cwd and nlst round trip per day. Listings expire based on
+the age of the data: days older than the archive's settle period never change
+and are kept forever, while the last 48 hours are re-listed frequently as new
+hourly files arrive.
+
+  Typical usage example:
+
+  foo = ListingIndex(directory)
+  foo.warm(session, station, days, workers)
+  files = foo.listing(ftp, station, year, yday)
+"""
+import json
+import os
+import posixpath
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from ftplib import FTP, error_perm
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from src.Cache import day_age, is_settled
+from src.Output import atomic_write
+
+DIRECTORY_PATH = '/cors/rinex/{}/{:03d}/{}'
+RECENT_HOURS = 48
+RECENT_TTL = 10 * 60  # seconds, new hourly files keep arriving
+UNSETTLED_TTL = 60 * 60  # seconds, late files may still be added or replaced
+
+# file name -> size in bytes (None when the server did not report it)
+Listing = Dict[str, Optional[int]]
+
+
+class ListingIndex:
+    """ Cache of per-(station, year, doy) directory listings.
+
+        Args:
+            directory: path to the directory listings are persisted to (default: memory only)
+    """
+
+    def __init__(self, directory: str = None):
+        self.__directory = directory
+        self.__listings: Dict[Tuple[str, int, int], Tuple[float, Listing]] = {}
+        self.__lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def ttl(self, year: int, yday: int) -> Optional[float]:
+        """ Get how long a listing of a given day stays valid for.
+
+            Args:
+                year: 4-digit year
+                yday: day-of-year
+
+            Returns:
+                Time to live in seconds, or None if the listing never expires.
+        """
+        if is_settled(year, yday):
+            return None
+        if day_age(year, yday) > timedelta(hours=RECENT_HOURS):
+            return UNSETTLED_TTL
+        return RECENT_TTL
+
+    def __path(self, station: str, year: int, yday: int) -> str:
+        """ Get the location of a persisted listing. """
+        return os.path.join(self.__directory, station, str(year), '{:03d}.json'.format(yday))
+
+    def __is_fresh(self, fetched: float, year: int, yday: int) -> bool:
+        """ Checks whether a listing fetched at a given time is still valid. """
+        ttl = self.ttl(year, yday)
+        return ttl is None or time.time() - fetched < ttl
+
+    def get(self, station: str, year: int, yday: int) -> Optional[Listing]:
+        """ Look up a cached listing.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+
+            Returns:
+                Mapping of file names in the directory to their sizes, or None if there is no valid cached listing.
+        """
+        station = station.lower()
+        key = (station, year, yday)
+        with self.__lock:
+            entry = self.__listings.get(key)
+        if entry is None and self.__directory:
+            try:
+                with open(self.__path(*key)) as f:
+                    stored = json.load(f)
+                entry = (stored['fetched'], dict(stored['files']))
+            except (OSError, ValueError, KeyError):
+                return None
+            with self.__lock:
+                self.__listings[key] = entry
+        if entry is None or not self.__is_fresh(entry[0], year, yday):
+            return None
+        return entry[1]
+
+    def put(self, station: str, year: int, yday: int, files: Listing):
+        """ Store a listing in the index.
+
+            Args:
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                files: mapping of file names in the directory to their sizes (None if unknown)
+        """
+        station = station.lower()
+        entry = (time.time(), dict(files))
+        with self.__lock:
+            self.__listings[(station, year, yday)] = entry
+        if not self.__directory:
+            return
+        path = self.__path(station, year, yday)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump({'fetched': entry[0], 'files': entry[1]}, f, sort_keys=True)
+
+    def fetch(self, ftp: FTP, station: str, year: int, yday: int) -> Listing:
+        """ List a day's directory on the FTP server and store the result.
+
+            File sizes are taken from MLSD, falling back to a plain NLST without sizes
+            on servers that do not support it. A directory that does not exist on the
+            server is listed as empty.
+
+            Args:
+                ftp: a logged in FTP session
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+
+            Returns:
+                Mapping of file names in the directory to their sizes.
+        """
+        path = DIRECTORY_PATH.format(year, yday, station.lower())
+        try:
+            files = {posixpath.basename(name): int(facts['size']) if 'size' in facts else None
+                     for name, facts in ftp.mlsd(path, facts=['type', 'size'])
+                     if facts.get('type', 'file') == 'file'}
+        except error_perm as e:
+            if str(e).startswith('550'):
+                files = {}  # no such directory
+            else:
+                try:
+                    # some servers answer NLST with full paths
+                    files = {posixpath.basename(name): None for name in ftp.nlst(path)}
+                except error_perm:
+                    files = {}
+        self.put(station, year, yday, files)
+        return files
+
+    def listing(self, ftp: FTP, station: str, year: int, yday: int) -> Listing:
+        """ Get the listing of a day's directory, only going to the FTP server on a cache miss.
+
+            Args:
+                ftp: a logged in FTP session
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+
+            Returns:
+                Mapping of file names in the directory to their sizes.
+        """
+        files = self.get(station, year, yday)
+        if files is None:
+            files = self.fetch(ftp, station, year, yday)
+        return files
+
+    def resolve_sizes(self, ftp: FTP, station: str, year: int, yday: int, names: Iterable[str]) -> Listing:
+        """ Ask the FTP server for the size of listed files whose size is not known yet.
+
+            Args:
+                ftp: a logged in FTP session
+                station: 4-character site (base) identifier
+                year: 4-digit year
+                yday: day-of-year
+                names: names of the files that need a size
+
+            Returns:
+                Mapping of file names in the directory to their sizes.
+        """
+        files = self.listing(ftp, station, year, yday)
+        unknown = [name for name in names if name in files and files[name] is None]
+        if not unknown:
+            return files
+        files = dict(files)
+        ftp.voidcmd('TYPE I')  # SIZE is only reliable in binary mode
+        path = DIRECTORY_PATH.format(year, yday, station.lower())
+        for name in unknown:
+            try:
+                files[name] = ftp.size('{}/{}'.format(path, name))
+            except error_perm:
+                pass
+        self.put(station, year, yday, files)
+        return files
+
+    def warm(self, session: Callable[[], FTP], station: str, days: List[Tuple[int, int]], workers: int = 1):
+        """ Fetch every missing listing for a range of days in bulk.
+
+            Args:
+                session: callable returning a logged in FTP session owned by the calling thread
+                station: 4-character site (base) identifier
+                days: list of (year, day-of-year) tuples
+                workers: number of listings fetched concurrently (default: 1)
+        """
+        missing = [(year, yday) for year, yday in days
+                   if self.get(station, year, yday) is None]
+        if workers == 1 or len(missing) < 2:
+            for year, yday in missing:
+                self.fetch(session(), station, year, yday)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(lambda day: self.fetch(session(), station, *day), day)
+                           for day in missing]:
+                future.result()
@@ -1,24 +1,388 @@
 """Class responsible for decompressing and merging RINEX files.
 
 Decompresses Gzipped or Hatanaka compressed files.
-Merges files using TEQC with specified time-window and outputs file
-to root directory of project.
+Merges files with a streaming k-way merge of their epochs, keeping only the
+specified time-window (and optionally decimating it to a longer interval),
+and outputs the file to the current directory, optionally gzip and/or
+Hatanaka compressed as it is written (see open_output).
+
+Long ranges can be merged hierarchically instead (see TreeMerge): every day
+is merged on its own, in a pool of processes, as soon as its files are in,
+and the day files are then merged into weeks, months and so on. Each file is
+deleted as soon as it has been merged, so the temporary directory only ever
+holds the files still waiting to be merged.
 
   Typical usage example:
 
-  foo = RinexMerger(station, start_time, end_time, directory)
+  foo = RinexMerger(station, start_time, end_time, directory, decimate=30)
   foo.merge()
 """
+import heapq
+import multiprocessing
 import os
-import subprocess
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from glob import glob
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterable, Iterator, List, TextIO, Tuple
+from src.Decompress import decompress_file, is_compressed, is_hatanaka
+from src.Hatanaka import decompress_crx
+from src.Metrics import Metrics
+from src.Output import atomic_output, open_output, output_name
+from src.Planner import FetchPlan, PlannedFile
+from src.Rinex import (CYCLE_SLIP_FLAG, INTERVAL_LABEL, LAST_OBS_LABEL, Epoch, ObservationFile, ObservationReader,
+                       ObservationWriter, RinexHeader, is_aligned)
+
+GROUP_SIZE = 7  # files merged together at every level of a hierarchical merge, e.g. days into weeks
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """ Start a pool of processes that can run while files are being downloaded.
+
+        The processes are forked from a clean server process where the platform
+        has one, instead of from this process, so they never hold on to copies of
+        open FTP connections (a data connection is only seen closing once every
+        copy of it is closed).
+
+        Args:
+            workers: number of processes
+    """
+    context = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(context))
+
+
+def decompress_to_rinex(path: str) -> str:
+    """ Turn a downloaded file into standard RINEX, removing the original.
+
+        Args:
+            path: path to a gzipped, LZW compressed and/or Hatanaka compressed file
+
+        Returns:
+            Path to the RINEX file.
+    """
+    if is_compressed(path):
+        path = decompress_file(path)
+    if is_hatanaka(path):
+        path = decompress_crx(path)
+    return path
+
+
+def merge_headers(headers: List[RinexHeader], interval: float = None) -> RinexHeader:
+    """ Reconcile the headers of several observation files into the header of the merged file.
+
+        The first header is used as the base. The observation types are all types
+        of all files in the order they first appear. INTERVAL is only kept if every
+        file agrees on it, unless the files are decimated, and TIME OF LAST OBS is
+        dropped as it is not known before the merge is done.
+
+        Args:
+            headers: headers of the files being merged
+            interval: interval in seconds the files are decimated to (default: not decimated)
+
+        Returns:
+            The header of the merged file.
+    """
+    types = []
+    for header in headers:
+        types += [t for t in header.types if t not in types]
+    merged = headers[0].with_types(tuple(types)).replace(LAST_OBS_LABEL, [])
+    intervals = {header.interval for header in headers}
+    if interval is not None and (len(intervals) > 1 or None in intervals or interval > max(intervals)):
+        merged = merged.replace(INTERVAL_LABEL, ['{:10.3f}{:50}{:<20}'.format(interval, '', INTERVAL_LABEL)])
+    elif len(intervals) > 1:
+        merged = merged.replace(INTERVAL_LABEL, [])
+    return merged
+
+
+def merge_observations(inputs: List[TextIO], output: TextIO, start: datetime = None, end: datetime = None,
+                       interval: float = None) -> int:
+    """ Merge RINEX 2 observation files into one, keeping only the epochs inside a time window.
+
+        Args:
+            inputs: observation files opened in text mode
+            output: file opened in text mode the merged file is written to
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+
+        Returns:
+            The number of records written.
+    """
+    return merge_epochs([ObservationReader(f) for f in inputs], output, start, end, interval)
+
+
+def hour_window(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+    """ Get the window of epochs kept for a time window: whole hours, from the start of the first hour to the end of the last one. """
+    return (datetime(start.year, start.month, start.day, start.hour),
+            datetime(end.year, end.month, end.day, end.hour, 59, 59))
+
+
+def select_epochs(epochs: Iterable[Epoch], start: datetime = None, end: datetime = None,
+                  interval: float = None) -> Iterator[Epoch]:
+    """ Drop the epochs outside a time window, repeated ones and those dropped by decimation from merged epochs.
+
+        Args:
+            epochs: epochs of several files, merged in chronological order
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+
+        Returns:
+            An iterator over the epochs kept.
+    """
+    last = None  # time of the last epoch with observations
+    kinds = set()  # whether the epochs yielded at that time were cycle slip records
+    events = set()  # events yielded at the time of the last event
+    for epoch in epochs:
+        if start is not None and epoch.time < start:
+            continue
+        if end is not None and epoch.time > end:
+            return
+        if epoch.is_event:
+            if events and next(iter(events))[0] != epoch.time:
+                events.clear()
+            event = (epoch.time, epoch.flag, tuple(epoch.records))
+            if event in events:
+                continue
+            events.add(event)
+        elif epoch.time == last and (epoch.flag == CYCLE_SLIP_FLAG) in kinds:
+            # the same epoch from an overlapping file, cycle slips share the time of the epoch before them
+            continue
+        elif interval is not None and not is_aligned(epoch.time, interval):
+            continue
+        else:
+            if epoch.time != last:
+                last, kinds = epoch.time, set()
+            kinds.add(epoch.flag == CYCLE_SLIP_FLAG)
+        yield epoch
 
-START_TIMESTAMP = '{}{:02d}{:02d}{:02d}0000'
-END_TIMESTAMP = '{}{:02d}{:02d}{:02d}5959'
-ROOT_DIR = os.path.join(os.path.dirname(
-    os.path.dirname(os.path.realpath(__file__))))
+
+def merged_epochs(readers: List[ObservationReader], start: datetime = None, end: datetime = None,
+                  interval: float = None) -> Iterator[Epoch]:
+    """ Merge the epochs of several observation files by time, keeping only those inside a time window.
+
+        The epochs of all readers are merged by time as they are read, so only one
+        epoch per reader is held in memory. Readers can be given in any order, as
+        long as each of them is in chronological order. When several readers have
+        an epoch at the same time, the one from the reader given first is kept, and
+        identical events are only yielded once. Cycle slip records (epoch flag 6)
+        share the time of the epoch before them, and are only dropped in favour
+        of another cycle slip record. When decimating, only epochs at
+        whole multiples of the interval are kept (see is_aligned) and every
+        event is kept; readers of an ObservationFile can skip the other epochs
+        up front with ObservationFile.epochs.
+
+        Args:
+            readers: readers of the observation files
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+
+        Returns:
+            An iterator over the merged epochs, in chronological order.
+    """
+    return select_epochs(heapq.merge(*readers, key=lambda e: e.time), start, end, interval)
+
+
+def merge_epochs(readers: List[ObservationReader], output: TextIO, start: datetime = None, end: datetime = None,
+                 interval: float = None) -> int:
+    """ Merge the epochs of several observation files into one, keeping only those inside a time window.
+
+        See merged_epochs for how the epochs are merged.
+
+        Args:
+            readers: readers of the observation files
+            output: file opened in text mode the merged file is written to
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+
+        Returns:
+            The number of records written.
+    """
+    if not readers:
+        raise ValueError('No observation files to merge.')
+    header = merge_headers([reader.header for reader in readers], interval)
+    writer = None
+    written = 0
+    for epoch in merged_epochs(readers, start, end, interval):
+        if writer is None:
+            if epoch.time != datetime.min:
+                header = header.with_first_epoch(epoch.time)
+            writer = ObservationWriter(output, header)
+            writer.write_header()
+        writer.write(epoch)
+        written += 1
+    if writer is None:
+        ObservationWriter(output, header).write_header()
+    return written
+
+
+def merge_files(paths: List[str], output: str, start: datetime = None, end: datetime = None,
+                interval: float = None, remove: bool = False, compression: str = None) -> str:
+    """ Merge observation files into a new file, keeping only the epochs inside a time window.
+
+        Module level so it can run in a process pool. The merged file only
+        appears under its name once it is complete.
+
+        Args:
+            paths: paths to the observation files, in chronological order
+            output: path of the merged file
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+            remove: delete the observation files once they are merged (default: False)
+            compression: compression of the merged file, see open_output (default: plain RINEX)
+
+        Returns:
+            The path of the merged file.
+    """
+    with ExitStack() as stack:
+        inputs = [stack.enter_context(ObservationFile(f)) for f in paths]
+        f = stack.enter_context(atomic_output(output, compression))
+        merge_epochs([i.epochs(start, end, interval) for i in inputs], f, start, end, interval)
+    if remove:
+        for path in paths:
+            os.remove(path)
+    return output
+
+
+class TreeMerge:
+    """ Merges the files of a plan day by day, then the days in groups, until one file is left.
+
+        Days are merged as soon as all their files have been reported downloaded,
+        and every group of merged files as soon as all of its files are merged, so
+        merging overlaps with downloading. Every file is deleted once merged,
+        including the downloaded ones. Merges run in a pool of processes.
+
+        Args:
+            plan: the files to merge
+            directory: path to the directory containing the files, where intermediate files are written
+            output: path of the merged file
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+            workers: number of processes merging files concurrently (default: number of CPUs)
+            group_size: number of files merged together above the day level (default: 7)
+            metrics: where the CPU time of the merges is recorded (default: new metrics)
+            compression: compression of the merged file, see open_output (default: plain RINEX)
+    """
+
+    def __init__(self, plan: FetchPlan, directory: str, output: str, start: datetime = None,
+                 end: datetime = None, interval: float = None, workers: int = None, group_size: int = GROUP_SIZE,
+                 metrics: Metrics = None, compression: str = None):
+        if group_size < 2:
+            raise ValueError('Group size must be at least 2.')
+        self.__directory = directory
+        self.__output = output
+        self.__start = start
+        self.__end = end
+        self.__interval = interval
+        self.__group_size = group_size
+        self.__metrics = metrics or Metrics()
+        self.__compression = compression
+        # files of every day in chronological order, and how many of them are still to come
+        self.__days: Dict[Tuple[int, int], List[PlannedFile]] = {}
+        for file in plan:
+            self.__days.setdefault((file.year, file.yday), []).append(file)
+        self.__missing = Counter({day: len(files) for day, files in self.__days.items()})
+        self.__order = {day: i for i, day in enumerate(self.__days)}
+        # merges of every level in chronological order, level 0 being the days
+        self.__levels: List[Dict[int, Future]] = [{}]
+        self.__pool = process_pool(workers or os.cpu_count() or 1)
+        self.__lock = threading.Lock()
+
+    def __enter__(self) -> 'TreeMerge':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Stop merging, waiting for the merges already running. """
+        with self.__lock:
+            for level in self.__levels:
+                for future in level.values():
+                    future.cancel()
+        self.__pool.shutdown()
+
+    def __intermediate(self, level: int, index: int) -> str:
+        return os.path.join(self.__directory, 'merge-{}-{:05d}.obs'.format(level, index))
+
+    def __count(self, level: int) -> int:
+        """ Number of files a level of the tree has, level 0 being the days. """
+        total = len(self.__days)
+        for _ in range(level):
+            total = (total + self.__group_size - 1) // self.__group_size
+        return total
+
+    def __reduce(self, level: int):
+        """ Merge every group of files of a level that are all merged into a file of the level above.
+
+            The last merge is left to result, so it can write the output directly.
+        """
+        if self.__count(level + 1) <= 1:
+            return
+        if len(self.__levels) == level + 1:
+            self.__levels.append({})
+        merged, above = self.__levels[level], self.__levels[level + 1]
+        size = self.__group_size
+        for index in range(self.__count(level + 1)):
+            if index in above:
+                continue
+            members = [merged.get(i) for i in range(index * size, min(self.__count(level), (index + 1) * size))]
+            if all(f is not None and f.done() and f.exception() is None for f in members):
+                above[index] = self.__metrics.submit(self.__pool, merge_files, [f.result() for f in members],
+                                                  self.__intermediate(level + 1, index), remove=True)
+
+    def downloaded(self, file: PlannedFile):
+        """ Report a file of the plan downloaded, merging its day once all of the day's files are in. """
+        day = (file.year, file.yday)
+        with self.__lock:
+            self.__missing[day] -= 1
+            if self.__missing[day]:
+                return
+            paths = [os.path.join(self.__directory, f.rinex_name) for f in self.__days[day]]
+            self.__levels[0][self.__order[day]] = self.__metrics.submit(
+                self.__pool, merge_files, paths, self.__intermediate(0, self.__order[day]),
+                self.__start, self.__end, self.__interval, remove=True)
+            # groups completed by earlier merges
+            for level in range(len(self.__levels)):
+                self.__reduce(level)
+
+    def result(self) -> str:
+        """ Wait for every merge, merging what is left once every day is in.
+
+            Returns:
+                The path of the merged file.
+
+            Raises:
+                ValueError: the plan has no files.
+                RuntimeError: some files were never reported downloaded.
+        """
+        if not self.__days:
+            raise ValueError('No observation files to merge.')
+        with self.__lock:
+            missing = sum(1 for count in self.__missing.values() if count)
+        if missing:
+            raise RuntimeError('Could not merge, {} days are missing files.'.format(missing))
+        level = 0
+        while self.__count(level) > 1:
+            paths = [self.__levels[level][i].result() for i in range(self.__count(level))]
+            if self.__count(level + 1) == 1:
+                return merge_files(paths, self.__output, remove=True, compression=self.__compression)
+            with self.__lock:
+                self.__reduce(level)
+            level += 1
+        if self.__compression is not None:
+            return merge_files([self.__levels[level][0].result()], self.__output, remove=True,
+                               compression=self.__compression)
+        shutil.move(self.__levels[level][0].result(), self.__output)
+        return self.__output
 
 
 class RinexMerger:
@@ -29,13 +393,33 @@ class RinexMerger:
             start_time: datetime object
             end_time: datetime object
             directory: path to directory containing RINEX files (default: current directory)
+            workers: number of processes files are decompressed and merged in (default: number of CPUs)
+            decimate: interval in seconds to decimate the merged file to (default: keep every epoch)
+            output: path of the merged file (default: {station}.obs in the current directory, with the
+                extension of the compression, see output_name)
+            hierarchical: merge day by day and then the days in groups (see TreeMerge), deleting the
+                downloaded files as they are merged (default: False)
+            metrics: where the time spent decompressing and merging is recorded (default: new metrics)
+            compression: compress the merged file as it is written, see open_output (default: plain RINEX)
     """
 
-    def __init__(self, station: str, start_time: datetime, end_time: datetime, directory: str = ''):
+    def __init__(self, station: str, start_time: datetime, end_time: datetime, directory: str = '',
+                 workers: int = None, decimate: float = None, output: str = None, hierarchical: bool = False,
+                 metrics: Metrics = None, compression: str = None):
+        if workers is not None and workers < 1:
+            raise ValueError('Number of workers must be at least 1.')
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
         self.__station = station.lower()
         self.__start = self.deconstruct_datetime(start_time)
         self.__end = self.deconstruct_datetime(end_time)
         self.__directory = directory
+        self.__workers = workers or os.cpu_count() or 1
+        self.__decimate = decimate
+        self.__output = output or output_name(self.__station, compression)
+        self.__compression = compression
+        self.__hierarchical = hierarchical
+        self.metrics = metrics or Metrics()
 
     def deconstruct_datetime(self, date: datetime) -> List[int]:
         """ Extracts information from a datetime object
@@ -49,80 +433,106 @@ class RinexMerger:
         year, month, day, hour, _, _, _, _, _ = date.timetuple()
         return [year, month, day, hour]
 
-    def __file_sorter(self, filename: str) -> int:
-        """ Sorts file name by their looking at their day-of-year and hour block code 
+    def decompress_files(self) -> List[str]:
+        """ Decompresses all downloaded Rinex files inside a specified directory.
+
+            Files are shared out between a pool of processes, and every file is
+            attempted even if others fail.
 
-            File names are of the form: /file/path/ssssdddh.YYo
-            We focus on using dddh and YY as our sorting keys.
+            Returns:
+                Paths to the RINEX files made, in the order they were ready.
 
-            We extract the year from YYo to use as our first key.
+            Raises:
+                RuntimeError: the directory is empty, or some files could not be decompressed.
+        """
+        files = glob('{}/*'.format(self.__directory))
+        if not files:
+            raise RuntimeError(
+                'Could not decompress. No files were downloaded from FTP server.')
+        # files may already have been decompressed while they were downloaded
+        files = [f for f in files if is_compressed(f) or is_hatanaka(f)]
+        started = time.monotonic()
+        ready = []
+        failures = []
+        if self.__workers == 1 or len(files) < 2:
+            for f in files:
+                try:
+                    ready.append(decompress_to_rinex(f))
+                except (OSError, ValueError) as e:
+                    failures.append((f, e))
+        else:
+            with process_pool(min(self.__workers, len(files))) as pool:
+                futures = {self.metrics.submit(pool, decompress_to_rinex, f): f for f in files}
+                for future in as_completed(futures):
+                    try:
+                        ready.append(future.result())
+                    except (OSError, ValueError) as e:
+                        failures.append((futures[future], e))
+        if files:
+            self.metrics.record_stage('decompress', time.monotonic() - started, len(files))
+        if failures:
+            raise RuntimeError('Could not decompress {} of {} files:\n{}'.format(
+                len(failures), len(files),
+                '\n'.join('{}: {}'.format(os.path.basename(f), e) for f, e in sorted(failures, key=lambda failure: failure[0]))))
+        return ready
 
-            In order to sort all ddd0 before ddd[a-x], we split the 4-letter string into
-            two components and add them together to get our second key.
+    def __window(self) -> Tuple[datetime, datetime]:
+        """ Get the window of epochs kept, see hour_window. """
+        return hour_window(datetime(*self.__start), datetime(*self.__end))
 
-            E.g. 
-            for 3140, we split into 314 + 0 = 314
-            for 314a, we split int 314 + ord(a) = 314 + 97
+    def tree(self, plan: FetchPlan) -> TreeMerge:
+        """ Start a hierarchical merge of the files of a plan, to be reported to it as they are downloaded.
 
             Args:
-                filename: the filename in format /file/path/ssssdddh.YYo
+                plan: the files that are being downloaded, already decompressed
 
-            Returns: 
-                Return a tuple (YY, ddd + h) that we want the sorting function to sort on 
+            Returns:
+                The merge, to close once done with it.
         """
-        filename = filename.split('/')[-1]
-        year = int(filename[-3:-1])  # extracts YY from ssssdddh.YYo
-        day_info = filename[4:8]  # extracts dddh from ssssdddh.YYo
-        day_of_year = int(day_info[:3])  # ddd
-        hour_block = day_info[-1]    # h
-        if hour_block.isdigit():
-            return (year, day_of_year)
-        return (year, day_of_year + ord(hour_block))
-
-    def decompress_files(self):
-        """ Decompresses all downloaded Rinex files inside a specified directory. """
-        crx2rnx_path = os.path.join(ROOT_DIR, 'CRX2RNX')
-        if not os.path.isfile(crx2rnx_path):
-            raise OSError('Cannot find CRX2RNX binary in project directory!')
-
-        if glob('{}/*'.format(self.__directory)):
-            subprocess.run(["gunzip", "-dr", self.__directory])
-            # convert Hatanaka compressed RINEX to standard RINEX
-            for f in glob('{}/*.??d'.format(self.__directory)):
-                subprocess.run([crx2rnx_path, f])
-        else:
-            raise RuntimeError(
-                'Could not decompress. No files were downloaded from FTP server.')
+        start, end = self.__window()
+        return TreeMerge(plan, self.__directory, self.__output, start, end, self.__decimate, self.__workers,
+                         metrics=self.metrics, compression=self.__compression)
+
+    def index(self, file: PlannedFile) -> ObservationFile:
+        """ Open and index a downloaded file of a plan, ready to be merged (see merge).
 
-    def merge(self):
-        """ Merges RINEX files and extracts required time window from merged file. """
+            Args:
+                file: a planned file, already decompressed
+
+            Returns:
+                The indexed file, to close once merged.
+        """
+        return ObservationFile(os.path.join(self.__directory, file.rinex_name))
+
+    def merge(self, plan: FetchPlan = None, indexed: List[ObservationFile] = None):
+        """ Merges RINEX files and extracts required time window from merged file.
+
+            Args:
+                plan: the files that were downloaded (default: merge every file in the directory)
+                indexed: files of the plan that were already indexed, e.g. while the others were
+                    downloading (see index). They are closed once merged. (default: none)
+        """
+        indexed = {f.path: f for f in indexed or []}
         self.decompress_files()
-        teqc_path = os.path.join(ROOT_DIR, 'teqc')
-        if not os.path.isfile(teqc_path):
-            raise OSError('Cannot find TEQC binary in project directory!')
-
-        # currently cannot tell if there are daily logs or not
-        daily_logs = glob('{}/*0.??o'.format(self.__directory)) + \
-            glob('{}/*.??d'.format(self.__directory))
-        try:
-            # Merge and extract the time window from the Rinex files if using daily logs
-            if daily_logs:
-                start_timestamp = START_TIMESTAMP.format(*self.__start)
-                end_timestamp = END_TIMESTAMP.format(*self.__end)
-                # files must be entered into TEQC in (a specific) chronological order or it will fail
-                # hence we must sort them
-                day_logs_uncompressed = glob(
-                    '{}/*0.??o'.format(self.__directory))
-                hourly_logs_uncompressed = glob(
-                    '{}/*[a-z].??o'.format(self.__directory))
-                files = sorted(day_logs_uncompressed, key=self.__file_sorter) + \
-                    sorted(hourly_logs_uncompressed, key=self.__file_sorter)
-                subprocess.run(
-                    ['{0} -O.s M -st {1} -e {2} {3} > {4}.obs'.format(teqc_path, start_timestamp, end_timestamp, ' '.join(files), self.__station)], capture_output=True, shell=True)
-            else:
-                # Merge files as is if there are no daily logs present
-                subprocess.run(
-                    "{0} -O.s M {1}/*.??o > {2}.obs".format(teqc_path, self.__directory, self.__station), capture_output=True, shell=True)
-        except Exception as e:
-            print(e)
-            # raise RuntimeError('Error occurred while trying to merge files.')
+        if plan is not None and self.__hierarchical:
+            with self.metrics.stage('merge'), self.tree(plan) as tree:
+                for f in plan:
+                    tree.downloaded(f)
+                tree.result()
+            return
+        if plan is not None:
+            files = [os.path.join(self.__directory, f.rinex_name)
+                     for f in plan]
+        else:
+            files = sorted(glob('{}/*.??o'.format(self.__directory)))
+        start, end = self.__window()
+        with ExitStack() as stack:
+            stack.enter_context(self.metrics.stage('merge'))
+            # the files are indexed so only the epochs inside the window, and
+            # kept by the decimation, are read
+            for f in indexed.values():
+                stack.enter_context(f)
+            inputs = [indexed.get(f) or stack.enter_context(ObservationFile(f)) for f in files]
+            output = stack.enter_context(open_output(self.__output, self.__compression))
+            merge_epochs([f.epochs(start, end, self.__decimate) for f in inputs],
+                         output, start, end, self.__decimate)
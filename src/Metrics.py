@@ -0,0 +1,250 @@
+"""Class responsible for recording where a run spends its time.
+
+The downloader, merger and runner all record into one Metrics object: the
+wall time of every stage, one entry per downloaded file (source, bytes,
+attempts and wall time), counters (bytes transferred, FTP round trips,
+retries) and gauges (e.g. peak disk used by the temporary directory). Calls
+submitted to pools of processes through the metrics (see submit) measure the
+CPU time they use in the process that runs them.
+
+The metrics of a run can be written as a JSON trace, or as a Prometheus
+textfile (for the node exporter's textfile collector) when the path ends
+in .prom.
+
+  Typical usage example:
+
+  foo = Metrics()
+  with foo.stage('download'):
+      download()
+  foo.count('bytes_transferred', size)
+  foo.write('metrics.json')
+"""
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from src.Output import atomic_write
+
+PROMETHEUS_SUFFIX = '.prom'
+PROMETHEUS_PREFIX = 'rinex_'
+DISK_INTERVAL = 0.5  # seconds between samples of the disk used by a directory
+
+
+def timed_call(function: Callable, *args, **kwargs) -> Tuple[Any, float]:
+    """ Call a function and measure the CPU time it uses, e.g. in a process of a pool.
+
+        Returns:
+            What the function returned and the CPU seconds it used.
+    """
+    started = time.process_time()
+    result = function(*args, **kwargs)
+    return result, time.process_time() - started
+
+
+def directory_size(path: str) -> int:
+    """ Get the number of bytes of the files in a directory and its subdirectories. """
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                continue  # removed while walking
+    return size
+
+
+def escape_label(value: str) -> str:
+    """ Escape a Prometheus label value. """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_name(name: str) -> str:
+    """ Turn a metric name into a valid Prometheus one, e.g. 'merge input' -> rinex_merge_input """
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class Metrics:
+    """ Thread safe record of the stages, files, counters and gauges of a run. """
+
+    def __init__(self):
+        self.__started = time.time()
+        self.__clock = time.monotonic()
+        self.__stages: Dict[str, Dict[str, float]] = {}
+        self.__files: List[Dict[str, Any]] = []
+        self.__counters: Dict[str, float] = {}
+        self.__gauges: Dict[str, float] = {}
+        self.__lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # e.g. a merger sent to a pool of processes, which then records into its own copy
+        state = self.__dict__.copy()
+        del state['_Metrics__lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        """ Get the seconds since the metrics were started. """
+        return time.monotonic() - self.__clock
+
+    def record_stage(self, name: str, seconds: float, items: int = 1):
+        """ Add the wall time and number of items of a stage, e.g. from a pool of threads. """
+        with self.__lock:
+            stage = self.__stages.setdefault(name, {'items': 0, 'seconds': 0.0})
+            stage['items'] += items
+            stage['seconds'] += seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Time a stage, adding to any earlier time spent in it. """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.monotonic() - started)
+
+    def count(self, name: str, amount: float = 1):
+        """ Add to a counter. """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def gauge(self, name: str, value: float):
+        """ Set a gauge. """
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def peak(self, name: str, value: float):
+        """ Raise a gauge to a value, if it is higher. """
+        with self.__lock:
+            self.__gauges[name] = max(self.__gauges.get(name, value), value)
+
+    def file(self, name: str, source: str, size: int, seconds: float, **fields):
+        """ Record a file that was fetched.
+
+            Args:
+                name: name of the file
+                source: where the file came from, e.g. ftp or cache
+                size: number of bytes fetched
+                seconds: wall time spent fetching it, including retries
+                fields: anything else worth knowing, e.g. the server or number of attempts
+        """
+        entry = dict(name=name, source=source, bytes=size, seconds=seconds,
+                     started=self.elapsed() - seconds, **fields)
+        with self.__lock:
+            self.__files.append(entry)
+
+    def submit(self, pool: Executor, function: Callable, *args, **kwargs) -> Future:
+        """ Submit a call to a pool of processes, adding the CPU time it uses to subprocess_cpu_seconds.
+
+            Returns:
+                The future of what the function returns. Cancelling it cancels the call if it has not started.
+        """
+        outer = Future()
+        inner = pool.submit(timed_call, function, *args, **kwargs)
+
+        def done(inner: Future):
+            if outer.cancelled():
+                return
+            if inner.cancelled():
+                outer.cancel()
+            elif inner.exception() is not None:
+                outer.set_exception(inner.exception())
+            else:
+                result, seconds = inner.result()
+                self.count('subprocess_cpu_seconds', seconds)
+                outer.set_result(result)
+
+        outer.add_done_callback(lambda f: f.cancelled() and inner.cancel())
+        inner.add_done_callback(done)
+        return outer
+
+    @contextmanager
+    def watch_disk(self, path: str, interval: float = DISK_INTERVAL) -> Iterator[None]:
+        """ Sample the disk used by a directory in the background, keeping the peak as peak_disk_bytes. """
+        stop = threading.Event()
+
+        def sample():
+            while True:
+                self.peak('peak_disk_bytes', directory_size(path))
+                if stop.wait(interval):
+                    return
+
+        thread = threading.Thread(target=sample, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.peak('peak_disk_bytes', directory_size(path))
+
+    def trace(self) -> Dict[str, Any]:
+        """ Get everything recorded so far, ready to be written as JSON. """
+        with self.__lock:
+            files = [dict(f) for f in self.__files]
+            trace = {
+                'started': self.__started,
+                'seconds': self.elapsed(),
+                'stages': {name: dict(stage) for name, stage in self.__stages.items()},
+                'counters': dict(self.__counters),
+                'gauges': dict(self.__gauges),
+            }
+        trace['counters']['files'] = len(files)
+        trace['files'] = sorted(files, key=lambda f: f['started'])
+        return trace
+
+    def prometheus(self) -> str:
+        """ Get the metrics of the run in the Prometheus text format.
+
+            Every value describes the last run, so they are all gauges. Files are
+            only counted by source, as one series per file would never stop growing.
+        """
+        trace = self.trace()
+        lines = []
+
+        def metric(name: str, help_text: str, samples: List[str]):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.extend(samples)
+
+        metric(metric_name('last_run_timestamp_seconds'), 'Time the last run started.',
+               ['{} {}'.format(metric_name('last_run_timestamp_seconds'), trace['started'])])
+        metric(metric_name('run_seconds'), 'Wall time of the last run.',
+               ['{} {}'.format(metric_name('run_seconds'), trace['seconds'])])
+        for field in ('seconds', 'items'):
+            name = metric_name('stage_' + field)
+            metric(name, 'Wall time spent in every stage.' if field == 'seconds' else 'Items every stage worked on.',
+                   ['{}{{stage="{}"}} {}'.format(name, escape_label(stage), values[field])
+                    for stage, values in sorted(trace['stages'].items())])
+        sources = {}
+        for f in trace['files']:
+            sources[f['source']] = sources.get(f['source'], 0) + 1
+        name = metric_name('files_by_source')
+        metric(name, 'Files fetched from every source.',
+               ['{}{{source="{}"}} {}'.format(name, escape_label(source), count)
+                for source, count in sorted(sources.items())])
+        for kind in ('counters', 'gauges'):
+            for key, value in sorted(trace[kind].items()):
+                metric(metric_name(key), '{} of the last run.'.format(key.replace('_', ' ').capitalize()),
+                       ['{} {}'.format(metric_name(key), value)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """ Write the metrics to a file, replacing it in one step so collectors never read half a file.
+
+            Args:
+                path: where to write them: a Prometheus textfile if it ends in .prom, a JSON trace otherwise
+        """
+        if path.endswith(PROMETHEUS_SUFFIX):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.trace(), indent=2, sort_keys=True) + '\n'
+        # readable by everyone, e.g. for a collector running as another user
+        with atomic_write(path, permissions=0o644) as f:
+            f.write(text)
@@ -0,0 +1,206 @@
+"""Class responsible for sharing downloads out between mirrors of the archive.
+
+Every mirror is probed first, timing how long it takes to log in and to
+transfer the start of one of the files (PROBE_BYTES of it). The files to
+download are then split between the mirrors in proportion to their estimated
+throughput, which starts out as the throughput of that sample (or, for a
+mirror that could not send it, the inverse of its login latency, as TCP
+throughput is bounded by window / round trip time) and is updated with the
+measured throughput of their transfers as they complete. A mirror that runs
+out of files steals the last files queued on the mirror that is furthest from
+finishing, so a slow mirror never holds up the download.
+
+  Typical usage example:
+
+  foo = MirrorManager(servers, connect)
+  foo.probe(sample_path)
+  foo.split(files)
+  for mirror in foo.assign(workers):
+      # on a worker thread per mirror
+      file = foo.next(mirror)
+      foo.record(mirror, file.size, seconds)
+"""
+import threading
+import time
+from collections import deque
+from ftplib import FTP, all_errors
+from typing import Callable, Deque, List, Optional, Tuple
+from src.Planner import PlannedFile
+
+SMOOTHING = 0.5  # weight of the latest transfer in the throughput estimate
+UNKNOWN_SIZE = 1  # bytes counted for files of unknown size
+PROBE_BYTES = 256 * 1024  # bytes of a file transferred to estimate the throughput of a mirror
+
+
+def sample_throughput(ftp: FTP, path: str) -> Optional[float]:
+    """ Time the transfer of the first PROBE_BYTES of a file, leaving the session to be closed.
+
+        Returns:
+            The throughput in bytes per second, or None if the file could not be transferred.
+    """
+    received = 0
+    started = time.monotonic()
+    try:
+        ftp.voidcmd('TYPE I')
+        with ftp.transfercmd('RETR ' + path) as conn:
+            while received < PROBE_BYTES:
+                data = conn.recv(PROBE_BYTES - received)
+                if not data:
+                    break
+                received += len(data)
+    except all_errors:
+        return None
+    seconds = time.monotonic() - started
+    return received / seconds if received and seconds > 0 else None
+
+
+class Mirror:
+    """ A server of the archive and what is known about its speed.
+
+        Args:
+            server: (host, port) pair of the server
+            latency: seconds it took to connect and log in
+    """
+
+    def __init__(self, server: Tuple[str, int], latency: float):
+        self.server = server
+        self.latency = latency
+        self.throughput: Optional[float] = None  # bytes per second, once measured
+        self.queue: Deque[PlannedFile] = deque()
+
+    @property
+    def queued_bytes(self) -> int:
+        return sum(f.size or UNKNOWN_SIZE for f in self.queue)
+
+    def __repr__(self) -> str:
+        return 'Mirror({}:{})'.format(*self.server)
+
+
+class MirrorManager:
+    """ Splits a download between several mirrors and rebalances it as they go.
+
+        Args:
+            servers: list of (host, port) pairs of the mirrors
+            connect: callable opening a logged in session with a given server
+    """
+
+    def __init__(self, servers: List[Tuple[str, int]], connect: Callable[[Tuple[str, int]], FTP]):
+        self.__servers = servers
+        self.__connect = connect
+        self.__lock = threading.Lock()
+        self.mirrors: List[Mirror] = []
+
+    def speed(self, mirror: Mirror) -> float:
+        """ Estimate the throughput of a mirror in bytes per second.
+
+            Until a transfer from the mirror completes, it is scaled from the
+            throughput of the other mirrors by their latencies (or, before any
+            transfer completes, taken as the inverse of its latency).
+        """
+        if mirror.throughput is not None:
+            return mirror.throughput
+        measured = [m for m in self.mirrors if m.throughput is not None]
+        scale = sum(m.throughput * m.latency for m in measured) / len(measured) if measured else 1
+        return scale / max(mirror.latency, 1e-6)
+
+    def probe(self, sample: str = None) -> List[Mirror]:
+        """ Time a login to every mirror and the transfer of a sample, dropping the mirrors that cannot be reached.
+
+            Args:
+                sample: path of a file on the mirrors, whose first PROBE_BYTES are transferred to estimate their
+                    throughput, e.g. the largest file to download (default: only time the login)
+
+            Returns:
+                The reachable mirrors, fastest first.
+
+            Raises:
+                RuntimeError: no mirror could be reached.
+        """
+        mirrors = []
+        for server in self.__servers:
+            started = time.monotonic()
+            try:
+                ftp = self.__connect(server)
+            except (OSError, EOFError, RuntimeError):
+                continue
+            mirror = Mirror(server, time.monotonic() - started)
+            if sample is not None:
+                mirror.throughput = sample_throughput(ftp, sample)
+            mirrors.append(mirror)
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+        if not mirrors:
+            raise RuntimeError('Unable to connect to FTP. Please check your connection.')
+        self.mirrors = mirrors  # speed() scales the mirrors without a sample by those with one
+        self.mirrors = sorted(mirrors, key=lambda m: (-self.speed(m), m.latency))
+        return self.mirrors
+
+    def split(self, files: List[PlannedFile]):
+        """ Queue files on the mirrors in proportion to their estimated speed, keeping their order. """
+        assigned = [0] * len(self.mirrors)
+        with self.__lock:
+            for file in files:
+                # the mirror that would be done with it soonest
+                i = min(range(len(self.mirrors)),
+                        key=lambda i: (assigned[i] + (file.size or UNKNOWN_SIZE)) / self.speed(self.mirrors[i]))
+                self.mirrors[i].queue.append(file)
+                assigned[i] += file.size or UNKNOWN_SIZE
+
+    def assign(self, workers: int) -> List[Mirror]:
+        """ Share worker sessions out between the mirrors in proportion to their estimated speed.
+
+            Every mirror with files queued gets at least one session, as long as
+            there are enough workers.
+
+            Args:
+                workers: total number of sessions
+
+            Returns:
+                The mirror of every worker.
+        """
+        mirrors = [m for m in self.mirrors if m.queue] or self.mirrors[:1]
+        mirrors = mirrors[:workers]
+        slots = list(mirrors)
+        while len(slots) < workers:
+            # the mirror with the fewest sessions for its share of the speed
+            slots.append(min(mirrors, key=lambda m: slots.count(m) / self.speed(m)))
+        return slots
+
+    def next(self, mirror: Mirror) -> Optional[PlannedFile]:
+        """ Get the next file for a worker of a mirror, stealing one from another mirror if its queue is empty.
+
+            A file is stolen from the end of the queue of the mirror that is
+            expected to take the longest to finish, unless that mirror is
+            expected to get to it before this one could download it.
+
+            Returns:
+                The file to download, or None if there is nothing left worth taking.
+        """
+        with self.__lock:
+            if mirror.queue:
+                return mirror.queue.popleft()
+            victims = [m for m in self.mirrors if m.queue]
+            if not victims:
+                return None
+            victim = max(victims, key=lambda m: m.queued_bytes / self.speed(m))
+            file = victim.queue[-1]
+            if victim.queued_bytes / self.speed(victim) <= (file.size or UNKNOWN_SIZE) / self.speed(mirror):
+                return None
+            return victim.queue.pop()
+
+    def record(self, mirror: Mirror, size: Optional[int], seconds: float):
+        """ Update the throughput of a mirror with a completed transfer. """
+        if not size or seconds <= 0:
+            return
+        with self.__lock:
+            measured = size / seconds
+            mirror.throughput = measured if mirror.throughput is None else \
+                SMOOTHING * measured + (1 - SMOOTHING) * mirror.throughput
+
+    def cancel(self):
+        """ Drop every queued file, so workers stop after their current transfer. """
+        with self.__lock:
+            for mirror in self.mirrors:
+                mirror.queue.clear()
@@ -0,0 +1,182 @@
+"""Class responsible for writing merged observation files compressed, as they are merged.
+
+Merged files of 1 second data over several days are large plain text. Instead
+of compressing the merged file once it is written, the merge can write to a
+CompressedWriter, which encodes the RINEX text to Compact RINEX (Hatanaka) and
+gzip as it comes in, so the uncompressed file never touches the disk. Compact
+RINEX keeps only the differences of the observations from epoch to epoch, which
+gzip then compresses much better than the observations themselves.
+
+Files that readers may open while they are rewritten (indexes, manifests,
+metrics) are written through atomic_write, which replaces them in one step once
+they are complete, and so are the merged files of a hierarchical merge
+(atomic_output, open_output through atomic_write).
+
+  Typical usage example:
+
+  with open_output('nybp.crx.gz', HATANAKA_GZIP) as foo:
+      merge_epochs(readers, foo)
+"""
+import gzip
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, BinaryIO, Iterator, List, TextIO
+from src.Hatanaka import CRXEncoder
+
+GZIP = 'gzip'
+HATANAKA = 'hatanaka'
+HATANAKA_GZIP = 'hatanaka+gzip'
+# extension of the merged file for every compression
+EXTENSIONS = {None: '.obs', GZIP: '.obs.gz', HATANAKA: '.crx', HATANAKA_GZIP: '.crx.gz'}
+COMPRESSIONS = (GZIP, HATANAKA, HATANAKA_GZIP)
+BUFFER_SIZE = 1024 * 1024  # characters of RINEX gathered before they are compressed
+GZIP_LEVEL = 6  # like the gzip tool
+PARTIAL_SUFFIX = '.part'
+
+
+def output_name(station: str, compression: str = None) -> str:
+    """ Get the default name of the merged file of a station, e.g. nybp.crx.gz. """
+    return station.lower() + EXTENSIONS[compression]
+
+
+class CompressedWriter(io.TextIOBase):
+    """ Text file compressing the RINEX observations written to it on their way to a binary file.
+
+        Args:
+            raw: binary file the compressed data is written to
+            compression: GZIP, HATANAKA or HATANAKA_GZIP
+            close_raw: close the binary file when the writer is closed, e.g. not for stdout (default: True)
+    """
+
+    def __init__(self, raw: BinaryIO, compression: str, close_raw: bool = True):
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        self.__raw = raw
+        self.__close_raw = close_raw
+        self.__encoder = CRXEncoder() if compression in (HATANAKA, HATANAKA_GZIP) else None
+        self.__gzip = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL, filename='') \
+            if compression in (GZIP, HATANAKA_GZIP) else None
+        self.__buffer: List[str] = []
+        self.__buffered = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        """ Write RINEX text, compressing it once enough of it is gathered.
+
+            Returns:
+                The number of characters written.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        self.__buffer.append(text)
+        self.__buffered += len(text)
+        if self.__buffered >= BUFFER_SIZE:
+            self.__compress()
+        return len(text)
+
+    def __compress(self, final: bool = False):
+        """ Compress the text gathered so far, and whatever the encoder holds back if it is the end. """
+        data = ''.join(self.__buffer).encode('latin-1')
+        self.__buffer = []
+        self.__buffered = 0
+        if self.__encoder is not None:
+            data = self.__encoder.compress(data) + (self.__encoder.flush() if final else b'')
+        (self.__gzip or self.__raw).write(data)
+
+    def flush(self):
+        """ Compress the text gathered so far. Compact RINEX epochs still being differenced are held back. """
+        if not self.closed and self.__buffer:
+            self.__compress()
+
+    def close(self):
+        """ Compress the rest of the text and finish the compressed data. """
+        if self.closed:
+            return
+        try:
+            self.__compress(final=True)
+            if self.__gzip is not None:
+                self.__gzip.close()
+            self.__raw.flush()
+        finally:
+            self.__release()
+
+    def __release(self):
+        super().close()
+        if self.__close_raw:
+            self.__raw.close()
+
+    def __exit__(self, kind, *args):
+        if kind is None:
+            self.close()
+        else:
+            # the data is incomplete, so it is not finished off
+            self.__release()
+
+
+def open_output(path: str, compression: str = None) -> TextIO:
+    """ Open a merged file for writing, compressed as it is written.
+
+        Args:
+            path: path of the merged file
+            compression: GZIP, HATANAKA or HATANAKA_GZIP (default: plain RINEX)
+
+        Returns:
+            A text file the RINEX observations are written to.
+    """
+    if compression is None:
+        return open(path, 'w', encoding='latin-1')
+    return CompressedWriter(open(path, 'wb'), compression)
+
+
+@contextmanager
+def atomic_output(path: str, compression: str = None) -> Iterator[TextIO]:
+    """ Open a merged file for writing like open_output, through atomic_write, so it only appears once complete.
+
+        Args:
+            path: path of the merged file
+            compression: GZIP, HATANAKA or HATANAKA_GZIP (default: plain RINEX)
+
+        Yields:
+            A text file the RINEX observations are written to.
+    """
+    if compression is None:
+        with atomic_write(path, encoding='latin-1') as f:
+            yield f
+        return
+    with atomic_write(path, 'wb') as raw, CompressedWriter(raw, compression, close_raw=False) as f:
+        yield f
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', encoding: str = None, permissions: int = None) -> Iterator[IO]:
+    """ Write a file through a temporary file next to it, which replaces it in one step once it is complete.
+
+        Readers see either the old file or the whole new one, never part of it. If writing fails, the temporary
+        file is removed and the old file is left as it was.
+
+        Args:
+            path: path of the file
+            mode: 'w' to write text or 'wb' to write bytes (default: 'w')
+            encoding: encoding of the text (default: the locale's)
+            permissions: mode bits of the new file, e.g. 0o644 (default: only readable by the user, like mkstemp)
+
+        Yields:
+            The open temporary file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix='.' + os.path.basename(path), suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if permissions is not None:
+            os.chmod(temp_path, permissions)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
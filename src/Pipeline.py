@@ -0,0 +1,129 @@
+"""Class responsible for running items through stages of worker threads connected by bounded queues.
+
+Every stage has its own pool of threads taking items from its queue and
+putting what they return on the queue of the next stage. The queues are
+bounded, so a stage that falls behind makes the stages before it wait
+(backpressure) instead of letting work pile up, and every stage works on
+different items at the same time. The first error stops the pipeline: the
+later items are drained without being worked on, and the error is raised to
+whoever feeds or closes it.
+
+  Typical usage example:
+
+  with Pipeline([('decompress', decompress, 4), ('index', index, 1)]) as foo:
+      for item in items:
+          foo.put(item)
+      foo.close()
+  print(foo.stats())
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+DEPTH = 4  # items waiting in each queue before the stage feeding it has to wait
+_END = object()  # tells a worker there are no more items
+
+
+class Pipeline:
+    """ Stages of worker threads connected by bounded queues.
+
+        Args:
+            stages: list of (name, function, number of threads) tuples. Each function is called with an
+                item and returns the item for the next stage, or None to drop it.
+            depth: number of items waiting in each queue at most (default: 4)
+    """
+
+    def __init__(self, stages: List[Tuple[str, Callable[[Any], Any], int]], depth: int = DEPTH):
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage.')
+        if depth < 1 or any(workers < 1 for _, _, workers in stages):
+            raise ValueError('Queue depth and number of threads of every stage must be at least 1.')
+        self.__stages = stages
+        self.__queues = [queue.Queue(maxsize=depth) for _ in stages]
+        self.__running = [workers for _, _, workers in stages]  # threads left in every stage
+        self.__items = [0] * len(stages)
+        self.__busy = [0.0] * len(stages)  # seconds spent working, summed over threads
+        self.__error = None
+        self.__closed = False
+        self.__lock = threading.Lock()
+        self.__threads = [threading.Thread(target=self.__work, args=(i,), daemon=True)
+                          for i, (_, _, workers) in enumerate(stages) for _ in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if kind is not None:
+            # stop working on items, but let the threads finish
+            with self.__lock:
+                self.__error = self.__error or error
+        if not self.__closed:
+            self.__finish()
+
+    def __work(self, stage: int):
+        """ Work on the items of a stage until there are no more. """
+        _, function, _ = self.__stages[stage]
+        source = self.__queues[stage]
+        while True:
+            item = source.get()
+            if item is _END:
+                break
+            if self.__error is not None:
+                continue  # drain
+            started = time.monotonic()
+            try:
+                item = function(item)
+            except BaseException as e:
+                with self.__lock:
+                    self.__error = self.__error or e
+                continue
+            finally:
+                with self.__lock:
+                    self.__items[stage] += 1
+                    self.__busy[stage] += time.monotonic() - started
+            if item is not None and stage + 1 < len(self.__stages):
+                self.__queues[stage + 1].put(item)
+        with self.__lock:
+            self.__running[stage] -= 1
+            last = not self.__running[stage]
+        if last and stage + 1 < len(self.__stages):
+            for _ in range(self.__stages[stage + 1][2]):
+                self.__queues[stage + 1].put(_END)
+
+    def put(self, item: Any):
+        """ Feed an item to the first stage, waiting while its queue is full.
+
+            Safe to call from several threads.
+
+            Raises:
+                Exception: a stage failed, with its error.
+        """
+        if self.__error is not None:
+            raise self.__error
+        self.__queues[0].put(item)
+
+    def __finish(self):
+        self.__closed = True
+        for _ in range(self.__stages[0][2]):
+            self.__queues[0].put(_END)
+        for thread in self.__threads:
+            thread.join()
+
+    def close(self):
+        """ Tell the pipeline there are no more items and wait for every stage to finish them.
+
+            Raises:
+                Exception: a stage failed, with its error.
+        """
+        self.__finish()
+        if self.__error is not None:
+            raise self.__error
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """ Get the number of items every stage worked on and the seconds its threads spent on them. """
+        with self.__lock:
+            return {name: {'items': self.__items[i], 'seconds': self.__busy[i]}
+                    for i, (name, _, _) in enumerate(self.__stages)}
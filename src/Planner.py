@@ -0,0 +1,167 @@
+"""Classes describing which RINEX files a request needs and how much they cost to fetch.
+
+For every day in the window the planner chooses between the full daily log and
+the hourly files covering the requested hours, picking whichever transfers the
+fewest bytes. The resulting plan is shared by the downloader and the merger.
+
+  Typical usage example:
+
+  foo = RinexPlanner(station)
+  files = foo.choose(listing, year, yday, first_hour, last_hour)
+  plan = FetchPlan(station, planned_files)
+  print(plan.describe())
+  everything = FetchPlan.union([plan, other_plan])
+"""
+import string
+from datetime import datetime, timedelta
+from typing import Iterator, List, NamedTuple, Optional
+from src.Listing import DIRECTORY_PATH, Listing
+
+HOUR_BLOCKS = string.ascii_lowercase[:24]  # a (00:00) through x (23:00)
+
+
+class PlannedFile(NamedTuple):
+    """ A single archive file to fetch.
+
+        Args:
+            year: 4-digit year
+            yday: day-of-year
+            name: name of the file on the FTP server
+            size: size of the file in bytes (None if unknown)
+    """
+    year: int
+    yday: int
+    name: str
+    size: Optional[int] = None
+
+    @property
+    def rinex_name(self) -> str:
+        """ Name of the file once decompressed to standard RINEX, e.g. ssssddd0.yyd.Z -> ssssddd0.yyo """
+        name = self.name
+        for extension in ('.gz', '.Z'):
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+        if name.endswith('d'):
+            name = name[:-1] + 'o'  # Hatanaka compressed
+        return name
+
+    @property
+    def station(self) -> str:
+        """ Station the file belongs to, from the first 4 characters of its name. """
+        return self.name[:4]
+
+    @property
+    def is_daily(self) -> bool:
+        """ True for full day logs (hour block code 0), False for hourly files. """
+        return self.name[7] == '0'
+
+    @property
+    def start(self) -> datetime:
+        """ Time the file starts at: midnight for full day logs, the start of its hour for hourly files. """
+        day = datetime(self.year, 1, 1) + timedelta(days=self.yday - 1)
+        return day if self.is_daily else day + timedelta(hours=HOUR_BLOCKS.index(self.name[7]))
+
+
+class FetchPlan:
+    """ The ordered list of files needed to cover a time window.
+
+        Args:
+            station: 4-character site (base) identifier ('' for a plan across several stations)
+            files: files to fetch in chronological order
+    """
+
+    def __init__(self, station: str, files: List[PlannedFile]):
+        self.station = station.lower()
+        self.files = files
+
+    def __iter__(self) -> Iterator[PlannedFile]:
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @classmethod
+    def union(cls, plans: List['FetchPlan']) -> 'FetchPlan':
+        """ Combine several plans into one that fetches every file they need exactly once.
+
+            Args:
+                plans: plans of any stations
+
+            Returns:
+                A plan with the files in the order they first appear.
+        """
+        files = {}
+        for plan in plans:
+            for file in plan:
+                files.setdefault((file.year, file.yday, file.name), file)
+        stations = {plan.station for plan in plans}
+        return cls(stations.pop() if len(stations) == 1 else '', list(files.values()))
+
+    @property
+    def total_bytes(self) -> int:
+        """ Total number of bytes to transfer, counting files of unknown size as 0. """
+        return sum(f.size or 0 for f in self.files)
+
+    def remote_path(self, file: PlannedFile) -> str:
+        """ Get the full path of a planned file on the FTP server. """
+        return '{}/{}'.format(DIRECTORY_PATH.format(file.year, file.yday, file.station), file.name)
+
+    def describe(self) -> str:
+        """ Describe the plan as human readable text, one file per line followed by the total. """
+        lines = ['{:>12}  {}'.format('?' if f.size is None else f.size, self.remote_path(f))
+                 for f in self.files]
+        lines.append('{} files, {} bytes'.format(len(self.files), self.total_bytes))
+        return '\n'.join(lines)
+
+
+class RinexPlanner:
+    """ Chooses the cheapest set of files covering part of a day.
+
+        Args:
+            station: 4-character site (base) identifier
+    """
+
+    def __init__(self, station: str):
+        self.__station = station.lower()
+
+    def daily_names(self, year: int, yday: int) -> List[str]:
+        """ Names a full day log can have, newest format first.
+
+            Older full day logs look different and are compressed differently.
+        """
+        return ["{}{:03d}0.{:02d}o.gz".format(self.__station, yday, year % 100),
+                "{}{:03d}0.{:02d}d.Z".format(self.__station, yday, year % 100)]
+
+    def hourly_names(self, year: int, yday: int, first_hour: int, last_hour: int) -> List[str]:
+        """ Names of the hourly files between two hours (inclusive). """
+        return ["{}{:03d}{}.{:02d}o.gz".format(self.__station, yday, h, year % 100)
+                for h in HOUR_BLOCKS[first_hour:last_hour + 1]]
+
+    def choose(self, listing: Listing, year: int, yday: int, first_hour: int, last_hour: int) -> List[str]:
+        """ Choose the files that cover a range of hours of a day with the fewest bytes.
+
+            The full day log is preferred unless the hourly files are all available
+            and their sizes are known to add up to fewer bytes than it.
+
+            Args:
+                listing: mapping of file names in the day's directory to their sizes
+                year: 4-digit year
+                yday: day-of-year
+                first_hour: first hour needed in 24-hour format
+                last_hour: last hour needed in 24-hour format
+
+            Returns:
+                A list of file names. Hourly files that are not available yet are
+                still included so the caller can warn about them.
+        """
+        hourly = self.hourly_names(year, yday, first_hour, last_hour)
+        daily = next((name for name in self.daily_names(year, yday)
+                      if name in listing), None)
+        if daily is None:
+            return hourly
+        if not all(name in listing for name in hourly):
+            return [daily]
+        sizes = [listing[name] for name in hourly + [daily]]
+        if None in sizes or sum(sizes[:-1]) >= sizes[-1]:
+            return [daily]
+        return hourly
@@ -0,0 +1,579 @@
+"""Classes responsible for reading and writing RINEX 2 observation files.
+
+Observation files are read one epoch at a time, so files of any length can be
+processed with bounded memory. Observations are kept as the text of their
+16-character fields (F14.3 value, loss of lock indicator and signal strength)
+and are written back out exactly as they were read, only rearranged to match
+the observation types of the output file.
+
+Files on disk can also be memory-mapped with an index of where each epoch
+starts, so a time window is found with a binary search and only the epochs
+inside it are ever read. Decimating to a longer interval is done on the index
+too, so the epochs that are dropped are never parsed.
+
+  Typical usage example:
+
+  foo = ObservationReader(f)
+  writer = ObservationWriter(out, foo.header)
+  writer.write_header()
+  for epoch in foo:
+      writer.write(epoch)
+
+  with ObservationFile(path) as foo:
+      for epoch in foo.epochs(start, end):
+          writer.write(epoch)
+"""
+import bisect
+import mmap
+import os
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+import numpy as np
+
+LABEL_COLUMN = 60
+VERSION_LABEL = 'RINEX VERSION / TYPE'
+TYPES_LABEL = '# / TYPES OF OBSERV'
+INTERVAL_LABEL = 'INTERVAL'
+FIRST_OBS_LABEL = 'TIME OF FIRST OBS'
+LAST_OBS_LABEL = 'TIME OF LAST OBS'
+END_OF_HEADER_LABEL = 'END OF HEADER'
+STAMP_WIDTH = 26  # ' yy mm dd hh mm ss.sssssss'
+FIELD_WIDTH = 16
+FIELDS_PER_LINE = 5
+TYPES_PER_LINE = 9
+SATELLITES_PER_LINE = 12
+CLOCK_COLUMN = 68
+EVENT_FLAGS = (2, 3, 4, 5)  # followed by header records instead of observations
+CYCLE_SLIP_FLAG = 6  # cycle slips of the epoch before, at the same time
+BLANK_FIELD = ' ' * FIELD_WIDTH
+TIME_ORIGIN = datetime(1980, 1, 1)
+
+
+def parse_epoch_time(stamp: str) -> Optional[datetime]:
+    """ Parse the time of an epoch line.
+
+        Args:
+            stamp: the first 26 columns of the epoch line, e.g. ' 17  9 14  0  0  0.0000000'
+
+        Returns:
+            A datetime object, or None if the epoch has no time (allowed for events).
+    """
+    if not stamp.strip():
+        return None
+    year, month, day, hour, minute = (int(stamp[i:i + 3]) for i in range(0, 15, 3))
+    seconds = float(stamp[15:STAMP_WIDTH])
+    # two digit years from 80 onwards belong to the 20th century
+    year += 1900 if year >= 80 else 2000
+    return datetime(year, month, day, hour, minute) + timedelta(microseconds=round(seconds * 1e6))
+
+
+def record_lines(flag: int, count: int, types: int) -> int:
+    """ Get how many lines follow the first line of an epoch record.
+
+        Args:
+            flag: epoch flag
+            count: number in columns 30-32 (satellites, or header records for events)
+            types: number of observation types in effect
+
+        Returns:
+            The number of lines.
+    """
+    if flag in EVENT_FLAGS:
+        return count
+    continuation = max(count - 1, 0) // SATELLITES_PER_LINE
+    return continuation + count * ((types + FIELDS_PER_LINE - 1) // FIELDS_PER_LINE)
+
+
+def microseconds(time: datetime) -> int:
+    """ Convert a time to the number of microseconds since TIME_ORIGIN. """
+    return (time - TIME_ORIGIN) // timedelta(microseconds=1)
+
+
+def interval_microseconds(interval: float) -> int:
+    """ Convert a decimation interval in seconds to microseconds.
+
+        Raises:
+            ValueError: the interval is not positive.
+    """
+    step = round(interval * 10 ** 6)
+    if step <= 0:
+        raise ValueError('Decimation interval must be positive.')
+    return step
+
+
+def is_aligned(time: datetime, interval: float) -> bool:
+    """ Check whether an epoch is kept when decimating to an interval in seconds.
+
+        Epochs are kept at whole multiples of the interval since TIME_ORIGIN, so
+        intervals that divide a day keep the same epochs as teqc -O.dec, e.g.
+        every :00 and :30 second for 30.
+    """
+    return microseconds(time) % interval_microseconds(interval) == 0
+
+
+def format_epoch_time(time: datetime) -> str:
+    """ Format a time as the first 26 columns of an epoch line, e.g. ' 17  9 14  0  0  0.0000000' """
+    return ' {:02d} {:2d} {:2d} {:2d} {:2d}{:11.7f}'.format(
+        time.year % 100, time.month, time.day, time.hour, time.minute, time.second + time.microsecond / 1e6)
+
+
+class Epoch(NamedTuple):
+    """ One record of an observation file.
+
+        Args:
+            time: time of the epoch (events without a time take the time of the epoch before them)
+            stamp: the first 26 columns of the epoch line, written back out as they were read
+            flag: epoch flag, 0 for normal observations
+            satellites: satellite numbers, e.g. G01
+            clock: receiver clock offset as written in columns 69-80 ('' if absent)
+            observations: for every satellite, one 16-character field per observation type
+            types: observation types the fields follow
+            records: header records that follow an event (epoch flags 2 to 5)
+    """
+    time: datetime
+    stamp: str
+    flag: int
+    satellites: List[str]
+    clock: str
+    observations: List[List[str]]
+    types: Tuple[str, ...]
+    records: List[str]
+
+    @property
+    def is_event(self) -> bool:
+        """ True for event records (epoch flags 2 to 5), False for epochs holding observations. """
+        return self.flag in EVENT_FLAGS
+
+
+def label(line: str) -> str:
+    """ Get the label of a header record, e.g. 'END OF HEADER'. """
+    return line[LABEL_COLUMN:].strip()
+
+
+def parse_types(lines: List[str]) -> Tuple[str, ...]:
+    """ Parse the observation types of consecutive '# / TYPES OF OBSERV' records. """
+    count = int(lines[0][:6])
+    types = [line[i:i + 6].strip() for line in lines
+             for i in range(6, 6 + 6 * TYPES_PER_LINE, 6)]
+    return tuple(t for t in types if t)[:count]
+
+
+def format_types(types: Tuple[str, ...]) -> List[str]:
+    """ Format observation types as '# / TYPES OF OBSERV' records. """
+    lines = []
+    for i in range(0, max(len(types), 1), TYPES_PER_LINE):
+        count = '{:6d}'.format(len(types)) if i == 0 else ' ' * 6
+        content = count + ''.join('{:>6}'.format(t) for t in types[i:i + TYPES_PER_LINE])
+        lines.append('{:<60}{:<20}'.format(content, TYPES_LABEL))
+    return lines
+
+
+def types_event(types: Tuple[str, ...]) -> str:
+    """ Format an event (epoch flag 4) changing the observation types of the epochs after it. """
+    records = format_types(types)
+    return '{}  4{:3d}\n'.format(' ' * STAMP_WIDTH, len(records)) + ''.join(r + '\n' for r in records)
+
+
+class RinexHeader:
+    """ The header of a RINEX 2 observation file.
+
+        Args:
+            lines: header records without their line breaks, up to and including END OF HEADER
+    """
+
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        if not lines or label(lines[0]) != VERSION_LABEL:
+            raise ValueError('Not a RINEX file.')
+        if lines[0][5:6] != '2' or lines[0][20:21] != 'O':
+            raise ValueError('Only RINEX version 2 observation files are supported.')
+        types = [line for line in lines if label(line) == TYPES_LABEL]
+        if not types:
+            raise ValueError('RINEX header does not list any observation types.')
+        self.types = parse_types(types)
+
+    @classmethod
+    def read(cls, f: TextIO) -> 'RinexHeader':
+        """ Read a header from the start of a file, leaving the file at the first epoch. """
+        lines = []
+        for line in iter(f.readline, ''):
+            lines.append(line.rstrip('\r\n'))
+            if label(lines[-1]) == END_OF_HEADER_LABEL:
+                return cls(lines)
+        raise ValueError('RINEX header ended before END OF HEADER.')
+
+    def get(self, name: str) -> Optional[str]:
+        """ Get the first record with a given label, or None if there is none. """
+        return next((line for line in self.lines if label(line) == name), None)
+
+    @property
+    def interval(self) -> Optional[float]:
+        """ Observation interval in seconds, or None if the header does not give it. """
+        line = self.get(INTERVAL_LABEL)
+        return float(line[:10]) if line and line[:10].strip() else None
+
+    def replace(self, name: str, records: List[str]) -> 'RinexHeader':
+        """ Get a copy of the header with the records of a given label replaced.
+
+            Args:
+                name: label of the records to replace
+                records: new records, put where the first old one was (or before END OF HEADER); empty to remove them
+
+            Returns:
+                A new RinexHeader.
+        """
+        positions = [i for i, line in enumerate(self.lines) if label(line) == name]
+        at = positions[0] if positions else len(self.lines) - 1
+        lines = [line for i, line in enumerate(self.lines) if i not in positions[1:]]
+        lines[at:at + (1 if positions else 0)] = records
+        return RinexHeader(lines)
+
+    def with_types(self, types: Tuple[str, ...]) -> 'RinexHeader':
+        """ Get a copy of the header listing different observation types. """
+        return self.replace(TYPES_LABEL, format_types(types))
+
+    def with_first_epoch(self, time: datetime) -> 'RinexHeader':
+        """ Get a copy of the header with TIME OF FIRST OBS set, keeping its time system. """
+        line = self.get(FIRST_OBS_LABEL) or ''
+        content = '{:6d}{:6d}{:6d}{:6d}{:6d}{:13.7f}'.format(
+            time.year, time.month, time.day, time.hour, time.minute, time.second + time.microsecond / 1e6)
+        return self.replace(FIRST_OBS_LABEL, ['{:<60}{:<20}'.format(
+            content + line[43:LABEL_COLUMN], FIRST_OBS_LABEL)])
+
+
+class ObservationReader:
+    """ Reads a RINEX 2 observation file one epoch at a time.
+
+        Args:
+            f: observation file opened in text mode, positioned at its start
+            header: header of the file when f is positioned at an epoch instead (default: read from f)
+            types: observation types in effect at that epoch (default: those of the header)
+            time: time given to events without one at the start of f (default: datetime.min)
+    """
+
+    def __init__(self, f: TextIO, header: RinexHeader = None, types: Tuple[str, ...] = None,
+                 time: datetime = datetime.min):
+        self.__file = f
+        self.header = header or RinexHeader.read(f)
+        self.__types = types or self.header.types
+        self.__time = time
+
+    def __next_line(self) -> str:
+        line = self.__file.readline()
+        if not line:
+            raise ValueError('RINEX file ended in the middle of an epoch.')
+        return line.rstrip('\r\n')
+
+    def __iter__(self) -> Iterator[Epoch]:
+        while True:
+            line = self.__file.readline()
+            if not line:
+                return
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            if len(line) < 32 or not line[28].isdigit():
+                raise ValueError('Invalid epoch line: {}'.format(line))
+            stamp = line[:STAMP_WIDTH]
+            flag = int(line[28])
+            count = int(line[29:32])
+            time = parse_epoch_time(stamp) or self.__time
+            self.__time = time
+            if flag in EVENT_FLAGS:
+                records = [self.__next_line() for _ in range(count)]
+                types = [r for r in records if label(r) == TYPES_LABEL]
+                if types:
+                    self.__types = parse_types(types)
+                yield Epoch(time, stamp, flag, [], '', [], self.__types, records)
+                continue
+            satellites = line[32:CLOCK_COLUMN]
+            clock = line[CLOCK_COLUMN:CLOCK_COLUMN + 12].rstrip()
+            for _ in range((count - 1) // SATELLITES_PER_LINE):
+                satellites += self.__next_line()[32:CLOCK_COLUMN]
+            satellites = [satellites[i:i + 3] for i in range(0, 3 * count, 3)]
+            lines_per_satellite = (len(self.__types) + FIELDS_PER_LINE - 1) // FIELDS_PER_LINE
+            observations = []
+            for _ in satellites:
+                text = ''.join(self.__next_line().ljust(FIELD_WIDTH * FIELDS_PER_LINE)
+                               for _ in range(lines_per_satellite))
+                observations.append([text[i:i + FIELD_WIDTH]
+                                     for i in range(0, FIELD_WIDTH * len(self.__types), FIELD_WIDTH)])
+            yield Epoch(time, stamp, flag, satellites, clock, observations, self.__types, [])
+
+
+class ObservationWriter:
+    """ Writes epochs to a RINEX 2 observation file.
+
+        Observations are rearranged to the observation types of the header;
+        types an epoch does not have are left blank.
+
+        Args:
+            f: file opened in text mode for writing
+            header: header of the output file
+    """
+
+    def __init__(self, f: TextIO, header: RinexHeader):
+        self.__file = f
+        self.header = header
+        self.__columns: Dict[Tuple[str, ...], List[Optional[int]]] = {}
+
+    def write_header(self):
+        """ Write out the header. """
+        self.__file.write(''.join(line + '\n' for line in self.header.lines))
+
+    def __columns_of(self, types: Tuple[str, ...]) -> List[Optional[int]]:
+        """ For every output observation type, the position of its field in an epoch with given types. """
+        columns = self.__columns.get(types)
+        if columns is None:
+            columns = [types.index(t) if t in types else None for t in self.header.types]
+            self.__columns[types] = columns
+        return columns
+
+    def write(self, epoch: Epoch):
+        """ Write out one epoch. """
+        if epoch.is_event:
+            # the output has a single list of observation types
+            records = [r for r in epoch.records if label(r) != TYPES_LABEL]
+            if epoch.records and not records:
+                return
+            self.__file.write('{}  {}{:3d}\n'.format(epoch.stamp, epoch.flag, len(records)))
+            self.__file.write(''.join(r + '\n' for r in records))
+            return
+        output = []
+        line = '{}  {}{:3d}{}'.format(epoch.stamp, epoch.flag, len(epoch.satellites),
+                                      ''.join(epoch.satellites[:SATELLITES_PER_LINE]))
+        if epoch.clock:
+            line = line.ljust(CLOCK_COLUMN) + epoch.clock
+        output.append(line)
+        for i in range(SATELLITES_PER_LINE, len(epoch.satellites), SATELLITES_PER_LINE):
+            output.append(' ' * 32 + ''.join(epoch.satellites[i:i + SATELLITES_PER_LINE]))
+        columns = self.__columns_of(epoch.types)
+        for fields in epoch.observations:
+            fields = [BLANK_FIELD if c is None else fields[c] for c in columns]
+            for i in range(0, len(fields), FIELDS_PER_LINE):
+                output.append(''.join(fields[i:i + FIELDS_PER_LINE]).rstrip())
+        self.__file.write(''.join(line + '\n' for line in output))
+
+
+class MappedLines:
+    """ Text file-like view of the lines in part of a memory-mapped file.
+
+        Args:
+            buffer: the memory-mapped file
+            start: byte offset of the first line
+            end: byte offset just past the last line
+    """
+
+    def __init__(self, buffer: mmap.mmap, start: int, end: int):
+        self.__buffer = buffer
+        self.__position = start
+        self.__end = end
+
+    def readline(self) -> str:
+        if self.__position >= self.__end:
+            return ''
+        stop = self.__buffer.find(b'\n', self.__position, self.__end)
+        stop = self.__end if stop < 0 else stop + 1
+        line = self.__buffer[self.__position:stop]
+        self.__position = stop
+        return line.decode('latin-1')
+
+
+class MappedSpans:
+    """ Text file-like view of the lines in several parts of a memory-mapped file, one after the other.
+
+        Args:
+            buffer: the memory-mapped file
+            spans: byte offsets of the first line and just past the last line of each part
+    """
+
+    def __init__(self, buffer: mmap.mmap, spans: List[Tuple[int, int]]):
+        self.__buffer = buffer
+        self.__spans = iter(spans)
+        self.__lines = MappedLines(buffer, 0, 0)
+
+    def readline(self) -> str:
+        line = self.__lines.readline()
+        while not line:
+            span = next(self.__spans, None)
+            if span is None:
+                return ''
+            self.__lines = MappedLines(self.__buffer, *span)
+            line = self.__lines.readline()
+        return line
+
+
+class ObservationFile:
+    """ Memory-mapped RINEX 2 observation file with an index of its records.
+
+        The file is scanned once when it is opened, recording the byte offset and
+        time of every record (epochs and events) in compact arrays: offsets has
+        one more entry than times, the size of the file, and flags holds the
+        epoch flag of every record. Any time window is then found with a binary
+        search, and only the records inside it are read. The records of a file
+        must be in chronological order.
+
+        Args:
+            path: path to the observation file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__map = None
+        self.__file = open(path, 'rb')
+        try:
+            if not os.fstat(self.__file.fileno()).st_size:
+                raise ValueError('Not a RINEX file.')
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            lines = MappedLines(self.__map, 0, len(self.__map))
+            self.header = RinexHeader.read(lines)
+            self.offsets = array('q')
+            self.times = array('q')  # microseconds since TIME_ORIGIN
+            self.flags = array('B')
+            # (first record, observation types) wherever the types change
+            self.__types = [(0, self.header.types)]
+            self.__scan(len(self.header.lines))
+        except BaseException:
+            self.close()
+            raise
+
+    def __scan(self, header_lines: int):
+        """ Index every record of the file. """
+        buffer = self.__map
+        position = 0
+        for _ in range(header_lines):
+            position = buffer.find(b'\n', position) + 1
+        size = len(buffer)
+        types = self.header.types
+        time = 0
+        while 0 < position < size:
+            end = buffer.find(b'\n', position)
+            end = size if end < 0 else end + 1
+            line = buffer[position:end].decode('latin-1')
+            if not line.strip():
+                position = end
+                continue
+            if len(line) < 32 or not line[28].isdigit():
+                raise ValueError('Invalid epoch line: {}'.format(line.rstrip()))
+            flag = int(line[28])
+            count = int(line[29:32])
+            stamp = parse_epoch_time(line[:STAMP_WIDTH])
+            if stamp is not None:
+                stamp = microseconds(stamp)
+                if stamp < time:
+                    raise ValueError('Epochs of {} are not in chronological order.'.format(self.path))
+                time = stamp
+            self.offsets.append(position)
+            self.times.append(time)
+            self.flags.append(flag)
+            records_start = end
+            for _ in range(record_lines(flag, count, len(types))):
+                if end >= size:
+                    raise ValueError('RINEX file ended in the middle of an epoch.')
+                end = buffer.find(b'\n', end)
+                end = size if end < 0 else end + 1
+            if flag in EVENT_FLAGS:
+                records = buffer[records_start:end].decode('latin-1').splitlines()
+                changed = [r for r in records if label(r) == TYPES_LABEL]
+                if changed:
+                    types = parse_types(changed)
+                    self.__types.append((len(self.offsets), types))
+            position = end
+        self.offsets.append(size)
+
+    def close(self):
+        """ Unmap and close the file. Slices of it must be released first. """
+        if self.__map is not None:
+            self.__map.close()
+        self.__file.close()
+
+    def __enter__(self) -> 'ObservationFile':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def time(self, record: int) -> datetime:
+        """ Get the time of a record by its position in the file. """
+        return TIME_ORIGIN + timedelta(microseconds=self.times[record])
+
+    def types_at(self, record: int) -> Tuple[str, ...]:
+        """ Get the observation types in effect at a record. """
+        return self.__types[bisect.bisect_right([i for i, _ in self.__types], record) - 1][1]
+
+    def window(self, start: datetime = None, end: datetime = None) -> Tuple[int, int]:
+        """ Find the records inside a time window.
+
+            Args:
+                start: time of the first record to include (default: no limit)
+                end: time of the last record to include (default: no limit)
+
+            Returns:
+                The positions of the first record inside the window and of the first record after it.
+        """
+        first = 0 if start is None else bisect.bisect_left(
+            self.times, microseconds(start))
+        last = len(self) if end is None else bisect.bisect_right(
+            self.times, microseconds(end))
+        return first, max(first, last)
+
+    def slice(self, start: datetime = None, end: datetime = None) -> memoryview:
+        """ Get the text of the records inside a time window without copying it. """
+        first, last = self.window(start, end)
+        return memoryview(self.__map)[self.offsets[first]:self.offsets[last]]
+
+    def records(self, start: datetime = None, end: datetime = None) -> Iterator[memoryview]:
+        """ Iterate over the text of each record inside a time window without copying it. """
+        first, last = self.window(start, end)
+        view = memoryview(self.__map)
+        for i in range(first, last):
+            yield view[self.offsets[i]:self.offsets[i + 1]]
+
+    def decimate(self, interval: float, start: datetime = None, end: datetime = None) -> np.ndarray:
+        """ Find the records inside a time window that are kept when decimating to an interval.
+
+            Epochs are selected from the index in one go, see is_aligned. Events
+            are always kept, as they can change the observation types.
+
+            Args:
+                interval: interval in seconds to keep epochs at
+                start: time of the first record to include (default: no limit)
+                end: time of the last record to include (default: no limit)
+
+            Returns:
+                The positions of the records kept, in order.
+        """
+        step = interval_microseconds(interval)
+        first, last = self.window(start, end)
+        times = np.frombuffer(self.times, dtype=np.int64)[first:last]
+        flags = np.frombuffer(self.flags, dtype=np.uint8)[first:last]
+        keep = (times % step == 0) | np.isin(flags, EVENT_FLAGS)
+        return np.flatnonzero(keep) + first
+
+    def epochs(self, start: datetime = None, end: datetime = None, interval: float = None) -> ObservationReader:
+        """ Read the records inside a time window.
+
+            Args:
+                start: time of the first record to include (default: no limit)
+                end: time of the last record to include (default: no limit)
+                interval: only read the epochs kept when decimating to this interval in seconds (default: all)
+
+            Returns:
+                An ObservationReader over the records.
+        """
+        first, last = self.window(start, end)
+        time = self.time(first - 1) if first else datetime.min
+        if interval is None:
+            lines = MappedLines(self.__map, self.offsets[first], self.offsets[last])
+        else:
+            records = self.decimate(interval, start, end)
+            # consecutive records are read as one span
+            breaks = np.flatnonzero(np.diff(records) != 1) + 1
+            offsets = np.frombuffer(self.offsets, dtype=np.int64)
+            lines = MappedSpans(self.__map, [(int(offsets[run[0]]), int(offsets[run[-1] + 1]))
+                                             for run in np.split(records, breaks) if len(run)])
+        return ObservationReader(lines, self.header, self.types_at(first), time)
@@ -4,15 +4,72 @@ The most important feature about this class is that it requires the user to pass
 in the RinexDownloader and RinexMerger as arguments into the constructor. This is done to 
 abstract away the initialisation detaiils of the injected dependencies.
 
+Every file flows through a pipeline as soon as it is downloaded: it is
+decompressed in a pool of processes and then indexed for the merge (or, for
+a hierarchical merge, its day is merged once complete), with bounded queues
+between the stages, so downloading, decompressing and merging overlap.
+
+The time spent in every stage, every file fetched, the FTP round trips and
+the peak disk used by the temporary directory are recorded in the runner's
+metrics, and can be written out as a JSON trace or a Prometheus textfile.
+
+Instead of writing the merged file, the runner can also stream the merged
+epochs to the caller while later files are still downloading (see stream).
+
   Typical usage example:
 
   foo = RinexRunner(station, start_time, end_time)
   foo.run()
 """
+import os
 import tempfile
+from contextlib import ExitStack
 from datetime import datetime
+from typing import Optional, Tuple
+from src.Cache import RinexCache
+from src.Catalog import StationCatalog
 from src.Downloader import RinexDownloader
-from src.Merger import RinexMerger
+from src.Listing import ListingIndex
+from src.Merger import RinexMerger, decompress_to_rinex, hour_window, process_pool
+from src.Metrics import Metrics
+from src.Pipeline import Pipeline
+from src.Planner import PlannedFile
+from src.Stream import ObservationStream
+
+LISTING_DIR = '.listings'  # directory listings and the station catalog live alongside the cached files
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FIRST_YEAR = 1994  # first year of the archive
+DECOMPRESS_WORKERS = os.cpu_count() or 1
+
+
+def check_window(start_date: datetime, end_date: datetime):
+    """ Check that a time window can be served by the archive.
+
+        Raises:
+            ValueError: the window is reversed, in the future or before the archive starts.
+    """
+    if start_date > end_date:
+        raise ValueError('Start date is past end date')
+    if start_date > datetime.now() or end_date > datetime.now():
+        raise ValueError(
+            'FTP does not have log files that extend all the way to your end date yet.')
+    if start_date.year < FIRST_YEAR or end_date.year < FIRST_YEAR:
+        raise ValueError('Date is too early')
+
+
+def open_caches(cache_dir: str = None) -> Tuple[Optional[RinexCache], ListingIndex, StationCatalog]:
+    """ Open the persistent caches shared across runs, or in-memory listings and catalog without them.
+
+        Args:
+            cache_dir: directory of the persistent file and listing caches (default: no cache)
+
+        Returns:
+            The file cache (None without a directory), the listing index and the station catalog.
+    """
+    if not cache_dir:
+        return None, ListingIndex(None), StationCatalog(None)
+    listing_dir = os.path.join(cache_dir, LISTING_DIR)
+    return RinexCache(cache_dir), ListingIndex(listing_dir), StationCatalog(listing_dir)
 
 
 class RinexRunner:
@@ -24,23 +81,132 @@ class RinexRunner:
             end_date: a datetime object
             downloader: reference to RinexDownloader (uninitialised)
             merger: reference to RinexMerger (uninitialised)
+            workers: largest number of concurrent FTP sessions used by the downloader (default: 1)
+            min_workers: smallest number of concurrent FTP sessions the downloader adapts down to (default: 1)
+            cache_dir: directory of the persistent file and listing caches shared across runs (default: no cache)
+            dry_run: only print the files that would be downloaded and their total size (default: False)
+            decimate: interval in seconds to decimate the merged file to (default: keep every epoch)
+            hierarchical: merge each day as soon as its files are downloaded, then the days in groups,
+                deleting files as they are merged (default: False)
+            metrics_out: path the metrics of the run are written to once it ends, as a Prometheus textfile
+                if it ends in .prom and as a JSON trace otherwise (default: not written)
+            output: path of the merged file (default: [station].obs in the current directory)
+            compression: compress the merged file as it is written: gzip, hatanaka or hatanaka+gzip
+                (default: plain RINEX)
      """
 
-    def __init__(self, station: str, start_date: datetime, end_date: datetime, downloader: RinexDownloader, merger: RinexMerger):
+    def __init__(self, station: str, start_date: datetime, end_date: datetime, downloader: RinexDownloader, merger: RinexMerger,
+                 workers: int = 1, cache_dir: str = None, dry_run: bool = False, decimate: float = None,
+                 min_workers: int = 1, hierarchical: bool = False, metrics_out: str = None, output: str = None,
+                 compression: str = None):
         self.__station = station
         self.__start_date = start_date
         self.__end_date = end_date
         self.__downloader = downloader
         self.__merger = merger
+        self.__workers = workers
+        self.__min_workers = min_workers
+        self.__cache, self.__index, self.__catalog = open_caches(cache_dir)
+        self.__dry_run = dry_run
+        self.__decimate = decimate
+        self.__hierarchical = hierarchical
+        self.__metrics_out = metrics_out
+        self.__output = output
+        self.__compression = compression
+        self.stats = {}  # items and busy seconds of every stage of the pipeline of the last run
+        self.metrics = Metrics()  # everything recorded during the last run
 
     def run(self):
         """ Downloads multiple RINEX files from FTP and merges them into a single file. """
-        with tempfile.TemporaryDirectory() as temp_dir:
+        self.metrics = Metrics()
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir, self.metrics.watch_disk(temp_dir):
+                self.__run(temp_dir)
+        finally:
+            if self.__metrics_out:
+                self.metrics.write(self.__metrics_out)
+
+    def stream(self) -> ObservationStream:
+        """ Start downloading the files of the time window, and stream their merged epochs as they come in.
+
+            The epochs kept are those run would write to the merged file. The
+            files are downloaded to a temporary directory, removed once the
+            stream is closed, when the metrics are written out too.
+
+            Returns:
+                The stream of merged epochs, to be closed once done with.
+        """
+        self.metrics = Metrics()
+        temp_dir = tempfile.TemporaryDirectory()
+
+        def close():
+            temp_dir.cleanup()
+            if self.__metrics_out:
+                self.metrics.write(self.__metrics_out)
+
+        try:
             downloader = self.__downloader(
-                self.__station, self.__start_date, self.__end_date, temp_dir)
-            merger = self.__merger(
-                self.__station, self.__start_date, self.__end_date, temp_dir)
-            downloader.download()
+                self.__station, self.__start_date, self.__end_date, temp_dir.name,
+                workers=self.__workers, min_workers=self.__min_workers, cache=self.__cache, index=self.__index,
+                catalog=self.__catalog, decompress=True, metrics=self.metrics)
+            with self.metrics.stage('plan'):
+                plan = downloader.fetch_plan()
+        except BaseException:
+            close()
+            raise
+        start, end = hour_window(self.__start_date, self.__end_date)
+        return ObservationStream(plan, temp_dir.name, downloader.download, start, end, self.__decimate,
+                                 metrics=self.metrics, cleanup=close)
+
+    def __run(self, temp_dir: str):
+        """ Download and merge the files in a temporary directory. """
+        # files are decompressed by the pipeline, in other processes than the transfers
+        downloader = self.__downloader(
+            self.__station, self.__start_date, self.__end_date, temp_dir,
+            workers=self.__workers, min_workers=self.__min_workers, cache=self.__cache, index=self.__index,
+            catalog=self.__catalog, decompress=False, metrics=self.metrics)
+        merger = self.__merger(
+            self.__station, self.__start_date, self.__end_date, temp_dir, decimate=self.__decimate,
+            hierarchical=self.__hierarchical, output=self.__output, metrics=self.metrics,
+            compression=self.__compression)
+        with self.metrics.stage('plan'):
+            plan = downloader.fetch_plan()
+        if self.__dry_run:
+            print(plan.describe())
+            return
+        with ExitStack() as stack:
+            processes = stack.enter_context(process_pool(DECOMPRESS_WORKERS))
+            tree = stack.enter_context(merger.tree(plan)) if self.__hierarchical else None
+            indexed = []
+            stack.callback(lambda: [f.close() for f in indexed])
+
+            def decompress(file: PlannedFile) -> PlannedFile:
+                if file.rinex_name != file.name:
+                    self.metrics.submit(processes, decompress_to_rinex, os.path.join(temp_dir, file.name)).result()
+                return file
+
+            def prepare(file: PlannedFile):
+                if tree is not None:
+                    tree.downloaded(file)
+                else:
+                    indexed.append(merger.index(file))
+
+            pipeline = stack.enter_context(Pipeline([
+                ('decompress', decompress, DECOMPRESS_WORKERS),
+                ('merge input', prepare, 1),
+            ]))
+            with self.metrics.stage('download'):
+                downloader.download(plan, on_file=pipeline.put)
+                pipeline.close()
+            self.stats = pipeline.stats()
+            for name, stage in self.stats.items():
+                self.metrics.record_stage(name, stage['seconds'], stage['items'])
+            for name, value in downloader.concurrency.stats().items():
+                self.metrics.gauge('concurrency_' + name, value)
             print("Merging files...")
-            merger.merge()
-            print('All done!')
+            if tree is not None:
+                with self.metrics.stage('merge'):
+                    tree.result()
+            else:
+                merger.merge(plan, indexed)
+        print('All done!')
@@ -0,0 +1,366 @@
+"""Class responsible for serving merged RINEX files over HTTP from a long-running process.
+
+A single grab_data run pays for starting Python, logging in to the FTP server,
+validating the station and a cold temporary directory, which is most of the
+time it takes for a window of an hour or two. The service pays for these once:
+it keeps logged in FTP sessions, the directory listings and the station catalog
+warm between requests, and every file it downloads stays decompressed on disk
+for later requests. Requests that need the same file at the same time share a
+single download of it, so overlapping windows are fetched and decompressed once.
+
+  GET /obs?station=nybp&start=2017-09-14T00:00:00Z&end=2017-09-14T02:59:59Z[&decimate=30]
+      the merged observation file of the window, as RINEX text
+  GET /metrics
+      the metrics of every request so far, as a Prometheus textfile
+
+  Typical usage example:
+
+  with RinexService(RinexDownloader, RinexMerger, workers=4) as foo:
+      foo.serve_forever('127.0.0.1', 8080)
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
+from ftplib import FTP, Error as FTPError
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+from src.Downloader import TRANSIENT_ERRORS, RinexDownloader
+from src.Merger import RinexMerger
+from src.Metrics import Metrics
+from src.Planner import FetchPlan, PlannedFile
+from src.Runner import TIMESTAMP_FORMAT, check_window, open_caches
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+OBS_PATH = '/obs'
+METRICS_PATH = '/metrics'
+IDLE_CHECK = 30.0  # seconds a session may sit idle before it is checked with a NOOP
+STORE_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB of decompressed files kept between requests
+FILES_DIR = 'files'
+
+
+class SessionPool:
+    """ Logged in FTP sessions kept open between requests.
+
+        Args:
+            size: number of idle sessions kept at most, the others are closed once used
+            idle_check: seconds a session may sit idle before it is checked with a NOOP (default: 30)
+    """
+
+    def __init__(self, size: int, idle_check: float = IDLE_CHECK):
+        self.__size = size
+        self.__idle_check = idle_check
+        self.__idle: List[Tuple[float, FTP]] = []  # (time it was handed back, session)
+        self.__lock = threading.Lock()
+
+    def __take(self) -> Optional[FTP]:
+        """ Take the most recently used idle session that still works, if any. """
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    return None
+                returned, ftp = self.__idle.pop()
+            if time.monotonic() - returned < self.__idle_check:
+                return ftp
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except (FTPError,) + TRANSIENT_ERRORS:
+                ftp.close()  # e.g. timed out by the server
+
+    @contextmanager
+    def session(self, connect: Callable[[], FTP]) -> Iterator[FTP]:
+        """ Lend a logged in session, opening one if none is idle.
+
+            Args:
+                connect: opens a new logged in session
+
+            Returns:
+                The session, handed back for reuse unless it failed or was closed while lent.
+        """
+        ftp = self.__take() or connect()
+        try:
+            yield ftp
+        except BaseException:
+            ftp.close()  # in an unknown state
+            raise
+        if ftp.sock is None:
+            return
+        with self.__lock:
+            if len(self.__idle) < self.__size:
+                self.__idle.append((time.monotonic(), ftp))
+                return
+        quit_session(ftp)
+
+    def close(self):
+        """ Close every idle session. """
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for _, ftp in idle:
+            quit_session(ftp)
+
+
+def quit_session(ftp: FTP):
+    """ Log out of a session, closing it even if the server does not answer. """
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def parse_query(query: str) -> Tuple[str, datetime, datetime, Optional[float]]:
+    """ Parse the query of an /obs request.
+
+        Args:
+            query: query string with station, start and end, and optionally decimate
+
+        Returns:
+            The station, start, end and decimation interval (None if not given).
+
+        Raises:
+            ValueError: a parameter is missing or invalid.
+    """
+    values = parse_qs(query)
+    for name in ('station', 'start', 'end'):
+        if len(values.get(name, [])) != 1:
+            raise ValueError('Expected one {} parameter.'.format(name))
+    times = []
+    for name in ('start', 'end'):
+        try:
+            times.append(datetime.strptime(values[name][0], TIMESTAMP_FORMAT))
+        except ValueError:
+            raise ValueError('Invalid {} time, expected e.g. 2017-09-14T23:11:22Z.'.format(name))
+    decimate = None
+    if 'decimate' in values:
+        try:
+            decimate = float(values['decimate'][0])
+        except ValueError:
+            raise ValueError('Invalid decimation interval.')
+        if decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+    return values['station'][0].lower(), times[0], times[1], decimate
+
+
+class RinexService:
+    """ Downloads and merges RINEX files on request, keeping sessions, listings and files warm between requests.
+
+        Args:
+            downloader: reference to RinexDownloader (uninitialised)
+            merger: reference to RinexMerger (uninitialised)
+            workers: number of files downloaded at once, over as many FTP sessions kept open (default: 1)
+            servers: list of (host, port) pairs of mirrors, tried in order (default: NOAA main and alternate servers)
+            cache_dir: directory of the persistent file and listing caches shared across runs (default: no cache)
+            max_bytes: size the decompressed files kept between requests may grow to before the least
+                recently used are deleted (default: 2 GiB)
+    """
+
+    def __init__(self, downloader: RinexDownloader, merger: RinexMerger, workers: int = 1,
+                 servers: List[Tuple[str, int]] = None, cache_dir: str = None, max_bytes: int = STORE_MAX_BYTES):
+        if workers < 1:
+            raise ValueError('Number of workers must be at least 1.')
+        self.__downloader = downloader
+        self.__merger = merger
+        self.__servers = servers
+        self.__cache, self.__index, self.__catalog = open_caches(cache_dir)
+        self.__max_bytes = max_bytes
+        self.__temp_dir = tempfile.TemporaryDirectory()
+        self.__directory = os.path.join(self.__temp_dir.name, FILES_DIR)
+        os.makedirs(self.__directory)
+        # planning takes a session too, so every transfer can have one
+        self.__sessions = SessionPool(workers + 1)
+        self.__transfers = ThreadPoolExecutor(max_workers=workers)
+        self.__lock = threading.Lock()
+        self.__downloading: Dict[str, Future] = {}  # decompressed file name -> its download
+        self.__files: Dict[str, int] = OrderedDict()  # decompressed file name -> size, least recently used first
+        self.__users: Dict[str, int] = {}  # decompressed file name -> number of requests using it
+        self.__size = 0
+        self.metrics = Metrics()  # everything recorded since the service started
+
+    def __enter__(self) -> 'RinexService':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Stop downloading, close the FTP sessions and delete the files kept. """
+        self.__transfers.shutdown(wait=True)
+        self.__sessions.close()
+        self.__temp_dir.cleanup()
+
+    @contextmanager
+    def observations(self, station: str, start: datetime, end: datetime,
+                     decimate: float = None) -> Iterator[str]:
+        """ Merge the observations of a station in a time window.
+
+            Files already kept from earlier requests are not downloaded again, and
+            files another request is downloading are waited for instead.
+
+            Args:
+                station: 4-character site (base) identifier
+                start: start of the time window
+                end: end of the time window
+                decimate: interval in seconds to decimate the merged file to (default: keep every epoch)
+
+            Returns:
+                Path to the merged file, deleted once the block exits.
+
+            Raises:
+                ValueError: the station or time window is not valid.
+                FileNotFoundError: the archive has no files of the station in the time window.
+                RuntimeError: files could not be downloaded or merged.
+        """
+        check_window(start, end)
+        self.metrics.count('requests')
+        downloader = self.__downloader(
+            station, start, end, self.__directory, servers=self.__servers, cache=self.__cache,
+            index=self.__index, catalog=self.__catalog, decompress=True, metrics=self.metrics)
+        try:
+            with self.metrics.stage('plan'), self.__sessions.session(downloader.connect) as ftp:
+                downloader.validate(ftp)
+                plan = downloader.plan(ftp)
+        finally:
+            downloader.close()
+        if not len(plan):
+            raise FileNotFoundError('The archive has no files of {} in the time window.'.format(station))
+        names = [file.rinex_name for file in plan]
+        with self.__lock:
+            # files in use are never deleted, even those still downloading
+            for name in names:
+                self.__users[name] = self.__users.get(name, 0) + 1
+        try:
+            try:
+                with self.metrics.stage('download'):
+                    self.__fetch(downloader, plan)
+            finally:
+                downloader.close()
+            with tempfile.TemporaryDirectory(dir=self.__temp_dir.name) as output_dir:
+                output = os.path.join(output_dir, '{}.obs'.format(station))
+                merger = self.__merger(station, start, end, self.__directory, workers=1, decimate=decimate,
+                                       output=output, metrics=self.metrics)
+                merger.merge(plan)
+                yield output
+        finally:
+            self.__release(names)
+
+    def __fetch(self, downloader: RinexDownloader, plan: FetchPlan):
+        """ Make sure every file of a plan is kept, downloading those no other request is downloading already. """
+        futures = []
+        with self.__lock:
+            for file in plan:
+                name = file.rinex_name
+                if name in self.__files:
+                    self.__files.move_to_end(name)
+                    self.metrics.count('files_kept')
+                    continue
+                future = self.__downloading.get(name)
+                if future is None:
+                    future = self.__transfers.submit(self.__download, downloader, file)
+                    self.__downloading[name] = future
+                else:
+                    self.metrics.count('files_coalesced')
+                futures.append(future)
+        # every download has to end before the downloader's sessions are closed
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def __download(self, downloader: RinexDownloader, file: PlannedFile):
+        """ Download and decompress a file into the kept files. """
+        name = file.rinex_name
+        try:
+            if not downloader.from_cache(file):
+                with self.__sessions.session(downloader.connect) as ftp:
+                    downloader.fetch_file(ftp, file)
+            size = os.path.getsize(os.path.join(self.__directory, name))
+            with self.__lock:
+                self.__files[name] = size
+                self.__size += size
+        finally:
+            with self.__lock:
+                del self.__downloading[name]
+
+    def __release(self, names: List[str]):
+        """ Let go of the files of a request, and delete the least recently used files nobody uses once over the limit. """
+        removed = []
+        with self.__lock:
+            for name in names:
+                self.__users[name] -= 1
+                if not self.__users[name]:
+                    del self.__users[name]
+            for name in list(self.__files):
+                if self.__size <= self.__max_bytes:
+                    break
+                if name not in self.__users:
+                    self.__size -= self.__files.pop(name)
+                    removed.append(name)
+        for name in removed:
+            os.remove(os.path.join(self.__directory, name))
+
+    def server(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+        """ Create an HTTP server answering requests with this service, each on its own thread.
+
+            Args:
+                host: address to listen on (default: 127.0.0.1)
+                port: port to listen on, 0 for any free port (default: 8080)
+
+            Returns:
+                The server, to run with serve_forever.
+        """
+        handler = type('ObservationHandler', (ObservationHandler,), {'service': self})
+        return ThreadingHTTPServer((host, port), handler)
+
+    def serve_forever(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """ Answer HTTP requests until interrupted. """
+        with self.server(host, port) as server:
+            print('Serving on http://{}:{}{}'.format(host, server.server_address[1], OBS_PATH))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+
+class ObservationHandler(BaseHTTPRequestHandler):
+    """ Answers the HTTP requests of a RinexService. """
+
+    service: RinexService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == METRICS_PATH:
+            self.__send(HTTPStatus.OK, self.service.metrics.prometheus().encode(), 'text/plain; version=0.0.4')
+            return
+        if url.path != OBS_PATH:
+            self.__send(HTTPStatus.NOT_FOUND, b'Unknown path, try ' + OBS_PATH.encode() + b'\n')
+            return
+        try:
+            station, start, end, decimate = parse_query(url.query)
+            with self.service.observations(station, start, end, decimate) as path:
+                with open(path, 'rb') as f:
+                    self.send_response(HTTPStatus.OK)
+                    self.send_header('Content-Type', 'text/plain; charset=latin-1')
+                    self.send_header('Content-Length', str(os.path.getsize(path)))
+                    self.send_header('Content-Disposition', 'attachment; filename="{}.obs"'.format(station))
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile)
+        except ValueError as e:
+            self.__send(HTTPStatus.BAD_REQUEST, '{}\n'.format(e).encode())
+        except FileNotFoundError as e:
+            self.__send(HTTPStatus.NOT_FOUND, '{}\n'.format(e).encode())
+        except (RuntimeError, OSError, FTPError) as e:
+            self.__send(HTTPStatus.BAD_GATEWAY, '{}\n'.format(e).encode())
+
+    def __send(self, status: HTTPStatus, body: bytes, content_type: str = 'text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
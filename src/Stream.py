@@ -0,0 +1,225 @@
+"""Class responsible for streaming the merged epochs of a time window while its files are still downloading.
+
+Instead of writing [station].obs once every file is in, the stream yields the
+merged epochs in chronological order as soon as they are known to be final.
+Files are downloaded in the background; the epochs of a file are yielded as
+soon as it is in, up to the start of the next file of the plan, which is the
+earliest an epoch of a later file can be. Each file is deleted once all its
+epochs have been yielded, so little is kept on disk however long the window is.
+
+The header of the stream is the header of the first file (see merge_headers),
+known as soon as that file is in. Observation types only found in later files
+are carried by the epochs themselves, and announced by an event (epoch flag 4)
+when the stream is written out as RINEX.
+
+  Typical usage example:
+
+  with RinexRunner(station, start_time, end_time, RinexDownloader, RinexMerger).stream() as foo:
+      print(foo.header.types)
+      for epoch in foo:
+          ...
+"""
+import heapq
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Iterator, TextIO
+from src.Merger import merge_headers, select_epochs
+from src.Metrics import Metrics
+from src.Planner import FetchPlan, PlannedFile
+from src.Rinex import Epoch, ObservationFile, ObservationWriter, RinexHeader, types_event
+
+
+class StreamClosed(Exception):
+    """ Raised in the download thread to stop downloading once the stream is closed. """
+
+
+class ObservationStream:
+    """ Merged epochs of a time window, available while its files are still being downloaded.
+
+        Args:
+            plan: the files covering the time window, in chronological order
+            directory: directory the files are downloaded to, decompressed to standard RINEX
+            download: downloads the files of a plan, calling on_file with every file once it is in the directory
+                (e.g. RinexDownloader.download)
+            start: time of the first epoch to keep (default: no limit)
+            end: time of the last epoch to keep (default: no limit)
+            interval: interval in seconds to decimate the epochs to (default: keep every epoch)
+            metrics: where the download time is recorded (default: not recorded)
+            cleanup: called once the stream is closed, e.g. to remove the directory (default: nothing)
+    """
+
+    def __init__(self, plan: FetchPlan, directory: str, download: Callable[..., FetchPlan],
+                 start: datetime = None, end: datetime = None, interval: float = None, metrics: Metrics = None,
+                 cleanup: Callable[[], None] = None):
+        self.plan = plan
+        self.__directory = directory
+        self.__download = download
+        self.__start = start
+        self.__end = end
+        self.__interval = interval
+        self.__metrics = metrics or Metrics()
+        self.__cleanup = cleanup
+        self.__ready = set()  # names of the files in the directory
+        self.__error = None  # why the download failed
+        self.__done = False
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__header = None
+        self.__first = None  # first file of the plan, opened for the header
+        self.__iterating = False
+        self.__open = []  # files read from and not exhausted yet
+        self.__thread = threading.Thread(target=self.__fetch, name='stream-download', daemon=True)
+        self.__thread.start()
+
+    def __fetch(self):
+        """ Download the files of the plan, in the background. """
+        def ready(file: PlannedFile):
+            with self.__condition:
+                if self.__closed:
+                    raise StreamClosed()
+                self.__ready.add(file.name)
+                self.__condition.notify_all()
+
+        try:
+            with self.__metrics.stage('download'):
+                self.__download(self.plan, on_file=ready)
+        except StreamClosed:
+            pass
+        except Exception as e:
+            self.__error = e
+        finally:
+            with self.__condition:
+                self.__done = True
+                self.__condition.notify_all()
+
+    def __wait(self, file: PlannedFile) -> str:
+        """ Wait until a file of the plan is in the directory.
+
+            Returns:
+                The path to the file, decompressed.
+
+            Raises:
+                RuntimeError: the download failed before the file was in.
+        """
+        with self.__condition:
+            while file.name not in self.__ready:
+                if self.__error is not None:
+                    raise RuntimeError('Could not download {}: {}'.format(file.name, self.__error)) from self.__error
+                if self.__done:
+                    raise RuntimeError('{} was not downloaded.'.format(file.name))
+                self.__condition.wait()
+        return os.path.join(self.__directory, file.rinex_name)
+
+    def __open_file(self, file: PlannedFile) -> ObservationFile:
+        """ Wait for a file of the plan, and open it for reading. """
+        opened = ObservationFile(self.__wait(file))
+        self.__open.append(opened)
+        return opened
+
+    def __release(self, opened: ObservationFile):
+        """ Close a file all epochs of which have been read, and delete it. """
+        opened.close()
+        self.__open.remove(opened)
+        os.remove(opened.path)
+
+    def __first_file(self) -> ObservationFile:
+        """ Get the first file of the plan, waiting for it and keeping it open for the merge.
+
+            Raises:
+                RuntimeError: no files cover the time window.
+        """
+        if self.__first is None:
+            if not self.plan.files:
+                raise RuntimeError('No files cover the time window.')
+            self.__first = self.__open_file(self.plan.files[0])
+        return self.__first
+
+    @property
+    def header(self) -> RinexHeader:
+        """ Header of the merged epochs, waiting for the first file of the plan if needed. """
+        if self.__header is None:
+            self.__header = merge_headers([self.__first_file().header], self.__interval)
+        return self.__header
+
+    def __merged(self) -> Iterator[Epoch]:
+        """ Merge the epochs of the files by time, reading each file as soon as it is in. """
+        files = self.plan.files
+        heap = []  # (time, position in the plan, epoch, reader, file) of the next epoch of every file open
+
+        def push(position: int, reader: Iterator[Epoch], opened: ObservationFile):
+            epoch = next(reader, None)
+            if epoch is None:
+                self.__release(opened)
+            else:
+                heapq.heappush(heap, (epoch.time, position, epoch, reader, opened))
+
+        for position, file in enumerate(files):
+            opened = self.__first_file() if position == 0 else self.__open_file(file)
+            push(position, iter(opened.epochs(self.__start, self.__end, self.__interval)), opened)
+            # no later file has epochs before the start of the next one
+            boundary = files[position + 1].start if position + 1 < len(files) else None
+            while heap and (boundary is None or heap[0][0] < boundary):
+                _, at, epoch, reader, opened = heapq.heappop(heap)
+                yield epoch
+                push(at, reader, opened)
+
+    def __iter__(self) -> Iterator[Epoch]:
+        """ Iterate over the merged epochs inside the time window, in chronological order.
+
+            Epochs of the same time from several files are only yielded once, as
+            in a merge (see merged_epochs). A stream can only be iterated over once.
+
+            Raises:
+                RuntimeError: a file could not be downloaded, or the stream was already iterated over.
+        """
+        if self.__iterating:
+            raise RuntimeError('The stream was already iterated over.')
+        self.__iterating = True
+        self.__first_file()
+        return select_epochs(self.__merged(), self.__start, self.__end, self.__interval)
+
+    def write(self, output: TextIO) -> int:
+        """ Write the merged epochs out as a RINEX observation file, as they come in.
+
+            Args:
+                output: file opened in text mode, e.g. sys.stdout
+
+            Returns:
+                The number of records written.
+        """
+        header = self.header
+        writer = None
+        written = 0
+        for epoch in self:
+            if writer is None:
+                if epoch.time != datetime.min:
+                    header = header.with_first_epoch(epoch.time)
+                writer = ObservationWriter(output, header)
+                writer.write_header()
+            if not epoch.is_event and not set(epoch.types) <= set(writer.header.types):
+                types = writer.header.types + tuple(t for t in epoch.types if t not in writer.header.types)
+                output.write(types_event(types))
+                writer = ObservationWriter(output, writer.header.with_types(types))
+            writer.write(epoch)
+            written += 1
+        if writer is None:
+            ObservationWriter(output, header).write_header()
+        return written
+
+    def close(self):
+        """ Stop downloading, wait for the download in progress and remove the files. """
+        with self.__condition:
+            self.__closed = True
+        self.__thread.join()
+        for opened in self.__open:
+            opened.close()
+        self.__open = []
+        if self.__cleanup is not None:
+            self.__cleanup()
+
+    def __enter__(self) -> 'ObservationStream':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,36 +1,308 @@
 import click
-from datetime import datetime
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
 from typing import List
 import string
-from src.Runner import RinexRunner
+import os
+import sys
+from src.Archive import ObservationArchive
+from src.Batch import RinexBatch, read_jobs
+from src.Catalog import SEARCH_LIMIT, StationCatalog
+from src.Follow import POLL_INTERVAL, RinexFollower
+from src.Runner import LISTING_DIR, TIMESTAMP_FORMAT, RinexRunner, check_window
 from src.Downloader import RinexDownloader
 from src.Merger import RinexMerger
+from src.Output import COMPRESSIONS, CompressedWriter
+from src.Service import DEFAULT_HOST, DEFAULT_PORT, RinexService
+
+DEFAULT_WORKERS = 4
 
 
 @click.command()
 @click.argument('station', type=str)
-@click.argument('start_date', type=click.DateTime(formats=['%Y-%m-%dT%H:%M:%SZ']))
-@click.argument('end_date', type=click.DateTime(formats=['%Y-%m-%dT%H:%M:%SZ']))
-def cli(station: str, start_date: datetime, end_date: datetime):
+@click.argument('start_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.argument('end_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.option('--workers', type=click.IntRange(min=1), default=DEFAULT_WORKERS, show_default=True,
+              help='Largest number of concurrent FTP sessions used to download files.')
+@click.option('--min-workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Smallest number of concurrent FTP sessions when backing off from a busy server.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache of downloaded files shared across runs.')
+@click.option('--dry-run', is_flag=True,
+              help='Print the files that would be downloaded and their total size, then exit.')
+@click.option('--decimate', type=float, default=None, metavar='SECONDS',
+              help='Only keep epochs at multiples of this interval in the merged file, e.g. 30.')
+@click.option('--hierarchical', is_flag=True,
+              help='Merge each day as soon as it is downloaded, then the days into weeks and so on, '
+                   'keeping little on disk. Best for long ranges.')
+@click.option('--metrics-out', type=click.Path(dir_okay=False), default=None,
+              help='Write the timings, bytes and FTP round trips of the run to this file once it ends: '
+                   'a Prometheus textfile if it ends in .prom, a JSON trace otherwise.')
+@click.option('--output', type=click.Path(dir_okay=False, allow_dash=True), default=None,
+              help='File the merged observations are written to, or - to stream them to stdout as they are '
+                   'downloaded (default: [station].obs, .obs.gz, .crx or .crx.gz).')
+@click.option('--compress', type=click.Choice(COMPRESSIONS), default=None,
+              help='Compress the merged file as it is written: gzip, Compact RINEX (hatanaka) or both.')
+def cli(station: str, start_date: datetime, end_date: datetime, workers: int, min_workers: int, cache_dir: str,
+        dry_run: bool, decimate: float, hierarchical: bool, metrics_out: str, output: str, compress: str):
     """ Downloads RINEX files from FTP server and merges them into one file 
 
         Args:
             station: 4-character site (base) identifier
             start_date: datetime object
             end_date: datetime object
+            workers: largest number of concurrent FTP sessions
+            min_workers: smallest number of concurrent FTP sessions
+            cache_dir: path to the persistent file cache
+            dry_run: only print the download plan
+            decimate: interval in seconds to decimate the merged file to
+            hierarchical: merge day by day while downloading
+            metrics_out: path the metrics of the run are written to
+            output: path the merged file is written to, - for stdout
+            compress: compression of the merged file
     """
+    stdout = sys.stdout
     try:
-        if start_date > end_date:
-            raise ValueError('Start date is past end date')
-        if start_date > datetime.now() or end_date > datetime.now():
-            raise ValueError(
-                'FTP does not have log files that extend all the way to your end date yet.')
-        if start_date.year < 1994 or end_date.year < 1994:
-            raise ValueError('Date is too early')
+        check_window(start_date, end_date)
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+        if min_workers > workers:
+            raise ValueError('Minimum number of workers cannot be more than the number of workers.')
 
         runner = RinexRunner(station, start_date, end_date,
-                             RinexDownloader, RinexMerger)
+                             RinexDownloader, RinexMerger, workers=workers, cache_dir=cache_dir, dry_run=dry_run,
+                             decimate=decimate, min_workers=min_workers, hierarchical=hierarchical,
+                             metrics_out=metrics_out, output=output, compression=compress)
+        if output == '-' and not dry_run:
+            if hierarchical:
+                raise ValueError('Streaming to stdout already keeps little on disk, --hierarchical is not needed.')
+            # everything but the observations goes to stderr
+            with redirect_stdout(sys.stderr), runner.stream() as stream:
+                if compress is None:
+                    stream.write(stdout)
+                else:
+                    with CompressedWriter(stdout.buffer, compress, close_raw=False) as f:
+                        stream.write(f)
+        else:
+            runner.run()
+
+    except Exception as e:
+        print("Error:", e, file=sys.stderr if output == '-' else stdout)
+
+
+@click.command()
+@click.argument('jobs_file', type=click.File('r'))
+@click.option('--workers', type=click.IntRange(min=1), default=DEFAULT_WORKERS, show_default=True,
+              help='Largest number of concurrent FTP sessions used to download files.')
+@click.option('--min-workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Smallest number of concurrent FTP sessions when backing off from a busy server.')
+@click.option('--merge-workers', type=click.IntRange(min=1), default=None,
+              help='Number of processes merging files concurrently (default: number of CPUs).')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache of downloaded files shared across runs.')
+@click.option('--dry-run', is_flag=True,
+              help='Print the files that would be downloaded and their total size, then exit.')
+@click.option('--decimate', type=float, default=None, metavar='SECONDS',
+              help='Only keep epochs at multiples of this interval in the merged files, e.g. 30.')
+def batch(jobs_file, workers: int, min_workers: int, merge_workers: int, cache_dir: str, dry_run: bool,
+          decimate: float):
+    """ Downloads and merges the files of many jobs, read from a JSON Lines file
+
+        Each line is a job like {"station": "nybp", "start": "2017-09-14T23:11:22Z",
+        "end": "2017-09-15T01:33:44Z", "output": "nybp.obs"}. Files needed by
+        several jobs are only downloaded once.
+
+        Args:
+            jobs_file: file with one job per line
+            workers: largest number of concurrent FTP sessions
+            min_workers: smallest number of concurrent FTP sessions
+            merge_workers: number of processes merging files
+            cache_dir: path to the persistent file cache
+            dry_run: only print the download plan
+            decimate: interval in seconds to decimate the merged files to
+    """
+    try:
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+        if min_workers > workers:
+            raise ValueError('Minimum number of workers cannot be more than the number of workers.')
+        runner = RinexBatch(read_jobs(jobs_file), RinexDownloader, RinexMerger, workers=workers,
+                            merge_workers=merge_workers, cache_dir=cache_dir, dry_run=dry_run, decimate=decimate,
+                            min_workers=min_workers)
         runner.run()
 
     except Exception as e:
         print("Error:", e)
+
+
+@click.command()
+@click.argument('query', type=str)
+@click.option('--limit', type=click.IntRange(min=1), default=SEARCH_LIMIT, show_default=True,
+              help='Largest number of stations listed.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache shared across runs, where the station catalog is kept.')
+def stations(query: str, limit: int, cache_dir: str):
+    """ Lists the stations whose code starts with, or is close to, a query
+
+        Args:
+            query: the start of a station code, or a misspelt one
+            limit: largest number of stations listed
+            cache_dir: path to the persistent cache
+    """
+    try:
+        catalog = StationCatalog(os.path.join(cache_dir, LISTING_DIR) if cache_dir else None)
+        if catalog.get() is None:
+            with RinexDownloader(query, datetime.now(), datetime.now()).connect() as ftp:
+                catalog.fetch(ftp)
+        matches = catalog.search(query, limit)
+        if not matches:
+            print('No stations match {}.'.format(query))
+        for station in matches:
+            print(station)
+
+    except Exception as e:
+        print("Error:", e)
+
+
+@click.command()
+@click.option('--host', type=str, default=DEFAULT_HOST, show_default=True,
+              help='Address the HTTP server listens on.')
+@click.option('--port', type=click.IntRange(min=0, max=65535), default=DEFAULT_PORT, show_default=True,
+              help='Port the HTTP server listens on.')
+@click.option('--workers', type=click.IntRange(min=1), default=DEFAULT_WORKERS, show_default=True,
+              help='Largest number of files downloaded at once, over as many FTP sessions kept open.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache of downloaded files shared across runs.')
+def serve(host: str, port: int, workers: int, cache_dir: str):
+    """ Serves merged RINEX files over HTTP, e.g. GET /obs?station=nybp&start=...&end=...
+
+        FTP sessions, directory listings and downloaded files are kept between
+        requests, and requests needing the same files at once share their downloads.
+
+        Args:
+            host: address to listen on
+            port: port to listen on
+            workers: largest number of concurrent downloads
+            cache_dir: path to the persistent file cache
+    """
+    try:
+        with RinexService(RinexDownloader, RinexMerger, workers=workers, cache_dir=cache_dir) as service:
+            service.serve_forever(host, port)
+
+    except Exception as e:
+        print("Error:", e)
+
+
+@click.command()
+@click.argument('station', type=str)
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--since', type=click.DateTime(formats=[TIMESTAMP_FORMAT]), default=None,
+              help='Time of the first epoch of a new merged file (default: the start of the current day, UTC).')
+@click.option('--retention', type=click.FloatRange(min=0, min_open=True), default=None, metavar='HOURS',
+              help='Only keep this many hours of epochs in the merged file, trimming older ones.')
+@click.option('--interval', type=click.FloatRange(min=0), default=POLL_INTERVAL, show_default=True,
+              metavar='SECONDS', help='Seconds between updates.')
+@click.option('--once', is_flag=True,
+              help='Update the merged file once, then exit, e.g. to run from cron.')
+@click.option('--decimate', type=float, default=None, metavar='SECONDS',
+              help='Only keep epochs at multiples of this interval in the merged file, e.g. 30.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Largest number of concurrent FTP sessions used to download files.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache of downloaded files shared across runs.')
+def follow(station: str, output: str, since: datetime, retention: float, interval: float, once: bool,
+           decimate: float, workers: int, cache_dir: str):
+    """ Keeps a merged file up to date, appending new hourly files as they are published
+
+        Args:
+            station: 4-character site (base) identifier
+            output: path of the merged file
+            since: time of the first epoch of a new merged file
+            retention: hours of epochs kept in the merged file
+            interval: seconds between updates
+            once: update once and exit
+            decimate: interval in seconds to decimate the merged file to
+            workers: largest number of concurrent FTP sessions
+            cache_dir: path to the persistent file cache
+    """
+    try:
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+        follower = RinexFollower(station, output, RinexDownloader, since=since,
+                                 retention=timedelta(hours=retention) if retention else None, decimate=decimate,
+                                 workers=workers, cache_dir=cache_dir)
+        follower.follow(interval, updates=1 if once else None)
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print("Error:", e)
+
+
+@click.command()
+@click.argument('station', type=str)
+@click.argument('start_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.argument('end_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.option('--archive-dir', type=click.Path(file_okay=False), required=True,
+              help='Directory of the local archive of decoded observations.')
+@click.option('--workers', type=click.IntRange(min=1), default=DEFAULT_WORKERS, show_default=True,
+              help='Largest number of concurrent FTP sessions used to download files.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory of a persistent cache of downloaded files shared across runs.')
+def ingest(station: str, start_date: datetime, end_date: datetime, archive_dir: str, workers: int, cache_dir: str):
+    """ Downloads the hours of a time window a local archive does not hold yet, and stores them decoded
+
+        Args:
+            station: 4-character site (base) identifier
+            start_date: datetime object
+            end_date: datetime object
+            archive_dir: path to the local archive
+            workers: largest number of concurrent FTP sessions
+            cache_dir: path to the persistent file cache
+    """
+    try:
+        check_window(start_date, end_date)
+        archive = ObservationArchive(archive_dir)
+        files = archive.ingest(station, start_date, end_date, RinexDownloader, workers=workers,
+                               cache_dir=cache_dir)
+        print('Ingested {} files.'.format(files))
+
+    except Exception as e:
+        print("Error:", e)
+
+
+@click.command()
+@click.argument('station', type=str)
+@click.argument('start_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.argument('end_date', type=click.DateTime(formats=[TIMESTAMP_FORMAT]))
+@click.option('--archive-dir', type=click.Path(file_okay=False), required=True,
+              help='Directory of the local archive of decoded observations.')
+@click.option('--output', type=click.Path(dir_okay=False, allow_dash=True), default=None,
+              help='File the observations are written to, - for stdout (default: [station].obs).')
+@click.option('--decimate', type=float, default=None, metavar='SECONDS',
+              help='Only keep epochs at multiples of this interval, e.g. 30.')
+def query(station: str, start_date: datetime, end_date: datetime, archive_dir: str, output: str,
+          decimate: float):
+    """ Writes the observations of a time window held in a local archive as a RINEX file
+
+        Args:
+            station: 4-character site (base) identifier
+            start_date: datetime object
+            end_date: datetime object
+            archive_dir: path to the local archive
+            output: path the observations are written to
+            decimate: interval in seconds to decimate the observations to
+    """
+    try:
+        if decimate is not None and decimate <= 0:
+            raise ValueError('Decimation interval must be positive.')
+        archive = ObservationArchive(archive_dir)
+        missing = archive.missing(station, start_date, end_date)
+        if missing:
+            print('Warning: the archive does not hold every hour of {} days, e.g. {}/{:03d}.'.format(
+                len(missing), *missing[0]), file=sys.stderr)
+        with click.open_file(output or '{}.obs'.format(station.lower()), 'w', encoding='latin-1') as f:
+            archive.write(station, start_date, end_date, f, decimate)
+
+    except Exception as e:
+        print("Error:", e, file=sys.stderr)
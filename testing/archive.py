@@ -0,0 +1,108 @@
+"""Class responsible for serving a local stand-in for the NOAA CORS FTP archive.
+
+The tests and the benchmarks publish files to a directory laid out like the
+archive (/cors/rinex/{year}/{doy}/{station} and /cors/station_log) and point
+the downloader at a pyftpdlib server on localhost serving it, which expands
+wildcards in NLST like the NOAA server does, and can be slowed down with a
+latency per command and a bandwidth per transfer.
+
+  Typical usage example:
+
+  foo = CorsArchive(directory)
+  foo.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z', data)
+  foo.start()
+  RinexDownloader(station, start_time, end_time, servers=foo.servers).download()
+  foo.stop()
+"""
+import os
+import threading
+from fnmatch import fnmatch
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.servers import FTPServer
+
+
+class CorsHandler(FTPHandler):
+    """ FTP handler that expands wildcards in NLST like the NOAA server does. """
+
+    latency = 0  # seconds every command waits before it is processed
+
+    def process_command(self, cmd, *args, **kwargs):
+        if not self.latency:
+            return super().process_command(cmd, *args, **kwargs)
+        # wait on the loop, so the other connections are still served meanwhile
+        self.ioloop.call_later(self.latency, self.__process_later, cmd, *args, **kwargs)
+
+    def __process_later(self, cmd, *args, **kwargs):
+        if not self._closed:
+            super().process_command(cmd, *args, **kwargs)
+
+    def ftp_NLST(self, path):
+        directory, pattern = os.path.split(path)
+        if not any(c in pattern for c in '*?['):
+            return super().ftp_NLST(path)
+        listing = sorted(f for f in self.fs.listdir(directory)
+                         if fnmatch(f, pattern))
+        data = ''.join('{}\r\n'.format(f) for f in listing)
+        self.push_dtp_data(data.encode(self.encoding), cmd='NLST')
+        return path
+
+
+class CorsArchive:
+    """ Local stand-in for the NOAA CORS FTP archive, served by pyftpdlib.
+
+        Args:
+            root: directory used as the root of the FTP server
+            handler: pyftpdlib handler class serving the connections
+            max_cons: number of sockets open at once, counting the listening one; others get a 421 reply (default: no limit)
+            latency: seconds every command waits before it is processed, like a round trip to a distant server (default: 0)
+            bandwidth: bytes per second every transfer is throttled to (default: no limit)
+    """
+
+    def __init__(self, root: str, handler=CorsHandler, max_cons: int = 0, latency: float = 0, bandwidth: int = 0):
+        self.root = root
+        os.makedirs(os.path.join(root, 'cors', 'station_log'), exist_ok=True)
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(root)
+        attributes = {'latency': latency} if latency else {}
+        if bandwidth:
+            attributes['dtp_handler'] = type('DTPHandler', (ThrottledDTPHandler,), {'write_limit': bandwidth})
+        handler = type('CorsHandler', (handler,), attributes)
+        handler.authorizer = authorizer
+        # each archive runs its own loop, so several can serve at once
+        self.__server = FTPServer(('127.0.0.1', 0), handler, ioloop=IOLoop())
+        self.__server.max_cons = max_cons
+        self.servers = [self.__server.address]
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__serve, daemon=True)
+
+    def __serve(self):
+        while not self.__stop.is_set():
+            self.__server.serve_forever(timeout=0.05, blocking=False)
+        self.__server.close_all()
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def add_station(self, station: str, log: str = ''):
+        """ Register a station log so the station code validates, keeping any log already registered. """
+        path = os.path.join(self.root, 'cors', 'station_log', '{}.log.txt'.format(station))
+        if log or not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(log)
+
+    def add_file(self, year: int, yday: int, station: str, name: str, data: bytes = b'') -> str:
+        """ Publish a file under /cors/rinex/{year}/{doy}/{station}. """
+        self.add_station(station)
+        directory = os.path.join(self.root, 'cors', 'rinex', str(
+            year), '{:03d}'.format(yday), station)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
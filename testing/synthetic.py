@@ -0,0 +1,224 @@
+"""Synthetic RINEX 2 observation files for tests and benchmarks, published like the NOAA archive publishes them.
+
+Observations are smooth functions of the satellite and the time of the epoch,
+plus noise seeded by the time of the epoch, so the same epoch always has the
+same observations whichever file it is written to and however often the files
+are made. The satellites in view are those highest in a simple model of the
+sky, so satellites rise and set over the day like in real logs, and ranges and
+phases change smoothly enough for Hatanaka compression to work like on real
+data.
+
+  Typical usage example:
+
+  foo = observation_data('nybp', start, end, interval=30, satellites=10)
+  publish(archive, 'nybp', start, end)
+"""
+import gzip
+import io
+import math
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, List, Sequence
+from src.Decompress import LZWCompressor
+from src.Hatanaka import CRXEncoder
+from src.Planner import HOUR_BLOCKS
+
+TYPES = ('L1', 'L2', 'C1', 'P1', 'P2', 'S1', 'S2')
+GPS_SATELLITES = 32
+ORBIT_PERIOD = 43082.0  # seconds, half a sidereal day
+MEAN_RANGE = 22e6  # metres
+RANGE_SWING = 3e6  # metres between the satellite at the zenith and at the horizon
+L1_WAVELENGTH = 0.190293672798  # metres
+L2_WAVELENGTH = 0.244210213425
+CODE_NOISE = 1.5  # metres
+PHASE_NOISE = 0.01  # cycles
+SATELLITES_PER_LINE = 12
+FIELDS_PER_LINE = 5
+
+
+def record(content: str, label: str) -> str:
+    """ Format a header record, content in the first 60 columns and the label after it. """
+    return '{:<60}{:<20}\n'.format(content, label)
+
+
+def header(station: str, start: datetime, interval: float, types: Sequence[str] = TYPES) -> str:
+    """ Write the header of a synthetic observation file.
+
+        Args:
+            station: 4-character site (base) identifier
+            start: time of the first epoch
+            interval: seconds between epochs
+            types: observation types
+
+        Returns:
+            The header, up to and including END OF HEADER.
+    """
+    station = station.upper()
+    lines = [record('     2.11           OBSERVATION DATA    G (GPS)', 'RINEX VERSION / TYPE'),
+             record('{:<20}{:<20}{:%Y%m%d %H:%M:%S}UTC'.format('synthetic', 'grab_data', start),
+                    'PGM / RUN BY / DATE'),
+             record(station, 'MARKER NAME'),
+             record(station, 'MARKER NUMBER'),
+             record('{:<20}{}'.format('benchmark', 'grab_data'), 'OBSERVER / AGENCY'),
+             record('{:<20}{:<20}{}'.format('0', 'SYNTHETIC', '1.0'), 'REC # / TYPE / VERS'),
+             record('{:<20}{}'.format('0', 'SYNTHETIC       NONE'), 'ANT # / TYPE'),
+             record('  1334872.4620 -4654040.4780  4138134.9790', 'APPROX POSITION XYZ'),
+             record('        0.0000        0.0000        0.0000', 'ANTENNA: DELTA H/E/N'),
+             record('     1     1', 'WAVELENGTH FACT L1/2')]
+    for i in range(0, len(types), 9):
+        count = '{:6d}'.format(len(types)) if i == 0 else ' ' * 6
+        lines.append(record(count + ''.join('{:>6}'.format(t) for t in types[i:i + 9]), '# / TYPES OF OBSERV'))
+    lines.append(record('{:10.3f}'.format(interval), 'INTERVAL'))
+    lines.append(record('{:6d}{:6d}{:6d}{:6d}{:6d}{:13.7f}     GPS'.format(
+        start.year, start.month, start.day, start.hour, start.minute, start.second + start.microsecond / 1e6),
+        'TIME OF FIRST OBS'))
+    lines.append(record('', 'END OF HEADER'))
+    return ''.join(lines)
+
+
+def elevation(satellite: int, seconds: float) -> float:
+    """ How high a satellite is in the sky at a time, from -1 (nadir) to 1 (zenith). """
+    return math.sin(2 * math.pi * seconds / ORBIT_PERIOD + satellite * 2.399963)
+
+
+def observe(satellite: int, seconds: float, types: Sequence[str], rnd: random.Random) -> str:
+    """ Write the data lines of a satellite at an epoch. """
+    height = elevation(satellite, seconds)
+    distance = MEAN_RANGE - RANGE_SWING * height
+    snr = 35 + 12 * height
+    strength = str(min(9, max(1, int(snr / 6))))
+    fields = []
+    for observation in types:
+        kind, band = observation[0], observation[1:]
+        if kind == 'L':
+            wavelength = L1_WAVELENGTH if band == '1' else L2_WAVELENGTH
+            # the phase ambiguity differs by satellite, which the differences take out
+            value = distance / wavelength - satellite * 1000003 + rnd.uniform(-PHASE_NOISE, PHASE_NOISE)
+            fields.append('{:14.3f} {}'.format(value, strength))
+        elif kind in 'CP':
+            if kind == 'P' and band == '1' and satellite % 4 == 0:
+                fields.append(' ' * 16)  # not tracked, like P1 on many receivers
+                continue
+            delay = 0 if band == '1' else 5 + 3 * (1 - height)
+            value = distance + delay + rnd.uniform(-CODE_NOISE, CODE_NOISE)
+            fields.append('{:14.3f} {}'.format(value, strength))
+        else:
+            value = snr - (6 if band == '2' else 0) + rnd.uniform(-0.5, 0.5)
+            fields.append('{:14.3f}  '.format(value))
+    return ''.join(''.join(fields[i:i + FIELDS_PER_LINE]).rstrip() + '\n'
+                   for i in range(0, len(fields), FIELDS_PER_LINE))
+
+
+def first_epoch(start: datetime, interval: float) -> datetime:
+    """ Time of the first epoch at or after a time, epochs being on multiples of the interval since midnight. """
+    midnight = datetime(start.year, start.month, start.day)
+    return midnight + timedelta(seconds=math.ceil((start - midnight).total_seconds() / interval) * interval)
+
+
+def epochs(start: datetime, end: datetime, interval: float = 30, satellites: int = 10,
+           types: Sequence[str] = TYPES, seed: int = 0) -> Iterator[str]:
+    """ Generate the epochs between two times (inclusive), on multiples of the interval since midnight.
+
+        Args:
+            start: earliest time of an epoch
+            end: latest time of an epoch
+            interval: seconds between epochs
+            satellites: number of satellites in view at every epoch (at most 32)
+            types: observation types
+            seed: seed of the noise, the same seed always gives the same observations
+
+        Returns:
+            An iterator over the epochs, each the epoch line and the data lines of its satellites.
+    """
+    if interval <= 0:
+        raise ValueError('Interval must be positive.')
+    if not 1 <= satellites <= GPS_SATELLITES:
+        raise ValueError('Number of satellites must be between 1 and {}.'.format(GPS_SATELLITES))
+    first = first_epoch(start, interval)
+    step = 0
+    while True:
+        time = first + timedelta(seconds=step * interval)
+        if time > end:
+            return
+        seconds = (time - datetime(1980, 1, 6)).total_seconds()
+        rnd = random.Random(hash((seed, round(seconds * 1000))))
+        # the satellites highest in the sky are in view
+        in_view = sorted(sorted(range(1, GPS_SATELLITES + 1), key=lambda s: -elevation(s, seconds))[:satellites])
+        names = ''.join('G{:02d}'.format(s) for s in in_view)
+        lines = [' {:02d} {:2d} {:2d} {:2d} {:2d}{:11.7f}  0{:3d}{}\n'.format(
+            time.year % 100, time.month, time.day, time.hour, time.minute,
+            time.second + time.microsecond / 1e6, len(in_view), names[:3 * SATELLITES_PER_LINE])]
+        for i in range(3 * SATELLITES_PER_LINE, len(names), 3 * SATELLITES_PER_LINE):
+            lines.append(' ' * 32 + names[i:i + 3 * SATELLITES_PER_LINE] + '\n')
+        lines.extend(observe(s, seconds, types, rnd) for s in in_view)
+        yield ''.join(lines)
+        step += 1
+
+
+def observation_data(station: str, start: datetime, end: datetime, interval: float = 30, satellites: int = 10,
+                     types: Sequence[str] = TYPES, seed: int = 0) -> bytes:
+    """ Write a synthetic RINEX 2 observation file covering a time window (see epochs). """
+    body = ''.join(epochs(start, end, interval, satellites, types, seed))
+    if not body:
+        raise ValueError('No epochs between {} and {}.'.format(start, end))
+    return (header(station, first_epoch(start, interval), interval, types) + body).encode('latin-1')
+
+
+def gzip_file(data: bytes) -> bytes:
+    """ Compress RINEX data like an hourly file of the archive (.yyo.gz). """
+    compressed = io.BytesIO()
+    # no time stamp, so the same data always gives the same file
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        f.write(data)
+    return compressed.getvalue()
+
+
+def hatanaka_file(data: bytes) -> bytes:
+    """ Compress RINEX data like a daily file of the archive (.yyd.Z), Hatanaka and then LZW compressed. """
+    encoder = CRXEncoder()
+    compressor = LZWCompressor()
+    return compressor.compress(encoder.compress(data) + encoder.flush()) + compressor.flush()
+
+
+def publish(archive, station: str, start: datetime, end: datetime, interval: float = 30, satellites: int = 10,
+            seed: int = 0) -> List[str]:
+    """ Publish the files covering a time window to an archive, as the NOAA archive does.
+
+        Days the window covers entirely get a daily Hatanaka compressed file
+        (ssssddd0.yyd.Z), the others gzipped hourly files (ssssdddh.yyo.gz)
+        for the hours the window covers, so the downloader plans and merges
+        both kinds.
+
+        Args:
+            archive: the archive, with an add_file(year, yday, station, name, data) method (see CorsArchive)
+            station: 4-character site (base) identifier
+            start: start of the time window
+            end: end of the time window
+            interval: seconds between epochs
+            satellites: number of satellites in view at every epoch
+            seed: seed of the noise
+
+        Returns:
+            Paths to the published files.
+    """
+    station = station.lower()
+    paths = []
+    day = datetime(start.year, start.month, start.day)
+    while day <= end:
+        year, yday = day.year, day.timetuple().tm_yday
+        first = max(start, day).hour
+        last = min(end, day + timedelta(hours=23)).hour
+        if first == 0 and last == 23:
+            data = observation_data(station, day, day + timedelta(hours=23, minutes=59, seconds=59.9),
+                                    interval, satellites, seed=seed)
+            paths.append(archive.add_file(year, yday, station, '{}{:03d}0.{:02d}d.Z'.format(
+                station, yday, year % 100), hatanaka_file(data)))
+        else:
+            for hour in range(first, last + 1):
+                begin = day + timedelta(hours=hour)
+                data = observation_data(station, begin, begin + timedelta(minutes=59, seconds=59.9),
+                                        interval, satellites, seed=seed)
+                paths.append(archive.add_file(year, yday, station, '{}{:03d}{}.{:02d}o.gz'.format(
+                    station, yday, HOUR_BLOCKS[hour], year % 100), gzip_file(data)))
+        day += timedelta(days=1)
+    return paths
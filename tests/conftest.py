@@ -0,0 +1,10 @@
+import pytest
+from testing.archive import CorsArchive
+
+
+@pytest.fixture
+def cors_archive(tmp_path):
+    archive = CorsArchive(str(tmp_path / 'ftp'))
+    archive.start()
+    yield archive
+    archive.stop()
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+import io
+import os
+import numpy as np
+import pytest
+from src.Archive import Chunk, ObservationArchive, write_chunk
+from src.Columnar import BLANK, ObservationTable
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Rinex import ObservationFile
+from testing.archive import CorsArchive, CorsHandler
+from testing.synthetic import publish
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+DAY = datetime(2021, 3, 10)
+
+
+class CountingHandler(CorsHandler):
+    """ Handler recording the name of every file transferred. """
+    transfers = []
+
+    def ftp_RETR(self, file):
+        self.transfers.append(os.path.basename(file))
+        return super().ftp_RETR(file)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    CountingHandler.transfers = []
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=CountingHandler)
+    publish(archive, 'nybp', DAY - timedelta(days=1), DAY + timedelta(hours=17, minutes=59),
+            interval=300, satellites=4)
+    archive.start()
+    yield archive
+    archive.stop()
+
+
+def merged(archive: CorsArchive, tmp_path, start: datetime, end: datetime) -> str:
+    """ Merge a window the way grab_data does, to compare with. """
+    directory = str(tmp_path / 'expected')
+    os.makedirs(directory)
+    output = str(tmp_path / 'expected.obs')
+    plan = RinexDownloader('nybp', start, end, directory, servers=archive.servers).download()
+    RinexMerger('nybp', start, end, directory, workers=1, output=output).merge(plan)
+    with open(output, encoding='latin-1') as f:
+        return f.read()
+
+
+def test_chunk(tmp_path):
+    table = ObservationTable.from_file(os.path.join(FIXTURES, 'nybp2570.17o'))
+    with ObservationFile(os.path.join(FIXTURES, 'nybp2570.17o')) as f:
+        header = f.header
+    path = str(tmp_path / '257.col')
+    write_chunk(path, table, header)
+    chunk = Chunk(path)
+    assert len(chunk) == len(table)
+    assert chunk.header.lines == header.lines
+    read = chunk.table()
+    for name in ('times', 'flags', 'offsets', 'satellites', 'lli', 'snr'):
+        assert np.array_equal(getattr(read, name), getattr(table, name))
+    assert np.array_equal(read.values, table.values, equal_nan=True)
+    start, end = datetime(2017, 9, 14, 0, 5), datetime(2017, 9, 14, 0, 10, 15)
+    window = chunk.table(start, end)
+    assert np.array_equal(window.times, table.window(start, end).times)
+    assert np.array_equal(window.values, table.window(start, end).values, equal_nan=True)
+    assert len(chunk.table(datetime(2018, 1, 1))) == 0
+
+    write_chunk(path, ObservationTable.empty(table.types), header)
+    assert len(Chunk(path).table()) == 0
+
+
+def test_chunk_with_zero_for_blank(tmp_path, monkeypatch):
+    table = ObservationTable.from_file(os.path.join(FIXTURES, 'nybp2570.17o'))
+    with ObservationFile(os.path.join(FIXTURES, 'nybp2570.17o')) as f:
+        header = f.header
+    path = str(tmp_path / '257.col')
+    # a chunk written before blank indicators were told apart from 0
+    old = ObservationTable(table.types, table.times, table.flags, table.clocks, table.offsets, table.satellites,
+                           table.values, np.where(table.lli == BLANK, 0, table.lli),
+                           np.where(table.snr == BLANK, 0, table.snr))
+    monkeypatch.setattr('src.Archive.BLANK', 0)
+    write_chunk(path, old, header)
+    monkeypatch.undo()
+    read = Chunk(path).table()
+    assert np.array_equal(read.lli, table.lli) and np.array_equal(read.snr, table.snr)
+
+
+def test_ingest_and_query(archive, tmp_path):
+    store = ObservationArchive(str(tmp_path / 'archive'))
+    start, end = DAY - timedelta(hours=2), DAY + timedelta(hours=15, minutes=59, seconds=59)
+    assert store.missing('nybp', start, end) == [(2021, 68), (2021, 69)]
+    assert store.ingest('nybp', start, end, RinexDownloader, servers=archive.servers) == 17
+    assert store.missing('nybp', start, end) == []
+    assert store.index('nybp')[(2021, 68)]['hours'] == list(range(24))
+    assert store.index('nybp')[(2021, 69)]['hours'] == list(range(16))
+    # whole hours come out the same as merging the downloaded files
+    output = io.StringIO()
+    assert store.write('nybp', start, end, output) == 24 + 16 * 12
+    assert output.getvalue() == merged(archive, tmp_path, start, end)
+
+    # only the hours not held yet are downloaded
+    CountingHandler.transfers = []
+    assert store.ingest('nybp', DAY + timedelta(hours=15), DAY + timedelta(hours=16, minutes=59),
+                        RinexDownloader, servers=archive.servers) == 1
+    assert CountingHandler.transfers == ['nybp069q.21o.gz']
+    assert store.index('nybp')[(2021, 69)]['hours'] == list(range(17))
+    assert store.ingest('nybp', start, end, RinexDownloader, servers=archive.servers) == 0
+
+
+def test_query_window(archive, tmp_path):
+    store = ObservationArchive(str(tmp_path / 'archive'))
+    store.ingest('nybp', DAY + timedelta(hours=14), DAY + timedelta(hours=16, minutes=59), RinexDownloader,
+                 servers=archive.servers)
+    start, end = DAY + timedelta(hours=14, minutes=20), DAY + timedelta(hours=15, minutes=40)
+    header, table = store.query('nybp', start, end)
+    times = list(table.datetimes())
+    assert times[0] == start and times[-1] == end and len(times) == 17
+    assert header.get('TIME OF FIRST OBS').startswith('  2021     3    10    14    20')
+    header, table = store.query('nybp', start, end, decimate=900)
+    assert [t.minute for t in table.datetimes().astype(datetime)] == [30, 45, 0, 15, 30]
+    assert header.interval == 900
+    header, table = store.query('nybp', datetime(2021, 3, 1), datetime(2021, 3, 2))
+    assert header is None and len(table) == 0
+    with pytest.raises(FileNotFoundError):
+        store.write('nybp', datetime(2021, 3, 1), datetime(2021, 3, 2), io.StringIO())
@@ -0,0 +1,80 @@
+from datetime import datetime
+from functools import partial
+import io
+import os
+import pytest
+from src.Batch import BatchJob, RinexBatch, read_jobs
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from testing.archive import CorsArchive, CorsHandler
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def read_fixture(name: str, mode: str = 'r'):
+    with open(os.path.join(FIXTURES, name), mode) as f:
+        return f.read()
+
+
+def test_read_jobs():
+    jobs = read_jobs(io.StringIO(
+        '{"station": "NYBP", "start": "2017-09-14T23:11:22Z", "end": "2017-09-15T01:33:44Z"}\n'
+        '\n'
+        '{"station": "p589", "start": "2018-12-31T22:30:54Z", "end": "2019-01-01T02:45:13Z", "output": "out/p589.obs"}\n'))
+    assert jobs == [
+        BatchJob('nybp', datetime(2017, 9, 14, 23, 11, 22), datetime(2017, 9, 15, 1, 33, 44), 'nybp.obs'),
+        BatchJob('p589', datetime(2018, 12, 31, 22, 30, 54), datetime(2019, 1, 1, 2, 45, 13), 'out/p589.obs'),
+    ]
+
+
+@pytest.mark.parametrize('data,error', [
+    ('{"station": "nybp", "start": "2017-09-14T23:11:22Z"', r'Line 1: Invalid JSON'),
+    ('["nybp"]', r'Line 1: .*JSON object'),
+    ('{"station": "nybp", "start": "2017-09-14T23:11:22Z"}', r'Line 1: Missing end'),
+    ('{"station": "nybp", "start": "2017-09-14 23:11:22", "end": "2017-09-15T01:33:44Z"}', r'Line 1: .*format'),
+    ('{"station": "nybp", "start": "2017-09-15T23:11:22Z", "end": "2017-09-15T01:33:44Z"}', r'Line 1: .*past end date'),
+    ('{"station": "nybp", "start": "1993-09-14T23:11:22Z", "end": "2017-09-15T01:33:44Z"}', r'Line 1: .*too early'),
+    ('{"station": "nybp", "start": "2017-09-14T23:11:22Z", "end": "2017-09-15T01:33:44Z"}\n'
+     '{"station": "nybp", "start": "2017-09-16T23:11:22Z", "end": "2017-09-17T01:33:44Z"}', r'Line 2: .*nybp.obs'),
+])
+def test_read_invalid_jobs(data, error):
+    with pytest.raises(ValueError, match=error):
+        read_jobs(io.StringIO(data))
+
+
+class CountingHandler(CorsHandler):
+    """ Handler recording the path of every file transferred. """
+    transfers = []
+
+    def ftp_RETR(self, file):
+        self.transfers.append(os.path.basename(file))
+        return super().ftp_RETR(file)
+
+
+@pytest.mark.parametrize('merge_workers', [1, 2])
+def test_batch(tmp_path, monkeypatch, merge_workers):
+    CountingHandler.transfers = []
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=CountingHandler)
+    archive.start()
+    try:
+        data = read_fixture('nybp2570.17o.gz', 'rb')
+        archive.add_file(2017, 257, 'nybp', 'nybp2570.17o.gz', data)
+        archive.add_file(2017, 257, 'p589', 'p5892570.17o.gz', data)
+        jobs = [
+            BatchJob('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), 'first.obs'),
+            BatchJob('nybp', datetime(2017, 9, 14, 0, 0), datetime(2017, 9, 14, 0, 59), 'second.obs'),
+            BatchJob('zzzz', datetime(2017, 9, 14, 0, 0), datetime(2017, 9, 14, 0, 59), 'invalid.obs'),
+            BatchJob('p589', datetime(2017, 9, 14, 0, 0), datetime(2017, 9, 14, 0, 59), 'third.obs'),
+        ]
+        monkeypatch.chdir(str(tmp_path))
+        batch = RinexBatch(jobs, partial(RinexDownloader, servers=archive.servers), RinexMerger,
+                           workers=2, merge_workers=merge_workers)
+        with pytest.raises(RuntimeError, match=r'1 of 4 jobs:\ninvalid.obs: Station code is not valid'):
+            batch.run()
+    finally:
+        archive.stop()
+    # files needed by several jobs are only downloaded once
+    assert sorted(CountingHandler.transfers) == ['nybp2570.17o.gz', 'p5892570.17o.gz']
+    for output in ('first.obs', 'second.obs', 'third.obs'):
+        assert (tmp_path / output).read_text() == read_fixture('nybp2570.17o')
+    assert not (tmp_path / 'invalid.obs').exists()
@@ -0,0 +1,119 @@
+from datetime import datetime
+from ftplib import FTP
+import gzip
+import io
+import json
+import os
+import time
+import pytest
+from benchmarks.suite import Scenario, compare, run, run_scenario, write_results
+from src.Decompress import LZWDecompressor
+from src.Hatanaka import CRXDecoder
+from src.Rinex import ObservationFile
+from testing.archive import CorsArchive
+from testing.synthetic import epochs, hatanaka_file, observation_data, publish
+
+
+class Shelf:
+    """ Archive that only keeps the names and data of the files published to it. """
+
+    def __init__(self):
+        self.files = {}
+
+    def add_file(self, year: int, yday: int, station: str, name: str, data: bytes = b'') -> str:
+        self.files[name] = data
+        return name
+
+
+def test_epochs_are_reproducible():
+    start, end = datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 15)
+    first = list(epochs(start, end, 30, 14))
+    assert len(first) == 121
+    assert first == list(epochs(start, end, 30, 14))
+    # the same epoch is the same in any file
+    assert first[60:] == list(epochs(datetime(2021, 3, 10, 14, 29, 45), end, 30, 14))
+    assert first != list(epochs(start, end, 30, 14, seed=1))
+    # 14 satellites take a continuation line
+    assert first[0].splitlines()[1].startswith(' ' * 32 + 'G')
+    assert len(first[0].splitlines()) == 2 + 14 * 2
+
+
+def test_observation_data(tmp_path):
+    data = observation_data('nybp', datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 14, 59, 59), 30, 10)
+    path = tmp_path / 'nybp069o.21o'
+    path.write_bytes(data)
+    with ObservationFile(str(path)) as f:
+        assert len(list(f.epochs())) == 120
+    # compressed like the archive, the data comes back the same bar trailing blanks of the header
+    compressed = hatanaka_file(data)
+    lzw, crx = LZWDecompressor(), CRXDecoder()
+    decoded = crx.decompress(lzw.decompress(compressed) + lzw.flush()) + crx.flush()
+    assert decoded.splitlines() == [line.rstrip() for line in data.splitlines()]
+
+
+@pytest.mark.parametrize('start,end,expected', [
+    (datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 15, 59), ['nybp069o.21o.gz', 'nybp069p.21o.gz']),
+    (datetime(2021, 3, 10), datetime(2021, 3, 11, 23, 59), ['nybp0690.21d.Z', 'nybp0700.21d.Z']),
+    (datetime(2020, 12, 31, 23), datetime(2021, 1, 1, 0, 59), ['nybp366x.20o.gz', 'nybp001a.21o.gz']),
+])
+def test_publish(start, end, expected):
+    shelf = Shelf()
+    assert publish(shelf, 'NYBP', start, end, interval=300, satellites=4) == expected
+    name = expected[0]
+    if name.endswith('.gz'):
+        assert gzip.decompress(shelf.files[name]).startswith(b'     2.11')
+    else:
+        assert shelf.files[name].startswith(b'\x1f\x9d')
+
+
+def test_compare():
+    def results(**medians):
+        return {'scenarios': {'1-day': {'stages': {stage: {'median': median} for stage, median in medians.items()}}}}
+    baseline = results(download=1.0, merge=0.01, decompress=2.0)
+    assert compare(results(download=1.1, merge=0.05, decompress=1.0), baseline) == []
+    assert compare(results(download=1.5, merge=0.1, decompress=2.0), baseline) == [
+        '1-day download: 1.000s -> 1.500s (+50%)', '1-day merge: 0.010s -> 0.100s (+900%)']
+    assert compare(results(download=1.5), baseline, tolerance=0.6) == []
+    assert compare(results(download=1.5), {'scenarios': {}}) == []
+
+
+def test_run_scenario(tmp_path):
+    scenario = Scenario('cross-year', datetime(2020, 12, 31, 23), datetime(2021, 1, 1, 0, 59, 59), 300, 4)
+    result = run_scenario(scenario, str(tmp_path / 'archive'), repeat=2)
+    assert result['files'] == 2
+    assert result['counters']['bytes_transferred'] == result['archive_bytes']
+    assert set(result['stages']) == {'download', 'decompress', 'merge', 'total'}
+    assert len(result['stages']['total']['runs']) == 2
+    # the archive is reused
+    assert run_scenario(scenario, str(tmp_path / 'archive'), repeat=1)['archive_bytes'] == result['archive_bytes']
+    with pytest.raises(ValueError):
+        run_scenario(scenario._replace(satellites=5), str(tmp_path / 'archive'), repeat=1)
+
+
+def test_run_with_latency(tmp_path):
+    scenario = Scenario('1-hour', datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 14, 59, 59), 600, 4)
+    results = run([scenario], repeat=1, latency=0.02, data_dir=str(tmp_path))
+    result = results['scenarios']['1-hour']
+    # every command waits for the latency
+    assert result['stages']['download']['median'] >= 0.02 * result['counters']['ftp_round_trips'] / 2
+    write_results(results, str(tmp_path / 'results.json'))
+    assert json.loads((tmp_path / 'results.json').read_text()) == results
+    assert not compare(results, results)
+
+
+def test_throttled_archive(tmp_path):
+    archive = CorsArchive(str(tmp_path), bandwidth=100000)
+    archive.add_file(2021, 69, 'nybp', 'nybp069o.21o.gz', os.urandom(300000))
+    archive.start()
+    try:
+        ftp = FTP()
+        ftp.connect(*archive.servers[0])
+        ftp.login()
+        started = time.monotonic()
+        data = io.BytesIO()
+        ftp.retrbinary('RETR /cors/rinex/2021/069/nybp/nybp069o.21o.gz', data.write)
+        assert time.monotonic() - started >= 1
+        assert len(data.getvalue()) == 300000
+        ftp.quit()
+    finally:
+        archive.stop()
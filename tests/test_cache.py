@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+import os
+import pytest
+import tempfile
+from src.Cache import SETTLE_DAYS, RinexCache, day_age
+from src.Listing import ListingIndex
+from src.Downloader import RinexDownloader
+
+
+def test_store_and_get(tmp_path):
+    cache = RinexCache(str(tmp_path))
+    assert cache.get('nybp', 2017, 257, 'nybp2570.17d.Z') is None
+    with cache.store('NYBP', 2017, 257, 'nybp2570.17d.Z') as f:
+        f.write(b'rinex')
+    path = cache.get('nybp', 2017, 257, 'nybp2570.17d.Z')
+    assert path == str(tmp_path / 'nybp' / '2017' / '257' / 'nybp2570.17d.Z')
+    assert open(path, 'rb').read() == b'rinex'
+
+
+def test_failed_store_leaves_nothing_behind(tmp_path):
+    cache = RinexCache(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        with cache.store('nybp', 2017, 257, 'nybp2570.17d.Z') as f:
+            f.write(b'rin')
+            raise RuntimeError('connection dropped')
+    assert cache.get('nybp', 2017, 257, 'nybp2570.17d.Z') is None
+    assert os.listdir(str(tmp_path / 'nybp' / '2017' / '257')) == []
+
+
+def test_corrupted_file_is_a_miss(tmp_path):
+    cache = RinexCache(str(tmp_path))
+    with cache.store('nybp', 2017, 257, 'nybp2570.17d.Z') as f:
+        f.write(b'rinex')
+    with open(cache.path('nybp', 2017, 257, 'nybp2570.17d.Z'), 'wb') as f:
+        f.write(b'xenir')
+    assert cache.get('nybp', 2017, 257, 'nybp2570.17d.Z') is None
+    assert not os.path.exists(cache.path('nybp', 2017, 257, 'nybp2570.17d.Z'))
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    data = b'x' * 1000
+    cache = RinexCache(str(tmp_path), max_bytes=2 * (len(data) + 64))
+    for yday in (1, 2):
+        with cache.store('nybp', 2017, yday, 'nybp{:03d}0.17d.Z'.format(yday)) as f:
+            f.write(data)
+    # touch day 1 so day 2 becomes the least recently used file
+    os.utime(cache.path('nybp', 2017, 2, 'nybp0020.17d.Z'), (0, 0))
+    assert cache.get('nybp', 2017, 1, 'nybp0010.17d.Z')
+    with cache.store('nybp', 2017, 3, 'nybp0030.17d.Z') as f:
+        f.write(data)
+    assert cache.get('nybp', 2017, 1, 'nybp0010.17d.Z')
+    assert cache.get('nybp', 2017, 2, 'nybp0020.17d.Z') is None
+    assert cache.get('nybp', 2017, 3, 'nybp0030.17d.Z')
+    assert cache.size() <= 2 * (len(data) + 64)
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    ([2017, 257], True),
+    ([datetime.utcnow().year, datetime.utcnow().timetuple().tm_yday], False),
+])
+def test_is_settled(tmp_path, test_input, expected):
+    assert RinexCache(str(tmp_path)).is_settled(*test_input) == expected
+
+
+@pytest.mark.parametrize('days', range(SETTLE_DAYS - 1, SETTLE_DAYS + 3))
+def test_files_and_listings_settle_together(tmp_path, days):
+    day = (datetime.utcnow() - timedelta(days=days)).timetuple()
+    # the age of a day is counted from its end, in UTC
+    assert timedelta(days=days - 1) < day_age(day.tm_year, day.tm_yday) <= timedelta(days=days)
+    settled = RinexCache(str(tmp_path)).is_settled(day.tm_year, day.tm_yday)
+    assert settled == (days > SETTLE_DAYS)
+    assert settled == (ListingIndex().ttl(day.tm_year, day.tm_yday) is None)
+
+
+def test_download_served_from_cache(cors_archive, tmp_path):
+    path = cors_archive.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z', b'day')
+    start_date = datetime(2017, 9, 14, 23, 11, 22)
+    end_date = datetime(2017, 9, 14, 23, 33, 44)
+    cache = RinexCache(str(tmp_path / 'cache'))
+    for _ in range(2):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            r = RinexDownloader('nybp', start_date, end_date, temp_dir,
+                                servers=cors_archive.servers, cache=cache)
+            r.download()
+            assert open(os.path.join(temp_dir, 'nybp2570.17d.Z'),
+                        'rb').read() == b'day'
+        # the second run must not need the file on the server
+        os.remove(path)
+        open(path, 'wb').close()
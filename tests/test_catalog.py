@@ -0,0 +1,136 @@
+from datetime import date, datetime
+from ftplib import FTP
+import os
+import pytest
+from click.testing import CliRunner
+from src.Catalog import StationCatalog, parse_site_log, station_code
+from src.Downloader import RinexDownloader
+from src.cli import stations
+from testing.archive import CorsArchive, CorsHandler
+
+SITE_LOG = '''     nybp Site Information Form (site log)
+
+1.   Site Identification of the GNSS Monument
+
+     Site Name                : New York Battery Park
+     Four Character ID        : NYBP
+     Date Installed           : 2004-06-24T00:00Z
+
+3.   GNSS Receiver Information
+
+3.1  Receiver Type            : TRIMBLE NETRS
+     Date Installed           : 2004-06-24T00:00Z
+     Date Removed             : 2011-03-02T15:00Z
+
+3.2  Receiver Type            : TRIMBLE NETR9
+     Date Installed           : 2011-03-02T16:00Z
+     Date Removed             : {removed}
+
+3.x  Receiver Type            : (A20, from rcvr_ant.tab; see instr.)
+     Date Installed           : (CCYY-MM-DDThh:mmZ)
+     Date Removed             : (CCYY-MM-DDThh:mmZ)
+
+4.   GNSS Antenna Information
+
+4.1  Antenna Type             : TRM29659.00     SCIS
+     Date Installed           : 2004-06-24T00:00Z
+     Date Removed             : (CCYY-MM-DDThh:mmZ)
+'''
+
+
+@pytest.mark.parametrize('name,expected', [
+    ('nybp.log.txt', 'nybp'),
+    ('P589.log.txt', 'p589'),
+    ('readme.pdf', None),
+    ('nyb.log.txt', None),
+    ('ny-b.log.txt', None),
+])
+def test_station_code(name, expected):
+    assert station_code(name) == expected
+
+
+@pytest.mark.parametrize('removed,expected', [
+    ('(CCYY-MM-DDThh:mmZ)', (date(2004, 6, 24), None)),
+    ('2019-05-01T00:00Z', (date(2004, 6, 24), date(2019, 5, 1))),
+])
+def test_parse_site_log(removed, expected):
+    assert parse_site_log(SITE_LOG.format(removed=removed)) == expected
+    assert parse_site_log('') == (None, None)
+
+
+def test_search():
+    catalog = StationCatalog()
+    catalog.put({station: '{}.log.txt'.format(station) for station in ('nybp', 'nyb1', 'nyqn', 'p589', 'zbp1')})
+    assert catalog.search('nyb') == ['nyb1', 'nybp']
+    assert catalog.search('NY', 2) == ['nyb1', 'nybp']
+    # a misspelt code suggests the closest stations instead
+    assert catalog.search('nybq') == ['nyb1', 'nybp', 'nyqn']
+    assert catalog.search('qqqq') == []
+
+
+def test_catalog_persists_across_instances(tmp_path):
+    catalog = StationCatalog(str(tmp_path))
+    assert catalog.get() is None
+    catalog.put({'nybp': 'nybp.log.txt'})
+    assert StationCatalog(str(tmp_path)).get() == {'nybp': 'nybp.log.txt'}
+    # an expired catalog is a miss
+    assert StationCatalog(str(tmp_path), ttl=0).get() is None
+
+
+class CountingHandler(CorsHandler):
+    """ Handler counting the listings of the site log directory and the site logs transferred. """
+    requests = []
+
+    def ftp_MLSD(self, path):
+        if path.endswith('station_log'):
+            self.requests.append('MLSD')
+        return super().ftp_MLSD(path)
+
+    def ftp_RETR(self, file):
+        if 'station_log' in file:
+            self.requests.append('RETR')
+        return super().ftp_RETR(file)
+
+
+def test_validate_from_catalog(tmp_path):
+    handler = type('CountingHandler', (CountingHandler,), {'requests': []})
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=handler)
+    archive.add_station('nybp', SITE_LOG.format(removed='2019-05-01T00:00Z'))
+    archive.add_station('p589')
+    archive.start()
+    try:
+        catalog = StationCatalog(str(tmp_path / 'catalog'))
+        with FTP() as ftp:
+            ftp.connect(*archive.servers[0])
+            ftp.login()
+            for station in ('nybp', 'p589', 'zzzz'):
+                r = RinexDownloader(station, datetime(2017, 9, 14), datetime(2017, 9, 15), catalog=catalog)
+                assert r.is_valid_station_code(ftp) == (station != 'zzzz')
+            RinexDownloader('nybp', datetime(2017, 9, 14), datetime(2017, 9, 15), catalog=catalog).validate(ftp)
+            with pytest.raises(ValueError, match=r'no data before 2004-06-24'):
+                RinexDownloader('nybp', datetime(2003, 9, 14), datetime(2003, 9, 15), catalog=catalog).validate(ftp)
+            with pytest.raises(ValueError, match=r'no data after 2019-05-01'):
+                RinexDownloader('nybp', datetime(2019, 9, 14), datetime(2019, 9, 15), catalog=catalog).validate(ftp)
+            with pytest.raises(ValueError, match=r'not valid! Did you mean nybp'):
+                RinexDownloader('nybq', datetime(2017, 9, 14), datetime(2017, 9, 15), catalog=catalog).validate(ftp)
+        # the site directory is listed once and each site log read once, then a new run needs neither
+        assert handler.requests == ['MLSD', 'RETR']
+        r = RinexDownloader('nybp', datetime(2003, 9, 14), datetime(2003, 9, 15),
+                            catalog=StationCatalog(str(tmp_path / 'catalog')))
+        with pytest.raises(ValueError, match=r'no data before'):
+            r.validate(None)
+    finally:
+        archive.stop()
+
+
+def test_stations_command(cors_archive, tmp_path, monkeypatch):
+    for station in ('nybp', 'nyb1', 'p589'):
+        cors_archive.add_station(station)
+    catalog = StationCatalog(str(tmp_path / '.listings'))
+    with FTP() as ftp:
+        ftp.connect(*cors_archive.servers[0])
+        ftp.login()
+        catalog.fetch(ftp)
+    result = CliRunner().invoke(stations, ['nyb', '--cache-dir', str(tmp_path)])
+    assert result.exit_code == 0
+    assert result.output == 'nyb1\nnybp\n'
@@ -0,0 +1,150 @@
+from datetime import datetime
+import io
+import os
+import numpy as np
+import pytest
+from src.Columnar import BLANK, ObservationTable, parse_fields, satellite_code, satellite_name
+from src.Rinex import ObservationReader, ObservationWriter
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+CHANGING_TYPES = """     2.11           OBSERVATION DATA    G (GPS)             RINEX VERSION / TYPE
+     2    C1    L1                                          # / TYPES OF OBSERV
+                                                            END OF HEADER
+ 17  9 14  0  0  0.0000000  0  1G03
+  18813359.413    11111111.111 5
+ 17  9 14  0  0 30.0000000  4  1
+     1    S1                                                # / TYPES OF OBSERV
+ 17  9 14  0  1  0.0000000  0  2G03R05
+        45.500
+        40.250
+"""
+
+# an epoch followed by the cycle slips found in it (epoch flag 6), at the same time
+CYCLE_SLIPS = """     2.11           OBSERVATION DATA    G (GPS)             RINEX VERSION / TYPE
+     2    C1    L1                                          # / TYPES OF OBSERV
+                                                            END OF HEADER
+ 17  9 14  0  0  0.0000000  0  1G03
+  18813359.413    11111111.111 5
+ 17  9 14  0  0  0.0000000  6  1G03
+                  11111110.123 1
+ 17  9 14  0  0 30.0000000  0  1G03
+  18813360.413    11111112.111 5
+"""
+
+
+def write_file(tmp_path, data: str) -> str:
+    path = str(tmp_path / 'test2570.17o')
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(data)
+    return path
+
+
+@pytest.mark.parametrize('name,code', [
+    ('G01', 1),
+    (' 07', 7),
+    ('R05', 105),
+    ('E24', 324),
+])
+def test_satellite_code(name, code):
+    assert satellite_code(name) == code
+    assert satellite_name(code) == name.replace(' ', 'G')
+
+
+@pytest.mark.parametrize('field,value,lli,snr', [
+    ('  18813359.413 5', 18813359.413, BLANK, 5),
+    (' -37418613.44945', -37418613.449, 4, 5),
+    ('  18813359.41300', 18813359.413, 0, 0),
+    ('          .572  ', 0.572, BLANK, BLANK),
+    ('         -.314 1', -0.314, BLANK, 1),
+    ('         1.5    ', 1.5, BLANK, BLANK),
+    ('                ', np.nan, BLANK, BLANK),
+    ('                8', np.nan, BLANK, BLANK),
+])
+def test_parse_fields(field, value, lli, snr):
+    values, llis, snrs = parse_fields(np.frombuffer(field[:16].encode(), dtype=np.uint8).reshape(1, 16))
+    np.testing.assert_array_equal(values, [value])
+    assert (llis[0], snrs[0]) == (lli, snr)
+
+
+@pytest.mark.parametrize('name', [
+    ('nybp2570.17o',),
+    ('crx2rnx', 'clck2570.17o'),
+    ('crx2rnx', 'wide2570.17o'),
+])
+def test_from_file(name):
+    path = os.path.join(FIXTURES, *name)
+    table = ObservationTable.from_file(path)
+    with open(path, encoding='latin-1') as f:
+        reader = ObservationReader(f)
+        epochs = [e for e in reader if not e.is_event]
+    assert len(table) == len(epochs)
+    assert list(table.datetimes()) == [e.time for e in epochs]
+    assert table.offsets[-1] == len(table.satellites) == sum(len(e.satellites) for e in epochs)
+    # the values are the same as parsing every field on its own, and writing
+    # them back gives the original epochs
+    values = [[float(field[:14]) if field[:14].strip() else np.nan for field in satellite]
+              for e in epochs for satellite in e.observations]
+    np.testing.assert_array_equal(table.values, values)
+    expected, output = io.StringIO(), io.StringIO()
+    for epoch in epochs:
+        ObservationWriter(expected, reader.header).write(epoch)
+    for epoch in table.to_epochs():
+        ObservationWriter(output, reader.header).write(epoch)
+    assert output.getvalue() == expected.getvalue()
+
+
+def test_window_and_concatenate():
+    path = os.path.join(FIXTURES, 'nybp2570.17o')
+    table = ObservationTable.from_file(path)
+    start, end = datetime(2017, 9, 14, 0, 5), datetime(2017, 9, 14, 0, 10, 15)
+    window = table.window(start, end)
+    assert list(window.datetimes()) == [t for t in table.datetimes() if start <= t <= end]
+    assert np.array_equal(window.values, table.values[table.offsets[10]:table.offsets[21]], equal_nan=True)
+    assert len(ObservationTable.from_file(path, start, end)) == len(window) == 11
+    # overlapping tables keep each epoch once
+    merged = ObservationTable.concatenate([table.window(end=end), window, table.window(start=start)])
+    assert np.array_equal(merged.times, table.times)
+    assert np.array_equal(merged.satellites, table.satellites)
+    assert np.array_equal(merged.values, table.values, equal_nan=True)
+    assert len(ObservationTable.concatenate([])) == 0
+
+
+def test_concatenate_cycle_slips(tmp_path):
+    table = ObservationTable.from_file(write_file(tmp_path, CYCLE_SLIPS))
+    assert list(table.flags) == [0, 6, 0]
+    merged = ObservationTable.concatenate([table, table])
+    assert list(merged.flags) == [0, 6, 0]
+    assert np.array_equal(merged.values, table.values, equal_nan=True)
+
+
+def test_types_change(tmp_path):
+    table = ObservationTable.from_file(write_file(tmp_path, CHANGING_TYPES))
+    assert table.types == ('C1', 'L1', 'S1')
+    assert len(table) == 2
+    assert list(table.offsets) == [0, 1, 3]
+    assert [satellite_name(s) for s in table.satellites] == ['G03', 'G03', 'R05']
+    np.testing.assert_array_equal(table.values, [
+        [18813359.413, 11111111.111, np.nan],
+        [np.nan, np.nan, 45.5],
+        [np.nan, np.nan, 40.25],
+    ])
+    assert list(table.snr[:, 1]) == [5, BLANK, BLANK]
+    assert table.with_types(('S1', 'L1')).values[2].tolist()[0] == 40.25
+
+
+def test_explicit_zero_indicators(tmp_path):
+    # a loss of lock indicator or signal strength of 0 is written back, not left blank
+    data = CHANGING_TYPES[:CHANGING_TYPES.index(' 17  9 14  0  0 30')].replace(
+        '  18813359.413    11111111.111 5', '  18813359.41300  11111111.1110 ')
+    path = write_file(tmp_path, data)
+    table = ObservationTable.from_file(path)
+    assert table.lli.tolist() == [[0, 0]] and table.snr.tolist() == [[0, BLANK]]
+    with open(path, encoding='latin-1') as f:
+        reader = ObservationReader(f)
+        epochs = list(reader)
+    expected, output = io.StringIO(), io.StringIO()
+    ObservationWriter(expected, reader.header).write(epochs[0])
+    ObservationWriter(output, reader.header).write(next(table.to_epochs()))
+    assert output.getvalue() == expected.getvalue()
+    assert '18813359.41300  11111111.1110\n' in output.getvalue()
@@ -0,0 +1,138 @@
+from datetime import datetime
+from glob import glob
+import os
+import pytest
+from src.Concurrency import LATENCY_ROUNDS, ConcurrencyWindow
+from src.Downloader import RinexDownloader
+from testing.archive import CorsArchive
+
+
+def complete_round(window: ConcurrencyWindow, size: int = 1000, latency: float = 0.01):
+    for _ in range(window.window):
+        window.completed(size, 0.1, latency)
+
+
+@pytest.mark.parametrize('maximum,minimum,initial', [
+    (0, 1, None),
+    (4, 0, None),
+    (2, 3, None),
+    (4, 1, 5),
+    (4, 2, 1),
+])
+def test_invalid_limits(maximum, minimum, initial):
+    with pytest.raises(ValueError):
+        ConcurrencyWindow(maximum, minimum, initial)
+
+
+def test_slow_start_then_additive_increase():
+    window = ConcurrencyWindow(16)
+    sizes = []
+    for _ in range(4):
+        complete_round(window)
+        sizes.append(window.window)
+    assert sizes == [2, 4, 8, 16]
+    # capped at the maximum
+    complete_round(window)
+    assert window.window == 16
+    window.congested()
+    assert window.window == 8
+    complete_round(window)
+    assert window.window == 9
+
+
+def test_decrease_once_per_round():
+    window = ConcurrencyWindow(8, initial=8)
+    window.congested()
+    window.congested()
+    assert window.window == 4
+    assert window.congestion_events == 1
+    complete_round(window)
+    window.congested()
+    assert window.window == 2
+    window.congested()
+    assert window.window == 2
+    assert window.congestion_events == 2
+
+
+def test_minimum():
+    window = ConcurrencyWindow(8, minimum=3, initial=4)
+    window.congested()
+    assert window.window == 3
+    complete_round(window)
+    window.congested()
+    assert window.window == 3
+
+
+def test_latency_jump_halves_the_window():
+    window = ConcurrencyWindow(8, initial=4)
+    complete_round(window, latency=0.01)
+    assert window.window == 8
+    complete_round(window, latency=0.1)
+    assert window.window == 4
+    assert window.congestion_events == 1
+
+
+def test_sustained_latency_never_grows_the_window():
+    window = ConcurrencyWindow(16, initial=16)
+    complete_round(window, latency=0.01)
+    sizes = []
+    for _ in range(6):
+        complete_round(window, latency=1.0)
+        sizes.append(window.window)
+    # halved every other round, holding in the round right after a decrease
+    assert sizes == [8, 8, 4, 4, 2, 2]
+    assert window.congestion_events == 3
+
+
+def test_latency_baseline_ages():
+    window = ConcurrencyWindow(16, initial=16)
+    complete_round(window, latency=0.01)
+    for _ in range(LATENCY_ROUNDS - 1):
+        complete_round(window, latency=1.0)
+    assert window.window == 1
+    # the rounds before the change of latency are forgotten, so it is the new baseline
+    complete_round(window, latency=1.0)
+    assert window.window == 2
+    complete_round(window, latency=1.0)
+    assert window.window == 3
+
+
+def test_acquire():
+    window = ConcurrencyWindow(4, initial=2)
+    assert window.acquire(blocking=False)
+    assert window.acquire(blocking=False)
+    assert not window.acquire(blocking=False)
+    window.release()
+    with window:
+        assert window.in_flight == 2
+    assert window.in_flight == 1
+    window.release()
+    window.completed(100, 0.5, 0.01)
+    window.completed(100, 0.5, 0.01)
+    stats = window.stats()
+    assert stats['window'] == 4
+    assert stats['in_flight'] == 0
+    assert stats['completed_transfers'] == 2
+    assert stats['throughput'] > 0
+
+
+def test_download_from_busy_server(tmp_path):
+    """ A server refusing connections beyond its limit slows the download down but does not fail it. """
+    archive = CorsArchive(str(tmp_path / 'ftp'), max_cons=4)
+    expected = {}
+    for h in 'abcdefgh':
+        name = 'nybp257{}.17o.gz'.format(h)
+        expected[name] = os.urandom(20000)
+        archive.add_file(2017, 257, 'nybp', name, expected[name])
+    archive.start()
+    try:
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 7, 33), str(tmp_path),
+                            workers=6, servers=archive.servers, backoff=0.01)
+        r.concurrency.window = 6
+        r.download()
+    finally:
+        archive.stop()
+    downloaded = {os.path.basename(f): open(f, 'rb').read() for f in glob('{}/*.gz'.format(tmp_path))}
+    assert downloaded == expected
+    assert r.concurrency.congestion_events >= 1
+    assert r.concurrency.window < 6
@@ -0,0 +1,106 @@
+from datetime import datetime
+import os
+import pytest
+import shutil
+import tempfile
+from src.Cache import RinexCache
+from src.Decompress import GzipDecompressor, LZWCompressor, LZWDecompressor, decompress_file, decompressed_name
+from src.Downloader import RinexDownloader
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def read_fixture(*path: str) -> bytes:
+    with open(os.path.join(FIXTURES, *path), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('decompressor,compressed,expected', [
+    (GzipDecompressor, 'nybp2570.17o.gz', 'nybp2570.17o'),
+    (LZWDecompressor, 'nybp2570.17d.Z', 'nybp2570.17d'),
+])
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024, 1 << 20])
+def test_streaming_decompression(decompressor, compressed, expected, chunk_size):
+    data = read_fixture(compressed)
+    d = decompressor()
+    output = [d.decompress(data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    output.append(d.flush())
+    assert b''.join(output) == read_fixture(expected)
+
+
+def test_multi_member_gzip():
+    data = read_fixture('nybp2570.17o.gz')
+    d = GzipDecompressor()
+    assert d.decompress(data + data) + d.flush() == read_fixture('nybp2570.17o') * 2
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1024, 1 << 20])
+def test_lzw_compression_matches_compress(chunk_size):
+    data = read_fixture('nybp2570.17d')
+    c = LZWCompressor()
+    output = [c.compress(data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    output.append(c.flush())
+    assert b''.join(output) == read_fixture('nybp2570.17d.Z')
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'a',
+    b'ab' * 10000,
+    # fills the dictionary, so the codes stop growing
+    bytes(range(256)) * 2 + bytes((i * 7919) % 251 for i in range(200000)),
+], ids=['empty', 'one_byte', 'repeated', 'full_dictionary'])
+def test_lzw_round_trip(data):
+    c = LZWCompressor()
+    compressed = c.compress(data) + c.flush()
+    d = LZWDecompressor()
+    assert d.decompress(compressed) + d.flush() == data
+
+
+@pytest.mark.parametrize('decompressor,data', [
+    (GzipDecompressor, read_fixture('nybp2570.17o.gz')[:100]),
+    (LZWDecompressor, b'\x1f\x8b\x08'),
+])
+def test_invalid_data(decompressor, data):
+    with pytest.raises(ValueError):
+        d = decompressor()
+        d.decompress(data)
+        d.flush()
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    ('nybp2570.17o.gz', 'nybp2570.17o'),
+    ('nybp2570.17d.Z', 'nybp2570.17d'),
+    ('nybp2570.17o', 'nybp2570.17o'),
+])
+def test_decompressed_name(test_input, expected):
+    assert decompressed_name(test_input) == expected
+
+
+def test_decompress_file(tmp_path):
+    shutil.copy(os.path.join(FIXTURES, 'nybp2570.17d.Z'), str(tmp_path))
+    path = decompress_file(str(tmp_path / 'nybp2570.17d.Z'))
+    assert os.listdir(str(tmp_path)) == ['nybp2570.17d']
+    assert open(path, 'rb').read() == read_fixture('nybp2570.17d')
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_download_decompresses_on_the_fly(cors_archive, tmp_path, cached):
+    cors_archive.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z',
+                          read_fixture('nybp2570.17d.Z'))
+    cache = RinexCache(str(tmp_path / 'cache')) if cached else None
+    for _ in range(2 if cached else 1):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 2, 33), temp_dir,
+                                servers=cors_archive.servers, cache=cache, decompress=True)
+            r.download()
+            # Hatanaka compressed files are converted to standard RINEX as well
+            assert os.listdir(temp_dir) == ['nybp2570.17o']
+            assert open(os.path.join(temp_dir, 'nybp2570.17o'),
+                        'rb').read() == read_fixture('crx2rnx', 'nybp2570.17o')
+    if cached:
+        # the cache keeps the file as it is on the server
+        assert open(cache.path('nybp', 2017, 257, 'nybp2570.17d.Z'),
+                    'rb').read() == read_fixture('nybp2570.17d.Z')
@@ -1,8 +1,12 @@
+from ftplib import FTP
 from glob import glob
+import os
 import pytest
 import tempfile
 from datetime import datetime
-from src.Downloader import RinexDownloader
+from src.Downloader import RinexDownloader, backoff_delay
+from src.Planner import PlannedFile
+from testing.archive import CorsArchive, CorsHandler
 
 
 @pytest.mark.parametrize('test_input,expected', [
@@ -106,3 +110,130 @@ def test_download(test_input, expected):
         r.download()
         assert glob('{}/*'.format(temp_dir)
                     ) == ['{}/{}'.format(temp_dir, i) for i in expected]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_concurrent_download(cors_archive, workers):
+    """ Downloads a full day of hourly files through a pool of FTP sessions. """
+    expected = {}
+    for h in 'abcdefghijklmnopqrstuvwx':
+        name = 'nybp257{}.17o.gz'.format(h)
+        expected[name] = name.encode() * 100
+        cors_archive.add_file(2017, 257, 'nybp', name, expected[name])
+    start_date = datetime(2017, 9, 14, 0, 11, 22)
+    end_date = datetime(2017, 9, 14, 23, 33, 44)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        r = RinexDownloader('nybp', start_date, end_date, temp_dir,
+                            workers=workers, servers=cors_archive.servers)
+        r.download()
+        downloaded = {os.path.basename(f): open(f, 'rb').read()
+                      for f in glob('{}/*'.format(temp_dir))}
+    assert downloaded == expected
+
+
+def test_plan_across_years(cors_archive):
+    cors_archive.add_file(2017, 365, 'nybp', 'nybp3650.17d.Z')
+    cors_archive.add_file(2018, 1, 'nybp', 'nybp0010.18d.Z')
+    start_date = datetime(2017, 12, 31, 23, 11, 22)
+    end_date = datetime(2018, 1, 1, 1, 33, 44)
+    r = RinexDownloader('nybp', start_date, end_date,
+                        servers=cors_archive.servers)
+    with FTP() as ftp:
+        ftp.connect(*cors_archive.servers[0])
+        ftp.login()
+        assert list(r.plan(ftp)) == [PlannedFile(2017, 365, 'nybp3650.17d.Z', 0),
+                                     PlannedFile(2018, 1, 'nybp0010.18d.Z', 0)]
+
+
+class FlakyHandler(CorsHandler):
+    """ Handler cutting the first transfer of every file short, by ending it halfway or dropping the connection. """
+    drop = False
+    attempts = {}
+    restarts = []
+
+    def ftp_REST(self, line):
+        self.restarts.append(int(line))
+        return super().ftp_REST(line)
+
+    def ftp_RETR(self, file):
+        name = os.path.basename(file)
+        self.attempts[name] = self.attempts.get(name, 0) + 1
+        if self.attempts[name] > 1:
+            return super().ftp_RETR(file)
+        if self.drop:
+            self.close()
+            return
+        with open(file, 'rb') as f:
+            data = f.read()
+        with open(file + '.half', 'wb') as f:
+            f.write(data[:len(data) // 2])
+        return super().ftp_RETR(file + '.half')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('drop', [False, True])
+def test_resume_download(tmp_path, workers, drop):
+    handler = type('FlakyHandler', (FlakyHandler,), {'drop': drop, 'attempts': {}, 'restarts': []})
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=handler)
+    archive.start()
+    expected = {}
+    try:
+        for h in 'abcd':
+            name = 'nybp257{}.17o.gz'.format(h)
+            expected[name] = os.urandom(50000)
+            archive.add_file(2017, 257, 'nybp', name, expected[name])
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 3, 33), str(tmp_path),
+                            workers=workers, servers=archive.servers, backoff=0)
+        r.download()
+    finally:
+        archive.stop()
+    downloaded = {os.path.basename(f): open(f, 'rb').read() for f in glob('{}/*.gz'.format(tmp_path))}
+    assert downloaded == expected
+    assert handler.attempts == {name: 2 for name in expected}
+    # truncated transfers carry on from where they stopped
+    assert handler.restarts == ([] if drop else [25000] * 4)
+    # every byte is counted once, however many attempts it took
+    trace = r.metrics.trace()
+    assert trace['counters']['retries'] == 4
+    assert trace['counters']['bytes_transferred'] == 4 * 50000
+    assert {f['name']: f['attempts'] for f in trace['files']} == {name: 2 for name in expected}
+
+
+def test_download_gives_up(tmp_path):
+    handler = type('FlakyHandler', (FlakyHandler,), {'drop': True, 'attempts': {}, 'restarts': []})
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=handler)
+    archive.start()
+    try:
+        archive.add_file(2017, 257, 'nybp', 'nybp257a.17o.gz', b'x' * 1000)
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), str(tmp_path),
+                            servers=archive.servers, retries=0, backoff=0)
+        with pytest.raises(RuntimeError, match=r'nybp257a.17o.gz after 1 attempts'):
+            r.download()
+    finally:
+        archive.stop()
+    assert not glob('{}/*.gz'.format(tmp_path))
+
+
+@pytest.mark.parametrize('attempt,limit', [(1, 1.0), (3, 4.0), (20, 60.0)])
+def test_backoff_delay(attempt, limit):
+    delays = [backoff_delay(attempt) for _ in range(100)]
+    assert all(0 <= d <= limit for d in delays)
+    assert max(delays) > limit / 2
+
+
+def test_resume_while_decompressing(tmp_path):
+    handler = type('FlakyHandler', (FlakyHandler,), {'drop': False, 'attempts': {}, 'restarts': []})
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=handler)
+    archive.start()
+    fixtures = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+    try:
+        with open(os.path.join(fixtures, 'nybp2570.17d.Z'), 'rb') as f:
+            archive.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z', f.read())
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), str(tmp_path),
+                            servers=archive.servers, decompress=True, backoff=0)
+        r.download()
+    finally:
+        archive.stop()
+    assert len(handler.restarts) == 1
+    with open(os.path.join(fixtures, 'crx2rnx', 'nybp2570.17o'), 'rb') as expected:
+        assert (tmp_path / 'nybp2570.17o').read_bytes() == expected.read()
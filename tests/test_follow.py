@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+import os
+import pytest
+from src.Downloader import RinexDownloader
+from src.Follow import MANIFEST_SUFFIX, RinexFollower, read_manifest
+from src.Merger import RinexMerger
+from src.Rinex import ObservationFile
+from testing.archive import CorsArchive, CorsHandler
+from testing.synthetic import TYPES, gzip_file, observation_data, publish
+
+DAY = datetime(2021, 3, 10)
+
+
+class CountingHandler(CorsHandler):
+    """ Handler recording the name of every file transferred. """
+    transfers = []
+
+    def ftp_RETR(self, file):
+        self.transfers.append(os.path.basename(file))
+        return super().ftp_RETR(file)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    CountingHandler.transfers = []
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=CountingHandler)
+    archive.start()
+    yield archive
+    archive.stop()
+
+
+def hours(archive: CorsArchive, first: int, last: int):
+    publish(archive, 'nybp', DAY + timedelta(hours=first), DAY + timedelta(hours=last, minutes=59),
+            interval=300, satellites=4)
+
+
+def merged(archive: CorsArchive, tmp_path, start: datetime, end: datetime) -> bytes:
+    """ Merge a window the way grab_data does, to compare with. """
+    directory = str(tmp_path / 'expected')
+    os.makedirs(directory, exist_ok=True)
+    output = str(tmp_path / 'expected.obs')
+    plan = RinexDownloader('nybp', start, end, directory, servers=archive.servers).download()
+    RinexMerger('nybp', start, end, directory, workers=1, output=output).merge(plan)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    with open(output, 'rb') as f:
+        return f.read()
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_follow_appends_new_hours(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers)
+    hours(archive, 0, 2)
+    assert follower.update(now=DAY + timedelta(hours=3, minutes=10)) == 36
+    first = read(output)
+    assert first == merged(archive, tmp_path, DAY, DAY + timedelta(hours=2, minutes=59, seconds=59))
+    assert follower.update(now=DAY + timedelta(hours=3, minutes=20)) == 0
+
+    hours(archive, 3, 4)
+    CountingHandler.transfers = []
+    assert follower.update(now=DAY + timedelta(hours=5, minutes=10)) == 24
+    # only the new hours were downloaded, and appended after the epochs already there
+    assert CountingHandler.transfers == ['nybp069d.21o.gz', 'nybp069e.21o.gz']
+    data = read(output)
+    assert data.startswith(first)
+    assert data == merged(archive, tmp_path, DAY, DAY + timedelta(hours=4, minutes=59, seconds=59))
+    manifest = read_manifest(output + MANIFEST_SUFFIX)
+    assert [name for _, _, name in manifest.files] == ['nybp069{}.21o.gz'.format(h) for h in 'abcde']
+    assert manifest.size == len(data)
+    assert manifest.last == DAY + timedelta(hours=4, minutes=55)
+
+
+def test_follow_waits_for_missing_hours(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers)
+    hours(archive, 0, 0)
+    hours(archive, 2, 2)
+    # hour 1 may still be published, so hour 2 waits for it
+    assert follower.update(now=DAY + timedelta(hours=2, minutes=30)) == 12
+    assert follower.update(now=DAY + timedelta(hours=3, minutes=30)) == 0
+    # until it is too late
+    assert follower.update(now=DAY + timedelta(hours=4, minutes=30)) == 12
+    with ObservationFile(output) as f:
+        assert f.time(11) == DAY + timedelta(minutes=55)
+        assert f.time(12) == DAY + timedelta(hours=2)
+
+
+def test_follow_trims_to_retention(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, retention=timedelta(hours=1),
+                             servers=archive.servers)
+    hours(archive, 0, 1)
+    follower.update(now=DAY + timedelta(hours=2, minutes=10))
+    # not trimmed until the file holds an hour more than the window
+    with ObservationFile(output) as f:
+        assert f.time(0) == DAY
+    hours(archive, 2, 3)
+    follower.update(now=DAY + timedelta(hours=4, minutes=10))
+    with ObservationFile(output) as f:
+        assert f.time(0) == DAY + timedelta(hours=2, minutes=55)
+        assert f.header.get('TIME OF FIRST OBS').startswith('  2021     3    10     2    55')
+    assert read_manifest(output + MANIFEST_SUFFIX).first == DAY + timedelta(hours=2, minutes=55)
+    # the epochs kept are those of a full merge
+    merged(archive, tmp_path, DAY + timedelta(hours=2), DAY + timedelta(hours=3, minutes=59, seconds=59))
+    with ObservationFile(output) as f, ObservationFile(str(tmp_path / 'expected.obs')) as expected:
+        assert bytes(f.slice()) == bytes(expected.slice(DAY + timedelta(hours=2, minutes=55)))
+
+
+def test_follow_undoes_interrupted_update(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers)
+    hours(archive, 0, 0)
+    follower.update(now=DAY + timedelta(hours=1, minutes=10))
+    # an update that died half way through appending
+    with open(output, 'a') as f:
+        f.write(' 21  3 10  1  0  0.0000000  0  4G01G02')
+    hours(archive, 1, 1)
+    follower.update(now=DAY + timedelta(hours=2, minutes=10))
+    assert read(output) == merged(archive, tmp_path, DAY, DAY + timedelta(hours=1, minutes=59, seconds=59))
+
+
+def test_follow_restarts_interrupted_first_update(archive, tmp_path, monkeypatch):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers)
+    hours(archive, 0, 0)
+    replace = os.replace
+
+    def crash(source, destination):
+        if destination == output:
+            raise KeyboardInterrupt()
+        replace(source, destination)
+
+    # the first update dies once the manifest is written, before the merged file is in place
+    monkeypatch.setattr(os, 'replace', crash)
+    with pytest.raises(KeyboardInterrupt):
+        follower.update(now=DAY + timedelta(hours=1, minutes=10))
+    monkeypatch.undo()
+    assert not os.path.exists(output) and os.path.exists(output + MANIFEST_SUFFIX)
+    assert follower.update(now=DAY + timedelta(hours=1, minutes=10)) == 12
+    assert read(output) == merged(archive, tmp_path, DAY, DAY + timedelta(minutes=59, seconds=59))
+
+
+def test_follow_announces_new_types(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    follower = RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers)
+    types = ('L1', 'C1', 'P2')
+    archive.add_file(2021, 69, 'nybp', 'nybp069a.21o.gz', gzip_file(observation_data(
+        'nybp', DAY, DAY + timedelta(minutes=59), 300, 4, types)))
+    follower.update(now=DAY + timedelta(hours=1, minutes=10))
+    hours(archive, 1, 1)
+    follower.update(now=DAY + timedelta(hours=2, minutes=10))
+    with ObservationFile(output) as f:
+        assert f.header.types == types
+        assert f.types_at(len(f) - 1) == types + tuple(t for t in TYPES if t not in types)
+        assert f.flags[12] == 4
+        epochs = list(f.epochs())
+    assert epochs[0].types == types
+    assert epochs[-1].types == f.types_at(len(f) - 1)
+    assert epochs[-1].observations[0][len(types)].strip()  # S1 of the new file is kept
+
+
+def test_follow_checks_settings(archive, tmp_path):
+    output = str(tmp_path / 'nybp.obs')
+    hours(archive, 0, 0)
+    RinexFollower('nybp', output, RinexDownloader, since=DAY, servers=archive.servers).update(
+        now=DAY + timedelta(hours=1, minutes=10))
+    with pytest.raises(ValueError, match='decimated'):
+        RinexFollower('nybp', output, RinexDownloader, decimate=30, servers=archive.servers).update()
+    os.remove(output + MANIFEST_SUFFIX)
+    with pytest.raises(ValueError, match='no manifest'):
+        RinexFollower('nybp', output, RinexDownloader, servers=archive.servers).update()
@@ -0,0 +1,290 @@
+from datetime import datetime
+import io
+import os
+import pytest
+import shutil
+from src.Decompress import DecompressingWriter
+import numpy as np
+import src.Hatanaka
+from src.Hatanaka import (AccumulationTable, CRXDecoder, CRXEncoder, DifferenceTable, accumulate, compress_rinex,
+                          decompress_crx, difference, format_clock, format_observation, format_observations, repair,
+                          text_difference)
+from src.Merger import RinexMerger
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+# output of the reference CRX2RNX tool for each Compact RINEX fixture
+EXPECTED = os.path.join(FIXTURES, 'crx2rnx')
+CRX_FIXTURES = ['nybp2570.17d', 'wide2570.17d', 'clck2570.17d']
+
+
+def read_fixture(*path: str) -> bytes:
+    with open(os.path.join(FIXTURES, *path), 'rb') as f:
+        return f.read()
+
+
+def expected_output(name: str) -> bytes:
+    return read_fixture('crx2rnx', name[:-1] + 'o')
+
+
+@pytest.mark.parametrize('name', CRX_FIXTURES)
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024, 1 << 20])
+@pytest.mark.parametrize('block', [1, 3, 256])
+def test_matches_crx2rnx(name, chunk_size, block, monkeypatch):
+    monkeypatch.setattr(src.Hatanaka, 'BLOCK_EPOCHS', block)
+    data = read_fixture(name)
+    d = CRXDecoder()
+    output = [d.decompress(data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    output.append(d.flush())
+    assert b''.join(output) == expected_output(name)
+
+
+def test_crlf_line_endings():
+    data = read_fixture('clck2570.17d').replace(b'\n', b'\r\n')
+    d = CRXDecoder()
+    assert d.decompress(data) + d.flush() == expected_output('clck2570.17d')
+
+
+def test_decompress_from_lzw():
+    f = io.BytesIO()
+    writer = DecompressingWriter(f, 'nybp2570.17d.Z', hatanaka=True)
+    writer.write(read_fixture('nybp2570.17d.Z'))
+    writer.close()
+    assert f.getvalue() == expected_output('nybp2570.17d')
+
+
+CRX_DATA = read_fixture('nybp2570.17d')
+
+
+@pytest.mark.parametrize('data', [
+    b'not compact rinex\n',
+    CRX_DATA.replace(b'1.0', b'3.0', 1),
+    CRX_DATA[:CRX_DATA.index(b'END OF HEADER')],
+    # ends after the first epoch line, before its data lines
+    CRX_DATA[:CRX_DATA.index(b'\n3&', CRX_DATA.index(b'END OF HEADER'))],
+], ids=['not_crx', 'crinex_3', 'header', 'epoch'])
+def test_invalid_data(data):
+    with pytest.raises(ValueError):
+        d = CRXDecoder()
+        d.decompress(data)
+        d.flush()
+
+
+@pytest.mark.parametrize('name', CRX_FIXTURES)
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+@pytest.mark.parametrize('block', [1, 3, 256])
+def test_matches_rnx2crx(name, chunk_size, block, monkeypatch):
+    monkeypatch.setattr(src.Hatanaka, 'BLOCK_EPOCHS', block)
+    data = expected_output(name)
+    e = CRXEncoder()
+    output = [e.compress(data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    output.append(e.flush())
+    lines = b''.join(output).split(b'\n')
+    expected = read_fixture(name).split(b'\n')
+    assert lines[0] == expected[0]
+    assert lines[1].startswith(b'grab_data ') and lines[1].endswith(b'CRINEX PROG / DATE')
+    # the program and date line is the only one that differs
+    assert lines[2:] == expected[2:]
+
+
+@pytest.mark.parametrize('name', CRX_FIXTURES)
+def test_encode_round_trip(name):
+    data = expected_output(name)
+    e = CRXEncoder()
+    d = CRXDecoder()
+    assert d.decompress(e.compress(data) + e.flush()) + d.flush() == data
+
+
+RNX_DATA = expected_output('nybp2570.17d')
+
+
+def extra_field(data: bytes) -> bytes:
+    """ Add an observation past the last one the first data line can hold. """
+    start = data.index(b'\n', data.index(b'END OF HEADER')) + 1
+    start = data.index(b'\n', start) + 1
+    end = data.index(b'\n', start)
+    return data[:start] + data[start:end].ljust(80) + b'       1.000' + data[end:]
+
+
+@pytest.mark.parametrize('data', [
+    b'not rinex\n',
+    RNX_DATA.replace(b'     2.11', b'     3.02', 1),
+    RNX_DATA[:RNX_DATA.index(b'END OF HEADER')],
+    # ends after the first epoch line, before its data lines
+    RNX_DATA[:RNX_DATA.index(b'\n', RNX_DATA.index(b'END OF HEADER') + 20) + 1],
+    extra_field(RNX_DATA),
+], ids=['not_rinex', 'rinex_3', 'header', 'epoch', 'types'])
+def test_invalid_rinex(data):
+    with pytest.raises(ValueError):
+        e = CRXEncoder()
+        e.compress(data)
+        e.flush()
+
+
+@pytest.mark.parametrize('old,new', [
+    ('abcdef', 'aXc ef'),
+    ('abc', 'abcdef'),
+    ('abcde', 'abc'),
+    ('&', ' 17  9 14'),
+])
+def test_text_difference(old, new):
+    assert repair(old, text_difference(old, new)).rstrip(' ') == new.rstrip(' ')
+
+
+def test_difference():
+    text, arc = difference(123456789, None, 10 ** 5)
+    assert text == '3&123456789'
+    for value in (123456790, 123456793, 123456800, 123456810):
+        text, arc = difference(value, arc, 10 ** 5, 10 ** 5)
+    # third order difference of 1, 3, 7, 10
+    assert (text, arc[0]) == ('-1', 3)
+    # a jump in the upper part starts a new arc
+    text, arc = difference(10 ** 12, arc, 10 ** 5, 10 ** 5)
+    assert (text, arc[0]) == ('3&1000000000000', 0)
+
+
+def test_difference_table():
+    # two satellites and two types over six epochs, None where blank or the satellite is not in the epoch
+    series = [[(123456789, 5), (-2000, None)], [(123456790, 6), (-2001, 7)], [(123456793, None), (-2003, 8)],
+              [(123456800, 7), None], [(10 ** 12, 9), (-2010, 9)], [(10 ** 12 + 5, 10), (-2020, 10)]]
+    expected = []
+    arcs = {}
+    for epoch in series:
+        texts = []
+        for row, values in enumerate(epoch):
+            for column, value in enumerate(values or (None, None)):
+                if value is None:
+                    arcs.pop((row, column), None)
+                    texts.append('')
+                else:
+                    text, arcs[row, column] = difference(value, arcs.get((row, column)), 10 ** 5, 10 ** 5)
+                    texts.append(text)
+        expected.append(texts)
+    cells = [[v or (None, None) for v in epoch] for epoch in series]
+    values = np.array([[[0 if x is None else x for x in v] for v in epoch] for epoch in cells], dtype=np.int64)
+    present = np.array([[[x is not None for x in v] for v in epoch] for epoch in cells])
+    for split in (1, 4, 6):
+        table = DifferenceTable(2)
+        assert [table.row(s) for s in ('G01', 'G02')] == [0, 1]
+        texts = []
+        for start in range(0, len(series), split):
+            diffs, new = table.difference(values[start:start + split], present[start:start + split])
+            texts += [['' if not p else '3&{}'.format(v) if n else str(d)
+                       for d, n, v, p in zip(*(a.ravel().tolist() for a in cells))]
+                      for cells in zip(diffs, new, values[start:start + split], present[start:start + split])]
+        assert texts == expected
+
+
+def test_accumulation_table():
+    # two satellites and two types over seven epochs, with arcs of several orders, None where blank
+    series = [[('3&123456789', '1&-2000'), None], [('1', '-1'), ('2&7', '')], [('2', '-2'), ('3', '0&5')],
+              [('4', ''), ('-1', '6')], [('-1', '1&40'), ('3&100', '-3')], [('0', '2'), ('7', '2')],
+              [('5&9', '3'), ('8', '1')]]
+    expected = []
+    arcs = {}
+    for epoch in series:
+        values = []
+        for row, fields in enumerate(epoch):
+            for column, field in enumerate(fields or ('', '')):
+                if not field:
+                    arcs.pop((row, column), None)
+                    values.append(None)
+                else:
+                    arcs[row, column] = accumulate(field, arcs.get((row, column)))
+                    values.append(arcs[row, column][2][-1])
+        expected.append(values)
+    cells = [[fields or ('', '') for fields in epoch] for epoch in series]
+    differences = np.array([[[int(f.split('&')[-1] or 0) for f in fields] for fields in epoch] for epoch in cells])
+    present = np.array([[[f != '' for f in fields] for fields in epoch] for epoch in cells])
+    orders = np.array([[[int(f[0]) if '&' in f else -1 for f in fields] for fields in epoch] for epoch in cells])
+    for split in (1, 3, 7):
+        table = AccumulationTable(2)
+        assert [table.row(s) for s in ('G01', 'G02')] == [0, 1]
+        values = np.concatenate([table.accumulate(differences[start:start + split], present[start:start + split],
+                                                  orders[start:start + split])
+                                 for start in range(0, len(series), split)])
+        assert np.where(present, values, -1).reshape(len(series), -1).tolist() == \
+            [[-1 if v is None else v for v in epoch] for epoch in expected]
+    # a difference without an arc to add it to
+    table = AccumulationTable(1)
+    table.row('G01')
+    with pytest.raises(ValueError, match='does not belong'):
+        table.accumulate(np.ones((1, 1, 1), np.int64), np.ones((1, 1, 1), bool), np.full((1, 1, 1), -1))
+
+
+@pytest.mark.parametrize('old,diff,expected', [
+    ('abcdef', ' X & ', 'aXc ef'),
+    ('abc', '   def', 'abcdef'),
+    ('abc', '  c&&', 'abc  '),
+    ('', '&ab', ' ab'),
+])
+def test_repair(old, diff, expected):
+    assert repair(old, diff) == expected
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    (0, '          .000'),
+    (123, '          .123'),
+    (-123, '         -.123'),
+    (1234, '         1.234'),
+    (-123456, '      -123.456'),
+    (9999999999999, '9999999999.999'),
+])
+def test_format_observation(test_input, expected):
+    assert format_observation(test_input) == expected
+
+
+def test_format_observations():
+    values = np.array([[0, 123, -123], [1234, -123456, 9999999999999]])
+    text = format_observations(values)
+    assert text.shape == (2, 3, 14)
+    assert [[bytes(field).decode() for field in row] for row in text] == \
+        [[format_observation(v) for v in row] for row in values.tolist()]
+    for value in (10 ** 13, -10 ** 12):
+        with pytest.raises(ValueError):
+            format_observations(np.array([0, value]))
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    (308245, '  .000308245'),
+    (-308245, ' -.000308245'),
+    (-1234567890, '-1.234567890'),
+    (12345678901, '12.345678901'),
+])
+def test_format_clock(test_input, expected):
+    assert format_clock(test_input) == expected
+
+
+@pytest.mark.parametrize('format_function,test_input', [
+    (format_observation, 10 ** 13),
+    (format_observation, -10 ** 12),
+    (format_clock, 100 * 10 ** 9),
+])
+def test_format_out_of_range(format_function, test_input):
+    with pytest.raises(ValueError):
+        format_function(test_input)
+
+
+def test_decompress_crx(tmp_path):
+    shutil.copy(os.path.join(FIXTURES, 'wide2570.17d'), str(tmp_path))
+    path = decompress_crx(str(tmp_path / 'wide2570.17d'))
+    assert os.listdir(str(tmp_path)) == ['wide2570.17o']
+    assert open(path, 'rb').read() == expected_output('wide2570.17d')
+
+
+def test_compress_rinex(tmp_path):
+    (tmp_path / 'wide2570.17o').write_bytes(expected_output('wide2570.17d'))
+    path = compress_rinex(str(tmp_path / 'wide2570.17o'))
+    assert os.listdir(str(tmp_path)) == ['wide2570.17d']
+    assert decompress_crx(path) == str(tmp_path / 'wide2570.17o')
+    assert (tmp_path / 'wide2570.17o').read_bytes() == expected_output('wide2570.17d')
+
+
+def test_merger_decompresses_without_crx2rnx(tmp_path):
+    for name in ('nybp2570.17d.Z', 'clck2570.17d'):
+        shutil.copy(os.path.join(FIXTURES, name), str(tmp_path))
+    m = RinexMerger('nybp', datetime(2017, 9, 14), datetime(2017, 9, 14, 23), str(tmp_path))
+    m.decompress_files()
+    assert sorted(os.listdir(str(tmp_path))) == ['clck2570.17o', 'nybp2570.17o']
+    assert open(str(tmp_path / 'nybp2570.17o'), 'rb').read() == expected_output('nybp2570.17d')
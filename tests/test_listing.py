@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from ftplib import FTP
+import pytest
+from src.Downloader import RinexDownloader
+from src.Listing import ListingIndex, RECENT_TTL, UNSETTLED_TTL
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    (timedelta(days=400), None),
+    (timedelta(days=3), UNSETTLED_TTL),
+    (timedelta(hours=1), RECENT_TTL),
+])
+def test_ttl(test_input, expected):
+    day = (datetime.utcnow() - test_input).timetuple()
+    assert ListingIndex().ttl(day.tm_year, day.tm_yday) == expected
+
+
+def test_listing_persists_across_instances(tmp_path):
+    ListingIndex(str(tmp_path)).put('NYBP', 2017, 257, {'nybp2570.17d.Z': 42})
+    listing = ListingIndex(str(tmp_path)).get('nybp', 2017, 257)
+    assert listing == {'nybp2570.17d.Z': 42}
+    assert ListingIndex(str(tmp_path)).get('nybp', 2017, 258) is None
+
+
+def test_expired_listing_is_a_miss(tmp_path):
+    day = datetime.utcnow().timetuple()
+    index = ListingIndex(str(tmp_path))
+    index.put('nybp', day.tm_year, day.tm_yday, {})
+    with open(str(tmp_path / 'nybp' / str(day.tm_year) / '{:03d}.json'.format(day.tm_yday)), 'w') as f:
+        f.write('{"fetched": 0, "files": {}}')
+    assert ListingIndex(str(tmp_path)).get(
+        'nybp', day.tm_year, day.tm_yday) is None
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_warm(cors_archive, workers):
+    cors_archive.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z', b'day')
+    cors_archive.add_file(2017, 258, 'nybp', 'nybp258a.17o.gz')
+    sessions = []
+
+    def session() -> FTP:
+        ftp = FTP()
+        ftp.connect(*cors_archive.servers[0])
+        ftp.login()
+        sessions.append(ftp)
+        return ftp
+
+    index = ListingIndex()
+    index.warm(session, 'nybp', [(2017, 257), (2017, 258), (2017, 259)], workers)
+    for ftp in sessions:
+        ftp.quit()
+    assert index.get('nybp', 2017, 257) == {'nybp2570.17d.Z': 3}
+    assert index.get('nybp', 2017, 258) == {'nybp258a.17o.gz': 0}
+    assert index.get('nybp', 2017, 259) == {}
+
+
+def test_plan_from_cached_listings(cors_archive, tmp_path):
+    cors_archive.add_file(2017, 257, 'nybp', 'nybp2570.17d.Z')
+    start_date = datetime(2017, 9, 14, 23, 11, 22)
+    end_date = datetime(2017, 9, 14, 23, 33, 44)
+    with FTP() as ftp:
+        ftp.connect(*cors_archive.servers[0])
+        ftp.login()
+        RinexDownloader('nybp', start_date, end_date,
+                        index=ListingIndex(str(tmp_path))).plan(ftp)
+    # a repeat run plans without going to the FTP server at all
+    r = RinexDownloader('nybp', start_date, end_date,
+                        index=ListingIndex(str(tmp_path)))
+    assert [f.name for f in r.plan(None)] == ['nybp2570.17d.Z']
@@ -1,12 +1,47 @@
 from datetime import datetime
+from functools import partial
 import filecmp
+import gzip
 from glob import glob
+import io
 import os
 import pytest
+import shutil
 import subprocess
 import tempfile
 from src.Downloader import RinexDownloader
-from src.Merger import RinexMerger
+from src.Merger import RinexMerger, TreeMerge, merge_epochs, merge_files, merge_observations, process_pool
+from src.Output import GZIP
+from src.Planner import FetchPlan, PlannedFile
+from src.Runner import RinexRunner
+from src.Rinex import ObservationReader
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+# header and two epochs of a file with other observation types than the fixtures
+OTHER_TYPES = """     2.11           OBSERVATION DATA    G (GPS)             RINEX VERSION / TYPE
+     3    C1    L1    D1                                    # / TYPES OF OBSERV
+    15.0000                                                  INTERVAL
+                                                            END OF HEADER
+ 17  9 14  0 14 45.0000000  0  1G03
+  18813359.413    11111111.111 5        -1.250
+ 17  9 14  0 15  0.0000000  0  1G05
+  22222222.222                            .500
+"""
+
+# an epoch followed by the cycle slips found in it (epoch flag 6), at the same time
+CYCLE_SLIPS = """     2.11           OBSERVATION DATA    G (GPS)             RINEX VERSION / TYPE
+     2    C1    L1                                          # / TYPES OF OBSERV
+    30.0000                                                  INTERVAL
+                                                            END OF HEADER
+ 17  9 14  0 14 30.0000000  0  2G03G05
+  18813359.413    11111111.111 5
+  22222222.222    33333333.333 5
+ 17  9 14  0 14 30.0000000  6  1G05
+                  33333330.123 1
+ 17  9 14  0 15  0.0000000  0  2G03G05
+  18813360.413    11111112.111 5
+  22222223.222    33333334.333 5
+"""
 
 
 @pytest.mark.parametrize('test_input,expected', [
@@ -28,6 +63,244 @@ def test_decompress_files(test_input, expected):
                         )) == set(['{}/{}'.format(temp_dir, i) for i in expected])
 
 
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='latin-1') as f:
+        return f.read()
+
+
+def split_fixture(name: str, at: str):
+    """ Split an observation file in two files at an epoch line, each with the full header. """
+    data = read_fixture(name)
+    header_end = data.index('END OF HEADER')
+    header_end = data.index('\n', header_end) + 1
+    split = data.index(at, header_end)
+    return data[:split], data[:header_end] + data[split:]
+
+
+def merged(inputs, start=None, end=None, interval=None) -> str:
+    output = io.StringIO()
+    merge_observations([io.StringIO(i) for i in inputs], output, start, end, interval)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('order', [[0, 1], [1, 0]])
+def test_merge_split_file(order):
+    data = read_fixture('nybp2570.17o')
+    # the second part starts with an event
+    parts = split_fixture('nybp2570.17o', ' 17  9 14  0 10  0.0000000  4')
+    assert merged([parts[i] for i in order]) == data
+
+
+def test_merge_overlapping_files():
+    data = read_fixture('nybp2570.17o')
+    parts = split_fixture('nybp2570.17o', ' 17  9 14  0  5')
+    assert merged([data, parts[1], data]) == data
+
+
+def test_merge_cycle_slips():
+    def epochs(data: str):
+        return [(e.time, e.flag, e.satellites, e.observations) for e in ObservationReader(io.StringIO(data))]
+
+    expected = epochs(CYCLE_SLIPS)
+    assert [flag for _, flag, _, _ in expected] == [0, 6, 0]
+    assert epochs(merged([CYCLE_SLIPS])) == expected
+    # overlapping files keep the cycle slips once
+    assert epochs(merged([CYCLE_SLIPS, CYCLE_SLIPS])) == expected
+    assert epochs(merged([CYCLE_SLIPS], datetime(2017, 9, 14, 0, 14, 30), interval=30)) == expected
+
+
+def test_merge_time_window():
+    output = merged([read_fixture('nybp2570.17o')],
+                    datetime(2017, 9, 14, 0, 5), datetime(2017, 9, 14, 0, 10, 15))
+    epochs = list(ObservationReader(io.StringIO(output)))
+    assert epochs[0].time == datetime(2017, 9, 14, 0, 5)
+    assert epochs[-1].time == datetime(2017, 9, 14, 0, 10)
+    assert len([e for e in epochs if not e.is_event]) == 11
+    assert '  2017     9    14     0     5    0.0000000     GPS' in output
+
+
+def test_merge_observation_types():
+    output = merged([read_fixture('nybp2570.17o'), OTHER_TYPES])
+    reader = ObservationReader(io.StringIO(output))
+    assert reader.header.types == ('L1', 'L2', 'C1', 'P2', 'P1', 'S1', 'S2', 'D1')
+    # the files disagree on the interval
+    assert reader.header.interval is None
+    epochs = list(reader)
+    assert [e.time for e in epochs[-3:]] == [datetime(2017, 9, 14, 0, 14, 30),
+                                             datetime(2017, 9, 14, 0, 14, 45),
+                                             datetime(2017, 9, 14, 0, 15)]
+    assert epochs[-2].observations == [[
+        '  11111111.111 5', ' ' * 16, '  18813359.413  ', ' ' * 16, ' ' * 16, ' ' * 16, ' ' * 16, '        -1.250  ']]
+    assert epochs[-1].observations[0][7] == '          .500  '
+
+
+def test_merge_plan(tmp_path, monkeypatch):
+    first, second = split_fixture('nybp2570.17o', ' 17  9 14  0  5')
+    (tmp_path / 'nybp257a.17o').write_text(first)
+    (tmp_path / 'nybp257b.17o').write_text(second)
+    plan = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp257a.17o.gz'),
+                              PlannedFile(2017, 257, 'nybp257b.17o.gz')])
+    monkeypatch.chdir(str(tmp_path))
+    m = RinexMerger('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), str(tmp_path))
+    m.merge(plan)
+    assert (tmp_path / 'nybp.obs').read_text() == read_fixture('nybp2570.17o')
+
+
+def test_merge_decimated():
+    output = merged([read_fixture('nybp2570.17o'), OTHER_TYPES], interval=60)
+    reader = ObservationReader(io.StringIO(output))
+    assert reader.header.interval == 60
+    epochs = list(reader)
+    assert [e.time.second for e in epochs] == [0] * len(epochs)
+    assert len([e for e in epochs if not e.is_event]) == 16
+    # the event changing the observation types is kept
+    assert [e.flag for e in epochs if e.is_event] == [4]
+    # decimating to a shorter interval than the files keeps every epoch
+    assert ObservationReader(io.StringIO(merged([read_fixture('nybp2570.17o')], interval=10))).header.interval == 30
+
+
+@pytest.mark.parametrize('decimate', [None, 60, 90])
+def test_merge_plan_decimated(tmp_path, monkeypatch, decimate):
+    first, second = split_fixture('nybp2570.17o', ' 17  9 14  0  5')
+    (tmp_path / 'nybp257a.17o').write_text(first)
+    (tmp_path / 'nybp257b.17o').write_text(second)
+    (tmp_path / 'nybp257c.17o').write_text(OTHER_TYPES)
+    monkeypatch.chdir(str(tmp_path))
+    m = RinexMerger('nybp', datetime(2017, 9, 14), datetime(2017, 9, 14), str(tmp_path), decimate=decimate)
+    m.merge()
+    # skipping epochs with the index writes the same file as reading them all
+    expected = merged([first, second, OTHER_TYPES], datetime(2017, 9, 14), datetime(2017, 9, 14, 0, 59, 59), decimate)
+    assert (tmp_path / 'nybp.obs').read_text() == expected
+
+
+def shift_days(data: str, days: int) -> str:
+    """ Move the epochs of the nybp fixture (14 September 2017) a number of days later. """
+    return data.replace('\n 17  9 14', '\n 17  9 {:2d}'.format(14 + days))
+
+
+@pytest.mark.parametrize('group_size', [2, 3, 7])
+@pytest.mark.parametrize('decimate', [None, 60])
+def test_hierarchical_merge(tmp_path, monkeypatch, group_size, decimate):
+    files = []
+    for day in range(10):
+        # two hourly files a day, and one with other observation types from the fourth day
+        parts = split_fixture('nybp2570.17o', ' 17  9 14  0  5') + ((OTHER_TYPES,) if day >= 3 else ())
+        for h, data in zip('abc', parts):
+            name = 'nybp{}{}.17o'.format(257 + day, h)
+            (tmp_path / name).write_text(shift_days(data, day))
+            files.append(PlannedFile(2017, 257 + day, name + '.gz'))
+    plan = FetchPlan('nybp', files)
+    start, end = datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 23, 0, 33)
+    monkeypatch.chdir(str(tmp_path))
+    RinexMerger('nybp', start, end, str(tmp_path), decimate=decimate, output='flat.obs').merge(plan)
+    # days reported out of order, as parallel downloads would
+    with TreeMerge(plan, str(tmp_path), 'tree.obs', datetime(2017, 9, 14), datetime(2017, 9, 23, 0, 59, 59),
+                   decimate, workers=2, group_size=group_size) as tree:
+        for f in reversed(plan.files):
+            tree.downloaded(f)
+        assert tree.result() == 'tree.obs'
+    assert (tmp_path / 'tree.obs').read_text() == (tmp_path / 'flat.obs').read_text()
+    # every downloaded and intermediate file is deleted once merged
+    assert sorted(os.listdir(str(tmp_path))) == ['flat.obs', 'tree.obs']
+
+
+def test_hierarchical_merge_single_day(tmp_path, monkeypatch):
+    first, second = split_fixture('nybp2570.17o', ' 17  9 14  0  5')
+    (tmp_path / 'nybp257a.17o').write_text(first)
+    (tmp_path / 'nybp257b.17o').write_text(second)
+    plan = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp257a.17o.gz'),
+                              PlannedFile(2017, 257, 'nybp257b.17o.gz')])
+    monkeypatch.chdir(str(tmp_path))
+    m = RinexMerger('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), str(tmp_path),
+                    hierarchical=True)
+    with m.tree(plan) as tree:
+        tree.downloaded(plan.files[0])
+        with pytest.raises(RuntimeError, match=r'1 days are missing files'):
+            tree.result()
+    m.merge(plan)
+    assert (tmp_path / 'nybp.obs').read_text() == read_fixture('nybp2570.17o')
+    assert sorted(os.listdir(str(tmp_path))) == ['nybp.obs']
+
+
+@pytest.mark.parametrize('compression', [None, GZIP])
+def test_merge_files_cleans_up(tmp_path, monkeypatch, compression):
+    (tmp_path / 'nybp2570.17o').write_text(read_fixture('nybp2570.17o'))
+    inputs, output = [str(tmp_path / 'nybp2570.17o')], str(tmp_path / 'nybp.obs')
+    def fail(*args):
+        merge_epochs(*args)
+        raise OSError('disk full')
+    monkeypatch.setattr('src.Merger.merge_epochs', fail)
+    with pytest.raises(OSError):
+        merge_files(inputs, output, compression=compression)
+    # nothing is left half written
+    assert os.listdir(str(tmp_path)) == ['nybp2570.17o']
+    monkeypatch.undo()
+    assert merge_files(inputs, output, compression=compression) == output
+    data = (tmp_path / 'nybp.obs').read_bytes()
+    assert (gzip.decompress(data) if compression else data).decode('latin-1') == read_fixture('nybp2570.17o')
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+def test_run_hierarchical(cors_archive, tmp_path, monkeypatch, hierarchical):
+    for day in range(3):
+        data = shift_days(read_fixture('nybp2570.17o'), day)
+        cors_archive.add_file(2017, 257 + day, 'nybp', 'nybp{}0.17o.gz'.format(257 + day),
+                              gzip.compress(data.encode('latin-1')))
+    monkeypatch.chdir(str(tmp_path))
+    RinexRunner('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 16, 0, 33),
+                partial(RinexDownloader, servers=cors_archive.servers), RinexMerger, workers=2,
+                hierarchical=hierarchical).run()
+    expected = merged([shift_days(read_fixture('nybp2570.17o'), day) for day in range(3)],
+                      datetime(2017, 9, 14), datetime(2017, 9, 16, 0, 59, 59))
+    assert (tmp_path / 'nybp.obs').read_text() == expected
+
+
+def test_merger_invalid_decimation():
+    with pytest.raises(ValueError):
+        RinexMerger('nybp', datetime(2017, 9, 14), datetime(2017, 9, 14), decimate=0)
+
+
+def copy_fixtures(directory, names):
+    for name, target in names.items():
+        shutil.copy(os.path.join(FIXTURES, name), os.path.join(str(directory), target))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_decompress_files_in_parallel(tmp_path, monkeypatch, workers):
+    pools = []
+
+    def pool(count):
+        pools.append(count)
+        return process_pool(count)
+    monkeypatch.setattr('src.Merger.process_pool', pool)
+    copy_fixtures(tmp_path, {'nybp2570.17o.gz': 'nybp2570.17o.gz', 'nybp2570.17d.Z': 'nybp2580.17d.Z',
+                             'clck2570.17d': 'clck2570.17d', 'wide2570.17d': 'wide2570.17d'})
+    m = RinexMerger('nybp', datetime(2017, 9, 14), datetime(2017, 9, 15), str(tmp_path), workers=workers)
+    ready = m.decompress_files()
+    expected = ['clck2570.17o', 'nybp2570.17o', 'nybp2580.17o', 'wide2570.17o']
+    assert sorted(os.path.basename(f) for f in ready) == expected
+    assert sorted(os.listdir(str(tmp_path))) == expected
+    # the processes start from the same clean server as the merge processes
+    assert pools == ([] if workers == 1 else [3])
+    with open(os.path.join(FIXTURES, 'crx2rnx', 'nybp2570.17o'), 'rb') as f:
+        assert (tmp_path / 'nybp2580.17o').read_bytes() == f.read()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_decompress_files_reports_failures(tmp_path, workers):
+    copy_fixtures(tmp_path, {'nybp2570.17o.gz': 'nybp2570.17o.gz', 'clck2570.17d': 'clck2570.17d'})
+    (tmp_path / 'nybp2580.17o.gz').write_bytes(b'not gzip data')
+    (tmp_path / 'nybp2590.17d').write_text('not compact rinex')
+    m = RinexMerger('nybp', datetime(2017, 9, 14), datetime(2017, 9, 15), str(tmp_path), workers=workers)
+    with pytest.raises(RuntimeError) as e:
+        m.decompress_files()
+    assert 'Could not decompress 2 of 4 files' in str(e.value)
+    assert 'nybp2580.17o.gz' in str(e.value) and 'nybp2590.17d' in str(e.value)
+    # the other files were still decompressed, and no partial files are left behind
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'clck2570.17o', 'nybp2570.17o', 'nybp2580.17o.gz', 'nybp2590.17d']
+
+
 # The following code was supposed to do a diff between meta files.
 # However since meta files change depending on what time you use the teqc tool
 # You will always end up failing the diff. This can be fixed if you compare certain lines
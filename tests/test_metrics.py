@@ -0,0 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import gzip
+import json
+import os
+import pickle
+import time
+import pytest
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Metrics import Metrics, directory_size, metric_name
+from src.Runner import RinexRunner
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def test_record():
+    metrics = Metrics()
+    with metrics.stage('download'):
+        time.sleep(0.01)
+    with metrics.stage('download'):
+        pass
+    metrics.record_stage('merge input', 2.5, 10)
+    metrics.count('bytes_transferred', 100)
+    metrics.count('bytes_transferred', 50)
+    metrics.peak('peak_disk_bytes', 10)
+    metrics.peak('peak_disk_bytes', 5)
+    metrics.gauge('concurrency_window', 3)
+    metrics.file('nybp2570.17o.gz', 'ftp', 150, 0.5, attempts=1)
+    trace = metrics.trace()
+    assert trace['stages']['download']['items'] == 2
+    assert trace['stages']['download']['seconds'] >= 0.01
+    assert trace['stages']['merge input'] == {'items': 10, 'seconds': 2.5}
+    assert trace['counters']['bytes_transferred'] == 150
+    assert trace['counters']['files'] == 1
+    assert trace['gauges'] == {'peak_disk_bytes': 10, 'concurrency_window': 3}
+    assert trace['files'][0]['name'] == 'nybp2570.17o.gz'
+    assert trace['files'][0]['attempts'] == 1
+    assert json.loads(json.dumps(trace)) == trace
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.record_stage('merge input', 2.5, 10)
+    metrics.count('ftp_round_trips', 7)
+    metrics.file('a', 'ftp', 1, 0.1)
+    metrics.file('b', 'ftp', 1, 0.1)
+    metrics.file('c', 'cache', 1, 0.1)
+    lines = metrics.prometheus().splitlines()
+    assert 'rinex_stage_seconds{stage="merge input"} 2.5' in lines
+    assert 'rinex_stage_items{stage="merge input"} 10' in lines
+    assert 'rinex_ftp_round_trips 7' in lines
+    assert 'rinex_files_by_source{source="ftp"} 2' in lines
+    assert 'rinex_files_by_source{source="cache"} 1' in lines
+    assert '# TYPE rinex_ftp_round_trips gauge' in lines
+    # every sample has a valid metric name and a number
+    for line in lines:
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            float(value)
+            assert name.split('{')[0] == metric_name(name.split('{')[0][len('rinex_'):])
+
+
+@pytest.mark.parametrize('name', ['metrics.json', 'metrics.prom'])
+def test_write(tmp_path, name):
+    metrics = Metrics()
+    metrics.count('retries')
+    path = str(tmp_path / name)
+    metrics.write(path)
+    text = (tmp_path / name).read_text()
+    if name.endswith('.json'):
+        assert json.loads(text)['counters']['retries'] == 1
+    else:
+        assert 'rinex_retries 1' in text.splitlines()
+    assert os.listdir(str(tmp_path)) == [name]
+
+
+def test_watch_disk(tmp_path):
+    metrics = Metrics()
+    with metrics.watch_disk(str(tmp_path), interval=0.01):
+        (tmp_path / 'a').write_bytes(b'x' * 1000)
+        time.sleep(0.1)
+        (tmp_path / 'a').unlink()
+    assert directory_size(str(tmp_path)) == 0
+    assert metrics.trace()['gauges']['peak_disk_bytes'] == 1000
+
+
+def test_run_metrics(cors_archive, tmp_path, monkeypatch):
+    sizes = {}
+    with open(os.path.join(FIXTURES, 'nybp2570.17o'), 'rb') as f:
+        data = gzip.compress(f.read())
+    for yday in (257, 258):
+        name = 'nybp{}0.17o.gz'.format(yday)
+        cors_archive.add_file(2017, yday, 'nybp', name, data)
+        sizes[name] = len(data)
+    monkeypatch.chdir(str(tmp_path))
+    runner = RinexRunner('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 15, 0, 33),
+                         partial(RinexDownloader, servers=cors_archive.servers), RinexMerger, workers=2,
+                         metrics_out=str(tmp_path / 'metrics.json'))
+    runner.run()
+    trace = json.loads((tmp_path / 'metrics.json').read_text())
+    assert {f['name']: f['bytes'] for f in trace['files']} == sizes
+    assert all(f['source'] == 'ftp' and f['attempts'] == 1 for f in trace['files'])
+    assert trace['counters']['bytes_transferred'] == sum(sizes.values())
+    assert trace['counters']['ftp_round_trips'] > trace['counters']['ftp_connections'] > 0
+    assert {'plan', 'download', 'decompress', 'merge input', 'merge'} <= set(trace['stages'])
+    assert trace['stages']['decompress']['items'] == 2
+    assert trace['counters']['subprocess_cpu_seconds'] > 0
+    assert trace['gauges']['peak_disk_bytes'] > 0
+    assert trace['gauges']['concurrency_maximum'] == 2
+
+
+def test_pickle():
+    metrics = Metrics()
+    metrics.count('retries')
+    copy = pickle.loads(pickle.dumps(metrics))
+    copy.count('retries')
+    assert copy.trace()['counters']['retries'] == 2
+    assert metrics.trace()['counters']['retries'] == 1
+
+
+def test_submit():
+    metrics = Metrics()
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        assert metrics.submit(pool, sum, range(10 ** 6)).result() == sum(range(10 ** 6))
+        with pytest.raises(ValueError):
+            metrics.submit(pool, int, 'not a number').result()
+    assert metrics.trace()['counters']['subprocess_cpu_seconds'] > 0
@@ -0,0 +1,161 @@
+from datetime import datetime
+from glob import glob
+import os
+import pytest
+from pyftpdlib.handlers import ThrottledDTPHandler
+from src.Downloader import RinexDownloader
+from src.Mirrors import Mirror, MirrorManager
+from src.Planner import PlannedFile
+from testing.archive import CorsArchive, CorsHandler
+
+FILES = [PlannedFile(2017, 257, 'nybp257{}.17o.gz'.format(h), 1000) for h in 'abcdefgh']
+
+
+class FakeSession:
+    def quit(self):
+        pass
+
+
+def manager(latencies) -> MirrorManager:
+    mirrors = MirrorManager([], lambda server: FakeSession())
+    mirrors.mirrors = [Mirror(('mirror{}'.format(i), 21), latency) for i, latency in enumerate(latencies)]
+    return mirrors
+
+
+def test_probe_drops_unreachable_mirrors():
+    def connect(server):
+        if server[0] == 'down':
+            raise RuntimeError('Unable to connect to FTP.')
+        return FakeSession()
+    mirrors = MirrorManager([('down', 21), ('up', 21)], connect)
+    assert [m.server for m in mirrors.probe()] == [('up', 21)]
+    with pytest.raises(RuntimeError):
+        MirrorManager([('down', 21)], connect).probe()
+
+
+@pytest.mark.parametrize('latencies,expected', [
+    ([0.1, 0.1], [4, 4]),
+    # a mirror three times further away is expected to be three times slower
+    ([0.1, 0.3], [6, 2]),
+])
+def test_split(latencies, expected):
+    mirrors = manager(latencies)
+    mirrors.split(FILES)
+    assert [len(m.queue) for m in mirrors.mirrors] == expected
+    # the order of the files is kept on every mirror
+    for m in mirrors.mirrors:
+        assert list(m.queue) == sorted(m.queue)
+
+
+def test_split_by_measured_throughput():
+    mirrors = manager([0.1, 0.1])
+    mirrors.record(mirrors.mirrors[0], 3000, 1)
+    mirrors.record(mirrors.mirrors[1], 1000, 1)
+    mirrors.split(FILES)
+    assert [len(m.queue) for m in mirrors.mirrors] == [6, 2]
+    assert mirrors.assign(4) == [mirrors.mirrors[0], mirrors.mirrors[1], mirrors.mirrors[0], mirrors.mirrors[0]]
+    assert mirrors.assign(1) == [mirrors.mirrors[0]]
+
+
+def test_work_stealing():
+    mirrors = manager([0.1, 0.1])
+    fast, slow = mirrors.mirrors
+    mirrors.split(FILES)
+    taken = [mirrors.next(fast) for _ in range(4)]
+    assert taken == FILES[0::2]
+    # the fast mirror runs out and takes the last files of the slow one
+    assert mirrors.next(fast) == FILES[7]
+    assert mirrors.next(slow) == FILES[1]
+    mirrors.record(fast, 1000, 0.1)
+    mirrors.record(slow, 1000, 0.1)
+    assert mirrors.next(fast) == FILES[5]
+    # not worth stealing a file the other mirror will get to as soon
+    assert mirrors.next(fast) is None
+    assert list(slow.queue) == [FILES[3]]
+    mirrors.record(slow, 1000, 10)
+    assert mirrors.next(fast) == FILES[3]
+    mirrors.cancel()
+    assert mirrors.next(slow) is None
+
+
+def test_probe_times_a_transfer(tmp_path, monkeypatch):
+    monkeypatch.setattr('src.Mirrors.PROBE_BYTES', 40000)
+    # the mirror with the lower latency has the lower bandwidth
+    narrow = CorsArchive(str(tmp_path / 'narrow'), bandwidth=10000)
+    wide = CorsArchive(str(tmp_path / 'wide'), latency=0.02)
+    for archive in (narrow, wide):
+        archive.add_file(2017, 257, 'nybp', 'nybp257a.17o.gz', os.urandom(80000))
+        archive.start()
+    try:
+        r = RinexDownloader('nybp', datetime(2017, 9, 14), datetime(2017, 9, 14))
+        mirrors = MirrorManager(narrow.servers + wide.servers, r.connect)
+        probed = mirrors.probe('/cors/rinex/2017/257/nybp/nybp257a.17o.gz')
+        assert [m.server for m in probed] == wide.servers + narrow.servers
+        assert probed[1].latency < probed[0].latency
+        assert probed[1].throughput < 100000 < probed[0].throughput
+        mirrors.split(FILES)
+        assert len(probed[0].queue) > len(probed[1].queue)
+        # a mirror without the file is only timed by its login
+        assert all(m.throughput is None for m in MirrorManager(wide.servers, r.connect).probe('/cors/missing'))
+    finally:
+        narrow.stop()
+        wide.stop()
+
+
+def throttled(limit: int):
+    dtp = type('DTPHandler', (ThrottledDTPHandler,), {'write_limit': limit})
+    return type('ThrottledHandler', (CorsHandler,), {'dtp_handler': dtp, 'transfers': []})
+
+
+def test_download_from_mirrors(tmp_path):
+    slow_handler, fast_handler = throttled(4000), throttled(0)
+    slow = CorsArchive(str(tmp_path / 'slow'), handler=slow_handler)
+    fast = CorsArchive(str(tmp_path / 'fast'), handler=fast_handler)
+    for archive, handler in ((slow, slow_handler), (fast, fast_handler)):
+        def retr(self, file, handler=handler):
+            handler.transfers.append(os.path.basename(file))
+            return CorsHandler.ftp_RETR(self, file)
+        handler.ftp_RETR = retr
+    expected = {}
+    for h in 'abcdefgh':
+        name = 'nybp257{}.17o.gz'.format(h)
+        expected[name] = os.urandom(10000)
+        slow.add_file(2017, 257, 'nybp', name, expected[name])
+        fast.add_file(2017, 257, 'nybp', name, expected[name])
+    slow.start()
+    fast.start()
+    try:
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 7, 33), str(tmp_path),
+                            workers=2, servers=slow.servers + fast.servers)
+        r.download()
+    finally:
+        slow.stop()
+        fast.stop()
+    downloaded = {os.path.basename(f): open(f, 'rb').read() for f in glob('{}/*.gz'.format(tmp_path))}
+    assert downloaded == expected
+    # each mirror was probed with the first (largest) file
+    assert slow_handler.transfers.pop(0) == fast_handler.transfers.pop(0) == 'nybp257a.17o.gz'
+    # every file is downloaded once, and the probe already shows the fast mirror should take most of them
+    assert sorted(slow_handler.transfers + fast_handler.transfers) == sorted(expected)
+    assert len(fast_handler.transfers) >= 6
+
+
+def test_mirror_workers_keep_their_sessions(tmp_path):
+    archives = [CorsArchive(str(tmp_path / name)) for name in ('first', 'second')]
+    for archive in archives:
+        for yday in (257, 258):
+            for h in 'abcdefghijklmnopqrstuvwx':
+                archive.add_file(2017, yday, 'nybp', 'nybp{}{}.17o.gz'.format(yday, h), os.urandom(5000))
+        archive.start()
+    try:
+        workers = 4
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 1, 0), datetime(2017, 9, 15, 23, 0), str(tmp_path),
+                            workers=workers, min_workers=workers, servers=archives[0].servers + archives[1].servers)
+        plan = r.download()
+    finally:
+        for archive in archives:
+            archive.stop()
+    assert len(glob('{}/*.gz'.format(tmp_path))) == len(plan) == 47
+    # the planning session, a probe per mirror, and at most one listing and one download session per worker,
+    # rather than a new session for almost every file
+    assert r.metrics.trace()['counters']['ftp_connections'] <= 1 + len(archives) + 2 * workers
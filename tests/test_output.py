@@ -0,0 +1,102 @@
+from datetime import datetime
+import gzip
+import io
+import os
+import pytest
+from src.Hatanaka import CRXDecoder
+from src.Merger import RinexMerger
+from src.Output import GZIP, HATANAKA, HATANAKA_GZIP, CompressedWriter, atomic_write, open_output, output_name
+from src.Planner import FetchPlan, PlannedFile
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='latin-1') as f:
+        return f.read()
+
+
+def decompress(data: bytes, compression: str) -> str:
+    """ Undo a compression, back to RINEX. """
+    if compression in (GZIP, HATANAKA_GZIP):
+        data = gzip.decompress(data)
+    if compression in (HATANAKA, HATANAKA_GZIP):
+        d = CRXDecoder()
+        data = d.decompress(data) + d.flush()
+    return data.decode('latin-1')
+
+
+def strip(data: str) -> str:
+    """ Drop the trailing blanks of every line, which Compact RINEX does not keep. """
+    return ''.join(line.rstrip(' ') + '\n' for line in data.splitlines())
+
+
+@pytest.mark.parametrize('compression', [GZIP, HATANAKA, HATANAKA_GZIP])
+def test_compressed_writer(compression, monkeypatch):
+    monkeypatch.setattr('src.Output.BUFFER_SIZE', 1000)
+    data = read_fixture('nybp2570.17o')
+    raw = io.BytesIO()
+    with CompressedWriter(raw, compression, close_raw=False) as f:
+        for i in range(0, len(data), 333):
+            f.write(data[i:i + 333])
+        f.flush()
+    assert strip(decompress(raw.getvalue(), compression)) == strip(data)
+    assert len(raw.getvalue()) < len(data) * 0.6
+
+
+def test_compressed_writer_errors():
+    with pytest.raises(ValueError, match='Unknown compression'):
+        CompressedWriter(io.BytesIO(), 'bzip2')
+    raw = io.BytesIO()
+    # an error while writing leaves the data unfinished, rather than failing on the half written epoch
+    with pytest.raises(RuntimeError):
+        with CompressedWriter(raw, HATANAKA) as f:
+            f.write(read_fixture('nybp2570.17o')[:-100])
+            raise RuntimeError()
+    assert raw.closed
+    with pytest.raises(ValueError, match='middle of a record'):
+        with CompressedWriter(io.BytesIO(), HATANAKA) as f:
+            f.write(read_fixture('nybp2570.17o')[:-100])
+
+
+def test_output_name():
+    assert output_name('NYBP') == 'nybp.obs'
+    assert output_name('nybp', HATANAKA_GZIP) == 'nybp.crx.gz'
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+@pytest.mark.parametrize('compression', [GZIP, HATANAKA_GZIP])
+def test_merge_compressed(tmp_path, monkeypatch, hierarchical, compression):
+    (tmp_path / 'nybp2570.17o').write_text(read_fixture('nybp2570.17o'))
+    plan = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp2570.17o.gz')])
+    monkeypatch.chdir(str(tmp_path))
+    RinexMerger('nybp', datetime(2017, 9, 14, 0, 11), datetime(2017, 9, 14, 0, 33), str(tmp_path),
+                hierarchical=hierarchical, compression=compression).merge(plan)
+    path = tmp_path / output_name('nybp', compression)
+    assert strip(decompress(path.read_bytes(), compression)) == strip(read_fixture('nybp2570.17o'))
+
+
+def test_open_output(tmp_path):
+    with open_output(str(tmp_path / 'plain.obs')) as f:
+        f.write('plain')
+    assert (tmp_path / 'plain.obs').read_text() == 'plain'
+    with open_output(str(tmp_path / 'nybp.obs.gz'), GZIP) as f:
+        f.write('compressed')
+    assert gzip.decompress((tmp_path / 'nybp.obs.gz').read_bytes()) == b'compressed'
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / 'index.json'
+    with atomic_write(str(path)) as f:
+        f.write('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path)) as f:
+            f.write('new')
+            raise RuntimeError()
+    # the old file is untouched and the partial file is gone
+    assert os.listdir(str(tmp_path)) == ['index.json']
+    assert path.read_text() == 'old'
+    with atomic_write(str(path), 'wb', permissions=0o644) as f:
+        f.write(b'new')
+    assert path.read_bytes() == b'new'
+    assert os.stat(str(path)).st_mode & 0o777 == 0o644
@@ -0,0 +1,79 @@
+import threading
+import time
+import pytest
+from src.Pipeline import Pipeline
+
+
+def test_stages():
+    results = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+
+    with Pipeline([('double', lambda x: x * 2, 3), ('odd', lambda x: x + 1 if x % 4 else None, 2),
+                   ('collect', collect, 1)]) as pipeline:
+        for i in range(20):
+            pipeline.put(i)
+        pipeline.close()
+    # items dropped by a stage never reach the next one
+    assert sorted(results) == [x * 2 + 1 for x in range(20) if x % 2]
+    stats = pipeline.stats()
+    assert [stats[name]['items'] for name in ('double', 'odd', 'collect')] == [20, 20, 10]
+
+
+def test_backpressure():
+    release = threading.Event()
+    fed = []
+
+    def feed(pipeline):
+        for i in range(10):
+            pipeline.put(i)
+            fed.append(i)
+
+    with Pipeline([('slow', lambda x: release.wait(), 1)], depth=2) as pipeline:
+        feeder = threading.Thread(target=feed, args=(pipeline,))
+        feeder.start()
+        time.sleep(0.2)
+        # one item being worked on and two waiting, the rest held back
+        assert len(fed) == 3
+        release.set()
+        feeder.join()
+        pipeline.close()
+    assert len(fed) == 10
+
+
+def test_overlap():
+    """ Stages work on different items at the same time, so the pipeline takes about as long as its slowest stage. """
+    with Pipeline([('a', lambda x: time.sleep(0.05) or x, 1), ('b', lambda x: time.sleep(0.05), 1)]) as pipeline:
+        started = time.monotonic()
+        for i in range(10):
+            pipeline.put(i)
+        pipeline.close()
+    assert time.monotonic() - started < 0.9
+
+
+def test_error():
+    seen = []
+
+    def fail(item):
+        if item == 3:
+            raise ValueError('bad item')
+        return item
+
+    pipeline = Pipeline([('fail', fail, 1), ('seen', seen.append, 1)], depth=1)
+    with pytest.raises(ValueError, match='bad item'):
+        for i in range(100):
+            pipeline.put(i)
+            time.sleep(0.001)
+        pipeline.close()
+    with pytest.raises(ValueError, match='bad item'):
+        pipeline.close()
+    assert 3 not in seen and len(seen) < 100
+
+
+@pytest.mark.parametrize('stages,depth', [([], 1), ([('a', print, 0)], 1), ([('a', print, 1)], 0)])
+def test_invalid(stages, depth):
+    with pytest.raises(ValueError):
+        Pipeline(stages, depth)
@@ -0,0 +1,87 @@
+from datetime import datetime
+import pytest
+from src.Downloader import RinexDownloader
+from src.Planner import FetchPlan, PlannedFile, RinexPlanner
+from testing.archive import CorsArchive, CorsHandler
+
+HOURLY = {'nybp257{}.17o.gz'.format(h): 1000 for h in 'abcdefghijklmnopqrstuvwx'}
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    # a single hour is far smaller than the 1 Hz day file
+    ([dict(HOURLY, **{'nybp2570.17o.gz': 20000}), 5, 5],
+     ['nybp257f.17o.gz']),
+    # the whole day is cheaper as a day file
+    ([dict(HOURLY, **{'nybp2570.17o.gz': 20000}), 0, 23],
+     ['nybp2570.17o.gz']),
+    ([dict(HOURLY, **{'nybp2570.17d.Z': 500}), 5, 6],
+     ['nybp2570.17d.Z']),
+    # unknown sizes fall back to the day file
+    ([dict(HOURLY, **{'nybp2570.17o.gz': None}), 5, 5],
+     ['nybp2570.17o.gz']),
+    # missing hourly files fall back to the day file
+    ([{'nybp2570.17o.gz': 20000, 'nybp257a.17o.gz': 10}, 0, 1],
+     ['nybp2570.17o.gz']),
+    # without a day file the hourly files are used, even if some are missing
+    ([{'nybp257a.17o.gz': 10}, 0, 1],
+     ['nybp257a.17o.gz', 'nybp257b.17o.gz']),
+])
+def test_choose(test_input, expected):
+    listing, first_hour, last_hour = test_input
+    assert RinexPlanner('NYBP').choose(
+        listing, 2017, 257, first_hour, last_hour) == expected
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    ('nybp2570.17o.gz', 'nybp2570.17o'),
+    ('nybp2570.17d.Z', 'nybp2570.17o'),
+    ('nybp257a.17o.gz', 'nybp257a.17o'),
+])
+def test_rinex_name(test_input, expected):
+    assert PlannedFile(2017, 257, test_input).rinex_name == expected
+
+
+def test_describe():
+    plan = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp257f.17o.gz', 1000),
+                              PlannedFile(2017, 257, 'nybp257g.17o.gz')])
+    assert plan.total_bytes == 1000
+    assert plan.describe().splitlines() == [
+        '        1000  /cors/rinex/2017/257/nybp/nybp257f.17o.gz',
+        '           ?  /cors/rinex/2017/257/nybp/nybp257g.17o.gz',
+        '2 files, 1000 bytes',
+    ]
+
+
+class NoMlsdHandler(CorsHandler):
+    def ftp_MLSD(self, path):
+        self.respond('500 Command "MLSD" not understood.')
+
+
+@pytest.mark.parametrize('handler', [CorsHandler, NoMlsdHandler])
+def test_short_window_uses_hourly_files(tmp_path, handler):
+    archive = CorsArchive(str(tmp_path), handler=handler)
+    archive.start()
+    try:
+        archive.add_file(2017, 257, 'nybp', 'nybp2570.17o.gz', b'x' * 20000)
+        for name in HOURLY:
+            archive.add_file(2017, 257, 'nybp', name, b'x' * 1000)
+        r = RinexDownloader('nybp', datetime(2017, 9, 14, 5, 11, 22), datetime(2017, 9, 14, 6, 33, 44),
+                            servers=archive.servers)
+        plan = r.fetch_plan()
+    finally:
+        archive.stop()
+    assert [f.name for f in plan] == ['nybp257f.17o.gz', 'nybp257g.17o.gz']
+    assert plan.total_bytes == 2000
+
+
+def test_union():
+    first = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp2570.17o.gz', 1000)])
+    second = FetchPlan('nybp', [PlannedFile(2017, 257, 'nybp2570.17o.gz', 1000),
+                                PlannedFile(2017, 258, 'nybp2580.17o.gz', 500)])
+    third = FetchPlan('p589', [PlannedFile(2017, 257, 'p5892570.17o.gz', 200)])
+    assert list(FetchPlan.union([first, second])) == list(second)
+    assert FetchPlan.union([first, second]).station == 'nybp'
+    both = FetchPlan.union([first, third, second])
+    assert both.station == ''
+    assert both.total_bytes == 1700
+    assert both.describe().splitlines()[1] == '         200  /cors/rinex/2017/257/p589/p5892570.17o.gz'
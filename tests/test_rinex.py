@@ -0,0 +1,161 @@
+from datetime import datetime
+import io
+import os
+import pytest
+from src.Rinex import (ObservationFile, ObservationReader, ObservationWriter, format_types, is_aligned,
+                       parse_epoch_time)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def read_fixture(*path: str) -> str:
+    with open(os.path.join(FIXTURES, *path), encoding='latin-1') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('test_input,expected', [
+    (' 17  9 14  0  0  0.0000000', datetime(2017, 9, 14)),
+    (' 99 12 31 23 59 59.5000000', datetime(1999, 12, 31, 23, 59, 59, 500000)),
+    (' 18  1  1  0  0 59.9999999', datetime(2018, 1, 1, 0, 1)),
+    ('                          ', None),
+])
+def test_parse_epoch_time(test_input, expected):
+    assert parse_epoch_time(test_input) == expected
+
+
+@pytest.mark.parametrize('name', [
+    ('nybp2570.17o',),
+    # receiver clock offsets and more than 12 satellites
+    ('crx2rnx', 'clck2570.17o'),
+    ('crx2rnx', 'wide2570.17o'),
+])
+def test_round_trip(name):
+    data = read_fixture(*name)
+    reader = ObservationReader(io.StringIO(data))
+    output = io.StringIO()
+    writer = ObservationWriter(output, reader.header)
+    writer.write_header()
+    for epoch in reader:
+        writer.write(epoch)
+    assert output.getvalue() == data
+
+
+def test_read_epochs():
+    epochs = list(ObservationReader(io.StringIO(read_fixture('crx2rnx', 'wide2570.17o'))))
+    assert len([e for e in epochs if not e.is_event]) == 20
+    event = next(e for e in epochs if e.is_event)
+    assert event.flag == 3
+    assert event.records[0].startswith('JPL')
+    first = epochs[0]
+    assert first.time == datetime(2017, 9, 14)
+    assert len(first.satellites) == 14 and first.satellites[-1] == 'G14'
+    assert first.clock.strip() == '.239598024'
+    assert first.types == ('L1', 'L2', 'C1', 'P2', 'P1', 'S1', 'S2', 'D1', 'D2')
+    assert all(len(fields) == 9 for fields in first.observations)
+
+
+def test_header():
+    header = ObservationReader(io.StringIO(read_fixture('nybp2570.17o'))).header
+    assert header.types == ('L1', 'L2', 'C1', 'P2', 'P1', 'S1', 'S2')
+    assert header.interval == 30
+    types = tuple('L1 L2 C1 P1 P2 S1 S2 D1 D2 L5'.split())
+    changed = header.with_types(types).with_first_epoch(datetime(2017, 9, 14, 1, 2, 3, 500000))
+    assert changed.types == types
+    assert len(changed.lines) == len(header.lines) + 1
+    assert changed.get('TIME OF FIRST OBS') == \
+        '  2017     9    14     1     2    3.5000000     GPS         TIME OF FIRST OBS   '
+    assert changed.replace('INTERVAL', []).interval is None
+
+
+def test_format_types():
+    assert format_types(('L1', 'C1')) == [
+        '     2    L1    C1                                          # / TYPES OF OBSERV ']
+
+
+@pytest.mark.parametrize('data', [
+    '',
+    'not a rinex file\n',
+    read_fixture('nybp2570.17o').replace('2.11', '3.02', 1),
+    read_fixture('nybp2570.17o').replace('END OF HEADER', 'COMMENT'),
+])
+def test_invalid_header(data):
+    with pytest.raises(ValueError):
+        ObservationReader(io.StringIO(data))
+
+
+def test_truncated_epoch():
+    data = read_fixture('nybp2570.17o')
+    with pytest.raises(ValueError):
+        list(ObservationReader(io.StringIO(data[:-100])))
+
+
+# the observation types change half way through the file
+CHANGING_TYPES = """     2.11           OBSERVATION DATA    G (GPS)             RINEX VERSION / TYPE
+     2    C1    L1                                          # / TYPES OF OBSERV
+                                                            END OF HEADER
+ 17  9 14  0  0  0.0000000  0  1G03
+  18813359.413    11111111.111 5
+ 17  9 14  0  0 30.0000000  4  1
+     1    S1                                                # / TYPES OF OBSERV
+ 17  9 14  0  1  0.0000000  0  2G03G05
+        45.500
+        40.250
+"""
+
+
+def write_file(tmp_path, data: str) -> str:
+    path = str(tmp_path / 'test2570.17o')
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(data)
+    return path
+
+
+def test_observation_file_index():
+    path = os.path.join(FIXTURES, 'nybp2570.17o')
+    with ObservationFile(path) as f, open(path, encoding='latin-1') as text:
+        epochs = list(ObservationReader(text))
+        assert len(f) == len(epochs) == 31
+        assert [f.time(i) for i in range(len(f))] == [e.time for e in epochs]
+        assert list(f.epochs()) == epochs
+        start, end = datetime(2017, 9, 14, 0, 5), datetime(2017, 9, 14, 0, 10, 15)
+        first, last = f.window(start, end)
+        assert list(f.epochs(start, end)) == epochs[first:last]
+        assert [e.time for e in epochs[first:last]] == [e.time for e in epochs if start <= e.time <= end]
+        assert f.window(datetime(2018, 1, 1)) == (31, 31)
+        assert f.window(end=datetime(2017, 1, 1)) == (0, 0)
+        records = [bytes(r) for r in f.records(start, end)]
+        assert b''.join(records) == bytes(f.slice(start, end))
+        assert records[0].startswith(b' 17  9 14  0  5  0.0000000  0')
+        del records
+
+
+@pytest.mark.parametrize('interval', [30, 60, 90, 3600])
+def test_observation_file_decimate(interval):
+    path = os.path.join(FIXTURES, 'nybp2570.17o')
+    with ObservationFile(path) as f, open(path, encoding='latin-1') as text:
+        epochs = list(ObservationReader(text))
+        start = datetime(2017, 9, 14, 0, 5)
+        kept = [e for e in epochs if e.time >= start and (e.is_event or is_aligned(e.time, interval))]
+        assert [f.time(i) for i in f.decimate(interval, start)] == [e.time for e in kept]
+        assert list(f.epochs(start, interval=interval)) == kept
+
+
+def test_observation_file_types_change(tmp_path):
+    with ObservationFile(write_file(tmp_path, CHANGING_TYPES)) as f:
+        assert len(f) == 3
+        epochs = list(f.epochs(datetime(2017, 9, 14, 0, 1)))
+        assert epochs[0].types == ('S1',)
+        assert epochs[0].observations == [['        45.500  '], ['        40.250  ']]
+        assert [e.types for e in f.epochs()] == [('C1', 'L1'), ('S1',), ('S1',)]
+
+
+@pytest.mark.parametrize('data', [
+    '',
+    # out of order
+    CHANGING_TYPES.replace(' 17  9 14  0  1  0.0000000', ' 17  9 13  0  1  0.0000000'),
+    # truncated
+    CHANGING_TYPES[:CHANGING_TYPES.rindex('        40.250')],
+])
+def test_invalid_observation_file(tmp_path, data):
+    with pytest.raises(ValueError):
+        ObservationFile(write_file(tmp_path, data))
@@ -0,0 +1,187 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import pytest
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Service import RinexService, SessionPool, parse_query
+from testing.archive import CorsArchive, CorsHandler
+from testing.synthetic import publish
+
+START = datetime(2021, 3, 10, 14)
+END = datetime(2021, 3, 10, 17, 59, 59)
+
+
+class CountingHandler(CorsHandler):
+    """ Handler recording the name of every file transferred. """
+    transfers = []
+
+    def ftp_RETR(self, file):
+        self.transfers.append(os.path.basename(file))
+        return super().ftp_RETR(file)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    CountingHandler.transfers = []
+    # a little latency, so concurrent requests are still downloading when the others plan
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=CountingHandler, latency=0.02)
+    publish(archive, 'nybp', START, END, interval=300, satellites=4)
+    archive.start()
+    yield archive
+    archive.stop()
+
+
+@pytest.fixture
+def service(archive):
+    with RinexService(RinexDownloader, RinexMerger, workers=2, servers=archive.servers) as service:
+        server = service.server(port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        service.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        yield service
+        server.shutdown()
+        server.server_close()
+
+
+def get(service: RinexService, path: str) -> bytes:
+    with urlopen(service.url + path, timeout=30) as response:
+        return response.read()
+
+
+def merged(archive: CorsArchive, tmp_path, start: datetime, end: datetime) -> bytes:
+    """ Merge a window the way grab_data does, to compare with. """
+    directory = str(tmp_path / 'expected')
+    os.makedirs(directory, exist_ok=True)
+    output = str(tmp_path / 'expected.obs')
+    plan = RinexDownloader('nybp', start, end, directory, servers=archive.servers).download()
+    RinexMerger('nybp', start, end, directory, workers=1, output=output).merge(plan)
+    with open(output, 'rb') as f:
+        return f.read()
+
+
+def test_parse_query():
+    assert parse_query('station=NYBP&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z&decimate=30') == (
+        'nybp', datetime(2021, 3, 10, 14), datetime(2021, 3, 10, 15, 59, 59), 30.0)
+    assert parse_query('station=nybp&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z')[3] is None
+
+
+@pytest.mark.parametrize('query,error', [
+    ('start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z', 'one station'),
+    ('station=nybp&station=p589&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z', 'one station'),
+    ('station=nybp&start=2021-03-10 14:00:00&end=2021-03-10T15:59:59Z', 'Invalid start'),
+    ('station=nybp&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z&decimate=x', 'Invalid decimation'),
+    ('station=nybp&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z&decimate=0', 'positive'),
+])
+def test_parse_invalid_query(query, error):
+    with pytest.raises(ValueError, match=error):
+        parse_query(query)
+
+
+def test_observations(archive, tmp_path):
+    start, end = datetime(2021, 3, 10, 14, 20), datetime(2021, 3, 10, 15, 40)
+    with RinexService(RinexDownloader, RinexMerger, servers=archive.servers) as service:
+        with service.observations('nybp', start, end) as path:
+            with open(path, 'rb') as f:
+                data = f.read()
+        assert not os.path.exists(path)
+    assert data == merged(archive, tmp_path, start, end)
+
+
+def test_overlapping_requests_share_files(archive, service):
+    windows = [('2021-03-10T14:00:00Z', '2021-03-10T16:59:59Z'), ('2021-03-10T15:00:00Z', '2021-03-10T17:59:59Z'),
+               ('2021-03-10T14:00:00Z', '2021-03-10T17:59:59Z')]
+    paths = ['/obs?station=nybp&start={}&end={}'.format(*window) for window in windows]
+    with ThreadPoolExecutor(len(paths)) as pool:
+        results = list(pool.map(lambda path: get(service, path), paths))
+    assert all(result.startswith(b'     2.11') for result in results)
+    # every file was downloaded once, whichever request needed it first
+    assert sorted(CountingHandler.transfers) == ['nybp069o.21o.gz', 'nybp069p.21o.gz',
+                                                 'nybp069q.21o.gz', 'nybp069r.21o.gz']
+    connections = service.metrics.trace()['counters']['ftp_connections']
+
+    # later requests reuse the files, sessions and listings
+    assert get(service, paths[2]) == results[2]
+    counters = service.metrics.trace()['counters']
+    assert len(CountingHandler.transfers) == 4
+    assert counters['ftp_connections'] == connections
+    assert counters['files_kept'] >= 4
+    assert counters['requests'] == 4
+
+
+def test_files_are_deleted_over_the_limit(archive):
+    with RinexService(RinexDownloader, RinexMerger, servers=archive.servers, max_bytes=0) as service:
+        for _ in range(2):
+            with service.observations('nybp', START, datetime(2021, 3, 10, 14, 59, 59)) as path:
+                assert os.path.getsize(path)
+    assert CountingHandler.transfers == ['nybp069o.21o.gz'] * 2
+
+
+@pytest.mark.parametrize('path,status', [
+    ('/obs?station=nybp&start=2021-03-10T14:00:00Z', 400),
+    ('/obs?station=nybp&start=2021-03-10T15:00:00Z&end=2021-03-10T14:00:00Z', 400),
+    ('/obs?station=zzzz&start=2021-03-10T14:00:00Z&end=2021-03-10T15:59:59Z', 400),
+    ('/obs?station=nybp&start=2021-03-12T14:00:00Z&end=2021-03-12T15:59:59Z', 404),
+    ('/nothing', 404),
+])
+def test_errors(service, path, status):
+    with pytest.raises(HTTPError) as error:
+        get(service, path)
+    assert error.value.code == status
+
+
+def test_metrics(service):
+    get(service, '/obs?station=nybp&start=2021-03-10T14:00:00Z&end=2021-03-10T14:59:59Z')
+    metrics = get(service, '/metrics').decode()
+    assert 'rinex_requests 1' in metrics
+    assert 'rinex_bytes_transferred' in metrics
+
+
+class Session:
+    """ Stand-in for a logged in FTP session. """
+
+    def __init__(self, alive: bool = True):
+        self.sock = object()
+        self.alive = alive
+        self.commands = []
+
+    def voidcmd(self, command: str):
+        self.commands.append(command)
+        if not self.alive:
+            raise EOFError()
+
+    def quit(self):
+        self.sock = None
+
+    def close(self):
+        self.sock = None
+
+
+def test_session_pool():
+    opened = []
+
+    def connect():
+        opened.append(Session())
+        return opened[-1]
+
+    pool = SessionPool(1, idle_check=0)
+    with pool.session(connect) as first:
+        with pool.session(connect) as second:
+            assert first is not second
+    # only one session is kept, and it is checked before it is lent again
+    assert first.sock is None
+    with pool.session(connect) as ftp:
+        assert ftp is second and ftp.commands == ['NOOP']
+    # a session that timed out is replaced
+    second.alive = False
+    with pool.session(connect) as ftp:
+        assert ftp is opened[-1] and ftp is not second and len(opened) == 3
+    # a session that failed while lent is not kept
+    with pytest.raises(RuntimeError):
+        with pool.session(connect) as broken:
+            raise RuntimeError()
+    assert broken.sock is None
+    pool.close()
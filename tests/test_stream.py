@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+from functools import partial
+import io
+import os
+import threading
+import pytest
+from src.Downloader import RinexDownloader
+from src.Merger import RinexMerger
+from src.Planner import FetchPlan, PlannedFile
+from src.Rinex import ObservationFile
+from src.Runner import RinexRunner
+from src.Stream import ObservationStream
+from testing.archive import CorsArchive, CorsHandler
+from testing.synthetic import TYPES, gzip_file, observation_data, publish
+
+DAY = datetime(2021, 3, 10)
+
+
+class GatedHandler(CorsHandler):
+    """ Handler holding back the transfer of one file until the gate is opened. """
+    held = None
+    gate = threading.Event()
+
+    def ftp_RETR(self, file):
+        if os.path.basename(file) == self.held:
+            self.gate.wait(30)
+        return super().ftp_RETR(file)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    GatedHandler.held = None
+    GatedHandler.gate = threading.Event()
+    archive = CorsArchive(str(tmp_path / 'ftp'), handler=GatedHandler)
+    archive.start()
+    yield archive
+    GatedHandler.gate.set()
+    archive.stop()
+
+
+def merged(archive: CorsArchive, tmp_path, start: datetime, end: datetime, decimate: float = None) -> str:
+    """ Merge a window the way grab_data does, to compare with. """
+    directory = str(tmp_path / 'expected')
+    os.makedirs(directory, exist_ok=True)
+    output = str(tmp_path / 'expected.obs')
+    plan = RinexDownloader('nybp', start, end, directory, servers=archive.servers).download()
+    RinexMerger('nybp', start, end, directory, workers=1, decimate=decimate, output=output).merge(plan)
+    with open(output, encoding='latin-1') as f:
+        return f.read()
+
+
+def runner(archive: CorsArchive, start: datetime, end: datetime, **kwargs) -> RinexRunner:
+    return RinexRunner('nybp', start, end, partial(RinexDownloader, servers=archive.servers), RinexMerger, **kwargs)
+
+
+@pytest.mark.parametrize('decimate', [None, 900])
+def test_stream_is_the_merged_file(archive, tmp_path, decimate):
+    publish(archive, 'nybp', DAY - timedelta(days=1), DAY + timedelta(hours=5, minutes=59), interval=300,
+            satellites=4)
+    start, end = DAY - timedelta(hours=2, minutes=20), DAY + timedelta(hours=4, minutes=10)
+    output = io.StringIO()
+    with runner(archive, start, end, workers=2, decimate=decimate).stream() as stream:
+        assert [f.name for f in stream.plan][:2] == ['nybp0680.21d.Z', 'nybp069a.21o.gz']
+        assert stream.write(output) > 0
+    assert output.getvalue() == merged(archive, tmp_path, start, end, decimate)
+
+
+def test_epochs_come_before_the_download_ends(archive):
+    publish(archive, 'nybp', DAY, DAY + timedelta(hours=2, minutes=59), interval=300, satellites=4)
+    GatedHandler.held = 'nybp069c.21o.gz'
+    with runner(archive, DAY, DAY + timedelta(hours=2, minutes=59)).stream() as stream:
+        assert stream.header.types == TYPES
+        epochs = iter(stream)
+        # the first two hours are read while the last one is held back on the server
+        first = [next(epochs) for _ in range(24)]
+        assert first[0].time == DAY and first[-1].time == DAY + timedelta(hours=1, minutes=55)
+        GatedHandler.gate.set()
+        rest = list(epochs)
+    assert len(rest) == 12 and rest[-1].time == DAY + timedelta(hours=2, minutes=55)
+    with pytest.raises(RuntimeError, match='already'):
+        iter(stream)
+
+
+def test_stream_announces_new_types(archive, tmp_path):
+    types = ('L1', 'C1', 'P2')
+    archive.add_file(2021, 69, 'nybp', 'nybp069a.21o.gz', gzip_file(observation_data(
+        'nybp', DAY, DAY + timedelta(minutes=59), 300, 4, types)))
+    publish(archive, 'nybp', DAY + timedelta(hours=1), DAY + timedelta(hours=1, minutes=59), interval=300,
+            satellites=4)
+    output = str(tmp_path / 'nybp.obs')
+    with runner(archive, DAY, DAY + timedelta(hours=1, minutes=59)).stream() as stream, \
+            open(output, 'w', encoding='latin-1') as f:
+        assert stream.header.types == types
+        assert stream.write(f) == 24
+    with ObservationFile(output) as f:
+        assert f.header.types == types
+        assert f.flags[12] == 4
+        epochs = list(f.epochs())
+    assert epochs[0].types == types
+    assert epochs[-1].types == types + tuple(t for t in TYPES if t not in types)
+
+
+def test_download_errors_are_raised(tmp_path):
+    def download(plan, on_file):
+        on_file(plan.files[0])
+        raise OSError('connection lost')
+
+    directory = str(tmp_path)
+    with open(os.path.join(directory, 'nybp069a.21o'), 'wb') as f:
+        f.write(observation_data('nybp', DAY, DAY + timedelta(minutes=59), 300, 4, TYPES))
+    plan = FetchPlan('nybp', [PlannedFile(2021, 69, 'nybp069a.21o.gz'), PlannedFile(2021, 69, 'nybp069b.21o.gz')])
+    with ObservationStream(plan, directory, download) as stream:
+        with pytest.raises(RuntimeError, match='connection lost'):
+            list(stream)
+    # files all epochs of which were read are deleted
+    assert os.listdir(directory) == []
+    with ObservationStream(FetchPlan('nybp', []), directory, lambda plan, on_file: plan) as stream:
+        with pytest.raises(RuntimeError, match='No files'):
+            stream.header